@@ -0,0 +1,266 @@
+"""Short-lived in-process cache for authentication lookups.
+
+``get_current_user`` validates every request against ``core.usuarios`` and the
+reporting endpoints check that the requested branch is still active.  Both
+answers change rarely, so they are kept here for a few seconds.  Changes made
+from any process (API, ``scripts/reset_admin_password.py``, seeds, manual SQL)
+fire a ``pg_notify`` from triggers on ``core.usuarios`` / ``core.sucursales``;
+``AuthCacheListener`` receives them and drops the affected entries at once.
+The TTL only bounds staleness if the listener connection is down.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass
+import os
+import threading
+import time
+from typing import Any, Callable, Hashable
+
+import psycopg
+
+
+AUTH_CACHE_CHANNEL = "olm_auth_cache"
+_MISSING = object()
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on", "si", "sí"}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+@dataclass(frozen=True)
+class AuthCacheConfig:
+    enabled: bool = True
+    ttl_seconds: float = 30.0
+    max_entries: int = 1024
+
+    @classmethod
+    def from_env(cls) -> "AuthCacheConfig":
+        return cls(
+            enabled=_env_bool("AUTH_CACHE_ENABLED", True),
+            ttl_seconds=max(0.0, _env_float("AUTH_CACHE_TTL_SECONDS", 30.0)),
+            max_entries=max(1, int(_env_float("AUTH_CACHE_MAX_ENTRIES", 1024))),
+        )
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ``ttl_seconds``."""
+
+    def __init__(
+        self,
+        ttl_seconds: float,
+        max_entries: int,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._clock = clock
+        self._items: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a load that raced with one is dropped.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = self._clock()
+        with self._lock:
+            entry = self._items.get(key, _MISSING)
+            if entry is _MISSING or entry[0] <= now:
+                if entry is not _MISSING:
+                    del self._items[key]
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, *, generation: int | None = None) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        expires_at = self._clock() + self.ttl_seconds
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._items[key] = (expires_at, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self.generation += 1
+            self._items.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._items.clear()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+class AuthLookupCache:
+    """Caches ``username -> (rol, sucursal_id, activo, password_changed_at)``
+    and the set of active branch ids."""
+
+    _BRANCHES_KEY = "active_branch_ids"
+
+    def __init__(self, config: AuthCacheConfig | None = None) -> None:
+        self.config = config or AuthCacheConfig.from_env()
+        ttl = self.config.ttl_seconds if self.config.enabled else 0.0
+        self.users = TTLCache(ttl, self.config.max_entries)
+        self.branches = TTLCache(ttl, 1)
+
+    def get_user(
+        self, username: str, loader: Callable[[str], tuple[Any, ...] | None]
+    ) -> tuple[Any, ...] | None:
+        row = self.users.get(username, _MISSING)
+        if row is not _MISSING:
+            return row
+        generation = self.users.generation
+        row = loader(username)
+        if row is not None:
+            row = tuple(row)
+            self.users.set(username, row, generation=generation)
+        return row
+
+    def active_branch_ids(self, loader: Callable[[], set[int]]) -> frozenset[int]:
+        branch_ids = self.branches.get(self._BRANCHES_KEY, _MISSING)
+        if branch_ids is not _MISSING:
+            return branch_ids
+        generation = self.branches.generation
+        branch_ids = frozenset(int(value) for value in loader())
+        self.branches.set(self._BRANCHES_KEY, branch_ids, generation=generation)
+        return branch_ids
+
+    def invalidate_user(self, username: str) -> None:
+        self.users.pop(username)
+
+    def invalidate_branches(self) -> None:
+        self.branches.clear()
+
+    def invalidate_all(self) -> None:
+        self.users.clear()
+        self.branches.clear()
+
+    def apply_notification(self, payload: str) -> None:
+        kind, _, value = str(payload or "").partition(":")
+        if kind == "usuario" and value:
+            self.invalidate_user(value)
+        elif kind == "sucursales":
+            self.invalidate_branches()
+        else:
+            self.invalidate_all()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": self.config.enabled,
+            "ttl_seconds": self.config.ttl_seconds,
+            "users": self.users.stats(),
+            "branches": self.branches.stats(),
+        }
+
+
+AUTH_CACHE_USUARIOS_TRIGGER_SQL = f"""
+CREATE OR REPLACE FUNCTION core.fn_notify_auth_cache_usuarios()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM pg_notify('{AUTH_CACHE_CHANNEL}', 'usuario:' || OLD.username);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM pg_notify('{AUTH_CACHE_CHANNEL}', 'usuario:' || NEW.username);
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_usuarios_notify_auth_cache ON core.usuarios;
+CREATE TRIGGER trg_usuarios_notify_auth_cache
+AFTER INSERT OR UPDATE OR DELETE ON core.usuarios
+FOR EACH ROW EXECUTE FUNCTION core.fn_notify_auth_cache_usuarios();
+"""
+
+AUTH_CACHE_SUCURSALES_TRIGGER_SQL = f"""
+CREATE OR REPLACE FUNCTION core.fn_notify_auth_cache_sucursales()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  PERFORM pg_notify('{AUTH_CACHE_CHANNEL}', 'sucursales');
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_sucursales_notify_auth_cache ON core.sucursales;
+CREATE TRIGGER trg_sucursales_notify_auth_cache
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON core.sucursales
+FOR EACH STATEMENT EXECUTE FUNCTION core.fn_notify_auth_cache_sucursales();
+"""
+
+
+class AuthCacheListener:
+    """Background LISTEN loop on a dedicated (non-pooled) connection."""
+
+    channel = AUTH_CACHE_CHANNEL
+    thread_name = "auth-cache-listener"
+    log_prefix = "auth-cache"
+
+    def __init__(
+        self,
+        conninfo: str,
+        cache: Any,
+        *,
+        reconnect_delay_seconds: float = 5.0,
+    ) -> None:
+        self.conninfo = conninfo
+        self.cache = cache
+        self.reconnect_delay_seconds = reconnect_delay_seconds
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is not None or not self.cache.config.enabled:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=self.thread_name, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout=5)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                with psycopg.connect(self.conninfo, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {self.channel};")
+                    # Anything may have changed while we were not listening.
+                    self.cache.invalidate_all()
+                    while not self._stop.is_set():
+                        for notify in conn.notifies(timeout=1.0):
+                            self.cache.apply_notification(notify.payload)
+            except psycopg.Error as exc:
+                print(f"[{self.log_prefix}] listener desconectado: {exc}")
+                self.cache.invalidate_all()
+                self._stop.wait(self.reconnect_delay_seconds)
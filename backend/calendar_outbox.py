@@ -0,0 +1,359 @@
+"""Transactional outbox for Google Calendar sync of appointments.
+
+Creating, editing or deleting a consulta used to call Google inline: build a
+client, refresh OAuth credentials and insert or delete the event before the
+receptionist got a response.  The endpoints now only ``enqueue_calendar_sync``
+in their own transaction, and ``CalendarOutboxWorker`` replays the queue on a
+daemon thread (or ``scripts/run_calendar_outbox.py``).
+
+The outbox holds at most one row per ``consulta_id``: a later change to the
+same appointment overwrites the pending operation and bumps ``version``, and a
+row is never synced by two workers at once (``bloqueado_hasta`` lease), so a
+late create cannot land after the delete that superseded it.
+Google event ids are derived from the consulta (``calendar_event_id``), so a
+retried insert finds the event it already created instead of duplicating it.
+
+A pass leases due rows with ``SKIP LOCKED`` and commits before calling Google,
+so no transaction is held open across the network and enqueues never wait on
+the worker.  A row is only removed if its ``version`` is unchanged; a failure
+is retried with exponential backoff until ``max_attempts``, after which it is
+kept as ``fallido`` until the appointment changes again.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import os
+import threading
+import time
+from typing import Any, Callable
+
+import psycopg
+from psycopg.rows import dict_row
+
+
+OUTBOX_RELATION = "core.agenda_calendario_outbox"
+
+CALENDAR_OUTBOX_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS core.agenda_calendario_outbox (
+    consulta_id bigint PRIMARY KEY,
+    sucursal_id bigint NOT NULL,
+    operacion text NOT NULL CHECK (operacion IN ('sincronizar', 'eliminar')),
+    evento_id text NULL,
+    calendario_id text NULL,
+    solicitado_por text NULL,
+    version integer NOT NULL DEFAULT 1,
+    estado text NOT NULL DEFAULT 'pendiente' CHECK (estado IN ('pendiente', 'fallido')),
+    intentos integer NOT NULL DEFAULT 0,
+    proximo_intento_at timestamptz NOT NULL DEFAULT NOW(),
+    bloqueado_hasta timestamptz NULL,
+    ultimo_error text NULL,
+    created_at timestamptz NOT NULL DEFAULT NOW(),
+    updated_at timestamptz NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS agenda_calendario_outbox_pendiente_idx
+  ON core.agenda_calendario_outbox (proximo_intento_at, consulta_id)
+  WHERE estado = 'pendiente';
+"""
+
+OPERATIONS = ("sincronizar", "eliminar")
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on", "si", "sí"}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+@dataclass(frozen=True)
+class CalendarOutboxConfig:
+    enabled: bool = True
+    interval_seconds: float = 5.0
+    batch_size: int = 20
+    # A leased row becomes due again if its worker dies mid-sync.
+    lease_seconds: float = 120.0
+    max_attempts: int = 8
+    backoff_seconds: float = 30.0
+    max_backoff_seconds: float = 3600.0
+
+    @classmethod
+    def from_env(cls) -> "CalendarOutboxConfig":
+        return cls(
+            enabled=_env_bool("CALENDAR_OUTBOX_ENABLED", True),
+            interval_seconds=max(0.5, _env_float("CALENDAR_OUTBOX_INTERVAL_SECONDS", 5.0)),
+            batch_size=min(200, max(1, int(_env_float("CALENDAR_OUTBOX_BATCH_SIZE", 20)))),
+            lease_seconds=max(10.0, _env_float("CALENDAR_OUTBOX_LEASE_SECONDS", 120.0)),
+            max_attempts=max(1, int(_env_float("CALENDAR_OUTBOX_MAX_ATTEMPTS", 8))),
+            backoff_seconds=max(1.0, _env_float("CALENDAR_OUTBOX_BACKOFF_SECONDS", 30.0)),
+            max_backoff_seconds=max(1.0, _env_float("CALENDAR_OUTBOX_MAX_BACKOFF_SECONDS", 3600.0)),
+        )
+
+    def retry_delay(self, attempts: int) -> float:
+        """Seconds to wait after the ``attempts``-th consecutive failure."""
+        return min(self.max_backoff_seconds, self.backoff_seconds * (2 ** max(0, attempts - 1)))
+
+
+def calendar_event_id(consulta_id: int) -> str:
+    """Deterministic Google event id (base32hex alphabet: 0-9 and a-v)."""
+    return f"olmconsulta{int(consulta_id)}"
+
+
+def enqueue_calendar_sync(
+    cur,
+    *,
+    consulta_id: int,
+    sucursal_id: int,
+    operation: str,
+    event_id: str | None = None,
+    calendar_id: str | None = None,
+    requested_by: str | None = None,
+) -> None:
+    """Queue the latest calendar state for a consulta inside the caller's transaction."""
+    if operation not in OPERATIONS:
+        raise ValueError(f"Unknown calendar operation: {operation}")
+    cur.execute(
+        """
+        INSERT INTO core.agenda_calendario_outbox AS outbox (
+            consulta_id, sucursal_id, operacion, evento_id, calendario_id, solicitado_por
+        ) VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (consulta_id) DO UPDATE
+           SET sucursal_id = EXCLUDED.sucursal_id,
+               operacion = EXCLUDED.operacion,
+               evento_id = COALESCE(EXCLUDED.evento_id, outbox.evento_id),
+               calendario_id = COALESCE(EXCLUDED.calendario_id, outbox.calendario_id),
+               solicitado_por = COALESCE(EXCLUDED.solicitado_por, outbox.solicitado_por),
+               version = outbox.version + 1,
+               estado = 'pendiente',
+               intentos = 0,
+               proximo_intento_at = NOW(),
+               ultimo_error = NULL,
+               updated_at = NOW()
+        """,
+        (consulta_id, sucursal_id, operation, event_id, calendar_id, requested_by),
+    )
+
+
+class CalendarOutboxWorker:
+    """Drains the calendar outbox through ``sync`` and keeps metrics.
+
+    ``sync(job)`` receives the outbox row as a dict and returns the
+    ``(event_id, calendar_id)`` the event now lives at (``(None, None)`` when
+    there is nothing left in Google); any exception counts as a failed attempt.
+    """
+
+    def __init__(
+        self,
+        conninfo: str,
+        sync: Callable[[dict[str, Any]], tuple[str | None, str | None]],
+        config: CalendarOutboxConfig | None = None,
+        *,
+        connect: Callable[..., Any] = psycopg.connect,
+    ) -> None:
+        self.conninfo = conninfo
+        self.sync = sync
+        self.config = config or CalendarOutboxConfig.from_env()
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._runs = 0
+        self._last_run_at: datetime | None = None
+        self._last_duration_ms: float | None = None
+        self._counters = {"synced": 0, "deleted": 0, "superseded": 0, "retried": 0, "failed": 0}
+        self._last_error: str | None = None
+
+    def _claim(self) -> list[dict[str, Any]]:
+        with self._connect(self.conninfo, row_factory=dict_row) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regclass(%s) AS relation", (OUTBOX_RELATION,))
+                if cur.fetchone()["relation"] is None:
+                    return []
+                cur.execute(
+                    """
+                    WITH due AS (
+                        SELECT consulta_id
+                        FROM core.agenda_calendario_outbox
+                        WHERE estado = 'pendiente' AND proximo_intento_at <= NOW()
+                          AND (bloqueado_hasta IS NULL OR bloqueado_hasta <= NOW())
+                        ORDER BY proximo_intento_at, consulta_id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    UPDATE core.agenda_calendario_outbox outbox
+                    SET bloqueado_hasta = NOW() + (%s * INTERVAL '1 second')
+                    FROM due
+                    WHERE outbox.consulta_id = due.consulta_id
+                    RETURNING outbox.consulta_id, outbox.sucursal_id, outbox.operacion,
+                              outbox.evento_id, outbox.calendario_id, outbox.solicitado_por,
+                              outbox.version, outbox.intentos
+                    """,
+                    (self.config.batch_size, self.config.lease_seconds),
+                )
+                jobs = [dict(row) for row in cur.fetchall()]
+            conn.commit()
+        return sorted(jobs, key=lambda job: job["consulta_id"])
+
+    def _complete(self, job: dict[str, Any], event_id: str | None, calendar_id: str | None) -> bool:
+        """Records the result; returns False when the row changed meanwhile."""
+        with self._connect(self.conninfo, row_factory=dict_row) as conn:
+            with conn.cursor() as cur:
+                if job["operacion"] == "sincronizar" and event_id:
+                    cur.execute(
+                        """
+                        UPDATE core.consultas
+                        SET agenda_event_id = %s, agenda_calendar_id = %s
+                        WHERE consulta_id = %s
+                          AND agenda_event_id IS DISTINCT FROM %s
+                        """,
+                        (event_id, calendar_id, job["consulta_id"], event_id),
+                    )
+                cur.execute(
+                    """
+                    DELETE FROM core.agenda_calendario_outbox
+                    WHERE consulta_id = %s AND version = %s
+                    """,
+                    (job["consulta_id"], job["version"]),
+                )
+                completed = cur.rowcount > 0
+                if not completed and event_id:
+                    # A newer change is queued; let it find the event we just wrote.
+                    cur.execute(
+                        """
+                        UPDATE core.agenda_calendario_outbox
+                        SET evento_id = COALESCE(evento_id, %s),
+                            calendario_id = COALESCE(calendario_id, %s)
+                        WHERE consulta_id = %s
+                        """,
+                        (event_id, calendar_id, job["consulta_id"]),
+                    )
+                if not completed:
+                    cur.execute(
+                        "UPDATE core.agenda_calendario_outbox SET bloqueado_hasta = NULL WHERE consulta_id = %s",
+                        (job["consulta_id"],),
+                    )
+            conn.commit()
+        return completed
+
+    def _fail(self, job: dict[str, Any], error: str) -> bool:
+        """Schedules a retry; returns True when the row gave up as ``fallido``."""
+        attempts = int(job["intentos"]) + 1
+        exhausted = attempts >= self.config.max_attempts
+        with self._connect(self.conninfo, row_factory=dict_row) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE core.agenda_calendario_outbox
+                    SET intentos = %s,
+                        estado = CASE WHEN %s THEN 'fallido' ELSE 'pendiente' END,
+                        proximo_intento_at = NOW() + (%s * INTERVAL '1 second'),
+                        bloqueado_hasta = NULL,
+                        ultimo_error = %s,
+                        updated_at = NOW()
+                    WHERE consulta_id = %s AND version = %s
+                    """,
+                    (
+                        attempts, exhausted, self.config.retry_delay(attempts),
+                        error[:1000], job["consulta_id"], job["version"],
+                    ),
+                )
+                current = cur.rowcount > 0
+                if not current:
+                    cur.execute(
+                        "UPDATE core.agenda_calendario_outbox SET bloqueado_hasta = NULL WHERE consulta_id = %s",
+                        (job["consulta_id"],),
+                    )
+            conn.commit()
+        return current and exhausted
+
+    def run_once(self) -> dict[str, int]:
+        """Syncs one batch of due rows; returns per-outcome counts."""
+        started = time.perf_counter()
+        counts = {name: 0 for name in self._counters}
+        try:
+            jobs = self._claim()
+        except Exception as exc:
+            jobs = []
+            with self._lock:
+                self._last_error = f"{type(exc).__name__}: {exc}"
+            print(f"[calendar-outbox] no se pudo leer la cola: {self._last_error}")
+        for job in jobs:
+            try:
+                event_id, calendar_id = self.sync(job)
+            except Exception as exc:
+                detail = getattr(exc, "detail", None) or str(exc)
+                error = f"{type(exc).__name__}: {detail}"
+                with self._lock:
+                    self._last_error = error
+                try:
+                    counts["failed" if self._fail(job, error) else "retried"] += 1
+                except Exception as db_exc:
+                    print(f"[calendar-outbox] consulta {job['consulta_id']}: {type(db_exc).__name__}: {db_exc}")
+                continue
+            try:
+                if not self._complete(job, event_id, calendar_id):
+                    counts["superseded"] += 1
+                elif job["operacion"] == "eliminar":
+                    counts["deleted"] += 1
+                else:
+                    counts["synced"] += 1
+            except Exception as db_exc:
+                # The lease expires and the idempotent sync runs again.
+                print(f"[calendar-outbox] consulta {job['consulta_id']}: {type(db_exc).__name__}: {db_exc}")
+        with self._lock:
+            for name, count in counts.items():
+                self._counters[name] += count
+            self._runs += 1
+            self._last_run_at = datetime.now(timezone.utc)
+            self._last_duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        return counts
+
+    def notify(self) -> None:
+        """Wake the thread early after a commit that enqueued work."""
+        self._wake.set()
+
+    def start(self) -> None:
+        if self._thread is not None or not self.config.enabled:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="calendar-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout=5)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.clear()
+            counts = self.run_once()
+            if counts["synced"] + counts["deleted"] + counts["superseded"] + counts["retried"] + counts["failed"] >= self.config.batch_size:
+                continue
+            self._wake.wait(self.config.interval_seconds)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.config.enabled,
+                "running": self._thread is not None,
+                "interval_seconds": self.config.interval_seconds,
+                "batch_size": self.config.batch_size,
+                "runs": self._runs,
+                "last_run_at": self._last_run_at.isoformat() if self._last_run_at else None,
+                "last_duration_ms": self._last_duration_ms,
+                "last_error": self._last_error,
+                **self._counters,
+            }
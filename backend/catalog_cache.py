@@ -0,0 +1,224 @@
+"""Versioned snapshot cache for the public catalog API.
+
+Storefront pages ask for the same product lists, details and categories over
+and over; building one costs a COUNT, the page query and four hydration
+queries.  ``CatalogSnapshotCache`` keeps each finished response (keyed by
+route and filters) together with an ETag, so repeated requests are answered
+from memory and clients that send ``If-None-Match`` get a ``304``.  Stock for
+the availability routes is cached per product and branch with a seconds-level
+TTL, so carts polling overlapping product sets only load what is missing.
+
+Any write to the tables the catalog reads (products, images, online settings,
+branch inventory, branches) bumps ``core.catalogo_version_seq`` from a
+statement trigger and publishes the new value with ``pg_notify``.  That covers
+the admin catalog router, inventory movements, sales/reservations and
+``actualizar_comercio_online_producto`` alike.  ``CatalogCacheListener`` drops
+every snapshot when a notification arrives; the TTL only bounds staleness while
+the listener is disconnected.  A sequence is used instead of a counter row so
+concurrent inventory writes never wait on each other.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import hashlib
+import os
+from typing import Any, Callable, Hashable, Iterable, Sequence
+
+from auth_cache import AuthCacheListener, TTLCache
+
+
+CATALOG_CACHE_CHANNEL = "olm_catalog_cache"
+CATALOG_CACHE_TABLES = (
+    "catalogo_productos",
+    "catalogo_producto_imagenes",
+    "online_producto_configuracion",
+    "catalogo_inventario_sucursal",
+    "sucursales",
+)
+_MISSING = object()
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on", "si", "sí"}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+@dataclass(frozen=True)
+class CatalogCacheConfig:
+    enabled: bool = True
+    ttl_seconds: float = 300.0
+    max_entries: int = 512
+    # Stock is polled by carts; a short TTL keeps it fresh even without NOTIFY.
+    stock_ttl_seconds: float = 5.0
+    stock_max_entries: int = 8192
+
+    @classmethod
+    def from_env(cls) -> "CatalogCacheConfig":
+        return cls(
+            enabled=_env_bool("CATALOG_CACHE_ENABLED", True),
+            ttl_seconds=max(0.0, _env_float("CATALOG_CACHE_TTL_SECONDS", 300.0)),
+            max_entries=max(1, int(_env_float("CATALOG_CACHE_MAX_ENTRIES", 512))),
+            stock_ttl_seconds=max(0.0, _env_float("CATALOG_STOCK_CACHE_TTL_SECONDS", 5.0)),
+            stock_max_entries=max(1, int(_env_float("CATALOG_STOCK_CACHE_MAX_ENTRIES", 8192))),
+        )
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    payload: Any
+    etag: str
+
+
+def snapshot_etag(payload: Any) -> str:
+    # generatedAt is left out so an unchanged body keeps its ETag across rebuilds.
+    if hasattr(payload, "model_dump_json"):
+        exclude = {"generatedAt"} if "generatedAt" in type(payload).model_fields else None
+        body = payload.model_dump_json(exclude=exclude)
+    else:
+        body = str(payload)
+    return '"' + hashlib.sha256(body.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def build_snapshot(loader: Callable[[], Any]) -> CatalogSnapshot:
+    payload = loader()
+    return CatalogSnapshot(payload=payload, etag=snapshot_etag(payload))
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        value = candidate.strip()
+        if value == "*":
+            return True
+        if value.startswith("W/"):
+            value = value[2:]
+        if value == etag:
+            return True
+    return False
+
+
+class CatalogSnapshotCache:
+    """Response snapshots, per-product stock and the last catalog version seen."""
+
+    def __init__(self, config: CatalogCacheConfig | None = None) -> None:
+        self.config = config or CatalogCacheConfig.from_env()
+        enabled = self.config.enabled
+        self.entries = TTLCache(self.config.ttl_seconds if enabled else 0.0, self.config.max_entries)
+        self.stock = TTLCache(
+            self.config.stock_ttl_seconds if enabled else 0.0, self.config.stock_max_entries
+        )
+        self.version: int | None = None
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> CatalogSnapshot:
+        snapshot = self.entries.get(key, _MISSING)
+        if snapshot is not _MISSING:
+            return snapshot
+        generation = self.entries.generation
+        snapshot = build_snapshot(loader)
+        # Misses (unknown slugs) are not kept so they cannot evict real pages.
+        if snapshot.payload is not None:
+            self.entries.set(key, snapshot, generation=generation)
+        return snapshot
+
+    def availability(
+        self,
+        product_ids: Sequence[int],
+        branch_id: int | None,
+        loader: Callable[[list[int], int | None], Iterable[Any]],
+    ) -> list[Any]:
+        """Availability items for ``product_ids`` (in that order), loading only
+        the ids not cached for ``branch_id`` in a single ``loader`` call.
+
+        Unpublished ids are remembered as ``None`` so polling them stays cheap.
+        """
+        found: dict[int, Any] = {}
+        missing: list[int] = []
+        for product_id in product_ids:
+            item = self.stock.get((product_id, branch_id), _MISSING)
+            if item is _MISSING:
+                missing.append(product_id)
+            else:
+                found[product_id] = item
+        if missing:
+            generation = self.stock.generation
+            loaded = {int(item.productId): item for item in loader(missing, branch_id)}
+            for product_id in missing:
+                item = loaded.get(product_id)
+                found[product_id] = item
+                self.stock.set((product_id, branch_id), item, generation=generation)
+        return [found[product_id] for product_id in product_ids if found[product_id] is not None]
+
+    def invalidate_all(self) -> None:
+        self.entries.clear()
+        self.stock.clear()
+
+    def apply_notification(self, payload: str) -> None:
+        value = str(payload or "").strip()
+        if value.isdigit():
+            self.version = int(value)
+        self.invalidate_all()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": self.config.enabled,
+            "ttl_seconds": self.config.ttl_seconds,
+            "version": self.version,
+            "entries": self.entries.stats(),
+            "stock_ttl_seconds": self.config.stock_ttl_seconds,
+            "stock": self.stock.stats(),
+        }
+
+
+class CatalogCacheListener(AuthCacheListener):
+    channel = CATALOG_CACHE_CHANNEL
+    thread_name = "catalog-cache-listener"
+    log_prefix = "catalog-cache"
+
+
+_CATALOG_TABLES_SQL = ", ".join(f"'{table}'" for table in CATALOG_CACHE_TABLES)
+
+# The triggers live on tables created by the phase SQL files; the runtime
+# migration lists them in ``requires`` so it waits for all of them.
+CATALOG_CACHE_REQUIRED_TABLES = tuple(f"core.{table}" for table in CATALOG_CACHE_TABLES)
+
+CATALOG_CACHE_TRIGGER_SQL = f"""
+CREATE SEQUENCE IF NOT EXISTS core.catalogo_version_seq;
+
+CREATE OR REPLACE FUNCTION core.fn_catalogo_version_bump()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  PERFORM pg_notify('{CATALOG_CACHE_CHANNEL}', nextval('core.catalogo_version_seq')::text);
+  RETURN NULL;
+END;
+$$;
+
+DO $$
+DECLARE
+  v_tabla text;
+BEGIN
+  FOREACH v_tabla IN ARRAY ARRAY[{_CATALOG_TABLES_SQL}]
+  LOOP
+    EXECUTE format('DROP TRIGGER IF EXISTS %I ON core.%I', 'trg_' || v_tabla || '_catalogo_version', v_tabla);
+    EXECUTE format(
+      'CREATE TRIGGER %I AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON core.%I '
+      'FOR EACH STATEMENT EXECUTE FUNCTION core.fn_catalogo_version_bump()',
+      'trg_' || v_tabla || '_catalogo_version',
+      v_tabla
+    );
+  END LOOP;
+END;
+$$;
+"""
@@ -0,0 +1,236 @@
+"""Columnar exports (Arrow IPC stream or Parquet) built from record batches.
+
+Wide datasets such as ``/export/historias_ml`` are re-parsed by the data team
+on every training run; as CSV every value arrives as untyped text.  Here the
+query is read through a server-side cursor in batches of ``batch_size`` rows,
+each batch becomes one Arrow record batch (one Parquet row group) and the
+encoded bytes are yielded as soon as the batch is written.
+
+Column types follow the PostgreSQL result: integers, floats, numerics (as
+``float64``), dates, timestamps and booleans keep their type.  Text columns
+listed in ``numeric_text`` are parsed into ``float64`` (unparseable values
+become null) and those listed in ``categorical`` are dictionary encoded with a
+dictionary that only grows, so Arrow streams emit deltas instead of
+re-sending it with every batch.
+
+``pyarrow`` is an optional dependency: the API and the scripts work without
+it and only these formats raise :class:`ColumnarExportUnavailable`.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Collection, Iterator, Mapping, Sequence
+from typing import Any
+from uuid import uuid4
+
+
+COLUMNAR_FORMATS: dict[str, tuple[str, str]] = {
+    # format -> (media type, file extension)
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+DEFAULT_BATCH_SIZE = 5000
+
+_TEXT_OIDS = {25, 1042, 1043}
+
+
+class ColumnarExportUnavailable(RuntimeError):
+    """Raised when ``pyarrow`` is not installed."""
+
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as exc:  # pragma: no cover - depends on the environment
+        raise ColumnarExportUnavailable("pyarrow is required for Arrow/Parquet exports") from exc
+    return pa, pq
+
+
+def columnar_export_available() -> bool:
+    try:
+        _pyarrow()
+    except ColumnarExportUnavailable:
+        return False
+    return True
+
+
+def _parse_float(value: Any) -> float | None:
+    if value is None:
+        return None
+    try:
+        return float(str(value).strip().replace(",", "."))
+    except ValueError:
+        return None
+
+
+class _ChunkSink:
+    """File-like object that collects written bytes until drained."""
+
+    closed = False
+
+    def __init__(self) -> None:
+        self._parts: list[bytes] = []
+
+    def write(self, data: Any) -> int:
+        chunk = bytes(data)
+        self._parts.append(chunk)
+        return len(chunk)
+
+    def flush(self) -> None:
+        return None
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+class _BatchBuilder:
+    def __init__(
+        self,
+        pa: Any,
+        description: Sequence[Any],
+        names: Sequence[str],
+        categorical: Collection[str],
+        numeric_text: Collection[str],
+        metadata: Mapping[str, str] | None,
+    ) -> None:
+        self.pa = pa
+        self.names = list(names)
+        self.kinds: list[str] = []
+        fields = []
+        for column, name in zip(description, self.names):
+            kind, arrow_type = self._column_type(int(column.type_code), name, categorical, numeric_text)
+            self.kinds.append(kind)
+            fields.append(pa.field(name, arrow_type))
+        self.schema = pa.schema(fields, metadata=dict(metadata or {}))
+        self.dictionaries: dict[int, dict[str, int]] = {
+            idx: {} for idx, kind in enumerate(self.kinds) if kind == "dictionary"
+        }
+
+    def _column_type(
+        self,
+        oid: int,
+        name: str,
+        categorical: Collection[str],
+        numeric_text: Collection[str],
+    ) -> tuple[str, Any]:
+        pa = self.pa
+        if oid in _TEXT_OIDS and name in numeric_text:
+            return "numeric_text", pa.float64()
+        if oid in _TEXT_OIDS and name in categorical:
+            return "dictionary", pa.dictionary(pa.int32(), pa.string())
+        simple = {
+            16: pa.bool_(),
+            20: pa.int64(),
+            21: pa.int16(),
+            23: pa.int32(),
+            700: pa.float32(),
+            701: pa.float64(),
+            1082: pa.date32(),
+            1114: pa.timestamp("us"),
+            1184: pa.timestamp("us", tz="UTC"),
+        }
+        if oid in simple:
+            return "value", simple[oid]
+        if oid == 1700:
+            return "float", pa.float64()
+        return "text", pa.string()
+
+    def batch(self, rows: Sequence[Sequence[Any]]) -> Any:
+        pa = self.pa
+        arrays = []
+        for idx, (kind, field) in enumerate(zip(self.kinds, self.schema)):
+            values = [row[idx] for row in rows]
+            if kind == "dictionary":
+                lookup = self.dictionaries[idx]
+                indices = []
+                for value in values:
+                    if value is None:
+                        indices.append(None)
+                        continue
+                    token = str(value)
+                    if token not in lookup:
+                        lookup[token] = len(lookup)
+                    indices.append(lookup[token])
+                arrays.append(
+                    pa.DictionaryArray.from_arrays(
+                        pa.array(indices, type=pa.int32()),
+                        pa.array(list(lookup), type=pa.string()),
+                    )
+                )
+            elif kind == "numeric_text":
+                arrays.append(pa.array([_parse_float(v) for v in values], type=field.type))
+            elif kind == "float":
+                arrays.append(pa.array([None if v is None else float(v) for v in values], type=field.type))
+            elif kind == "text":
+                arrays.append(pa.array([None if v is None else str(v) for v in values], type=field.type))
+            else:
+                arrays.append(pa.array(values, type=field.type))
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+
+def columnar_chunks(
+    conn: Any,
+    sql: str,
+    params: Sequence[Any] | Mapping[str, Any] | None = None,
+    *,
+    fmt: str,
+    names: Sequence[str] | None = None,
+    categorical: Collection[str] = (),
+    numeric_text: Collection[str] = (),
+    metadata: Mapping[str, str] | None = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    stats: dict[str, Any] | None = None,
+) -> Iterator[bytes]:
+    """Yield ``sql`` encoded as an Arrow IPC stream or a Parquet file.
+
+    ``conn`` must be inside a transaction (server-side cursor).  ``names``
+    overrides the column names, like the CSV header list.  When given,
+    ``stats`` receives the written ``columns`` and ``rows``.
+    """
+    if fmt not in COLUMNAR_FORMATS:
+        raise ValueError(f"Unknown columnar format: {fmt}")
+    pa, pq = _pyarrow()
+
+    with conn.cursor(name=f"columnar_export_{uuid4().hex}") as cur:
+        cur.execute(sql, params)
+        description = cur.description or []
+        column_names = list(names) if names is not None else [str(d.name) for d in description]
+        if len(column_names) != len(description):
+            raise ValueError(f"Columnar export expects {len(description)} names, got {len(column_names)}")
+        builder = _BatchBuilder(pa, description, column_names, categorical, numeric_text, metadata)
+        if stats is not None:
+            stats.update(columns=column_names, rows=0)
+
+        sink = _ChunkSink()
+        out = pa.PythonFile(sink, mode="w")
+        if fmt == "arrow":
+            writer = pa.ipc.new_stream(
+                out,
+                builder.schema,
+                options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True),
+            )
+        else:
+            writer = pq.ParquetWriter(out, builder.schema, compression="zstd")
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                writer.write_batch(builder.batch(rows))
+                if stats is not None:
+                    stats["rows"] += len(rows)
+                chunk = sink.drain()
+                if chunk:
+                    yield chunk
+        finally:
+            writer.close()
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
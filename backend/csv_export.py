@@ -0,0 +1,130 @@
+"""CSV exports streamed straight from ``COPY ... TO STDOUT``.
+
+The ``/export/*.csv`` endpoints and ``scripts/export_csv_sucursal_anio.py``
+used to fetch rows in batches and format every cell in Python.  Here the
+server renders the CSV itself and the bytes are forwarded as they arrive, so a
+multi-year export costs a socket copy instead of a ``csv.writer`` call per row.
+
+A ``LIMIT 0`` probe of the query reports the column types; temporal and
+boolean columns are wrapped so the text matches what the Python exporter
+produced (``datetime.isoformat()`` and ``true``/``false``), and empty
+``text``/``varchar`` values are sent as NULL because COPY quotes an empty
+string (``""``) where ``csv.writer`` wrote nothing.  Every other type uses
+PostgreSQL's own text output.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Iterator, Sequence
+from typing import Any
+
+from psycopg import sql as pgsql
+
+
+CSV_BOM = "\ufeff".encode("utf-8")
+
+# OIDs of the built-in types whose COPY text differs from the old exporter.
+_BOOL_OID = 16
+_TIMESTAMP_OID = 1114
+_TIMESTAMPTZ_OID = 1184
+_TIME_OID = 1083
+_TIMETZ_OID = 1266
+_TEXT_OID = 25
+_VARCHAR_OID = 1043
+
+_ISO_TIME = "HH24:MI:SS"
+
+
+def _iso_to_char(column: pgsql.Composable, fmt: str, tz: bool = False) -> pgsql.Composable:
+    # isoformat() omits the fractional part when it is zero.
+    tz_fmt = "TZH:TZM" if tz else ""
+    return pgsql.SQL(
+        "CASE WHEN {col} IS NULL THEN NULL "
+        "WHEN mod(EXTRACT(MICROSECONDS FROM {col})::bigint, 1000000) = 0 THEN to_char({col}, {plain}) "
+        "ELSE to_char({col}, {micro}) END"
+    ).format(
+        col=column,
+        plain=pgsql.Literal(fmt + tz_fmt),
+        micro=pgsql.Literal(fmt + ".US" + tz_fmt),
+    )
+
+
+def _csv_column_expr(column: pgsql.Composable, type_oid: int) -> pgsql.Composable:
+    if type_oid == _BOOL_OID:
+        return pgsql.SQL("CASE WHEN {col} THEN 'true' WHEN NOT {col} THEN 'false' END").format(col=column)
+    if type_oid == _TIMESTAMPTZ_OID:
+        return _iso_to_char(column, f'YYYY-MM-DD"T"{_ISO_TIME}', tz=True)
+    if type_oid == _TIMESTAMP_OID:
+        return _iso_to_char(column, f'YYYY-MM-DD"T"{_ISO_TIME}')
+    if type_oid == _TIME_OID:
+        return _iso_to_char(pgsql.SQL("('2000-01-01'::date + {col})").format(col=column), _ISO_TIME)
+    if type_oid in (_TEXT_OID, _VARCHAR_OID):
+        # NULL is written as an unquoted empty field, like csv.writer's "".
+        return pgsql.SQL("NULLIF({col}, '')").format(col=column)
+    if type_oid == _TIMETZ_OID:
+        # to_char() does not accept timetz; its text form is already ISO.
+        return pgsql.SQL("{col}::text").format(col=column)
+    return column
+
+
+def _strip_statement(sql: str) -> str:
+    return sql.strip().rstrip(";").strip()
+
+
+def build_copy_csv_sql(
+    cur: Any,
+    sql: str,
+    params: Sequence[Any] | dict[str, Any] | None,
+    headers: Sequence[str] | None,
+    delimiter: str,
+) -> pgsql.Composed:
+    """Return the ``COPY`` statement that renders ``sql`` as CSV.
+
+    ``headers`` renames the output columns (and therefore the header line);
+    when omitted the query's own column names are used.
+    """
+    inner = _strip_statement(sql)
+    cur.execute(f"SELECT * FROM ({inner}) q LIMIT 0", params)
+    description = cur.description or []
+    names = [str(d.name) for d in description]
+    if headers is not None and len(headers) != len(names):
+        raise ValueError(f"CSV export expects {len(names)} headers, got {len(headers)}")
+    labels = list(headers) if headers is not None else names
+
+    columns = [
+        pgsql.SQL("{expr} AS {label}").format(
+            expr=_csv_column_expr(pgsql.SQL("q.{}").format(pgsql.Identifier(f"c{idx}")), int(d.type_code)),
+            label=pgsql.Identifier(label),
+        )
+        for idx, (d, label) in enumerate(zip(description, labels))
+    ]
+    # Source columns are renamed by position so duplicate names in the
+    # original query stay addressable.
+    positional = pgsql.SQL(", ").join(pgsql.Identifier(f"c{idx}") for idx in range(len(names)))
+    return pgsql.SQL(
+        "COPY (SELECT {columns} FROM ({inner}) AS q ({positional})) "
+        "TO STDOUT WITH (FORMAT csv, HEADER true, DELIMITER {delimiter})"
+    ).format(
+        columns=pgsql.SQL(", ").join(columns),
+        inner=pgsql.SQL(inner),
+        positional=positional,
+        delimiter=pgsql.Literal(delimiter),
+    )
+
+
+def copy_csv_chunks(
+    cur: Any,
+    sql: str,
+    params: Sequence[Any] | dict[str, Any] | None = None,
+    *,
+    headers: Sequence[str] | None = None,
+    delimiter: str = ",",
+    bom: bool = True,
+) -> Iterator[bytes]:
+    """Yield the CSV bytes of ``sql`` as PostgreSQL produces them."""
+    statement = build_copy_csv_sql(cur, sql, params, headers, delimiter)
+    if bom:
+        yield CSV_BOM
+    with cur.copy(statement, params) as copy:
+        for chunk in copy:
+            yield bytes(chunk)
@@ -0,0 +1,205 @@
+"""Process-wide PostgreSQL connection pool shared by the API and repositories.
+
+Every repository already accepts a ``connect`` callable with the
+``psycopg.connect(conninfo, **kwargs)`` signature and uses its result as a
+context manager.  ``PooledConnect`` keeps that contract (commit on success,
+rollback on error) but borrows the physical connection from one shared
+``psycopg_pool.ConnectionPool`` instead of opening a new one per block.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import os
+import threading
+import time
+from typing import Any
+
+import psycopg
+from psycopg.rows import tuple_row
+from psycopg_pool import ConnectionPool, PoolTimeout
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on", "si", "sí"}
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+@dataclass(frozen=True)
+class DatabasePoolConfig:
+    enabled: bool = True
+    min_size: int = 2
+    max_size: int = 10
+    timeout_seconds: float = 10.0
+    max_lifetime_seconds: float = 60 * 60
+    max_idle_seconds: float = 10 * 60
+    check_on_checkout: bool = True
+
+    @classmethod
+    def from_env(cls) -> "DatabasePoolConfig":
+        min_size = max(0, _env_int("DB_POOL_MIN_SIZE", 2))
+        max_size = max(1, _env_int("DB_POOL_MAX_SIZE", 10))
+        return cls(
+            enabled=_env_bool("DB_POOL_ENABLED", True),
+            min_size=min(min_size, max_size),
+            max_size=max_size,
+            timeout_seconds=max(0.1, _env_float("DB_POOL_TIMEOUT_SECONDS", 10.0)),
+            max_lifetime_seconds=max(60.0, _env_float("DB_POOL_MAX_LIFETIME_SECONDS", 3600.0)),
+            max_idle_seconds=max(30.0, _env_float("DB_POOL_MAX_IDLE_SECONDS", 600.0)),
+            check_on_checkout=_env_bool("DB_POOL_CHECK", True),
+        )
+
+
+class PoolWaitMetrics:
+    """Thread-safe counters for time spent waiting on a pooled connection."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+
+    def record_wait(self, seconds: float) -> None:
+        wait_ms = seconds * 1000
+        with self._lock:
+            self.checkouts += 1
+            self.wait_ms_total += wait_ms
+            self.wait_ms_max = max(self.wait_ms_max, wait_ms)
+
+    def record_timeout(self) -> None:
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_ms_total": round(self.wait_ms_total, 3),
+                "wait_ms_avg": round(self.wait_ms_total / self.checkouts, 3) if self.checkouts else 0.0,
+                "wait_ms_max": round(self.wait_ms_max, 3),
+            }
+
+
+def _reset_connection(conn: psycopg.Connection) -> None:
+    # Callers choose their own row factory per checkout; never leak it.
+    conn.row_factory = tuple_row
+
+
+class _PooledConnection:
+    def __init__(self, owner: "PooledConnect", row_factory: Any) -> None:
+        self._owner = owner
+        self._row_factory = row_factory
+        self._conn: psycopg.Connection | None = None
+
+    def __enter__(self) -> psycopg.Connection:
+        pool = self._owner.pool()
+        started = time.perf_counter()
+        try:
+            conn = pool.getconn()
+        except PoolTimeout:
+            self._owner.metrics.record_timeout()
+            raise
+        self._owner.metrics.record_wait(time.perf_counter() - started)
+        if self._row_factory is not None:
+            conn.row_factory = self._row_factory
+        self._conn = conn
+        return conn
+
+    def __exit__(self, exc_type, _exc, _traceback) -> bool:
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return False
+        try:
+            if not conn.closed:
+                if exc_type is None:
+                    conn.commit()
+                else:
+                    conn.rollback()
+        finally:
+            self._owner.pool().putconn(conn)
+        return False
+
+
+class PooledConnect:
+    """Drop-in replacement for ``psycopg.connect`` backed by a shared pool.
+
+    The pool is opened lazily on first use so importing ``main`` from scripts
+    never touches the database.  Calls with a different conninfo, or with
+    connection options other than ``row_factory``, fall back to a direct
+    ``psycopg.connect``.
+    """
+
+    def __init__(self, conninfo: str, config: DatabasePoolConfig | None = None) -> None:
+        self.conninfo = conninfo
+        self.config = config or DatabasePoolConfig.from_env()
+        self.metrics = PoolWaitMetrics()
+        self._pool: ConnectionPool | None = None
+        self._lock = threading.Lock()
+
+    def __call__(self, conninfo: str | None = None, **kwargs: Any):
+        row_factory = kwargs.pop("row_factory", None)
+        target = self.conninfo if conninfo is None else conninfo
+        if not self.config.enabled or kwargs or target != self.conninfo:
+            if row_factory is not None:
+                kwargs["row_factory"] = row_factory
+            return psycopg.connect(target, **kwargs)
+        return _PooledConnection(self, row_factory)
+
+    def pool(self) -> ConnectionPool:
+        if self._pool is not None:
+            return self._pool
+        with self._lock:
+            if self._pool is None:
+                pool = ConnectionPool(
+                    self.conninfo,
+                    min_size=self.config.min_size,
+                    max_size=self.config.max_size,
+                    timeout=self.config.timeout_seconds,
+                    max_lifetime=self.config.max_lifetime_seconds,
+                    max_idle=self.config.max_idle_seconds,
+                    check=ConnectionPool.check_connection if self.config.check_on_checkout else None,
+                    reset=_reset_connection,
+                    name="optica-olm",
+                    open=False,
+                )
+                pool.open(wait=False)
+                self._pool = pool
+        return self._pool
+
+    def close(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+
+    def stats(self) -> dict[str, Any]:
+        payload: dict[str, Any] = {
+            "enabled": self.config.enabled,
+            "open": self._pool is not None,
+            "min_size": self.config.min_size,
+            "max_size": self.config.max_size,
+            "timeout_seconds": self.config.timeout_seconds,
+            "max_lifetime_seconds": self.config.max_lifetime_seconds,
+            "wait": self.metrics.snapshot(),
+        }
+        if self._pool is not None:
+            payload["pool"] = self._pool.get_stats()
+        return payload
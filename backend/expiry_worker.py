@@ -0,0 +1,188 @@
+"""Background expiry of shipping quotes, inventory reservations and optical holds.
+
+Checkout requests used to sweep these tables inline: two table-wide UPDATEs
+for quotes and a row-by-row release of expired reservations before almost
+every storefront call.  ``ExpiryWorker`` now does that housekeeping on its own
+schedule, in ``SKIP LOCKED`` chunks of ``EXPIRY_WORKER_BATCH_SIZE`` rows, one
+short transaction per chunk, returning reserved stock with one bulk UPDATE per
+chunk.  Several API workers (or ``scripts/run_expiry_worker.py``) can run it at
+once; each chunk simply skips rows another one holds.
+
+Customer-facing reads treat anything past its expiry as expired even if the
+worker has not reached it yet, so the interval only bounds how long expired
+holds keep stock reserved.  The same pass purges expired Idempotency-Key rows
+(see idempotency.py).
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import os
+import threading
+import time
+from typing import Any, Callable
+
+import psycopg
+from psycopg.rows import dict_row
+
+from idempotency import purge_expired_idempotency
+from online_fulfillment import (
+    expire_quote_options,
+    expire_quote_requests,
+    release_expired_reservations,
+)
+from online_optical_drafts import release_expired_optical_reservations
+
+
+# (name, table it needs, chunk function). Options go before requests because a
+# request only expires once none of its options is live.
+EXPIRY_TASKS: tuple[tuple[str, str, Callable[..., int]], ...] = (
+    ("quote_options", "core.online_opciones_cotizacion_envio", expire_quote_options),
+    ("quote_requests", "core.online_solicitudes_cotizacion_envio", expire_quote_requests),
+    ("reservations", "core.online_reservas", release_expired_reservations),
+    ("optical_holds", "core.online_reservas_opticas_borrador", release_expired_optical_reservations),
+    ("idempotency_keys", "core.online_idempotencia", purge_expired_idempotency),
+)
+
+# The runtime migration that creates the index waits (``requires``) for the
+# phase SQL table instead of skipping it.
+EXPIRY_INDEX_TABLES = ("core.online_opciones_cotizacion_envio",)
+
+EXPIRY_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS online_opciones_activas_expira_idx
+  ON core.online_opciones_cotizacion_envio (expira_at, opcion_id)
+  WHERE activa = TRUE;
+"""
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on", "si", "sí"}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+@dataclass(frozen=True)
+class ExpiryWorkerConfig:
+    enabled: bool = True
+    interval_seconds: float = 30.0
+    batch_size: int = 200
+    # Per task and run, so a large backlog cannot monopolise one pass.
+    max_batches: int = 50
+
+    @classmethod
+    def from_env(cls) -> "ExpiryWorkerConfig":
+        return cls(
+            enabled=_env_bool("EXPIRY_WORKER_ENABLED", True),
+            interval_seconds=max(1.0, _env_float("EXPIRY_WORKER_INTERVAL_SECONDS", 30.0)),
+            batch_size=min(1000, max(1, int(_env_float("EXPIRY_WORKER_BATCH_SIZE", 200)))),
+            max_batches=max(1, int(_env_float("EXPIRY_WORKER_MAX_BATCHES", 50))),
+        )
+
+
+class ExpiryWorker:
+    """Runs every expiry task periodically on a daemon thread and keeps metrics."""
+
+    def __init__(
+        self,
+        conninfo: str,
+        config: ExpiryWorkerConfig | None = None,
+        *,
+        connect: Callable[..., Any] = psycopg.connect,
+        tasks: tuple[tuple[str, str, Callable[..., int]], ...] = EXPIRY_TASKS,
+    ) -> None:
+        self.conninfo = conninfo
+        self.config = config or ExpiryWorkerConfig.from_env()
+        self._connect = connect
+        self.tasks = tasks
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._runs = 0
+        self._last_run_at: datetime | None = None
+        self._last_duration_ms: float | None = None
+        self._task_stats = {
+            name: {"total": 0, "last": 0, "batches": 0, "errors": 0, "last_error": None}
+            for name, _relation, _task in tasks
+        }
+
+    def _chunk(self, relation: str, task: Callable[..., int]) -> int:
+        with self._connect(self.conninfo, row_factory=dict_row) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regclass(%s) AS relation", (relation,))
+                if cur.fetchone()["relation"] is None:
+                    return 0
+                count = task(cur, limit=self.config.batch_size)
+            conn.commit()
+        return count
+
+    def run_once(self) -> dict[str, int]:
+        """One pass over every task; returns how many rows each expired."""
+        started = time.perf_counter()
+        counts: dict[str, int] = {}
+        for name, relation, task in self.tasks:
+            total = batches = 0
+            error: str | None = None
+            try:
+                for _ in range(self.config.max_batches):
+                    count = self._chunk(relation, task)
+                    batches += 1
+                    total += count
+                    if count < self.config.batch_size:
+                        break
+            except Exception as exc:
+                error = f"{type(exc).__name__}: {exc}"
+                print(f"[expiry-worker] {name} falló: {error}")
+            counts[name] = total
+            with self._lock:
+                stats = self._task_stats[name]
+                stats["total"] += total
+                stats["last"] = total
+                stats["batches"] += batches
+                if error is not None:
+                    stats["errors"] += 1
+                    stats["last_error"] = error
+        with self._lock:
+            self._runs += 1
+            self._last_run_at = datetime.now(timezone.utc)
+            self._last_duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        return counts
+
+    def start(self) -> None:
+        if self._thread is not None or not self.config.enabled:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="expiry-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout=5)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.run_once()
+            self._stop.wait(self.config.interval_seconds)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.config.enabled,
+                "running": self._thread is not None,
+                "interval_seconds": self.config.interval_seconds,
+                "batch_size": self.config.batch_size,
+                "runs": self._runs,
+                "last_run_at": self._last_run_at.isoformat() if self._last_run_at else None,
+                "last_duration_ms": self._last_duration_ms,
+                "tasks": {name: dict(stats) for name, stats in self._task_stats.items()},
+            }
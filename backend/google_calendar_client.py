@@ -0,0 +1,162 @@
+"""Per-branch cache of Google Calendar credentials and ``calendar v3`` clients.
+
+``_get_google_calendar_service`` used to import the Google libraries, build a
+new service and exchange the refresh token for an access token on every call:
+once per ``/agenda/disponibilidad`` lookup and again for every event the
+calendar outbox writes.  ``GoogleCalendarClientCache`` keeps one credentials
+object per branch (or per service account) and reuses its access token until
+``refresh_margin_seconds`` before it expires; the refresh then happens once,
+under a per-branch lock, whichever thread gets there first.
+
+Built services are kept per thread, because the ``httplib2`` transport under
+``googleapiclient`` is not thread-safe; they share the branch credentials, so
+a thread's first call costs a local ``build`` but no token exchange.  Entries
+are keyed by a fingerprint of the configured secrets, so storing a new refresh
+token (``/oauth2/callback``) or changing the env starts a fresh entry.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+import os
+import threading
+from typing import Any, Callable
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on", "si", "sí"}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+def _utcnow() -> datetime:
+    # google-auth keeps ``Credentials.expiry`` as a naive UTC datetime.
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+@dataclass(frozen=True)
+class GoogleCalendarClientConfig:
+    enabled: bool = True
+    # Refresh this long before expiry; above google-auth's own threshold so
+    # requests never refresh implicitly (and unlocked) inside the transport.
+    refresh_margin_seconds: float = 300.0
+
+    @classmethod
+    def from_env(cls) -> "GoogleCalendarClientConfig":
+        return cls(
+            enabled=_env_bool("GOOGLE_CALENDAR_CLIENT_CACHE_ENABLED", True),
+            refresh_margin_seconds=max(0.0, _env_float("GOOGLE_CALENDAR_TOKEN_REFRESH_MARGIN_SECONDS", 300.0)),
+        )
+
+
+@dataclass
+class _Entry:
+    fingerprint: str
+    credentials: Any
+    serial: int
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+class GoogleCalendarClientCache:
+    """Thread-safe credentials cache with per-thread service objects."""
+
+    def __init__(
+        self,
+        config: GoogleCalendarClientConfig | None = None,
+        *,
+        clock: Callable[[], datetime] = _utcnow,
+    ) -> None:
+        self.config = config or GoogleCalendarClientConfig.from_env()
+        self._clock = clock
+        self._entries: dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._serial = 0
+        self._counters = {"hits": 0, "credentials_created": 0, "token_refreshes": 0, "services_built": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def _needs_refresh(self, credentials: Any) -> bool:
+        if not getattr(credentials, "token", None):
+            return True
+        expiry = getattr(credentials, "expiry", None)
+        if expiry is None:
+            return False
+        return expiry - timedelta(seconds=self.config.refresh_margin_seconds) <= self._clock()
+
+    def _entry(self, key: str, fingerprint: str, create_credentials: Callable[[], Any]) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.fingerprint == fingerprint:
+                return entry
+        # Created outside the global lock; a racing creator simply loses.
+        credentials = create_credentials()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.fingerprint != fingerprint:
+                self._serial += 1
+                entry = _Entry(fingerprint, credentials, self._serial)
+                self._entries[key] = entry
+                self._counters["credentials_created"] += 1
+            return entry
+
+    def service(
+        self,
+        key: str,
+        fingerprint: str,
+        *,
+        create_credentials: Callable[[], Any],
+        refresh: Callable[[Any], None],
+        build: Callable[[Any], Any],
+    ) -> Any:
+        """Returns a ready ``calendar v3`` service for ``key`` on this thread."""
+        if not self.config.enabled:
+            credentials = create_credentials()
+            refresh(credentials)
+            return build(credentials)
+
+        entry = self._entry(key, fingerprint, create_credentials)
+        if self._needs_refresh(entry.credentials):
+            with entry.lock:
+                if self._needs_refresh(entry.credentials):
+                    refresh(entry.credentials)
+                    self._count("token_refreshes")
+
+        services: dict[str, tuple[int, Any]] = getattr(self._local, "services", None) or {}
+        self._local.services = services
+        cached = services.get(key)
+        if cached is not None and cached[0] == entry.serial:
+            self._count("hits")
+            return cached[1]
+        service = build(entry.credentials)
+        services[key] = (entry.serial, service)
+        self._count("services_built")
+        return service
+
+    def invalidate(self, key: str | None = None) -> None:
+        """Drops one branch (or everything); threads rebuild on next use."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.config.enabled,
+                "entries": len(self._entries),
+                "refresh_margin_seconds": self.config.refresh_margin_seconds,
+                **self._counters,
+            }
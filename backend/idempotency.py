@@ -0,0 +1,217 @@
+"""Shared ``Idempotency-Key`` handling for the online storefront APIs.
+
+Commerce, fulfillment, optical drafts and patient identity all record their
+mutating calls in ``core.online_idempotencia``.  ``IdempotencyStore`` is the
+one implementation behind them:
+
+* a fresh key costs a single ``INSERT ... ON CONFLICT``; a key whose row has
+  expired is taken over in that same statement instead of being rejected;
+* replays of a completed call are answered from a small in-process LRU once
+  the database has served them, without touching the table;
+* ``purge_expired_idempotency`` deletes expired rows in ``SKIP LOCKED``
+  chunks (the expiry worker runs it), so the table only holds live keys.
+
+Callers keep hashing their own payloads and translating ``IdempotencyError``
+into their module's error type, so API codes and messages do not change.
+"""
+
+from __future__ import annotations
+
+import copy
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import hashlib
+import hmac
+import os
+import threading
+from typing import Any
+
+from auth_cache import TTLCache
+
+
+MAX_KEY_LENGTH = 200
+
+
+class IdempotencyError(RuntimeError):
+    """Base class; ``kind`` is ``invalid_key``, ``conflict`` or ``in_progress``."""
+
+    kind = "error"
+
+
+class IdempotencyKeyInvalid(IdempotencyError):
+    kind = "invalid_key"
+
+
+class IdempotencyConflict(IdempotencyError):
+    kind = "conflict"
+
+
+class IdempotencyInProgress(IdempotencyError):
+    kind = "in_progress"
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+@dataclass(frozen=True)
+class IdempotencyConfig:
+    # 0 disables the in-process replay cache.
+    cache_ttl_seconds: float = 600.0
+    cache_max_entries: int = 4096
+
+    @classmethod
+    def from_env(cls) -> "IdempotencyConfig":
+        return cls(
+            cache_ttl_seconds=max(0.0, _env_float("IDEMPOTENCY_CACHE_TTL_SECONDS", 600.0)),
+            cache_max_entries=max(1, int(_env_float("IDEMPOTENCY_CACHE_MAX_ENTRIES", 4096))),
+        )
+
+
+def idempotency_key_hash(key: str) -> str:
+    clean = (key or "").strip()
+    if not clean or len(clean) > MAX_KEY_LENGTH:
+        raise IdempotencyKeyInvalid("A valid Idempotency-Key is required.")
+    return hashlib.sha256(clean.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """Begin/finish bookkeeping for one mutating call, plus replay metrics."""
+
+    def __init__(self, config: IdempotencyConfig | None = None) -> None:
+        self.config = config or IdempotencyConfig.from_env()
+        self._replays = TTLCache(self.config.cache_ttl_seconds, self.config.cache_max_entries)
+        self._lock = threading.Lock()
+        self._counters = {
+            "started": 0,
+            "expired_reused": 0,
+            "replayed_from_db": 0,
+            "replayed_from_cache": 0,
+            "conflicts": 0,
+            "in_progress": 0,
+        }
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    @staticmethod
+    def _same_request(row: Any, owner_hash: str, request_hash: str) -> bool:
+        return hmac.compare_digest(str(row["propietario_ref_hash"]), owner_hash) and row["solicitud_hash"] == request_hash
+
+    def begin(
+        self,
+        cur,
+        *,
+        scope: str,
+        key: str,
+        owner_hash: str,
+        request_hash: str,
+        lifetime_hours: int = 24,
+    ) -> tuple[int | None, dict[str, Any] | None]:
+        """Returns ``(row_id, None)`` for a new call or ``(None, response)`` for a replay."""
+        key_hash = idempotency_key_hash(key)
+        cached = self._replays.get((scope, key_hash))
+        if cached is not None and cached["expira_at"] > datetime.now(timezone.utc):
+            if not self._same_request(cached, owner_hash, request_hash):
+                self._count("conflicts")
+                raise IdempotencyConflict("Idempotency-Key was already used differently.")
+            self._count("replayed_from_cache")
+            return None, copy.deepcopy(cached["respuesta"])
+        cur.execute(
+            """
+            INSERT INTO core.online_idempotencia AS idem (
+                alcance, clave_hash, propietario_ref_hash, solicitud_hash, expira_at
+            ) VALUES (%s, %s, %s, %s, NOW() + (%s * INTERVAL '1 hour'))
+            ON CONFLICT (alcance, clave_hash) DO UPDATE
+               SET propietario_ref_hash = EXCLUDED.propietario_ref_hash,
+                   solicitud_hash = EXCLUDED.solicitud_hash,
+                   estado = 'procesando', recurso_id = NULL, codigo_respuesta = NULL,
+                   respuesta = NULL, expira_at = EXCLUDED.expira_at,
+                   created_at = NOW(), updated_at = NOW()
+             WHERE idem.expira_at <= NOW()
+            RETURNING idempotencia_id, (xmax <> 0) AS reused
+            """,
+            (scope, key_hash, owner_hash, request_hash, lifetime_hours),
+        )
+        inserted = cur.fetchone()
+        if inserted:
+            self._count("expired_reused" if inserted["reused"] else "started")
+            return int(inserted["idempotencia_id"]), None
+        cur.execute(
+            "SELECT * FROM core.online_idempotencia WHERE alcance = %s AND clave_hash = %s FOR UPDATE",
+            (scope, key_hash),
+        )
+        existing = cur.fetchone()
+        if not existing or not self._same_request(existing, owner_hash, request_hash):
+            self._count("conflicts")
+            raise IdempotencyConflict("Idempotency-Key was already used differently.")
+        if existing["estado"] == "completado" and existing["respuesta"] is not None:
+            self._count("replayed_from_db")
+            self._replays.set(
+                (scope, key_hash),
+                {
+                    "propietario_ref_hash": str(existing["propietario_ref_hash"]),
+                    "solicitud_hash": existing["solicitud_hash"],
+                    "respuesta": existing["respuesta"],
+                    "expira_at": existing["expira_at"],
+                },
+            )
+            return None, existing["respuesta"]
+        self._count("in_progress")
+        raise IdempotencyInProgress("The same request is already being processed.")
+
+    @staticmethod
+    def finish(cur, row_id: int | None, response_json: str, resource_id: int | None) -> None:
+        """Stores the response; ``response_json`` is the caller's canonical JSON."""
+        if row_id is None:
+            return
+        cur.execute(
+            """
+            UPDATE core.online_idempotencia
+            SET estado = 'completado', recurso_id = %s, codigo_respuesta = 200,
+                respuesta = %s::jsonb, updated_at = NOW()
+            WHERE idempotencia_id = %s
+            """,
+            (resource_id, response_json, row_id),
+        )
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+        replays = counters["replayed_from_db"] + counters["replayed_from_cache"]
+        calls = counters["started"] + counters["expired_reused"] + replays + counters["conflicts"] + counters["in_progress"]
+        return {
+            **counters,
+            "replay_rate": round(replays / calls, 4) if calls else None,
+            "conflict_rate": round(counters["conflicts"] / calls, 4) if calls else None,
+            "cache": self._replays.stats(),
+        }
+
+
+def purge_expired_idempotency(cur, *, limit: int = 500) -> int:
+    """Delete one chunk of expired idempotency rows; returns how many."""
+    cur.execute(
+        """
+        WITH due AS (
+            SELECT idempotencia_id
+            FROM core.online_idempotencia
+            WHERE expira_at <= NOW()
+            ORDER BY expira_at, idempotencia_id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        DELETE FROM core.online_idempotencia idem
+        USING due
+        WHERE idem.idempotencia_id = due.idempotencia_id
+        """,
+        (max(1, min(limit, 5000)),),
+    )
+    return cur.rowcount
+
+
+# Shared by every storefront repository in the process.
+IDEMPOTENCY = IdempotencyStore()
@@ -0,0 +1,250 @@
+"""Width-bucketed WebP variants for product images under ``/media``.
+
+``/media`` is served as-is by ``StaticFiles``, so every storefront client used
+to download the full-size originals (the eye-exam PNG alone is ~2 MB).
+``MediaVariantStore`` resizes an image to each configured width smaller than
+the original, encodes it as WebP and keeps the result on disk under
+``MEDIA_VARIANT_CACHE_DIR``.  Variants are generated on first request or ahead
+of time with ``scripts/build_media_variants.py``.
+
+Variant URLs carry a digest of the source bytes
+(``/media/_v/<digest>/<width>/<path>``), so they are served with an immutable
+``Cache-Control`` and a replaced source simply gets new URLs.  The public
+catalog lists them on each image as ``variants``/``srcset``.
+
+``Pillow`` is an optional dependency: without it no variants are advertised and
+the originals keep working.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import hashlib
+import os
+from pathlib import Path
+import threading
+from typing import Any
+from urllib.parse import quote
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse, RedirectResponse
+
+
+VARIANT_URL_PREFIX = "/media/_v"
+VARIANT_MEDIA_TYPE = "image/webp"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+SOURCE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+DEFAULT_VARIANT_WIDTHS = (320, 640, 960, 1280)
+
+
+class MediaVariantNotFound(LookupError):
+    """Unknown source or a width that is not configured."""
+
+
+class MediaVariantMoved(LookupError):
+    """The source changed since the URL was issued; ``url`` is the current one."""
+
+    def __init__(self, url: str) -> None:
+        super().__init__(url)
+        self.url = url
+
+
+def _pillow():
+    try:
+        from PIL import Image
+    except ImportError:  # pragma: no cover - depends on the environment
+        return None
+    return Image
+
+
+def image_variants_available() -> bool:
+    return _pillow() is not None
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on", "si", "sí"}
+
+
+def _env_widths(name: str, default: tuple[int, ...]) -> tuple[int, ...]:
+    raw = os.getenv(name, "").strip()
+    if not raw:
+        return default
+    widths = {int(part) for part in raw.split(",") if part.strip().isdigit() and int(part) > 0}
+    return tuple(sorted(widths)) or default
+
+
+@dataclass(frozen=True)
+class MediaVariantConfig:
+    cache_dir: str
+    enabled: bool = True
+    widths: tuple[int, ...] = DEFAULT_VARIANT_WIDTHS
+    quality: int = 80
+
+    @classmethod
+    def from_env(cls, base_dir: str) -> "MediaVariantConfig":
+        try:
+            quality = int(os.getenv("MEDIA_VARIANT_QUALITY", "").strip() or 80)
+        except ValueError:
+            quality = 80
+        return cls(
+            cache_dir=os.getenv("MEDIA_VARIANT_CACHE_DIR", "").strip()
+            or os.path.join(base_dir, "media_variants"),
+            enabled=_env_bool("MEDIA_VARIANTS_ENABLED", True),
+            widths=_env_widths("MEDIA_VARIANT_WIDTHS", DEFAULT_VARIANT_WIDTHS),
+            quality=min(100, max(1, quality)),
+        )
+
+
+@dataclass(frozen=True)
+class MediaSource:
+    digest: str
+    width: int
+    height: int
+
+
+@dataclass(frozen=True)
+class MediaVariant:
+    url: str
+    width: int
+    height: int
+
+
+class MediaVariantStore:
+    """Source metadata (cached by mtime/size) and on-disk WebP variants."""
+
+    def __init__(self, media_root: str, config: MediaVariantConfig) -> None:
+        self.media_root = Path(media_root).resolve()
+        self.config = config
+        self.cache_dir = Path(config.cache_dir)
+        self._sources: dict[str, tuple[tuple[int, int], MediaSource]] = {}
+        self._lock = threading.Lock()
+        self._key_locks: dict[tuple[str, int], threading.Lock] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.enabled and image_variants_available()
+
+    def _source_path(self, media_path: str) -> Path:
+        path = (self.media_root / media_path.lstrip("/")).resolve()
+        if (
+            self.media_root not in path.parents
+            or path.suffix.lower() not in SOURCE_EXTENSIONS
+            or not path.is_file()
+        ):
+            raise MediaVariantNotFound(media_path)
+        return path
+
+    def source(self, media_path: str) -> MediaSource:
+        path = self._source_path(media_path)
+        stat = path.stat()
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._sources.get(media_path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()[:16]
+        with _pillow().open(path) as image:
+            width, height = image.size
+        source = MediaSource(digest=digest, width=width, height=height)
+        with self._lock:
+            self._sources[media_path] = (stamp, source)
+        return source
+
+    def _widths_for(self, source: MediaSource) -> list[int]:
+        return [width for width in self.config.widths if width < source.width]
+
+    def describe(self, media_path: str) -> tuple[MediaSource | None, list[MediaVariant]]:
+        """Source and variant URLs for ``media_path`` (relative to ``/media``).
+
+        Never raises: a missing or unreadable source just has no variants.
+        """
+        if not self.enabled:
+            return None, []
+        try:
+            source = self.source(media_path)
+        except Exception:
+            return None, []
+        quoted = quote(media_path.lstrip("/"))
+        return source, [
+            MediaVariant(
+                url=f"{VARIANT_URL_PREFIX}/{source.digest}/{width}/{quoted}",
+                width=width,
+                height=max(1, round(source.height * width / source.width)),
+            )
+            for width in self._widths_for(source)
+        ]
+
+    def _variant_path(self, digest: str, width: int) -> Path:
+        return self.cache_dir / digest[:2] / f"{digest}-{width}.webp"
+
+    def variant_file(self, media_path: str, digest: str, width: int) -> Path:
+        """Path of the encoded variant, generating it on first use."""
+        if not self.enabled:
+            raise MediaVariantNotFound(media_path)
+        source = self.source(media_path)
+        if width not in self._widths_for(source):
+            raise MediaVariantNotFound(media_path)
+        if source.digest != digest:
+            raise MediaVariantMoved(
+                f"{VARIANT_URL_PREFIX}/{source.digest}/{width}/{quote(media_path.lstrip('/'))}"
+            )
+        target = self._variant_path(digest, width)
+        if target.is_file():
+            return target
+        with self._lock:
+            key_lock = self._key_locks.setdefault((digest, width), threading.Lock())
+        with key_lock:
+            if not target.is_file():
+                self._encode(self._source_path(media_path), target, width)
+        return target
+
+    def _encode(self, source_path: Path, target: Path, width: int) -> None:
+        image_module = _pillow()
+        with image_module.open(source_path) as image:
+            height = max(1, round(image.height * width / image.width))
+            if image.mode not in {"RGB", "RGBA"}:
+                image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+            resized = image.resize((width, height), image_module.Resampling.LANCZOS)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        resized.save(tmp, "WEBP", quality=self.config.quality, method=4)
+        os.replace(tmp, target)
+
+    def warm(self, media_path: str) -> int:
+        """Generate every variant of ``media_path``; returns how many exist."""
+        source, variants = self.describe(media_path)
+        if source is None:
+            return 0
+        for variant in variants:
+            self.variant_file(media_path, source.digest, variant.width)
+        return len(variants)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            sources = len(self._sources)
+        return {"enabled": self.enabled, "widths": list(self.config.widths), "sources": sources}
+
+
+def create_media_variants_router(store: MediaVariantStore) -> APIRouter:
+    """Must be included before the ``/media`` static mount so it wins the match."""
+    router = APIRouter()
+
+    @router.get(VARIANT_URL_PREFIX + "/{digest}/{width}/{media_path:path}", include_in_schema=False)
+    def media_variant(digest: str, width: int, media_path: str):
+        try:
+            path = store.variant_file(media_path, digest, width)
+        except MediaVariantMoved as moved:
+            # Snapshots may still list the previous digest for a few minutes.
+            return RedirectResponse(moved.url, status_code=307, headers={"Cache-Control": "no-cache"})
+        except (MediaVariantNotFound, OSError):
+            raise HTTPException(status_code=404, detail="Not found")
+        return FileResponse(
+            path,
+            media_type=VARIANT_MEDIA_TYPE,
+            headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL},
+        )
+
+    return router
@@ -8,14 +8,13 @@ from jose import jwt, JWTError
 from passlib.hash import argon2
 
 from pydantic import BaseModel, ValidationError
-from typing import Optional, Any
+from typing import Optional, Any, Callable
 from datetime import datetime, timedelta, timezone, date, time
 import calendar
 from decimal import Decimal, InvalidOperation, ROUND_DOWN
 from zoneinfo import ZoneInfo
+import hashlib
 import json
-import csv
-import io
 from calendar import monthrange
 import secrets
 import re
@@ -27,7 +26,7 @@ from urllib.error import HTTPError
 import psycopg
 import os
 from dotenv import load_dotenv
-from public_catalog import create_public_catalog_router
+from public_catalog import PUBLIC_CATALOG_INDEX_SQL, PUBLIC_CATALOG_INDEX_TABLES, create_public_catalog_router
 from online_commerce import create_online_commerce_router
 from online_product_policy import is_configurable_optical_product, is_online_purchase_product
 from optical_preview import create_optical_preview_router
@@ -44,15 +43,61 @@ from online_patient_identity import (
 )
 from online_checkout_identity import create_checkout_identity_router
 from online_fulfillment import (
+    QUOTE_REUSE_SCHEMA_SQL,
+    QUOTE_REUSE_SCHEMA_TABLES,
     create_admin_fulfillment_router,
     create_storefront_fulfillment_router,
 )
+from calendar_outbox import (
+    CALENDAR_OUTBOX_SCHEMA_SQL,
+    CalendarOutboxConfig,
+    CalendarOutboxWorker,
+    calendar_event_id,
+    enqueue_calendar_sync,
+)
+from db_pool import DatabasePoolConfig, PooledConnect
+from expiry_worker import EXPIRY_INDEX_SQL, EXPIRY_INDEX_TABLES, ExpiryWorker, ExpiryWorkerConfig
+from google_calendar_client import GoogleCalendarClientCache, GoogleCalendarClientConfig
+from idempotency import IDEMPOTENCY
+from shipping_providers import ShippingRatesConfig, build_rate_registry
+from columnar_export import COLUMNAR_FORMATS, columnar_chunks, columnar_export_available
+from csv_export import copy_csv_chunks
+from reporting_rollups import (
+    LOCAL_DATE_COLUMNS_SQL,
+    ensure_reporting_rollups as _ensure_reporting_rollups,
+    reporting_rollups_outdated,
+)
+from schema_migrations import (
+    SCHEMA_MIGRATIONS_LOCK_KEY,
+    RuntimeMigration,
+    SchemaMigrationConfig,
+    ensure_schema_version,
+)
+from auth_cache import (
+    AUTH_CACHE_SUCURSALES_TRIGGER_SQL,
+    AUTH_CACHE_USUARIOS_TRIGGER_SQL,
+    AuthCacheConfig,
+    AuthCacheListener,
+    AuthLookupCache,
+)
+from catalog_cache import (
+    CATALOG_CACHE_REQUIRED_TABLES,
+    CATALOG_CACHE_TRIGGER_SQL,
+    CatalogCacheConfig,
+    CatalogCacheListener,
+    CatalogSnapshotCache,
+)
+from image_variants import MediaVariantConfig, MediaVariantStore, create_media_variants_router
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(BASE_DIR, ".env"))
 load_dotenv()
 
 app = FastAPI(title="Optica OLM API")
+# Variantes WebP por ancho de las imágenes de /media (ver image_variants.py);
+# el router va antes del mount para que /media/_v/... no caiga en StaticFiles.
+MEDIA_VARIANTS = MediaVariantStore(os.path.join(BASE_DIR, "media"), MediaVariantConfig.from_env(BASE_DIR))
+app.include_router(create_media_variants_router(MEDIA_VARIANTS))
 app.mount("/media", StaticFiles(directory=os.path.join(BASE_DIR, "media")), name="media")
 
 def _resolve_cors_origins() -> list[str]:
@@ -118,14 +163,34 @@ def _resolve_db_conninfo() -> str:
 
 
 DB_CONNINFO = _resolve_db_conninfo()
-
-app.include_router(create_public_catalog_router(DB_CONNINFO))
-app.include_router(create_online_commerce_router(DB_CONNINFO))
-app.include_router(create_optical_preview_router(DB_CONNINFO))
-app.include_router(create_online_optical_drafts_router(DB_CONNINFO))
-app.include_router(create_online_identity_router(DB_CONNINFO))
-app.include_router(create_checkout_identity_router(DB_CONNINFO, type("IdentityRouterConfig", (), {"db_conninfo": DB_CONNINFO, "bearer_token": os.getenv("ONLINE_IDENTITY_BEARER_TOKEN", "").strip()})(), psycopg.connect))
-app.include_router(create_storefront_fulfillment_router(DB_CONNINFO))
+# Pool compartido por endpoints y repositorios; se abre en la primera conexión.
+db_connect = PooledConnect(DB_CONNINFO, DatabasePoolConfig.from_env())
+# Usuarios y sucursales activas; se invalida por LISTEN/NOTIFY (ver auth_cache.py).
+AUTH_CACHE = AuthLookupCache(AuthCacheConfig.from_env())
+AUTH_CACHE_LISTENER = AuthCacheListener(DB_CONNINFO, AUTH_CACHE)
+# Respuestas del catálogo público; cualquier escritura en productos, imágenes,
+# inventario o sucursales sube core.catalogo_version_seq y la invalida.
+CATALOG_CACHE = CatalogSnapshotCache(CatalogCacheConfig.from_env())
+CATALOG_CACHE_LISTENER = CatalogCacheListener(DB_CONNINFO, CATALOG_CACHE)
+# Expira cotizaciones, reservas y apartados ópticos fuera de las peticiones
+# de checkout (ver expiry_worker.py).
+EXPIRY_WORKER = ExpiryWorker(DB_CONNINFO, ExpiryWorkerConfig.from_env(), connect=db_connect)
+# Credenciales de Google Calendar por sucursal: reutiliza el access token hasta
+# poco antes de vencer (ver google_calendar_client.py).
+GOOGLE_CALENDAR_CLIENTS = GoogleCalendarClientCache(GoogleCalendarClientConfig.from_env())
+# Tarifas automáticas de paqueterías en paralelo, con caché y circuit breaker
+# por proveedor (ver shipping_providers.py); None = solo cotización manual.
+SHIPPING_RATES = build_rate_registry(ShippingRatesConfig.from_env())
+
+app.include_router(
+    create_public_catalog_router(DB_CONNINFO, connect=db_connect, cache=CATALOG_CACHE, variants=MEDIA_VARIANTS)
+)
+app.include_router(create_online_commerce_router(DB_CONNINFO, connect=db_connect))
+app.include_router(create_optical_preview_router(DB_CONNINFO, connect=db_connect))
+app.include_router(create_online_optical_drafts_router(DB_CONNINFO, connect=db_connect))
+app.include_router(create_online_identity_router(DB_CONNINFO, connect=db_connect))
+app.include_router(create_checkout_identity_router(DB_CONNINFO, type("IdentityRouterConfig", (), {"db_conninfo": DB_CONNINFO, "bearer_token": os.getenv("ONLINE_IDENTITY_BEARER_TOKEN", "").strip()})(), db_connect))
+app.include_router(create_storefront_fulfillment_router(DB_CONNINFO, connect=db_connect, rates=SHIPPING_RATES))
 
 
 
@@ -141,7 +206,7 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 def ensure_historia_schema():
     # Migra columnas nuevas de forma idempotente al iniciar API.
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute("CREATE SCHEMA IF NOT EXISTS core;")
 
@@ -393,45 +458,28 @@ def ensure_historia_schema():
             )
             cur.execute(
                 """
-                UPDATE core.historias_clinicas
-                SET
-                  diagnostico_principal = NULLIF(regexp_replace(lower(trim(COALESCE(diagnostico_principal, ''))), E'\\s*\\|\\s*', '|', 'g'), ''),
-                  diagnosticos_secundarios = NULLIF(regexp_replace(lower(trim(COALESCE(diagnosticos_secundarios, ''))), E'\\s*\\|\\s*', '|', 'g'), ''),
-                  diagnostico_principal_otro = CASE
-                    WHEN regexp_replace(lower(trim(COALESCE(diagnostico_principal, ''))), E'\\s*\\|\\s*', '|', 'g') ~ '(^|\\|)otro(\\||$)' THEN NULLIF(trim(diagnostico_principal_otro), '')
-                    ELSE NULL
-                  END,
-                  diagnosticos_secundarios_otro = CASE
-                    WHEN regexp_replace(lower(trim(COALESCE(diagnosticos_secundarios, ''))), E'\\s*\\|\\s*', '|', 'g') ~ '(^|\\|)otro_secundario(\\||$)' THEN NULLIF(trim(diagnosticos_secundarios_otro), '')
-                    ELSE NULL
-                  END
-                WHERE
-                  diagnostico_principal IS NOT NULL
-                  OR diagnosticos_secundarios IS NOT NULL
-                  OR diagnostico_principal_otro IS NOT NULL
-                  OR diagnosticos_secundarios_otro IS NOT NULL;
+                ALTER TABLE core.historias_clinicas
+                  ALTER COLUMN created_at_tz SET DEFAULT NOW();
                 """
             )
-            repaired_diag_rows = _repair_historia_diag_fields(cur)
-            if repaired_diag_rows:
-                print(f"[startup] historias_clinicas diagnósticos reparados: {repaired_diag_rows}")
             cur.execute(
                 """
                 ALTER TABLE core.historias_clinicas
-                  ALTER COLUMN created_at_tz SET DEFAULT NOW();
+                  ALTER COLUMN created_at_tz SET NOT NULL;
                 """
             )
+            # Export incremental (cambios_desde) del dataset ML.
             cur.execute(
                 """
-                ALTER TABLE core.historias_clinicas
-                  ALTER COLUMN created_at_tz SET NOT NULL;
+                CREATE INDEX IF NOT EXISTS idx_historias_cambio
+                ON core.historias_clinicas ((COALESCE(updated_at, created_at_tz)));
                 """
             )
         conn.commit()
 
 
 def ensure_ventas_schema():
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             # 0) Asegurar schema
             cur.execute("CREATE SCHEMA IF NOT EXISTS core;")
@@ -477,6 +525,7 @@ def ensure_ventas_schema():
                 WHERE activa IS NULL;
                 """
             )
+            cur.execute(AUTH_CACHE_SUCURSALES_TRIGGER_SQL)
             cur.execute(
                 """
                 UPDATE core.sucursales
@@ -835,7 +884,7 @@ def ensure_ventas_schema():
 
 
 def ensure_consultas_schema():
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
 
             cur.execute("CREATE SCHEMA IF NOT EXISTS core;")
@@ -896,7 +945,7 @@ def ensure_consultas_schema():
 
 
 def ensure_pacientes_schema():
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute("CREATE SCHEMA IF NOT EXISTS core;")
 
@@ -997,11 +1046,160 @@ def ensure_pacientes_schema():
                   ALTER COLUMN activo SET NOT NULL;
                 """
             )
+
+            # Búsqueda de recepción: texto normalizado (sin acentos, minúsculas)
+            # con índice trigram y teléfono en dígitos para coincidencia exacta.
+            cur.execute(
+                """
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                CREATE EXTENSION IF NOT EXISTS unaccent;
+
+                DO $$
+                DECLARE
+                  unaccent_schema text;
+                BEGIN
+                  SELECT n.nspname INTO unaccent_schema
+                  FROM pg_extension e
+                  JOIN pg_namespace n ON n.oid = e.extnamespace
+                  WHERE e.extname = 'unaccent';
+
+                  EXECUTE format(
+                    $f$
+                    CREATE OR REPLACE FUNCTION core.fn_texto_busqueda(p_texto text)
+                    RETURNS text
+                    LANGUAGE sql
+                    IMMUTABLE
+                    PARALLEL SAFE
+                    AS $b$
+                      SELECT LOWER(%1$I.unaccent(%2$L::regdictionary, COALESCE(p_texto, '')))
+                    $b$
+                    $f$,
+                    unaccent_schema,
+                    unaccent_schema || '.unaccent'
+                  );
+                END
+                $$;
+
+                CREATE OR REPLACE FUNCTION core.fn_paciente_busqueda(
+                  p_primer_nombre text,
+                  p_segundo_nombre text,
+                  p_apellido_paterno text,
+                  p_apellido_materno text,
+                  p_correo text,
+                  p_telefono text
+                )
+                RETURNS text
+                LANGUAGE sql
+                IMMUTABLE
+                PARALLEL SAFE
+                AS $$
+                  SELECT core.fn_texto_busqueda(
+                    BTRIM(REGEXP_REPLACE(
+                      COALESCE(p_primer_nombre, '') || ' ' || COALESCE(p_segundo_nombre, '') || ' '
+                      || COALESCE(p_apellido_paterno, '') || ' ' || COALESCE(p_apellido_materno, '') || ' '
+                      || COALESCE(p_correo, '') || ' ' || REGEXP_REPLACE(COALESCE(p_telefono, ''), '\\D', '', 'g'),
+                      '\\s+', ' ', 'g'
+                    ))
+                  )
+                $$;
+
+                ALTER TABLE core.pacientes
+                ADD COLUMN IF NOT EXISTS busqueda text GENERATED ALWAYS AS (
+                  core.fn_paciente_busqueda(
+                    primer_nombre, segundo_nombre, apellido_paterno, apellido_materno, correo, telefono
+                  )
+                ) STORED,
+                ADD COLUMN IF NOT EXISTS telefono_digitos text GENERATED ALWAYS AS (
+                  NULLIF(REGEXP_REPLACE(COALESCE(telefono, ''), '\\D', '', 'g'), '')
+                ) STORED;
+
+                CREATE INDEX IF NOT EXISTS idx_pacientes_busqueda_trgm
+                  ON core.pacientes USING gin (busqueda gin_trgm_ops)
+                  WHERE activo = true;
+                CREATE INDEX IF NOT EXISTS idx_pacientes_telefono_digitos
+                  ON core.pacientes (telefono_digitos)
+                  WHERE activo = true AND telefono_digitos IS NOT NULL;
+                """
+            )
+        conn.commit()
+
+
+def ensure_reporting_rollups(force_rebuild: bool = False) -> bool:
+    """Tablas diarias por sucursal que alimentan Estadísticas y Finanzas."""
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            rebuilt = _ensure_reporting_rollups(cur, force_rebuild=force_rebuild)
+        conn.commit()
+    return rebuilt
+
+
+def ensure_reporting_rollups_version() -> bool:
+    """Reconstruye los rollups si REPORTING_ROLLUPS_VERSION cambió desde la última reconstrucción.
+
+    Con la versión al día es un solo SELECT. Si no, un worker reconstruye bajo
+    el mismo advisory lock de las migraciones y los demás, al obtenerlo, ya
+    encuentran la versión nueva.
+    """
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            if not reporting_rollups_outdated(cur):
+                return False
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_MIGRATIONS_LOCK_KEY,))
+            rebuilt = reporting_rollups_outdated(cur) and _ensure_reporting_rollups(cur)
+        conn.commit()
+    return rebuilt
+
+
+def ensure_catalog_cache_schema():
+    """Secuencia de versión del catálogo y triggers que la notifican."""
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            cur.execute(CATALOG_CACHE_TRIGGER_SQL)
+        conn.commit()
+
+
+def ensure_public_catalog_indexes():
+    """Índices parciales para el listado público paginado por cursor y la búsqueda."""
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            cur.execute(PUBLIC_CATALOG_INDEX_SQL)
+        conn.commit()
+
+
+def ensure_expiry_indexes():
+    """Índice parcial para que el worker de expiración encuentre opciones vencidas."""
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            cur.execute(EXPIRY_INDEX_SQL)
+        conn.commit()
+
+
+def ensure_calendar_outbox_schema():
+    """Cola transaccional de sincronización con Google Calendar (ver calendar_outbox.py)."""
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            cur.execute(CALENDAR_OUTBOX_SCHEMA_SQL)
+        conn.commit()
+
+
+def ensure_local_date_columns():
+    """Día de negocio local guardado en ventas, consultas, pacientes e historias."""
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            cur.execute(LOCAL_DATE_COLUMNS_SQL)
+        conn.commit()
+
+
+def ensure_quote_reuse_schema():
+    """Huella de cotización para reutilizar opciones vigentes de envíos idénticos."""
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            cur.execute(QUOTE_REUSE_SCHEMA_SQL)
         conn.commit()
 
 
 def ensure_reporting_views():
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -1173,7 +1371,7 @@ def _bootstrap_auth_user(
 
 
 def ensure_auth_schema():
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute("CREATE SCHEMA IF NOT EXISTS core;")
 
@@ -1300,7 +1498,7 @@ def ensure_auth_schema():
                     sucursal_id=sucursal_id,
                 )
 
-
+            cur.execute(AUTH_CACHE_USUARIOS_TRIGGER_SQL)
 
         conn.commit()
 
@@ -2105,88 +2303,221 @@ def _best_effort_diag_tokens(
     return []
 
 
-def _repair_historia_diag_fields(cur) -> int:
-    cur.execute(
-        """
-        SELECT
-          historia_id,
-          diagnostico_general,
-          diagnostico_principal,
-          diagnostico_principal_otro,
-          diagnosticos_secundarios,
-          diagnosticos_secundarios_otro
-        FROM core.historias_clinicas
-        WHERE activo = true;
-        """
+# Versión de la normalización de diagnósticos. Subirla hace que
+# repair_historia_diag_fields vuelva a revisar todas las historias activas.
+HISTORIA_DIAG_NORMALIZACION_VERSION = 1
+HISTORIA_DIAG_REPAIR_CHUNK_SIZE = 500
+
+
+def _sql_trim(value: str | None) -> str:
+    # trim() de PostgreSQL sin argumentos solo quita espacios.
+    return str(value or "").strip(" ")
+
+
+def _historia_diag_formato(value: str | None) -> str | None:
+    """NULLIF(regexp_replace(lower(trim(COALESCE(v, ''))), '\\s*\\|\\s*', '|', 'g'), '')."""
+    return re.sub(r"\s*\|\s*", "|", _sql_trim(value).lower()) or None
+
+
+def _historia_diag_reparada(
+    diag_general: str | None,
+    diag_principal: str | None,
+    diag_principal_otro: str | None,
+    diag_sec: str | None,
+    diag_sec_otro: str | None,
+) -> tuple[str | None, str | None, str | None, str | None] | None:
+    """Valores canónicos (principal, principal_otro, secundarios, secundarios_otro) o None si ya lo son.
+
+    Reproduce las dos pasadas del arranque original: primero el formato que
+    aplicaba el UPDATE en SQL (minúsculas, trim, pipes sin espacios, *_otro
+    en NULL sin su token) y después la reparación de tokens por fila.
+    """
+    guardado = (diag_principal, diag_principal_otro, diag_sec, diag_sec_otro)
+    diag_principal = _historia_diag_formato(diag_principal)
+    diag_sec = _historia_diag_formato(diag_sec)
+    diag_principal_otro = (
+        _sql_trim(diag_principal_otro) or None
+        if re.search(r"(^|\|)otro(\||$)", diag_principal or "")
+        else None
+    )
+    diag_sec_otro = (
+        _sql_trim(diag_sec_otro) or None
+        if re.search(r"(^|\|)otro_secundario(\||$)", diag_sec or "")
+        else None
+    )
+    formateado = (diag_principal, diag_principal_otro, diag_sec, diag_sec_otro)
+
+    principal_tokens = _best_effort_diag_tokens(
+        diag_principal,
+        DIAGNOSTICO_PRINCIPAL_ALLOWED,
+        DIAGNOSTICO_PRINCIPAL_ALIASES,
+        diag_general,
+        "principal",
+    )
+    secundarios_tokens = _best_effort_diag_tokens(
+        diag_sec,
+        DIAGNOSTICO_SECUNDARIO_ALLOWED,
+        DIAGNOSTICO_SECUNDARIO_ALIASES,
+        diag_general,
+        "secundarios?",
     )
-    rows = cur.fetchall()
-    repaired = 0
 
-    for historia_id, diag_general, diag_principal, diag_principal_otro, diag_sec, diag_sec_otro in rows:
-        principal_tokens = _best_effort_diag_tokens(
-            diag_principal,
-            DIAGNOSTICO_PRINCIPAL_ALLOWED,
-            DIAGNOSTICO_PRINCIPAL_ALIASES,
-            diag_general,
-            "principal",
-        )
-        secundarios_tokens = _best_effort_diag_tokens(
-            diag_sec,
-            DIAGNOSTICO_SECUNDARIO_ALLOWED,
-            DIAGNOSTICO_SECUNDARIO_ALIASES,
-            diag_general,
-            "secundarios?",
-        )
+    next_principal = "|".join(principal_tokens) if principal_tokens else None
+    next_secundarios = "|".join(secundarios_tokens) if secundarios_tokens else None
+    next_principal_otro = str(diag_principal_otro or "").strip() or None
+    next_sec_otro = str(diag_sec_otro or "").strip() or None
 
-        next_principal = "|".join(principal_tokens) if principal_tokens else None
-        next_secundarios = "|".join(secundarios_tokens) if secundarios_tokens else None
-        next_principal_otro = str(diag_principal_otro or "").strip() or None
-        next_sec_otro = str(diag_sec_otro or "").strip() or None
+    if "otro" not in principal_tokens:
+        next_principal_otro = None
+    if "otro_secundario" not in secundarios_tokens:
+        next_sec_otro = None
 
-        if "otro" not in principal_tokens:
-            next_principal_otro = None
-        if "otro_secundario" not in secundarios_tokens:
-            next_sec_otro = None
+    # La reparación por fila solo reescribía si cambiaban los tokens
+    # permitidos; si no, quedaba el valor ya formateado.
+    current_principal_tokens = [
+        t for t in split_pipe_tokens(diag_principal) if t in DIAGNOSTICO_PRINCIPAL_ALLOWED
+    ]
+    current_secundarios_tokens = [
+        t for t in split_pipe_tokens(diag_sec) if t in DIAGNOSTICO_SECUNDARIO_ALLOWED
+    ]
+    current_principal = "|".join(list(dict.fromkeys(current_principal_tokens))) or None
+    current_secundarios = "|".join(list(dict.fromkeys(current_secundarios_tokens))) or None
+    current_principal_otro = str(diag_principal_otro or "").strip() or None
+    current_sec_otro = str(diag_sec_otro or "").strip() or None
 
-        current_principal_tokens = [
-            t for t in split_pipe_tokens(diag_principal) if t in DIAGNOSTICO_PRINCIPAL_ALLOWED
-        ]
-        current_secundarios_tokens = [
-            t for t in split_pipe_tokens(diag_sec) if t in DIAGNOSTICO_SECUNDARIO_ALLOWED
-        ]
-        current_principal = "|".join(list(dict.fromkeys(current_principal_tokens))) or None
-        current_secundarios = "|".join(list(dict.fromkeys(current_secundarios_tokens))) or None
-        current_principal_otro = str(diag_principal_otro or "").strip() or None
-        current_sec_otro = str(diag_sec_otro or "").strip() or None
-
-        if (
-            current_principal != next_principal
-            or current_secundarios != next_secundarios
-            or current_principal_otro != next_principal_otro
-            or current_sec_otro != next_sec_otro
-        ):
+    if (
+        current_principal != next_principal
+        or current_secundarios != next_secundarios
+        or current_principal_otro != next_principal_otro
+        or current_sec_otro != next_sec_otro
+    ):
+        final = (next_principal, next_principal_otro, next_secundarios, next_sec_otro)
+    else:
+        final = formateado
+    return final if final != guardado else None
+
+
+def ensure_historia_diag_normalizacion_schema():
+    # Columna de versión + trigger: una edición de diagnósticos fuera del job
+    # regresa la fila a "pendiente" para la siguiente corrida.
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
             cur.execute(
                 """
-                UPDATE core.historias_clinicas
-                SET
-                  diagnostico_principal = %s,
-                  diagnostico_principal_otro = %s,
-                  diagnosticos_secundarios = %s,
-                  diagnosticos_secundarios_otro = %s,
-                  updated_at = NOW()
-                WHERE historia_id = %s;
+                ALTER TABLE core.historias_clinicas
+                  ADD COLUMN IF NOT EXISTS diag_normalizado_version smallint NOT NULL DEFAULT 0;
+
+                CREATE INDEX IF NOT EXISTS idx_historias_diag_pendiente
+                ON core.historias_clinicas (historia_id, diag_normalizado_version)
+                WHERE activo = true;
+
+                CREATE OR REPLACE FUNCTION core.fn_historias_diag_pendiente()
+                RETURNS trigger
+                LANGUAGE plpgsql
+                AS $$
+                BEGIN
+                  IF NEW.diag_normalizado_version IS NOT DISTINCT FROM OLD.diag_normalizado_version THEN
+                    NEW.diag_normalizado_version := 0;
+                  END IF;
+                  RETURN NEW;
+                END;
+                $$;
+
+                DROP TRIGGER IF EXISTS trg_historias_diag_pendiente ON core.historias_clinicas;
+                CREATE TRIGGER trg_historias_diag_pendiente
+                BEFORE UPDATE OF diagnostico_general, diagnostico_principal, diagnostico_principal_otro,
+                  diagnosticos_secundarios, diagnosticos_secundarios_otro
+                ON core.historias_clinicas
+                FOR EACH ROW EXECUTE FUNCTION core.fn_historias_diag_pendiente();
+                """
+            )
+
+
+def repair_historia_diag_fields(
+    chunk_size: int = HISTORIA_DIAG_REPAIR_CHUNK_SIZE,
+    log: Callable[[str], None] = print,
+) -> int:
+    """Normaliza diagnósticos de historias pendientes por bloques; regresa las filas reescritas.
+
+    Cada bloque es su propia transacción (bloqueos cortos, SKIP LOCKED para no
+    esperar a ediciones en curso) y marca las filas revisadas con
+    HISTORIA_DIAG_NORMALIZACION_VERSION, así que una corrida interrumpida
+    continúa donde se quedó.
+    """
+    version = HISTORIA_DIAG_NORMALIZACION_VERSION
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT COUNT(*) FROM core.historias_clinicas
+                WHERE activo = true AND diag_normalizado_version < %s;
                 """,
-                (
-                    next_principal,
-                    next_principal_otro,
-                    next_secundarios,
-                    next_sec_otro,
-                    historia_id,
-                ),
+                (version,),
             )
-            repaired += 1
+            pendientes = int(cur.fetchone()[0])
+    if not pendientes:
+        return 0
+
+    revisadas = 0
+    reparadas = 0
+    ultimo_id = 0
+    while True:
+        with db_connect(DB_CONNINFO) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT
+                      historia_id,
+                      diagnostico_general,
+                      diagnostico_principal,
+                      diagnostico_principal_otro,
+                      diagnosticos_secundarios,
+                      diagnosticos_secundarios_otro
+                    FROM core.historias_clinicas
+                    WHERE activo = true
+                      AND diag_normalizado_version < %s
+                      AND historia_id > %s
+                    ORDER BY historia_id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED;
+                    """,
+                    (version, ultimo_id, chunk_size),
+                )
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                ultimo_id = int(rows[-1][0])
+
+                values: list[Any] = []
+                for historia_id, diag_general, principal, principal_otro, sec, sec_otro in rows:
+                    reparada = _historia_diag_reparada(diag_general, principal, principal_otro, sec, sec_otro)
+                    values.extend(
+                        [historia_id, reparada is not None]
+                        + list(reparada if reparada is not None else (principal, principal_otro, sec, sec_otro))
+                    )
+                    if reparada is not None:
+                        reparadas += 1
+                cur.execute(
+                    f"""
+                    UPDATE core.historias_clinicas h
+                    SET
+                      diagnostico_principal = v.principal,
+                      diagnostico_principal_otro = v.principal_otro,
+                      diagnosticos_secundarios = v.secundarios,
+                      diagnosticos_secundarios_otro = v.secundarios_otro,
+                      updated_at = CASE WHEN v.cambio THEN NOW() ELSE h.updated_at END,
+                      diag_normalizado_version = %s
+                    FROM (
+                      VALUES {", ".join(["(%s::bigint, %s::boolean, %s::text, %s::text, %s::text, %s::text)"] * len(rows))}
+                    ) AS v(historia_id, cambio, principal, principal_otro, secundarios, secundarios_otro)
+                    WHERE h.historia_id = v.historia_id;
+                    """,
+                    (version, *values),
+                )
+        revisadas += len(rows)
+        log(f"[historias] diagnósticos revisados {revisadas}/{pendientes} (reparados {reparadas})")
 
-    return repaired
+    return reparadas
 
 
 def extract_consulta_from_tipo(tipo_consulta: str | None) -> tuple[str | None, str | None]:
@@ -2426,22 +2757,111 @@ def normalize_altura_cm(value: Any) -> int | None:
 
 
 
-@app.on_event("startup")
-def startup_migrations():
-    ensure_auth_schema()
-    ensure_historia_schema()
-    ensure_ventas_schema()
-    ensure_finanzas_schema()
-    ensure_consultas_schema()
-    ensure_pacientes_schema()
+def _ensure_reporting_views_tolerante():
     try:
         ensure_reporting_views()
     except Exception as e:
         # Evita tumbar el arranque por diferencias de objetos legacy en entornos productivos.
         print(f"[startup] ensure_reporting_views omitido temporalmente: {e}")
+
+
+def runtime_migrations() -> list[RuntimeMigration]:
+    # Cada cambio de esquema se agrega como una versión nueva al final; las
+    # versiones ya registradas en core.schema_migrations no se vuelven a correr.
+    return [
+        RuntimeMigration(
+            version=1,
+            name="runtime_baseline",
+            steps=(
+                ("ensure_auth_schema", ensure_auth_schema),
+                ("ensure_historia_schema", ensure_historia_schema),
+                ("ensure_ventas_schema", ensure_ventas_schema),
+                ("ensure_finanzas_schema", ensure_finanzas_schema),
+                ("ensure_consultas_schema", ensure_consultas_schema),
+                ("ensure_pacientes_schema", ensure_pacientes_schema),
+                ("ensure_reporting_rollups", ensure_reporting_rollups),
+                ("ensure_reporting_views", _ensure_reporting_views_tolerante),
+            ),
+        ),
+        RuntimeMigration(
+            version=2,
+            name="historias_diag_normalizacion",
+            steps=(
+                ("ensure_historia_diag_normalizacion_schema", ensure_historia_diag_normalizacion_schema),
+                ("repair_historia_diag_fields", repair_historia_diag_fields),
+            ),
+        ),
+        RuntimeMigration(
+            version=3,
+            name="catalogo_version",
+            steps=(("ensure_catalog_cache_schema", ensure_catalog_cache_schema),),
+            requires=CATALOG_CACHE_REQUIRED_TABLES,
+        ),
+        RuntimeMigration(
+            version=4,
+            name="catalogo_publico_keyset",
+            steps=(("ensure_public_catalog_indexes", ensure_public_catalog_indexes),),
+            requires=PUBLIC_CATALOG_INDEX_TABLES,
+        ),
+        RuntimeMigration(
+            version=5,
+            name="expiracion_en_segundo_plano",
+            steps=(("ensure_expiry_indexes", ensure_expiry_indexes),),
+            requires=EXPIRY_INDEX_TABLES,
+        ),
+        RuntimeMigration(
+            version=6,
+            name="cotizacion_fingerprint",
+            steps=(("ensure_quote_reuse_schema", ensure_quote_reuse_schema),),
+            requires=QUOTE_REUSE_SCHEMA_TABLES,
+        ),
+        RuntimeMigration(
+            version=7,
+            name="fecha_local_almacenada",
+            steps=(("ensure_local_date_columns", ensure_local_date_columns),),
+        ),
+        RuntimeMigration(
+            version=8,
+            name="agenda_calendario_outbox",
+            steps=(("ensure_calendar_outbox_schema", ensure_calendar_outbox_schema),),
+        ),
+    ]
+
+
+@app.on_event("startup")
+def startup_migrations():
+    # Los workers solo verifican la versión registrada; las migraciones las
+    # aplica scripts/apply_runtime_migrations.py (o el primer worker en modo
+    # auto, bajo advisory lock).
+    schema_config = SchemaMigrationConfig.from_env()
+    ensure_schema_version(DB_CONNINFO, runtime_migrations(), schema_config, connect=db_connect)
+    if schema_config.mode == "auto":
+        # El trigger regresa a pendiente las historias editadas después de v2;
+        # sin filas pendientes esto es solo un conteo por índice.
+        repair_historia_diag_fields()
+        ensure_reporting_rollups_version()
     _load_google_calendar_env_cache()
 
-   
+
+@app.on_event("startup")
+def start_auth_cache_listener():
+    AUTH_CACHE_LISTENER.start()
+    CATALOG_CACHE_LISTENER.start()
+    EXPIRY_WORKER.start()
+    # Arranca aunque ENABLE_GOOGLE_CALENDAR esté apagado: las bajas de
+    # consultas con evento encolan su borrado de todos modos.
+    CALENDAR_OUTBOX.start()
+
+
+@app.on_event("shutdown")
+def shutdown_db_pool():
+    AUTH_CACHE_LISTENER.stop()
+    CATALOG_CACHE_LISTENER.stop()
+    EXPIRY_WORKER.stop()
+    CALENDAR_OUTBOX.stop()
+    if SHIPPING_RATES is not None:
+        SHIPPING_RATES.shutdown()
+    db_connect.close()
 
 
 @app.get("/health", summary="Salud del sistema")
@@ -2504,52 +2924,59 @@ def _resolve_export_date_range(desde: str | None, hasta: str | None, sucursal_id
     return desde_date, hasta_date
 
 
-def _csv_value(value: Any) -> Any:
-    if value is None:
-        return ""
-    if isinstance(value, (datetime, date, time)):
-        return value.isoformat()
-    if isinstance(value, bool):
-        return "true" if value else "false"
-    return value
-
+def _fecha_local_filtro(
+    columna: str,
+    *,
+    fecha_desde: str | None = None,
+    fecha_hasta: str | None = None,
+    anio: int | None = None,
+    mes: int | None = None,
+    hoy: date | None = None,
+) -> tuple[list[str], list[Any]]:
+    """Condiciones sobre una columna ``fecha_local`` (rango, mes+año, año u hoy).
 
-def _sql_export_local_date_expr(ts_col_ref: str, sucursal_col_ref: str) -> str:
-    return (
-        f"DATE({ts_col_ref} AT TIME ZONE "
-        f"(CASE WHEN {sucursal_col_ref} = 2 THEN 'America/Cancun' ELSE 'America/Mexico_City' END))"
-    )
+    Mes y año se traducen a rangos semiabiertos para que el índice
+    (sucursal_id, fecha_local) se recorra por rango.
+    """
+    if fecha_desde and fecha_hasta:
+        return [f"{columna} BETWEEN %s AND %s"], [fecha_desde, fecha_hasta]
+    if fecha_desde:
+        return [f"{columna} >= %s"], [fecha_desde]
+    if fecha_hasta:
+        return [f"{columna} <= %s"], [fecha_hasta]
+    if anio is not None:
+        if not 1 <= anio < 9999:
+            return ["FALSE"], []
+        if mes is not None:
+            inicio = date(anio, mes, 1)
+            fin = date(anio + 1, 1, 1) if mes == 12 else date(anio, mes + 1, 1)
+        else:
+            inicio, fin = date(anio, 1, 1), date(anio + 1, 1, 1)
+        return [f"{columna} >= %s", f"{columna} < %s"], [inicio, fin]
+    if hoy is not None:
+        return [f"{columna} = %s"], [hoy]
+    return [], []
 
 
 def _stream_csv_query(sql: str, params: tuple[Any, ...], headers: list[str], delimiter_char: str):
+    # Postgres arma el CSV (COPY ... TO STDOUT) y los bytes se reenvían tal cual.
     def _generator():
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
-                cur.execute(sql, params)
-                buff = io.StringIO()
-                writer = csv.writer(buff, delimiter=delimiter_char, lineterminator="\n")
-                buff.write("\ufeff")
-                writer.writerow(headers)
-                yield buff.getvalue()
-                buff.seek(0)
-                buff.truncate(0)
-
-                while True:
-                    rows = cur.fetchmany(1000)
-                    if not rows:
-                        break
-                    for row in rows:
-                        writer.writerow([_csv_value(v) for v in row])
-                    yield buff.getvalue()
-                    buff.seek(0)
-                    buff.truncate(0)
+                yield from copy_csv_chunks(cur, sql, params, headers=headers, delimiter=delimiter_char)
 
     return _generator()
 
 
-def _export_filename(prefix: str, desde_date: date, hasta_date: date, sucursal_id: int | None) -> str:
+def _export_filename(
+    prefix: str,
+    desde_date: date,
+    hasta_date: date,
+    sucursal_id: int | None,
+    extension: str = "csv",
+) -> str:
     sid = "all" if sucursal_id is None else f"sucursal_{sucursal_id}"
-    return f"{prefix}_{sid}_{desde_date.isoformat()}_{hasta_date.isoformat()}.csv"
+    return f"{prefix}_{sid}_{desde_date.isoformat()}_{hasta_date.isoformat()}.{extension}"
 
 
 def _sql_humanize_anios_text_expr(sql_col_ref: str) -> str:
@@ -2593,6 +3020,12 @@ def _current_user_dep(token: str = Depends(oauth2_scheme)):
     return get_current_user(token)
 
 
+@app.get("/health/db-pool", summary="Métricas del pool de conexiones (solo admin)")
+def health_db_pool(user=Depends(_current_user_dep)):
+    require_roles(user, ("admin",))
+    return {**db_connect.stats(), "auth_cache": AUTH_CACHE.stats(), "catalog_cache": CATALOG_CACHE.stats(), "expiry_worker": EXPIRY_WORKER.stats(), "calendar_outbox": CALENDAR_OUTBOX.stats(), "google_calendar": GOOGLE_CALENDAR_CLIENTS.stats(), "idempotency": IDEMPOTENCY.stats(), "shipping_rates": SHIPPING_RATES.stats() if SHIPPING_RATES else None}
+
+
 @app.get("/usuarios/doctores", summary="Listar doctores (solo admin)")
 def listar_doctores_para_export(sucursal_id: int | None = None, user=Depends(_current_user_dep)):
     require_roles(user, ("admin",))
@@ -2602,7 +3035,7 @@ def listar_doctores_para_export(sucursal_id: int | None = None, user=Depends(_cu
         where.append("sucursal_id = %s")
         params.append(sucursal_id)
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 f"""
@@ -2638,7 +3071,7 @@ def export_consultas_csv(
 
     doctor_username: str | None = None
     if doctor_id is not None:
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """
@@ -2655,8 +3088,7 @@ def export_consultas_csv(
                     raise HTTPException(status_code=400, detail="doctor_id inválido o inactivo.")
                 doctor_username = str(row[0])
 
-    consulta_fecha_local_expr = _sql_export_local_date_expr("c.fecha_hora", "c.sucursal_id")
-    where = ["c.activo = true", f"{consulta_fecha_local_expr} BETWEEN %s AND %s"]
+    where = ["c.activo = true", "c.fecha_local BETWEEN %s AND %s"]
     params: list[Any] = [desde_date, hasta_date]
     if sid is not None:
         where.append("c.sucursal_id = %s")
@@ -2725,7 +3157,7 @@ def export_ventas_csv(
 
     doctor_username: str | None = None
     if doctor_id is not None:
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """
@@ -2742,8 +3174,7 @@ def export_ventas_csv(
                     raise HTTPException(status_code=400, detail="doctor_id inválido o inactivo.")
                 doctor_username = str(row[0])
 
-    venta_fecha_local_expr = _sql_export_local_date_expr("v.fecha_hora", "v.sucursal_id")
-    where = ["v.activo = true", f"{venta_fecha_local_expr} BETWEEN %s AND %s"]
+    where = ["v.activo = true", "v.fecha_local BETWEEN %s AND %s"]
     params: list[Any] = [desde_date, hasta_date]
     if sid is not None:
         where.append("v.sucursal_id = %s")
@@ -2816,8 +3247,7 @@ def export_pacientes_csv(
     delimiter_char = _parse_export_delimiter(delimiter)
     desde_date, hasta_date = _resolve_export_date_range(desde, hasta, sid)
 
-    paciente_fecha_local_expr = _sql_export_local_date_expr("p.creado_en", "p.sucursal_id")
-    where = ["p.activo = true", f"{paciente_fecha_local_expr} BETWEEN %s AND %s"]
+    where = ["p.activo = true", "p.fecha_local BETWEEN %s AND %s"]
     params: list[Any] = [desde_date, hasta_date]
     if sid is not None:
         where.append("p.sucursal_id = %s")
@@ -2902,7 +3332,7 @@ def export_historias_clinicas_csv(
     delimiter_char = _parse_export_delimiter(delimiter)
     desde_date, hasta_date = _resolve_export_date_range(desde, hasta, sid)
 
-    where = ["h.activo = true", "DATE(h.created_at_tz) BETWEEN %s AND %s"]
+    where = ["h.activo = true", "h.fecha_local BETWEEN %s AND %s"]
     params: list[Any] = [desde_date, hasta_date]
     if sid is not None:
         where.append("h.sucursal_id = %s")
@@ -2988,32 +3418,67 @@ def export_historias_clinicas_csv(
     )
 
 
-@app.get("/export/historias_ml.csv", summary="Exportar dataset ML base de historias clínicas (solo admin)")
-def export_historias_ml_csv(
-    sucursal_id: str = "all",
-    desde: str | None = None,
-    hasta: str | None = None,
-    paciente_id: int | None = None,
-    doctor_id: int | None = None,
-    delimiter: str = "comma",
-    user=Depends(_current_user_dep),
-):
-    require_roles(user, ("admin",))
-    if doctor_id is not None:
-        raise HTTPException(status_code=400, detail="doctor_id no aplica para export ML de historias clínicas.")
-
-    sid = _parse_export_sucursal_id(sucursal_id)
-    delimiter_char = _parse_export_delimiter(delimiter)
-    desde_date, hasta_date = _resolve_export_date_range(desde, hasta, sid)
-
-    where = ["h.activo = true", "DATE(h.created_at_tz) BETWEEN %s AND %s"]
-    params: list[Any] = [desde_date, hasta_date]
-    if sid is not None:
-        where.append("h.sucursal_id = %s")
-        params.append(sid)
-    if paciente_id is not None:
-        where.append("h.paciente_id = %s")
-        params.append(paciente_id)
+# Columnas de texto del dataset ML que el export columnar tipa: las
+# graduaciones y conteos se convierten a float64 y los tokens controlados se
+# codifican como diccionario.
+HISTORIAS_ML_NUMERIC_TEXT_COLUMNS = frozenset({
+    "alcohol_bebidas_dia",
+    "marihuana_veces_semana",
+    "drogas_frecuencia_semana",
+    "od_esfera",
+    "od_cilindro",
+    "od_eje",
+    "oi_esfera",
+    "oi_cilindro",
+    "oi_eje",
+})
+HISTORIAS_ML_CATEGORICAL_COLUMNS = frozenset({
+    "diagnostico_principal",
+    "diagnosticos_secundarios",
+    "seguimiento_valor",
+    "sexo",
+    "diabetes_estado",
+    "diabetes_control",
+    "tipo_lentes_actual",
+    "tiempo_uso_lentes",
+    "fotofobia_escala",
+    "dolor_ocular_escala",
+    "cefalea_frecuencia",
+    "horas_pantalla_dia",
+    "conduccion_nocturna_horas",
+    "horas_sueno_promedio",
+    "estres_nivel",
+    "tabaquismo_estado",
+    "tabaquismo_intensidad",
+    "tabaquismo_anios",
+    "tabaquismo_anios_desde_dejo",
+    "alcohol_estado",
+    "marihuana_estado",
+    "drogas_estado",
+    "sintomas",
+    "antecedentes_generales",
+    "antecedentes_oculares_familiares",
+    "exposicion_uv",
+    "uso_pantalla_en_oscuridad",
+    "nivel_educativo",
+    "horas_lectura_dia",
+    "horas_exterior_dia",
+    "deporte_frecuencia",
+    "deporte_duracion",
+    "deporte_tipos",
+})
+# Margen de seguridad de la marca incremental: los escritores sellan
+# updated_at con NOW() (inicio de su transacción), así que una fila puede
+# hacerse visible después de que otra con sello mayor ya se exportó.
+HISTORIAS_ML_WATERMARK_LAG_SECONDS = float(os.getenv("HISTORIAS_ML_WATERMARK_LAG_SECONDS", "5"))
+
+
+def _historias_ml_export_query(
+    where: list[str],
+    order_sql: str,
+    extra_columns: list[tuple[str, str]] | None = None,
+) -> tuple[str, list[str]]:
+    extra_columns = extra_columns or []
 
     headers = [
         "historia_id",
@@ -3127,14 +3592,45 @@ def export_historias_ml_csv(
       NULLIF(TRIM(h.od_eje), '') AS od_eje,
       NULLIF(TRIM(h.oi_esfera), '') AS oi_esfera,
       NULLIF(TRIM(h.oi_cilindro), '') AS oi_cilindro,
-      NULLIF(TRIM(h.oi_eje), '') AS oi_eje
+      NULLIF(TRIM(h.oi_eje), '') AS oi_eje{"".join(f", {expr}" for _, expr in extra_columns)}
     FROM core.historias_clinicas h
     LEFT JOIN core.pacientes p
       ON p.paciente_id = h.paciente_id
      AND p.sucursal_id = h.sucursal_id
     WHERE {' AND '.join(where)}
-    ORDER BY h.created_at_tz DESC, h.historia_id DESC;
+    ORDER BY {order_sql};
     """
+    return sql, headers + [name for name, _ in extra_columns]
+
+
+@app.get("/export/historias_ml.csv", summary="Exportar dataset ML base de historias clínicas (solo admin)")
+def export_historias_ml_csv(
+    sucursal_id: str = "all",
+    desde: str | None = None,
+    hasta: str | None = None,
+    paciente_id: int | None = None,
+    doctor_id: int | None = None,
+    delimiter: str = "comma",
+    user=Depends(_current_user_dep),
+):
+    require_roles(user, ("admin",))
+    if doctor_id is not None:
+        raise HTTPException(status_code=400, detail="doctor_id no aplica para export ML de historias clínicas.")
+
+    sid = _parse_export_sucursal_id(sucursal_id)
+    delimiter_char = _parse_export_delimiter(delimiter)
+    desde_date, hasta_date = _resolve_export_date_range(desde, hasta, sid)
+
+    where = ["h.activo = true", "h.fecha_local BETWEEN %s AND %s"]
+    params: list[Any] = [desde_date, hasta_date]
+    if sid is not None:
+        where.append("h.sucursal_id = %s")
+        params.append(sid)
+    if paciente_id is not None:
+        where.append("h.paciente_id = %s")
+        params.append(paciente_id)
+
+    sql, headers = _historias_ml_export_query(where, "h.created_at_tz DESC, h.historia_id DESC")
 
     filename = _export_filename("historias_ml", desde_date, hasta_date, sid)
     return StreamingResponse(
@@ -3143,6 +3639,122 @@ def export_historias_ml_csv(
         headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
+@app.get(
+    "/export/historias_ml.{formato}",
+    summary="Exportar dataset ML de historias clínicas en Arrow/Parquet (solo admin)",
+)
+def export_historias_ml_columnar(
+    formato: str,
+    sucursal_id: str = "all",
+    desde: str | None = None,
+    hasta: str | None = None,
+    paciente_id: int | None = None,
+    cambios_desde: str | None = None,
+    user=Depends(_current_user_dep),
+):
+    require_roles(user, ("admin",))
+    formato = formato.strip().lower()
+    if formato not in COLUMNAR_FORMATS:
+        raise HTTPException(status_code=404, detail="Formato no soportado. Usa .csv, .arrow o .parquet.")
+    if not columnar_export_available():
+        raise HTTPException(status_code=501, detail="Export columnar no disponible: falta instalar pyarrow.")
+
+    sid = _parse_export_sucursal_id(sucursal_id)
+    cambio_expr = "COALESCE(h.updated_at, h.created_at_tz)"
+    where: list[str] = []
+    params: list[Any] = []
+    if cambios_desde:
+        # Incremental: filas creadas, editadas o desactivadas después de la
+        # marca. La nueva marca es el último cambio incluido en el archivo.
+        try:
+            marca_desde = datetime.fromisoformat(cambios_desde.strip().replace("Z", "+00:00"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="cambios_desde inválido. Usa fecha/hora ISO 8601.")
+        if marca_desde.tzinfo is None:
+            marca_desde = marca_desde.replace(tzinfo=timezone.utc)
+        where.append(f"{cambio_expr} > %s")
+        params.append(marca_desde)
+        order_sql = f"{cambio_expr} ASC, h.historia_id ASC"
+        desde_date = hasta_date = None
+    else:
+        desde_date, hasta_date = _resolve_export_date_range(desde, hasta, sid)
+        where.extend(["h.activo = true", "h.fecha_local BETWEEN %s AND %s"])
+        params.extend([desde_date, hasta_date])
+        order_sql = "h.created_at_tz DESC, h.historia_id DESC"
+    if sid is not None:
+        where.append("h.sucursal_id = %s")
+        params.append(sid)
+    if paciente_id is not None:
+        where.append("h.paciente_id = %s")
+        params.append(paciente_id)
+
+    # La marca solo avanza hasta el horizonte: antes de la transacción abierta
+    # más antigua (y de NOW()) menos el margen. Una fila sellada por una
+    # transacción que aún no confirma queda por encima de la marca y sale en
+    # el siguiente export; a cambio, algunas filas pueden repetirse.
+    horizonte_sql = """
+        (SELECT LEAST(NOW(), MIN(a.xact_start)) - make_interval(secs => %s)
+         FROM pg_stat_activity a
+         WHERE a.datname = current_database()
+           AND a.backend_type = 'client backend'
+           AND a.pid <> pg_backend_pid()
+           AND a.xact_start IS NOT NULL)
+    """
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT MAX({cambio_expr})
+                FROM core.historias_clinicas h
+                WHERE {' AND '.join(where)}
+                  AND {cambio_expr} < {horizonte_sql};
+                """,
+                tuple(params) + (HISTORIAS_ML_WATERMARK_LAG_SECONDS,),
+            )
+            marca = cur.fetchone()[0]
+    if marca is not None:
+        # Fija el límite superior para que la marca cubra exactamente el archivo.
+        where.append(f"{cambio_expr} <= %s")
+        params.append(marca)
+    else:
+        # Nada antes del horizonte: el archivo sale vacío y la marca no avanza.
+        where.append("false")
+    marca_iso = marca.isoformat() if marca is not None else (cambios_desde or "")
+
+    sql, names = _historias_ml_export_query(
+        where,
+        order_sql,
+        extra_columns=[("activo", "h.activo"), ("cambiado_en", f"{cambio_expr}")],
+    )
+
+    def _generator():
+        with db_connect(DB_CONNINFO) as conn:
+            yield from columnar_chunks(
+                conn,
+                sql,
+                tuple(params),
+                fmt=formato,
+                names=names,
+                categorical=HISTORIAS_ML_CATEGORICAL_COLUMNS,
+                numeric_text=HISTORIAS_ML_NUMERIC_TEXT_COLUMNS,
+                metadata={"export": "historias_ml", "watermark": marca_iso},
+            )
+
+    media_type, extension = COLUMNAR_FORMATS[formato]
+    if desde_date is not None and hasta_date is not None:
+        filename = _export_filename("historias_ml", desde_date, hasta_date, sid, extension)
+    else:
+        scope = "all" if sid is None else f"sucursal_{sid}"
+        filename = f"historias_ml_{scope}_cambios.{extension}"
+    return StreamingResponse(
+        _generator(),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Export-Watermark": marca_iso,
+        },
+    )
+
 
 @app.get("/export/sucursales.csv", summary="Exportar sucursales CSV (solo admin)")
 def export_sucursales_csv(
@@ -3238,7 +3850,7 @@ def login(data: LoginIn):
     WHERE LOWER(TRIM(username)) = LOWER(%s)
     LIMIT 1;
     """
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(sql, (login_username,))
             row = cur.fetchone()
@@ -3283,6 +3895,26 @@ def decode_token(token: str):
     except JWTError:
         raise HTTPException(status_code=401, detail="Token inválido o expirado.")
 
+def _load_auth_user(username: str):
+    sql = """
+    SELECT rol, sucursal_id, activo, password_changed_at
+    FROM core.usuarios
+    WHERE username = %s;
+    """
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, (username,))
+            return cur.fetchone()
+
+
+def _load_active_branch_ids() -> set[int]:
+    with db_connect(DB_CONNINFO) as conn:
+        rows = conn.execute(
+            "SELECT sucursal_id FROM core.sucursales WHERE COALESCE(activa, true) = true;"
+        ).fetchall()
+    return {int(row[0]) for row in rows}
+
+
 def get_current_user(token: str = Depends(oauth2_scheme)):
     payload = decode_token(token)
     username = payload.get("sub")
@@ -3293,16 +3925,7 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         raise HTTPException(status_code=401, detail="Token inválido.")
 
     # Validar que el usuario siga activo y que no le cambiaron password
-    sql = """
-    SELECT rol, sucursal_id, activo, password_changed_at
-    FROM core.usuarios
-    WHERE username = %s;
-    """
-    with psycopg.connect(DB_CONNINFO) as conn:
-        with conn.cursor() as cur:
-            cur.execute(sql, (username,))
-            row = cur.fetchone()
-
+    row = AUTH_CACHE.get_user(username, _load_auth_user)
     if row is None:
         raise HTTPException(status_code=401, detail="Usuario no existe.")
     db_rol, db_sucursal_id, activo, pwd_changed_at = row
@@ -3336,12 +3959,7 @@ def _resolve_reporting_scope(user: dict[str, Any], raw_scope: str | int | None)
     branch_id = force_sucursal(user, branch_id)
     if branch_id is None:
         raise HTTPException(status_code=400, detail="Sucursal es requerida.")
-    with psycopg.connect(DB_CONNINFO) as conn:
-        row = conn.execute(
-            "SELECT 1 FROM core.sucursales WHERE sucursal_id = %s AND COALESCE(activa, true) = true;",
-            (branch_id,),
-        ).fetchone()
-    if row is None:
+    if int(branch_id) not in AUTH_CACHE.active_branch_ids(_load_active_branch_ids):
         raise HTTPException(status_code=400, detail="Sucursal física inválida.")
     return "branch", branch_id
 
@@ -3370,10 +3988,10 @@ def require_roles(user, allowed: Iterable[str]):
         raise HTTPException(status_code=403, detail="No tienes permisos para esta acción.")
 
 
-app.include_router(create_admin_fulfillment_router(DB_CONNINFO, get_current_user))
-app.include_router(create_optical_operations_router(DB_CONNINFO, get_current_user))
-app.include_router(create_prescription_access_admin_router(DB_CONNINFO, get_current_user))
-app.include_router(create_optical_catalog_admin_router(DB_CONNINFO, get_current_user))
+app.include_router(create_admin_fulfillment_router(DB_CONNINFO, get_current_user, connect=db_connect))
+app.include_router(create_optical_operations_router(DB_CONNINFO, get_current_user, connect=db_connect))
+app.include_router(create_prescription_access_admin_router(DB_CONNINFO, get_current_user, connect=db_connect))
+app.include_router(create_optical_catalog_admin_router(DB_CONNINFO, get_current_user, connect=db_connect))
 
 
 PACIENTE_ESTRELLA_CONSULTAS_6M = 15
@@ -3402,58 +4020,38 @@ def _estado_paciente_desde_metricas(
     return "nuevo"
 
 
+def _actividad_paciente_6m_sql(paciente_col: str, sucursal_param: str | None) -> str:
+    # Métricas de los últimos 6 meses desde core.rpt_paciente_actividad
+    # (mantenida por triggers), a nivel de día local de la sucursal.
+    sucursal_clause = f"AND a.sucursal_id = {sucursal_param}" if sucursal_param else ""
+    return f"""
+    LEFT JOIN LATERAL (
+      SELECT
+        COALESCE(SUM(a.consultas), 0)::int AS consultas_6m,
+        COALESCE(SUM(a.ventas), 0)::int AS ventas_6m,
+        COALESCE(SUM(a.monto_total), 0)::numeric AS monto_6m
+      FROM core.rpt_paciente_actividad a
+      WHERE a.paciente_id = {paciente_col}
+        AND a.dia >= (CURRENT_DATE - INTERVAL '6 months')::date
+        {sucursal_clause}
+    ) act ON true
+    """
+
+
 def _estado_paciente_map(sucursal_id: int | None, paciente_ids: list[int]) -> dict[int, str]:
     ids = sorted({int(pid) for pid in paciente_ids if pid is not None})
     if not ids:
         return {}
 
-    sucursal_consultas_clause = "AND c.sucursal_id = %s" if sucursal_id is not None else ""
-    sucursal_ventas_clause = "AND v.sucursal_id = %s" if sucursal_id is not None else ""
-
     sql = f"""
-    WITH ids AS (
-      SELECT UNNEST(%s::int[]) AS paciente_id
-    ),
-    consultas_agg AS (
-      SELECT c.paciente_id, COUNT(*)::int AS consultas_6m
-      FROM core.consultas c
-      JOIN ids i ON i.paciente_id = c.paciente_id
-      WHERE c.activo = true
-        {sucursal_consultas_clause}
-        AND c.fecha_hora >= (NOW() - INTERVAL '6 months')
-      GROUP BY c.paciente_id
-    ),
-    ventas_agg AS (
-      SELECT
-        v.paciente_id,
-        COUNT(*)::int AS ventas_6m,
-        COALESCE(SUM(v.monto_total), 0)::numeric AS monto_6m
-      FROM core.ventas v
-      JOIN ids i ON i.paciente_id = v.paciente_id
-      WHERE v.activo = true
-        {sucursal_ventas_clause}
-        AND v.fecha_hora >= (NOW() - INTERVAL '6 months')
-      GROUP BY v.paciente_id
-    )
-    SELECT
-      i.paciente_id,
-      COALESCE(ca.consultas_6m, 0) AS consultas_6m,
-      COALESCE(va.ventas_6m, 0) AS ventas_6m,
-      COALESCE(va.monto_6m, 0)::numeric AS monto_6m
-    FROM ids i
-    LEFT JOIN consultas_agg ca ON ca.paciente_id = i.paciente_id
-    LEFT JOIN ventas_agg va ON va.paciente_id = i.paciente_id;
+    SELECT i.paciente_id, act.consultas_6m, act.ventas_6m, act.monto_6m
+    FROM UNNEST(%(ids)s::bigint[]) AS i(paciente_id)
+    {_actividad_paciente_6m_sql("i.paciente_id", "%(sucursal_id)s" if sucursal_id is not None else None)};
     """
 
-    params: list[Any] = [ids]
-    if sucursal_id is not None:
-        params.append(sucursal_id)
-    if sucursal_id is not None:
-        params.append(sucursal_id)
-
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
-            cur.execute(sql, tuple(params))
+            cur.execute(sql, {"ids": ids, "sucursal_id": sucursal_id})
             rows = cur.fetchall()
 
     out: dict[int, str] = {}
@@ -3574,6 +4172,12 @@ def _should_retry_with_primary_calendar(exc: Exception) -> bool:
     )
 
 
+def _is_duplicate_calendar_event(exc: Exception) -> bool:
+    status = getattr(getattr(exc, "resp", None), "status", None)
+    msg = str(exc).lower()
+    return str(status) == "409" or "409" in msg or "duplicate" in msg or "already exists" in msg
+
+
 def _calendar_id_candidates(calendar_id: str | None) -> list[str]:
     candidates: list[str] = []
     if calendar_id and str(calendar_id).strip():
@@ -3892,17 +4496,28 @@ def oauth2_callback(code: str | None = None, state: str | None = None, error: st
     }
 
 
+_GOOGLE_CALENDAR_LIBS: tuple[Any, Any, Any, Any] | None = None
+
+
+def _google_calendar_libs() -> tuple[Any, Any, Any, Any]:
+    global _GOOGLE_CALENDAR_LIBS
+    if _GOOGLE_CALENDAR_LIBS is None:
+        try:
+            from google.oauth2 import service_account
+            from google.oauth2 import credentials as oauth2_credentials
+            from google.auth.transport.requests import Request as GoogleAuthRequest
+            from googleapiclient.discovery import build
+        except Exception:
+            raise HTTPException(
+                status_code=500,
+                detail="Faltan librerías de Google Calendar. Instala: google-api-python-client google-auth.",
+            )
+        _GOOGLE_CALENDAR_LIBS = (service_account, oauth2_credentials, GoogleAuthRequest, build)
+    return _GOOGLE_CALENDAR_LIBS
+
+
 def _get_google_calendar_service(sucursal_id: int | None = None):
-    try:
-        from google.oauth2 import service_account
-        from google.oauth2 import credentials as oauth2_credentials
-        from google.auth.transport.requests import Request as GoogleAuthRequest
-        from googleapiclient.discovery import build
-    except Exception:
-        raise HTTPException(
-            status_code=500,
-            detail="Faltan librerías de Google Calendar. Instala: google-api-python-client google-auth.",
-        )
+    service_account, oauth2_credentials, GoogleAuthRequest, build = _google_calendar_libs()
 
     scopes = ["https://www.googleapis.com/auth/calendar"]
     oauth_client_id = os.getenv("GOOGLE_OAUTH_CLIENT_ID", "").strip()
@@ -3910,19 +4525,32 @@ def _get_google_calendar_service(sucursal_id: int | None = None):
     oauth_token_uri = os.getenv("GOOGLE_OAUTH_TOKEN_URI", "https://oauth2.googleapis.com/token").strip()
     oauth_refresh_token = _refresh_token_for_sucursal(sucursal_id)
 
+    def build_service(creds):
+        return build("calendar", "v3", credentials=creds, cache_discovery=False)
+
+    def refresh(creds):
+        creds.refresh(GoogleAuthRequest())
+
+    def fingerprint(*parts: str) -> str:
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
     # Preferir OAuth si está configurado (útil cuando no hay service account/key).
     if oauth_client_id and oauth_client_secret and oauth_refresh_token:
         try:
-            creds = oauth2_credentials.Credentials(
-                token=None,
-                refresh_token=oauth_refresh_token,
-                token_uri=oauth_token_uri,
-                client_id=oauth_client_id,
-                client_secret=oauth_client_secret,
-                scopes=scopes,
-            )
-            creds.refresh(GoogleAuthRequest())
-            return build("calendar", "v3", credentials=creds, cache_discovery=False)
+            return GOOGLE_CALENDAR_CLIENTS.service(
+                f"oauth:{sucursal_id}",
+                fingerprint(oauth_client_id, oauth_client_secret, oauth_token_uri, oauth_refresh_token),
+                create_credentials=lambda: oauth2_credentials.Credentials(
+                    token=None,
+                    refresh_token=oauth_refresh_token,
+                    token_uri=oauth_token_uri,
+                    client_id=oauth_client_id,
+                    client_secret=oauth_client_secret,
+                    scopes=scopes,
+                ),
+                refresh=refresh,
+                build=build_service,
+            )
         except Exception as e:
             _raise_google_calendar_error(e)
 
@@ -3930,11 +4558,25 @@ def _get_google_calendar_service(sucursal_id: int | None = None):
     creds_json = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON", "").strip()
     try:
         if creds_json:
-            creds = service_account.Credentials.from_service_account_info(json.loads(creds_json), scopes=scopes)
-            return build("calendar", "v3", credentials=creds, cache_discovery=False)
+            return GOOGLE_CALENDAR_CLIENTS.service(
+                "service_account",
+                fingerprint("json", creds_json),
+                create_credentials=lambda: service_account.Credentials.from_service_account_info(
+                    json.loads(creds_json), scopes=scopes
+                ),
+                refresh=refresh,
+                build=build_service,
+            )
         if creds_file and os.path.isfile(creds_file) and os.path.getsize(creds_file) > 0:
-            creds = service_account.Credentials.from_service_account_file(creds_file, scopes=scopes)
-            return build("calendar", "v3", credentials=creds, cache_discovery=False)
+            return GOOGLE_CALENDAR_CLIENTS.service(
+                "service_account",
+                fingerprint("file", creds_file, str(os.path.getmtime(creds_file))),
+                create_credentials=lambda: service_account.Credentials.from_service_account_file(
+                    creds_file, scopes=scopes
+                ),
+                refresh=refresh,
+                build=build_service,
+            )
     except Exception as e:
         _raise_google_calendar_error(e)
 
@@ -4014,7 +4656,7 @@ def agenda_test(sucursal_id: int, user=Depends(get_current_user)):
 
 
 def _timezone_for_sucursal(sucursal_id: int) -> str:
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -4127,7 +4769,7 @@ def _fetch_busy_intervals_consultas(
     sql += " ORDER BY agenda_inicio ASC"
 
     busy: list[tuple[datetime, datetime]] = []
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(sql, tuple(params))
             rows = cur.fetchall()
@@ -4223,7 +4865,9 @@ def _create_calendar_event_for_consulta(
     doctor_nombre: str | None,
     sucursal_nombre: str | None,
     sucursal_location: str | None,
+    event_id: str | None = None,
 ) -> tuple[str, str | None]:
+    # Con event_id el alta es idempotente: si el evento ya existe se actualiza.
     tz_name = _timezone_for_sucursal(sucursal_id)
     cal_id = _calendar_id_for_sucursal(sucursal_id)
     calendar_candidates = _calendar_id_candidates(cal_id)
@@ -4293,6 +4937,8 @@ def _create_calendar_event_for_consulta(
         body["location"] = final_location
     if _looks_like_email(paciente_correo):
         body["attendees"] = [{"email": str(paciente_correo).strip()}]
+    if event_id:
+        body["id"] = event_id
 
     last_exc: Exception | None = None
     for idx, current_calendar_id in enumerate(calendar_candidates):
@@ -4300,6 +4946,17 @@ def _create_calendar_event_for_consulta(
             created = service.events().insert(calendarId=current_calendar_id, body=body, sendUpdates="all").execute()
             return str(created.get("id", "")), str(current_calendar_id)
         except Exception as e:
+            if event_id and _is_duplicate_calendar_event(e):
+                try:
+                    updated = service.events().update(
+                        calendarId=current_calendar_id,
+                        eventId=event_id,
+                        body=body,
+                        sendUpdates="all",
+                    ).execute()
+                    return str(updated.get("id", event_id)), str(current_calendar_id)
+                except Exception as update_exc:
+                    e = update_exc
             last_exc = e
             has_next = idx < (len(calendar_candidates) - 1)
             if has_next and _should_retry_with_primary_calendar(e):
@@ -4361,6 +5018,73 @@ def _delete_calendar_event_for_consulta(
     return False
 
 
+def _sync_consulta_calendar(job: dict[str, Any]) -> tuple[str | None, str | None]:
+    """Lleva a Google Calendar el estado actual de una consulta encolada."""
+    consulta_id = int(job["consulta_id"])
+    sucursal_id = int(job["sucursal_id"])
+    if job["operacion"] == "eliminar":
+        _delete_calendar_event_for_consulta(
+            sucursal_id=sucursal_id,
+            event_id=str(job.get("evento_id") or calendar_event_id(consulta_id)),
+            calendar_id_hint=job.get("calendario_id"),
+        )
+        return None, None
+    # Con el calendario apagado no se crean eventos; las bajas de eventos ya
+    # existentes sí se atienden, como antes de la cola.
+    if not _calendar_feature_enabled():
+        return None, None
+
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT c.paciente_id, c.agenda_inicio, c.agenda_fin, c.etapa_consulta,
+                       c.motivo_consulta, c.tipo_consulta, c.doctor_primer_nombre,
+                       c.doctor_apellido_paterno, c.agenda_event_id,
+                       p.primer_nombre, p.segundo_nombre, p.apellido_paterno,
+                       p.apellido_materno, p.correo,
+                       s.nombre, s.ciudad, s.estado
+                FROM core.consultas c
+                JOIN core.pacientes p ON p.paciente_id = c.paciente_id
+                JOIN core.sucursales s ON s.sucursal_id = c.sucursal_id
+                WHERE c.consulta_id = %s AND c.sucursal_id = %s AND c.activo = true;
+                """,
+                (consulta_id, sucursal_id),
+            )
+            row = cur.fetchone()
+    # Consulta borrada o sin horario: no hay evento que sincronizar.
+    if row is None or row[1] is None or row[2] is None:
+        return None, None
+
+    ciudad = str(row[15]).strip() if row[15] else ""
+    estado = str(row[16]).strip() if row[16] else ""
+    return _create_calendar_event_for_consulta(
+        consulta_id=consulta_id,
+        sucursal_id=sucursal_id,
+        start_dt=row[1],
+        end_dt=row[2],
+        paciente_id=int(row[0]),
+        paciente_nombre=" ".join([x for x in row[9:13] if x and str(x).strip()]),
+        paciente_correo=str(row[13]).strip() if row[13] else None,
+        tipo_consulta=compose_consulta_tipo(row[3], row[4]) or row[5],
+        doctor_id=job.get("solicitado_por") or "",
+        doctor_nombre=" ".join([x for x in row[6:8] if x and str(x).strip()]),
+        sucursal_nombre=str(row[14]).strip() if row[14] else None,
+        sucursal_location=", ".join([x for x in [ciudad, estado] if x]) or None,
+        event_id=str(job.get("evento_id") or row[8] or calendar_event_id(consulta_id)),
+    )
+
+
+# Altas, cambios y bajas de consultas solo encolan; este worker llama a Google
+# fuera de la petición, con reintentos (ver calendar_outbox.py).
+CALENDAR_OUTBOX = CalendarOutboxWorker(
+    DB_CONNINFO,
+    _sync_consulta_calendar,
+    CalendarOutboxConfig.from_env(),
+    connect=db_connect,
+)
+
+
 def _validate_in_business_hours(sucursal_id: int, start_dt: datetime, end_dt: datetime):
     tz_name = _timezone_for_sucursal(sucursal_id)
     tz = ZoneInfo(tz_name)
@@ -4417,7 +5141,7 @@ def me(token: str = Depends(oauth2_scheme)):
     LIMIT 1;
     """
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(sql, (username,))
             row = cur.fetchone()
@@ -4456,56 +5180,56 @@ def listar_pacientes(
     sucursal_id = force_sucursal(user, sucursal_id)
 
     # Por defecto se listan solo pacientes creados hoy.
-    where = ["activo = true"]
+    where = ["p.activo = true"]
     params = []
 
     if sucursal_id is not None:
-        where.append("sucursal_id = %s")
+        where.append("p.sucursal_id = %s")
         params.append(sucursal_id)
 
     if mes is not None and (mes < 1 or mes > 12):
         raise HTTPException(status_code=400, detail="Mes inválido. Debe ser entre 1 y 12.")
 
-    if fecha_desde and fecha_hasta:
-        where.append("DATE(creado_en) BETWEEN %s AND %s")
-        params.extend([fecha_desde, fecha_hasta])
-    elif fecha_desde:
-        where.append("DATE(creado_en) >= %s")
-        params.append(fecha_desde)
-    elif fecha_hasta:
-        where.append("DATE(creado_en) <= %s")
-        params.append(fecha_hasta)
-    elif anio is not None and mes is not None:
-        where.append("EXTRACT(YEAR FROM creado_en) = %s")
-        where.append("EXTRACT(MONTH FROM creado_en) = %s")
-        params.extend([anio, mes])
-    elif anio is not None:
-        where.append("EXTRACT(YEAR FROM creado_en) = %s")
-        params.append(anio)
-    else:
-        where.append("DATE(creado_en) = CURRENT_DATE")
+    tz_name = _timezone_for_sucursal(sucursal_id) if sucursal_id is not None else "America/Mexico_City"
+    fecha_where, fecha_params = _fecha_local_filtro(
+        "p.fecha_local",
+        fecha_desde=fecha_desde,
+        fecha_hasta=fecha_hasta,
+        anio=anio,
+        mes=mes,
+        hoy=datetime.now(ZoneInfo(tz_name)).date(),
+    )
+    where.extend(fecha_where)
+    params.extend(fecha_params)
 
     where_sql = "WHERE " + " AND ".join(where)
 
+    # El estado (estrella/intermedio/nuevo) sale en la misma consulta.
     sql = f"""
-    SELECT paciente_id, primer_nombre, segundo_nombre, apellido_paterno, apellido_materno,
-           fecha_nacimiento, sexo, telefono, correo, como_nos_conocio,
-           creado_en,
-           calle, numero, colonia, cp, municipio, estado, pais
-    FROM core.pacientes
-    {where_sql}
-    ORDER BY creado_en DESC, paciente_id DESC
-    LIMIT %s;
+    SELECT p.paciente_id, p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno,
+           p.fecha_nacimiento, p.sexo, p.telefono, p.correo, p.como_nos_conocio,
+           p.creado_en,
+           p.calle, p.numero, p.colonia, p.cp, p.municipio, p.estado, p.pais,
+           act.consultas_6m, act.ventas_6m, act.monto_6m
+    FROM (
+      SELECT p.*
+      FROM core.pacientes p
+      {where_sql}
+      ORDER BY p.creado_en DESC, p.paciente_id DESC
+      LIMIT %s
+    ) p
+    {_actividad_paciente_6m_sql("p.paciente_id", "%s" if sucursal_id is not None else None)}
+    ORDER BY p.creado_en DESC, p.paciente_id DESC;
     """
     params.append(limit)
+    if sucursal_id is not None:
+        params.append(sucursal_id)
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(sql, tuple(params))
             rows = cur.fetchall()
 
-    estado_map = _estado_paciente_map(sucursal_id, [int(r[0]) for r in rows])
-
     return [
         {
             "paciente_id": r[0],
@@ -4528,7 +5252,7 @@ def listar_pacientes(
             "estado": r[16],
             "estado_direccion": r[16],
             "pais": r[17],
-            "estado_paciente": estado_map.get(int(r[0]), "nuevo"),
+            "estado_paciente": _estado_paciente_desde_metricas(int(r[18] or 0), int(r[19] or 0), float(r[20] or 0)),
         }
         for r in rows
     ]
@@ -4549,66 +5273,77 @@ def buscar_pacientes(
     if limit < 1 or limit > 200:
         raise HTTPException(status_code=400, detail="limit inválido (1-200).")
 
-    q_clean = q.strip()
-    q_like = f"%{q_clean}%"
-    q_prefix = f"{q_clean}%"
+    q_clean = " ".join(q.split())
     where = ["p.activo = true"]
-    where_params: list[Any] = []
+    where_params: dict[str, Any] = {}
 
     if sucursal_id is not None:
-        where.append("p.sucursal_id = %s")
-        where_params.append(sucursal_id)
-
-    where.append(
-        """(
-            CAST(p.paciente_id AS TEXT) ILIKE %s
-            OR p.primer_nombre ILIKE %s
-            OR COALESCE(p.segundo_nombre, '') ILIKE %s
-            OR p.apellido_paterno ILIKE %s
-            OR COALESCE(p.apellido_materno, '') ILIKE %s
-            OR COALESCE(p.telefono, '') ILIKE %s
-            OR COALESCE(p.correo, '') ILIKE %s
-            OR CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) ILIKE %s
-        )"""
-    )
-    where_params.extend([q_like, q_like, q_like, q_like, q_like, q_like, q_like, q_like])
+        where.append("p.sucursal_id = %(sucursal_id)s")
+        where_params["sucursal_id"] = sucursal_id
 
-    sql = f"""
-    SELECT
-      p.paciente_id, p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno,
-      p.fecha_nacimiento, p.sexo, p.telefono, p.correo,
-      p.calle, p.numero, p.colonia, p.cp, p.municipio, p.estado, p.pais,
-      CASE
-        WHEN CAST(p.paciente_id AS TEXT) ILIKE %s THEN 0
-        WHEN p.primer_nombre ILIKE %s THEN 1
-        WHEN COALESCE(p.segundo_nombre, '') ILIKE %s THEN 2
-        WHEN p.apellido_paterno ILIKE %s THEN 3
-        WHEN COALESCE(p.apellido_materno, '') ILIKE %s THEN 4
-        WHEN CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) ILIKE %s THEN 5
-        ELSE 9
-      END AS orden_busqueda
-    FROM core.pacientes p
-    WHERE {" AND ".join(where)}
-    ORDER BY orden_busqueda ASC, p.creado_en DESC, p.paciente_id DESC
-    LIMIT %s;
-    """
-    params = [
-        q_prefix,
-        q_prefix,
-        q_prefix,
-        q_prefix,
-        q_prefix,
-        q_prefix,
-        *where_params,
-        limit,
-    ]
+    where_sql = " AND ".join(where)
+    actividad_sql = _actividad_paciente_6m_sql("p.paciente_id", "%(sucursal_id)s" if sucursal_id is not None else None)
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    def select_sql(match_sql: str, rank_sql: str, rank_order: str) -> str:
+        # Filtro, orden y LIMIT sobre core.pacientes primero; las métricas de
+        # actividad solo se calculan para la página, como en listar_pacientes.
+        return f"""
+        SELECT
+          p.paciente_id, p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno,
+          p.fecha_nacimiento, p.sexo, p.telefono, p.correo,
+          p.calle, p.numero, p.colonia, p.cp, p.municipio, p.estado, p.pais,
+          act.consultas_6m, act.ventas_6m, act.monto_6m
+        FROM (
+          SELECT p.*, {rank_sql}
+          FROM core.pacientes p
+          WHERE {where_sql}
+            AND ({match_sql})
+          ORDER BY {rank_order}, p.creado_en DESC, p.paciente_id DESC
+          LIMIT %(limit)s
+        ) p
+        {actividad_sql}
+        ORDER BY {rank_order}, p.creado_en DESC, p.paciente_id DESC;
+        """
+
+    # Un folio o teléfono completo resuelve por índice exacto sin pasar por
+    # la búsqueda aproximada.
+    q_digits = re.sub(r"\D", "", q_clean) if re.fullmatch(r"[\d\s()+.\-]+", q_clean) else ""
+    rows: list[tuple[Any, ...]] = []
+
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
-            cur.execute(sql, tuple(params))
-            rows = cur.fetchall()
+            if q_digits:
+                cur.execute(
+                    select_sql(
+                        "p.paciente_id = %(q_id)s OR p.telefono_digitos = %(q_digits)s",
+                        "(p.paciente_id = %(q_id)s) AS es_folio",
+                        "es_folio DESC",
+                    ),
+                    {
+                        **where_params,
+                        "q_id": int(q_digits) if len(q_digits) <= 18 else None,
+                        "q_digits": q_digits,
+                        "limit": limit,
+                    },
+                )
+                rows = cur.fetchall()
 
-    estado_map = _estado_paciente_map(sucursal_id, [int(r[0]) for r in rows])
+            if not rows:
+                # `busqueda` ya viene sin acentos y en minúsculas; LIKE y `<%`
+                # usan el índice trigram y el orden es por similitud.
+                q_text = q_digits or q_clean
+                q_pattern = "%" + re.sub(r"([\\%_])", r"\\\1", q_text) + "%"
+                cur.execute(
+                    select_sql(
+                        "p.busqueda LIKE core.fn_texto_busqueda(%(q_pattern)s) "
+                        "OR core.fn_texto_busqueda(%(q_text)s) <%% p.busqueda",
+                        "word_similarity(core.fn_texto_busqueda(%(q_text)s), p.busqueda) AS similitud_palabra, "
+                        "similarity(core.fn_texto_busqueda(%(q_text)s), p.busqueda) AS similitud",
+                        "similitud_palabra DESC, similitud DESC",
+                    ),
+                    {**where_params, "q_text": q_text, "q_pattern": q_pattern, "limit": limit},
+                )
+                rows = cur.fetchall()
 
     return [
         {
@@ -4630,7 +5365,7 @@ def buscar_pacientes(
             "estado": r[14],
             "estado_direccion": r[14],
             "pais": r[15],
-            "estado_paciente": estado_map.get(int(r[0]), "nuevo"),
+            "estado_paciente": _estado_paciente_desde_metricas(int(r[16] or 0), int(r[17] or 0), float(r[18] or 0)),
         }
         for r in rows
     ]
@@ -4655,7 +5390,7 @@ def listar_sucursales():
     FROM core.sucursales
     ORDER BY sucursal_id;
     """
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(sql)
             rows = cur.fetchall()
@@ -4713,7 +5448,7 @@ def crear_paciente(p: PacienteCreate, user=Depends(get_current_user)):
     RETURNING paciente_id;
     """
     try:
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
 
 
@@ -4913,7 +5648,7 @@ def listar_inventario_catalogo(
         where.append("producto.categoria = %s")
         params.append(normalize_controlled_token(categoria))
     where_sql = " AND ".join(where) if where else "true"
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 f"""
@@ -5006,7 +5741,7 @@ def actualizar_comercio_online_producto(
             detail="La cantidad máxima debe quedar vacía o ser un entero positivo.",
         )
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -5137,7 +5872,7 @@ def listar_movimientos_catalogo(
     sucursal_id = force_sucursal(user, sucursal_id)
     if sucursal_id is None:
         raise HTTPException(status_code=400, detail="Sucursal es requerida.")
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -5250,7 +5985,7 @@ def actualizar_stock_catalogo(
     sucursal_id = force_sucursal(user, sucursal_id)
     if sucursal_id is None:
         raise HTTPException(status_code=400, detail="Sucursal es requerida.")
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             stock = _phase1b_update_inventory(
                 cur, producto_id, sucursal_id, data.expected_stock, data.stock, user,
@@ -5275,7 +6010,7 @@ def actualizar_producto_catalogo(
         raise HTTPException(status_code=400, detail="El precio no puede ser negativo.")
     if data.costo_unitario is not None and data.costo_unitario < 0:
         raise HTTPException(status_code=400, detail="El costo no puede ser negativo.")
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 "SELECT controla_stock FROM core.catalogo_productos WHERE producto_id = %s FOR UPDATE;",
@@ -5345,7 +6080,7 @@ def registrar_movimiento_catalogo(
         target_stock = int(data.expected_stock) + int(data.cantidad)
     if tipo == "entrada_compra" and (data.costo_unitario is None or data.costo_unitario < 0):
         raise HTTPException(status_code=400, detail="El costo unitario es requerido para una compra.")
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             stock = _phase1b_update_inventory(
                 cur, producto_id, data.sucursal_id, data.expected_stock, target_stock, user,
@@ -5368,7 +6103,7 @@ def registrar_movimiento_catalogo(
 @app.get("/pacientes/{paciente_id}/prescripciones-opticas", summary="Listar recetas ópticas del paciente")
 def listar_prescripciones_opticas(paciente_id: int, user=Depends(get_current_user)):
     require_roles(user, ("admin", "recepcion", "doctor"))
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             _phase1b_patient_row(cur, paciente_id)
             cur.execute(
@@ -5420,7 +6155,7 @@ def crear_prescripcion_optica(
             fecha = date.fromisoformat(data.fecha_prescripcion)
         except ValueError:
             raise HTTPException(status_code=400, detail="Fecha de receta inválida.")
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             _phase1b_patient_row(cur, paciente_id, lock=True)
             if data.historia_id is not None:
@@ -5912,6 +6647,97 @@ def _phase1b_purchase_tokens(lines: list[dict[str, Any]], configs: list[dict[str
     return "|".join(dict.fromkeys(tokens))
 
 
+def _phase1b_apply_inventory_changes(
+    cur,
+    *,
+    sucursal_id: int,
+    changes: list[dict[str, Any]],
+    username: str,
+    missing_detail: str,
+) -> list[dict[str, Any]]:
+    """Aplica en bloque cambios de stock de `catalogo_inventario_sucursal`.
+
+    Cada cambio trae `producto_id`, `cantidad` (con signo, sobre el stock),
+    `tipo`, `fuente_tipo`, `fuente_id`, `notas` y opcionalmente
+    `clave_idempotencia`. Las filas se bloquean en un solo SELECT ordenado por
+    producto, se validan en memoria en el orden recibido y se escriben con un
+    UPDATE y un INSERT de movimientos, sin ida y vuelta por producto.
+    """
+    if not changes:
+        return []
+    product_ids = sorted({int(change["producto_id"]) for change in changes})
+    cur.execute(
+        """
+        SELECT producto_id, stock, stock_reservado
+        FROM core.catalogo_inventario_sucursal
+        WHERE sucursal_id = %s AND producto_id = ANY(%s::bigint[])
+        ORDER BY producto_id
+        FOR UPDATE;
+        """,
+        (sucursal_id, product_ids),
+    )
+    inventory = {int(row[0]): [int(row[1]), int(row[2])] for row in cur.fetchall()}
+    if len(inventory) != len(product_ids):
+        raise HTTPException(status_code=409, detail=missing_detail)
+
+    movements: list[dict[str, Any]] = []
+    for change in changes:
+        product_id = int(change["producto_id"])
+        quantity = int(change["cantidad"])
+        before, reserved = inventory[product_id]
+        after = before + quantity
+        if quantity < 0 and before - reserved < -quantity:
+            raise HTTPException(status_code=409, detail=f"Stock insuficiente para el producto #{product_id}. Disponible para venta: {before - reserved}.")
+        if after < reserved:
+            raise HTTPException(status_code=409, detail=f"El ajuste dejaría comprometido el inventario reservado del producto #{product_id}.")
+        inventory[product_id][0] = after
+        movements.append({**change, "producto_id": product_id, "stock_anterior": before, "stock_nuevo": after})
+
+    touched = sorted({movement["producto_id"] for movement in movements})
+    cur.execute(
+        """
+        UPDATE core.catalogo_inventario_sucursal inventario
+        SET stock = cambio.stock, version = inventario.version + 1, updated_at = NOW()
+        FROM unnest(%s::bigint[], %s::integer[]) AS cambio(producto_id, stock)
+        WHERE inventario.sucursal_id = %s AND inventario.producto_id = cambio.producto_id;
+        """,
+        (touched, [inventory[product_id][0] for product_id in touched], sucursal_id),
+    )
+    cur.execute(
+        """
+        INSERT INTO core.catalogo_inventario_movimientos (
+            producto_id, sucursal_id, tipo, cantidad, stock_anterior, stock_nuevo,
+            fuente_tipo, fuente_id, clave_idempotencia, notas, created_by
+        )
+        SELECT movimiento.producto_id, %s::bigint, movimiento.tipo, movimiento.cantidad,
+               movimiento.stock_anterior, movimiento.stock_nuevo, movimiento.fuente_tipo,
+               movimiento.fuente_id, movimiento.clave_idempotencia, movimiento.notas, %s::text
+        FROM unnest(
+            %s::bigint[], %s::text[], %s::integer[], %s::integer[], %s::integer[],
+            %s::text[], %s::bigint[], %s::text[], %s::text[]
+        ) WITH ORDINALITY AS movimiento(
+            producto_id, tipo, cantidad, stock_anterior, stock_nuevo,
+            fuente_tipo, fuente_id, clave_idempotencia, notas, orden
+        )
+        ORDER BY movimiento.orden;
+        """,
+        (
+            sucursal_id,
+            username,
+            [movement["producto_id"] for movement in movements],
+            [movement["tipo"] for movement in movements],
+            [int(movement["cantidad"]) for movement in movements],
+            [movement["stock_anterior"] for movement in movements],
+            [movement["stock_nuevo"] for movement in movements],
+            [movement["fuente_tipo"] for movement in movements],
+            [movement["fuente_id"] for movement in movements],
+            [movement.get("clave_idempotencia") for movement in movements],
+            [movement["notas"] for movement in movements],
+        ),
+    )
+    return movements
+
+
 def _phase1b_apply_inventory_delta(
     cur,
     *,
@@ -5931,49 +6757,26 @@ def _phase1b_apply_inventory_delta(
         if line["controla_stock"] and line["comportamiento_abasto"] == "inventario":
             new_quantities[line["producto_id"]] = new_quantities.get(line["producto_id"], 0) + line["cantidad"]
 
+    changes = []
     for product_id in sorted(set(old_quantities) | set(new_quantities)):
         delta_sale = new_quantities.get(product_id, 0) - old_quantities.get(product_id, 0)
         if delta_sale == 0:
             continue
-        cur.execute(
-            """
-            SELECT stock, stock_reservado
-            FROM core.catalogo_inventario_sucursal
-            WHERE producto_id = %s AND sucursal_id = %s
-            FOR UPDATE;
-            """,
-            (product_id, sucursal_id),
-        )
-        row = cur.fetchone()
-        if row is None:
-            raise HTTPException(status_code=409, detail="Falta inventario por sucursal para un producto físico.")
-        before = int(row[0])
-        reserved = int(row[1])
-        after = before - delta_sale
-        if delta_sale > 0 and before - reserved < delta_sale:
-            raise HTTPException(status_code=409, detail=f"Stock insuficiente para el producto #{product_id}. Disponible para venta: {before - reserved}.")
-        if after < reserved:
-            raise HTTPException(status_code=409, detail=f"El ajuste dejaría comprometido el inventario reservado del producto #{product_id}.")
-        cur.execute(
-            """
-            UPDATE core.catalogo_inventario_sucursal
-            SET stock = %s, version = version + 1, updated_at = NOW()
-            WHERE producto_id = %s AND sucursal_id = %s;
-            """,
-            (after, product_id, sucursal_id),
-        )
-        cur.execute(
-            """
-            INSERT INTO core.catalogo_inventario_movimientos (
-                producto_id, sucursal_id, tipo, cantidad, stock_anterior, stock_nuevo,
-                fuente_tipo, fuente_id, notas, created_by
-            ) VALUES (%s, %s, %s, %s, %s, %s, 'venta', %s, %s, %s);
-            """,
-            (
-                product_id, sucursal_id, movement_type, -delta_sale, before, after,
-                venta_id, f"Venta global #{venta_id}", username,
-            ),
-        )
+        changes.append({
+            "producto_id": product_id,
+            "cantidad": -delta_sale,
+            "tipo": movement_type,
+            "fuente_tipo": "venta",
+            "fuente_id": venta_id,
+            "notas": f"Venta global #{venta_id}",
+        })
+    _phase1b_apply_inventory_changes(
+        cur,
+        sucursal_id=sucursal_id,
+        changes=changes,
+        username=username,
+        missing_detail="Falta inventario por sucursal para un producto físico.",
+    )
 
 
 def _phase1b_write_payments(
@@ -6178,7 +6981,14 @@ def _phase1b_insert_discount_rows(
             )
 
 
-def _phase1b_sale_detail(cur, venta_id: int, role: str) -> dict[str, Any]:
+def _phase1b_sale_details(cur, venta_ids: list[int], role: str) -> dict[int, dict[str, Any]]:
+    """Detalle de varias ventas de catálogo con cinco consultas en total.
+
+    Las ventas sin contexto de catálogo (Fase 1B) no aparecen en el resultado.
+    """
+    venta_ids = sorted({int(venta_id) for venta_id in venta_ids})
+    if not venta_ids:
+        return {}
     cur.execute(
         """
         SELECT venta.venta_id, venta.fecha_hora, venta.paciente_id,
@@ -6193,27 +7003,28 @@ def _phase1b_sale_detail(cur, venta_id: int, role: str) -> dict[str, Any]:
         JOIN core.venta_catalogo_contextos contexto ON contexto.venta_id = venta.venta_id
         JOIN core.pacientes paciente ON paciente.paciente_id = venta.paciente_id
         JOIN core.sucursales sucursal ON sucursal.sucursal_id = venta.sucursal_id
-        WHERE venta.venta_id = %s;
+        WHERE venta.venta_id = ANY(%s::bigint[]);
         """,
-        (venta_id,),
+        (venta_ids,),
     )
-    header = cur.fetchone()
-    if header is None:
-        raise HTTPException(status_code=404, detail="Venta de catálogo no existe.")
+    headers = cur.fetchall()
+    if not headers:
+        return {}
     cur.execute(
         """
-        SELECT pago_id, metodo, monto, referencia, created_at
+        SELECT pago_id, metodo, monto, referencia, created_at, venta_id
         FROM core.venta_pagos
-        WHERE venta_id = %s AND activo = true
-        ORDER BY created_at, pago_id;
+        WHERE venta_id = ANY(%s::bigint[]) AND activo = true
+        ORDER BY venta_id, created_at, pago_id;
         """,
-        (venta_id,),
+        (venta_ids,),
     )
-    payments = [
-        {"pago_id": int(row[0]), "metodo": row[1], "monto": float(row[2]),
-         "referencia": row[3], "fecha_hora": str(row[4])}
-        for row in cur.fetchall()
-    ]
+    payments_by_sale: dict[int, list[dict[str, Any]]] = {}
+    for row in cur.fetchall():
+        payments_by_sale.setdefault(int(row[5]), []).append(
+            {"pago_id": int(row[0]), "metodo": row[1], "monto": float(row[2]),
+             "referencia": row[3], "fecha_hora": str(row[4])}
+        )
     cur.execute(
         """
         SELECT detalle.venta_catalogo_detalle_id, detalle.linea_ref,
@@ -6224,7 +7035,8 @@ def _phase1b_sale_detail(cur, venta_id: int, role: str) -> dict[str, Any]:
                detalle.precio_unitario_snapshot, detalle.costo_unitario_snapshot,
                detalle.subtotal_bruto_snapshot, detalle.estado_registro,
                detalle.cantidad_cancelada, imagen.url,
-               config.configuracion_ref, variante.codigo, variante.nombre
+               config.configuracion_ref, variante.codigo, variante.nombre,
+               detalle.venta_id
         FROM core.venta_catalogo_detalles detalle
         LEFT JOIN core.venta_configuraciones_opticas config
           ON config.configuracion_id = detalle.configuracion_id
@@ -6235,14 +7047,14 @@ def _phase1b_sale_detail(cur, venta_id: int, role: str) -> dict[str, Any]:
             WHERE producto_id = detalle.producto_id AND activo = true
             ORDER BY es_principal DESC, display_order, producto_imagen_id LIMIT 1
         ) imagen ON true
-        WHERE detalle.venta_id = %s AND detalle.estado_registro <> 'reemplazado'
-        ORDER BY detalle.venta_catalogo_detalle_id;
+        WHERE detalle.venta_id = ANY(%s::bigint[]) AND detalle.estado_registro <> 'reemplazado'
+        ORDER BY detalle.venta_id, detalle.venta_catalogo_detalle_id;
         """,
-        (venta_id,),
+        (venta_ids,),
     )
-    products = []
+    products_by_sale: dict[int, list[dict[str, Any]]] = {}
     for row in cur.fetchall():
-        products.append({
+        products_by_sale.setdefault(int(row[20]), []).append({
             "venta_catalogo_detalle_id": int(row[0]), "linea_ref": row[1],
             "tipo_linea": row[2], "producto_id": int(row[3]), "variante_id": int(row[4]) if row[4] else None,
             "sku": row[5], "nombre": row[6], "descripcion": row[7], "categoria": row[8],
@@ -6263,14 +7075,14 @@ def _phase1b_sale_detail(cur, venta_id: int, role: str) -> dict[str, Any]:
                precio_tratamiento_snapshot, precio_variante_snapshot,
                costo_armazon_snapshot, costo_diseno_snapshot,
                costo_tratamiento_snapshot, costo_variante_snapshot,
-               subtotal_bruto_snapshot, estado_registro
+               subtotal_bruto_snapshot, estado_registro, venta_id
         FROM core.venta_configuraciones_opticas
-        WHERE venta_id = %s AND estado_registro <> 'reemplazado'
-        ORDER BY configuracion_id;
+        WHERE venta_id = ANY(%s::bigint[]) AND estado_registro <> 'reemplazado'
+        ORDER BY venta_id, configuracion_id;
         """,
-        (venta_id,),
+        (venta_ids,),
     )
-    configurations = []
+    configurations_by_sale: dict[int, list[dict[str, Any]]] = {}
     for row in cur.fetchall():
         config = {
             "configuracion_id": int(row[0]), "configuracion_ref": row[1],
@@ -6296,7 +7108,7 @@ def _phase1b_sale_detail(cur, venta_id: int, role: str) -> dict[str, Any]:
                 "costo_tratamiento_snapshot": float(row[20]) if row[20] is not None else None,
                 "costo_variante_snapshot": float(row[21]) if row[21] is not None else None,
             })
-        configurations.append(config)
+        configurations_by_sale.setdefault(int(row[24]), []).append(config)
     cur.execute(
         """
         SELECT descuento.descuento_id, descuento.descuento_ref, descuento.tipo,
@@ -6306,7 +7118,8 @@ def _phase1b_sale_detail(cur, venta_id: int, role: str) -> dict[str, Any]:
                COALESCE(array_agg(DISTINCT config.configuracion_ref)
                         FILTER (WHERE config.configuracion_ref IS NOT NULL), ARRAY[]::text[]),
                COALESCE(array_agg(DISTINCT detalle.linea_ref)
-                        FILTER (WHERE detalle.linea_ref IS NOT NULL), ARRAY[]::text[])
+                        FILTER (WHERE detalle.linea_ref IS NOT NULL), ARRAY[]::text[]),
+               descuento.venta_id
         FROM core.venta_descuentos descuento
         LEFT JOIN core.venta_descuento_objetivos objetivo
           ON objetivo.descuento_id = descuento.descuento_id
@@ -6314,22 +7127,46 @@ def _phase1b_sale_detail(cur, venta_id: int, role: str) -> dict[str, Any]:
           ON config.configuracion_id = objetivo.configuracion_id
         LEFT JOIN core.venta_catalogo_detalles detalle
           ON detalle.venta_catalogo_detalle_id = objetivo.venta_catalogo_detalle_id
-        WHERE descuento.venta_id = %s AND descuento.estado = 'activo'
-        GROUP BY descuento.descuento_id
-        ORDER BY descuento.orden_aplicacion;
-        """,
-        (venta_id,),
-    )
-    discounts = [
-        {
-            "descuento_id": int(row[0]), "descuento_ref": row[1], "tipo": row[2],
-            "valor": float(row[3]), "motivo": row[4], "motivo_otro": row[5],
-            "cupon_tipo": row[6], "alcance": row[7], "orden_aplicacion": int(row[8]),
-            "base_elegible": float(row[9]), "monto_aplicado": float(row[10]),
-            "configuracion_refs": list(row[11] or []), "linea_refs": list(row[12] or []),
-        }
-        for row in cur.fetchall()
-    ]
+        WHERE descuento.venta_id = ANY(%s::bigint[]) AND descuento.estado = 'activo'
+        GROUP BY descuento.descuento_id
+        ORDER BY descuento.venta_id, descuento.orden_aplicacion;
+        """,
+        (venta_ids,),
+    )
+    discounts_by_sale: dict[int, list[dict[str, Any]]] = {}
+    for row in cur.fetchall():
+        discounts_by_sale.setdefault(int(row[13]), []).append(
+            {
+                "descuento_id": int(row[0]), "descuento_ref": row[1], "tipo": row[2],
+                "valor": float(row[3]), "motivo": row[4], "motivo_otro": row[5],
+                "cupon_tipo": row[6], "alcance": row[7], "orden_aplicacion": int(row[8]),
+                "base_elegible": float(row[9]), "monto_aplicado": float(row[10]),
+                "configuracion_refs": list(row[11] or []), "linea_refs": list(row[12] or []),
+            }
+        )
+    details: dict[int, dict[str, Any]] = {}
+    for header in headers:
+        venta_id = int(header[0])
+        details[venta_id] = _phase1b_sale_detail_payload(
+            header,
+            role,
+            payments=payments_by_sale.get(venta_id, []),
+            products=products_by_sale.get(venta_id, []),
+            configurations=configurations_by_sale.get(venta_id, []),
+            discounts=discounts_by_sale.get(venta_id, []),
+        )
+    return details
+
+
+def _phase1b_sale_detail_payload(
+    header,
+    role: str,
+    *,
+    payments: list[dict[str, Any]],
+    products: list[dict[str, Any]],
+    configurations: list[dict[str, Any]],
+    discounts: list[dict[str, Any]],
+) -> dict[str, Any]:
     amount_paid = round(sum(item["monto"] for item in payments), 2)
     total = float(header[8] or 0)
     return {
@@ -6350,6 +7187,13 @@ def _phase1b_sale_detail(cur, venta_id: int, role: str) -> dict[str, Any]:
     }
 
 
+def _phase1b_sale_detail(cur, venta_id: int, role: str) -> dict[str, Any]:
+    detail = _phase1b_sale_details(cur, [venta_id], role).get(int(venta_id))
+    if detail is None:
+        raise HTTPException(status_code=404, detail="Venta de catálogo no existe.")
+    return detail
+
+
 def _phase1b_order_status(configs: list[dict[str, Any]]) -> str:
     statuses = {config["estado_produccion"] for config in configs}
     if not statuses:
@@ -6394,7 +7238,7 @@ def _phase1b_save_sale(
     )
     discounts_normalized = _phase1b_normalize_discounts(list(data.descuentos or []), role=user["rol"])
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         try:
             with conn.cursor() as cur:
                 cur.execute("SELECT activa FROM core.sucursales WHERE sucursal_id = %s FOR SHARE;", (branch_id,))
@@ -6659,7 +7503,7 @@ def previsualizar_venta_fase1b(data: VentaFase1BCreate, user=Depends(get_current
     data = _phase1b_normalize_sale_input(data)
     if data.sucursal_id is None:
         raise HTTPException(status_code=400, detail="Sucursal es requerida.")
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             _phase1b_patient_row(cur, data.paciente_id)
             lines, configs = _phase1b_prepare_lines(cur, data, int(data.sucursal_id), lock=False)
@@ -6715,7 +7559,7 @@ def editar_venta_fase1b(venta_id: int, data: VentaFase1BCreate, user=Depends(get
 @app.get("/ventas/{venta_id}/fase1b", summary="Detalle de venta con catálogo global")
 def detalle_venta_fase1b(venta_id: int, user=Depends(get_current_user)):
     require_roles(user, ("admin", "recepcion", "doctor", "contador"))
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             detail = _phase1b_sale_detail(cur, venta_id, user["rol"])
     requested_branch = force_sucursal(user, detail["sucursal_id"])
@@ -6740,7 +7584,7 @@ def _phase1b_cancel_sale_scope(
         raise HTTPException(status_code=400, detail="El motivo de cancelación es obligatorio.")
     if data.sucursal_id is None:
         raise HTTPException(status_code=400, detail="Sucursal requerida.")
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         try:
             with conn.cursor() as cur:
                 cur.execute(
@@ -6904,6 +7748,31 @@ def _phase1b_cancel_sale_scope(
                 )
                 old_allocations = {int(row[0]): _money(row[1]) for row in cur.fetchall()}
 
+                restored_refs = {
+                    line["linea_ref"] for line in lines
+                    if line["linea_ref"] in cancel_quantities
+                    and line["controla_stock"] and line["comportamiento_abasto"] == "inventario"
+                }
+                _phase1b_apply_inventory_changes(
+                    cur,
+                    sucursal_id=data.sucursal_id,
+                    changes=[
+                        {
+                            "producto_id": line["producto_id"],
+                            "cantidad": cancel_quantities[line["linea_ref"]],
+                            "tipo": "cancelacion_venta",
+                            "fuente_tipo": "cancelacion_venta",
+                            "fuente_id": cancellation_id,
+                            "clave_idempotencia": f"fase1b-cancel-{cancellation_id}-detail-{line['detail_id']}",
+                            "notas": f"Cancelación de venta #{venta_id}",
+                        }
+                        for line in lines
+                        if line["linea_ref"] in restored_refs
+                    ],
+                    username=user["username"],
+                    missing_detail="Falta inventario para restaurar la cancelación.",
+                )
+
                 for line in lines:
                     ref = line["linea_ref"]
                     if ref not in cancel_quantities:
@@ -6916,44 +7785,7 @@ def _phase1b_cancel_sale_scope(
                     ).quantize(Decimal("0.01"))
                     net_cancelled = max(Decimal("0.00"), gross_cancelled - proportional_discount)
                     restore_key = f"fase1b-cancel-{cancellation_id}-detail-{line['detail_id']}"
-                    restored = False
-                    if line["controla_stock"] and line["comportamiento_abasto"] == "inventario":
-                        cur.execute(
-                            """
-                            SELECT stock FROM core.catalogo_inventario_sucursal
-                            WHERE producto_id = %s AND sucursal_id = %s FOR UPDATE;
-                            """,
-                            (line["producto_id"], data.sucursal_id),
-                        )
-                        inventory = cur.fetchone()
-                        if inventory is None:
-                            raise HTTPException(status_code=409, detail="Falta inventario para restaurar la cancelación.")
-                        before_stock = int(inventory[0])
-                        after_stock = before_stock + cancelled_quantity
-                        cur.execute(
-                            """
-                            UPDATE core.catalogo_inventario_sucursal
-                            SET stock = %s, version = version + 1, updated_at = NOW()
-                            WHERE producto_id = %s AND sucursal_id = %s;
-                            """,
-                            (after_stock, line["producto_id"], data.sucursal_id),
-                        )
-                        cur.execute(
-                            """
-                            INSERT INTO core.catalogo_inventario_movimientos (
-                                producto_id, sucursal_id, tipo, cantidad,
-                                stock_anterior, stock_nuevo, fuente_tipo, fuente_id,
-                                clave_idempotencia, notas, created_by
-                            ) VALUES (%s, %s, 'cancelacion_venta', %s, %s, %s,
-                                      'cancelacion_venta', %s, %s, %s, %s);
-                            """,
-                            (
-                                line["producto_id"], data.sucursal_id, cancelled_quantity,
-                                before_stock, after_stock, cancellation_id, restore_key,
-                                f"Cancelación de venta #{venta_id}", user["username"],
-                            ),
-                        )
-                        restored = True
+                    restored = ref in restored_refs
                     remaining_quantity = effective[ref] - cancelled_quantity
                     cur.execute(
                         """
@@ -7137,7 +7969,7 @@ def actualizar_paciente(paciente_id: int, p: PacienteCreate, user=Depends(get_cu
     RETURNING paciente_id;
     """
     try:
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
 
                 # validar sucursal (ya con la sucursal correcta)
@@ -7561,7 +8393,7 @@ def update_historia(
     """
     params.extend([paciente_id, sucursal_id])
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             _ensure_historia_clinica_base(cur, paciente_id, sucursal_id, user["username"])
             cur.execute(sql, tuple(params))
@@ -7587,7 +8419,7 @@ def delete_historia(
     require_roles(user, ("admin",))
     sucursal_id = force_sucursal(user, sucursal_id)
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -7648,21 +8480,6 @@ def listar_ventas(
     reporting_scope, branch_id = _resolve_reporting_scope(user, sucursal_id)
     tz_name = _timezone_for_sucursal(branch_id) if branch_id is not None else None
     search_tz = tz_name or "America/Mexico_City"
-    fecha_hora_local_expr = (
-        f"DATE(v.fecha_hora AT TIME ZONE '{tz_name}')"
-        if tz_name
-        else "DATE(v.fecha_hora)"
-    )
-    year_expr = (
-        f"EXTRACT(YEAR FROM v.fecha_hora AT TIME ZONE '{tz_name}')"
-        if tz_name
-        else "EXTRACT(YEAR FROM v.fecha_hora)"
-    )
-    month_expr = (
-        f"EXTRACT(MONTH FROM v.fecha_hora AT TIME ZONE '{tz_name}')"
-        if tz_name
-        else "EXTRACT(MONTH FROM v.fecha_hora)"
-    )
 
     where = ["v.activo = true", _report_scope_sql("venta_base", reporting_scope, branch_id)]
     params: list[Any] = []
@@ -7670,31 +8487,17 @@ def listar_ventas(
     if mes is not None and (mes < 1 or mes > 12):
         raise HTTPException(status_code=400, detail="Mes inválido. Debe ser entre 1 y 12.")
 
-    if fecha_desde and fecha_hasta:
-        where.append(f"{fecha_hora_local_expr} BETWEEN %s AND %s")
-        params.extend([fecha_desde, fecha_hasta])
-    elif fecha_desde:
-        where.append(f"{fecha_hora_local_expr} >= %s")
-        params.append(fecha_desde)
-    elif fecha_hasta:
-        where.append(f"{fecha_hora_local_expr} <= %s")
-        params.append(fecha_hasta)
-    elif anio is not None and mes is not None:
-        where.append(f"{year_expr} = %s")
-        where.append(f"{month_expr} = %s")
-        params.extend([anio, mes])
-    elif anio is not None:
-        where.append(f"{year_expr} = %s")
-        params.append(anio)
-    else:
-        # Si hay texto de búsqueda, no limitar automáticamente a "hoy"
-        if not (q and q.strip()):
-            if tz_name:
-                hoy_local = datetime.now(ZoneInfo(tz_name)).date()
-                where.append(f"{fecha_hora_local_expr} = %s")
-                params.append(hoy_local)
-            else:
-                where.append("DATE(v.fecha_hora) = CURRENT_DATE")
+    # Si hay texto de búsqueda, no limitar automáticamente a "hoy"
+    fecha_where, fecha_params = _fecha_local_filtro(
+        "venta_base.fecha_local",
+        fecha_desde=fecha_desde,
+        fecha_hasta=fecha_hasta,
+        anio=anio,
+        mes=mes,
+        hoy=None if (q and q.strip()) else datetime.now(ZoneInfo(search_tz)).date(),
+    )
+    where.extend(fecha_where)
+    params.extend(fecha_params)
 
     if q and q.strip():
         qq = f"%{q.strip()}%"
@@ -7747,7 +8550,7 @@ def listar_ventas(
     params.append(limit)
 
     fase1b_details: dict[int, dict[str, Any]] = {}
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(sql, tuple(params))
             rows = cur.fetchall()
@@ -7792,19 +8595,7 @@ def listar_ventas(
                     (venta_ids,),
                 )
                 productos_rows = cur.fetchall()
-                cur.execute(
-                    """
-                    SELECT venta_id
-                    FROM core.venta_catalogo_contextos
-                    WHERE venta_id = ANY(%s::bigint[])
-                    ORDER BY venta_id;
-                    """,
-                    (venta_ids,),
-                )
-                for (phase1b_venta_id,) in cur.fetchall():
-                    fase1b_details[int(phase1b_venta_id)] = _phase1b_sale_detail(
-                        cur, int(phase1b_venta_id), user["rol"]
-                    )
+                fase1b_details = _phase1b_sale_details(cur, venta_ids, user["rol"])
 
     estado_map = _estado_paciente_map(branch_id, [int(r[9]) for r in rows])
     pagos_por_venta: dict[int, list[dict[str, Any]]] = {}
@@ -7942,7 +8733,7 @@ def listar_inventario(
         where.append("p.categoria = %s")
         params.append(normalize_controlled_token(categoria))
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 f"""
@@ -8001,7 +8792,7 @@ def actualizar_stock_inventario(
     if data.stock < 0 or data.expected_stock < 0:
         raise HTTPException(status_code=400, detail="El stock no puede ser negativo.")
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -8061,7 +8852,7 @@ def actualizar_stock_inventario(
 
 def ensure_finanzas_schema():
     """Crea las estructuras auditables de inventario y finanzas sin duplicar ventas."""
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute("CREATE SCHEMA IF NOT EXISTS core;")
             cur.execute(
@@ -8218,7 +9009,7 @@ def actualizar_producto_inventario(
     if data.costo_unitario is not None and data.costo_unitario < 0:
         raise HTTPException(status_code=400, detail="El costo unitario no puede ser negativo.")
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -8319,7 +9110,7 @@ def registrar_movimiento_inventario(
     if data.costo_unitario is not None and data.costo_unitario < 0:
         raise HTTPException(status_code=400, detail="El costo unitario no puede ser negativo.")
     try:
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """
@@ -8397,7 +9188,7 @@ def listar_movimientos_inventario(
     sucursal_id = force_sucursal(user, sucursal_id)
     if sucursal_id is None:
         raise HTTPException(status_code=400, detail="Sucursal es requerida.")
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -8449,7 +9240,7 @@ def crear_movimiento_financiero(data: FinanzasMovimientoIn, user=Depends(get_cur
     if tipo not in {"ingreso", "egreso"} or data.monto <= 0:
         raise HTTPException(status_code=400, detail="Tipo o monto inválido.")
     fecha = data.fecha or datetime.now(timezone.utc).isoformat()
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """INSERT INTO core.fin_movimientos
@@ -8468,7 +9259,7 @@ def crear_gasto(data: FinanzasGastoIn, user=Depends(get_current_user)):
     sucursal_id = _finanzas_scope(user, data.sucursal_id)
     if data.monto <= 0 or (data.estado or "pendiente") not in {"pendiente", "pagado", "aprobado", "cancelado"}:
         raise HTTPException(status_code=400, detail="Monto o estado inválido.")
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """INSERT INTO core.fin_gastos
@@ -8487,7 +9278,7 @@ def crear_nomina(data: FinanzasNominaIn, user=Depends(get_current_user)):
     valores = [data.salario_base, data.horas, data.comisiones, data.bonos, data.deducciones, data.pago_neto, data.costo_patronal]
     if any(valor < 0 for valor in valores):
         raise HTTPException(status_code=400, detail="Los importes de nómina no pueden ser negativos.")
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """INSERT INTO core.fin_nomina
@@ -8509,7 +9300,7 @@ def crear_cuenta_pagar(data: FinanzasCuentaPagarIn, user=Depends(get_current_use
     if data.monto_total <= 0 or data.monto_pagado < 0 or data.monto_pagado > data.monto_total:
         raise HTTPException(status_code=400, detail="Importes de cuenta por pagar inválidos.")
     estado = data.estado or ("pagada" if data.monto_pagado >= data.monto_total else "pendiente")
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """INSERT INTO core.fin_cuentas_pagar
@@ -8563,7 +9354,7 @@ async def subir_comprobante_financiero(
         raise HTTPException(status_code=400, detail="Solo se permiten archivos PDF, JPG, PNG o WEBP.")
     nombre = re.sub(r"[^A-Za-z0-9._() -]", "_", str(nombre or "comprobante"))[:180]
     table, key = config
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(f"SELECT 1 FROM {table} WHERE {key}=%s AND sucursal_id=%s;", (registro_id, sucursal_id))
             if cur.fetchone() is None:
@@ -8587,7 +9378,7 @@ def abrir_comprobante_financiero(
     user=Depends(get_current_user),
 ):
     sucursal_id = _finanzas_scope(user, sucursal_id)
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """SELECT nombre_archivo, mime_type, contenido
@@ -8626,7 +9417,7 @@ def actualizar_estado_financiero(
     if config is None or estado not in config[2]:
         raise HTTPException(status_code=400, detail="Recurso o estado inválido.")
     table, key, _ = config
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             if recurso == "cuentas_pagar" and monto_pagado is not None:
                 cur.execute(
@@ -8692,22 +9483,24 @@ def obtener_datos_finanzas(
         else "FALSE" if reporting_scope == "online"
         else f"sucursal_id = {int(branch_id)}"
     )
+    # Todas las cifras usan el día de negocio local de la sucursal, igual que
+    # core.rpt_ventas_diarias: ventas por fecha_local y pagos/movimientos con
+    # core.fn_fecha_local, para que margen y saldos cubran la misma ventana.
     params = (desde, hasta)
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 f"""
-                SELECT COALESCE(SUM(v.subtotal),0), COALESCE(SUM(v.subtotal-v.monto_total),0), COALESCE(SUM(v.monto_total),0)
-                FROM core.ventas v WHERE {sales_scope} AND v.activo=true
-                  AND COALESCE(v.estado_venta,'confirmada') NOT IN ('cancelada','devuelta')
-                  AND v.fecha_hora::date BETWEEN %s AND %s;
+                SELECT COALESCE(SUM(v.subtotal),0), COALESCE(SUM(v.descuentos),0), COALESCE(SUM(v.monto_total),0)
+                FROM core.rpt_ventas_diarias v WHERE {sales_scope} AND v.vigente
+                  AND v.dia BETWEEN %s AND %s;
                 """, params,
             )
             ventas_brutas, descuentos, ventas_netas = cur.fetchone()
             cur.execute(
                 f"""SELECT COALESCE(SUM(p.monto),0) FROM core.venta_pagos p
                    JOIN core.ventas v ON v.venta_id=p.venta_id
-                   WHERE {sales_scope} AND p.activo=true AND p.created_at::date BETWEEN %s AND %s;""", params,
+                   WHERE {sales_scope} AND p.activo=true AND core.fn_fecha_local(p.created_at, v.sucursal_id) BETWEEN %s AND %s;""", params,
             )
             cobrado = cur.fetchone()[0]
             cur.execute(
@@ -8716,7 +9509,7 @@ def obtener_datos_finanzas(
                    LEFT JOIN (SELECT venta_id,SUM(monto) pagado FROM core.venta_pagos WHERE activo=true GROUP BY venta_id) p ON p.venta_id=v.venta_id
                    WHERE {sales_scope} AND v.activo=true
                      AND COALESCE(v.estado_venta,'confirmada') NOT IN ('cancelada','devuelta')
-                     AND v.fecha_hora::date BETWEEN %s AND %s;""", params,
+                     AND v.fecha_local BETWEEN %s AND %s;""", params,
             )
             cuentas_cobrar_total = cur.fetchone()[0]
             cur.execute(
@@ -8725,7 +9518,7 @@ def obtener_datos_finanzas(
                    JOIN core.productos p ON p.producto_id=d.producto_id
                      WHERE {sales_scope} AND v.activo=true
                      AND COALESCE(v.estado_venta,'confirmada') NOT IN ('cancelada','devuelta')
-                     AND v.fecha_hora::date BETWEEN %s AND %s;""", params,
+                     AND v.fecha_local BETWEEN %s AND %s;""", params,
             )
             costo_productos = cur.fetchone()[0]
             cur.execute(f"SELECT COALESCE(SUM(monto),0) FROM core.fin_gastos WHERE {branch_scope} AND fecha BETWEEN %s AND %s AND estado IN ('pagado','aprobado');", params)
@@ -8765,8 +9558,8 @@ def obtener_datos_finanzas(
             cur.execute(
                 f"""SELECT fecha,cuenta,tipo,categoria,descripcion,monto,fuente FROM (
                      SELECT p.created_at fecha,p.metodo cuenta,'ingreso' tipo,'venta' categoria,CONCAT('Pago venta #',v.venta_id) descripcion,p.monto,'venta' fuente
-                     FROM core.venta_pagos p JOIN core.ventas v ON v.venta_id=p.venta_id WHERE {sales_scope} AND p.activo=true AND p.created_at::date BETWEEN %s AND %s
-                     UNION ALL SELECT m.fecha,m.cuenta,m.tipo,m.categoria,m.descripcion,m.monto,'manual' FROM core.fin_movimientos m WHERE {branch_scope.replace('sucursal_id', 'm.sucursal_id')} AND m.estado<>'cancelado' AND m.fecha::date BETWEEN %s AND %s
+                     FROM core.venta_pagos p JOIN core.ventas v ON v.venta_id=p.venta_id WHERE {sales_scope} AND p.activo=true AND core.fn_fecha_local(p.created_at, v.sucursal_id) BETWEEN %s AND %s
+                     UNION ALL SELECT m.fecha,m.cuenta,m.tipo,m.categoria,m.descripcion,m.monto,'manual' FROM core.fin_movimientos m WHERE {branch_scope.replace('sucursal_id', 'm.sucursal_id')} AND m.estado<>'cancelado' AND core.fn_fecha_local(m.fecha, m.sucursal_id) BETWEEN %s AND %s
                      UNION ALL SELECT COALESCE(g.fecha_pago,g.fecha)::timestamptz,COALESCE(g.cuenta,'Sin cuenta'),'egreso','gasto',g.descripcion,g.monto,'gasto' FROM core.fin_gastos g WHERE {branch_scope.replace('sucursal_id', 'g.sucursal_id')} AND g.estado='pagado' AND COALESCE(g.fecha_pago,g.fecha) BETWEEN %s AND %s
                      UNION ALL SELECT COALESCE(n.fecha_pago,n.periodo_fin)::timestamptz,COALESCE(n.cuenta,'Sin cuenta'),'egreso','nomina',CONCAT('Nómina: ',n.empleado),n.pago_neto,'nomina' FROM core.fin_nomina n WHERE {branch_scope.replace('sucursal_id', 'n.sucursal_id')} AND n.estado='pagada' AND COALESCE(n.fecha_pago,n.periodo_fin) BETWEEN %s AND %s
                    ) movimientos ORDER BY fecha DESC LIMIT 1000;""", params + params + params + params,
@@ -8776,11 +9569,11 @@ def obtener_datos_finanzas(
                 f"""SELECT COALESCE(SUM(monto_firmado), 0) FROM (
                      SELECT p.monto AS monto_firmado
                      FROM core.venta_pagos p JOIN core.ventas v ON v.venta_id=p.venta_id
-                     WHERE {sales_scope} AND p.activo=true AND p.created_at::date < %s
+                     WHERE {sales_scope} AND p.activo=true AND core.fn_fecha_local(p.created_at, v.sucursal_id) < %s
                      UNION ALL
                      SELECT CASE WHEN m.tipo='ingreso' THEN m.monto ELSE -m.monto END
                      FROM core.fin_movimientos m
-                     WHERE {branch_scope.replace('sucursal_id', 'm.sucursal_id')} AND m.estado<>'cancelado' AND m.fecha::date < %s
+                     WHERE {branch_scope.replace('sucursal_id', 'm.sucursal_id')} AND m.estado<>'cancelado' AND core.fn_fecha_local(m.fecha, m.sucursal_id) < %s
                      UNION ALL
                      SELECT -g.monto FROM core.fin_gastos g
                      WHERE {branch_scope.replace('sucursal_id', 'g.sucursal_id')} AND g.estado='pagado' AND COALESCE(g.fecha_pago,g.fecha) < %s
@@ -8859,30 +9652,32 @@ def _restore_inventory_for_sales(
             cantidades_por_producto.get(producto_id, 0) + int(cantidad or 0)
         )
 
-    for producto_id in sorted(cantidades_por_producto):
-        cantidad_restaurada = cantidades_por_producto[producto_id]
+    if cantidades_por_producto:
+        productos = sorted(cantidades_por_producto)
         cur.execute(
             """
-            UPDATE core.productos
-            SET stock = stock + %s, updated_at = NOW()
-            WHERE producto_id = %s
-              AND sucursal_id = %s
-            RETURNING stock;
+            WITH restaurado AS (
+                UPDATE core.productos p
+                SET stock = p.stock + cambio.cantidad, updated_at = NOW()
+                FROM unnest(%s::bigint[], %s::integer[]) AS cambio(producto_id, cantidad)
+                WHERE p.producto_id = cambio.producto_id
+                  AND p.sucursal_id = %s
+                RETURNING p.producto_id, cambio.cantidad, p.stock
+            )
+            INSERT INTO core.inventario_movimientos (
+                sucursal_id, producto_id, tipo, cantidad, stock_anterior, stock_nuevo,
+                fuente_tipo, fuente_id, notas, created_by
+            )
+            SELECT %s::integer, producto_id, 'venta_eliminada', cantidad, stock - cantidad, stock,
+                   'venta', %s::bigint, %s::text, %s::text
+            FROM restaurado
+            ORDER BY producto_id;
             """,
-            (cantidad_restaurada, producto_id, sucursal_id),
-        )
-        stock_nuevo = int(cur.fetchone()[0])
-        cur.execute(
-            """INSERT INTO core.inventario_movimientos (
-                 sucursal_id, producto_id, tipo, cantidad, stock_anterior, stock_nuevo,
-                 fuente_tipo, fuente_id, notas, created_by
-               ) VALUES (%s, %s, 'venta_eliminada', %s, %s, %s, 'venta', %s, %s, %s);""",
             (
+                productos,
+                [cantidades_por_producto[producto_id] for producto_id in productos],
+                sucursal_id,
                 sucursal_id,
-                producto_id,
-                cantidad_restaurada,
-                stock_nuevo - cantidad_restaurada,
-                stock_nuevo,
                 normalized_ids[0] if len(normalized_ids) == 1 else None,
                 f"Restauración por eliminación de {len(normalized_ids)} venta(s)",
                 created_by,
@@ -9043,7 +9838,7 @@ def crear_venta(v: VentaCreate, user=Depends(get_current_user)):
     compra_tokens = set(split_pipe_tokens(v.compra))
 
     try:
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT activa FROM core.sucursales WHERE sucursal_id = %s;", (v.sucursal_id,))
                 srow = cur.fetchone()
@@ -9436,7 +10231,7 @@ def actualizar_venta(venta_id: int, v: VentaCreate, user=Depends(get_current_use
     monto_total = (subtotal_venta - descuento_calculado).quantize(Decimal("0.01"))
 
     try:
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """
@@ -9608,7 +10403,7 @@ def editar_venta_completa(venta_id: int, v: VentaCreate, user=Depends(get_curren
         productos_solicitados[producto_id] = productos_solicitados.get(producto_id, 0) + cantidad
 
     try:
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """
@@ -9929,7 +10724,7 @@ def actualizar_seguimiento_venta(
             detail="No se puede registrar un pago nuevo y marcarlo como reembolsado al mismo tiempo.",
         )
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -10148,7 +10943,7 @@ def eliminar_venta(venta_id: int, sucursal_id: int, user=Depends(get_current_use
     if user["rol"] == "admin" and sucursal_id is None:
         raise HTTPException(status_code=400, detail="Sucursal es requerida.")
 
-    with psycopg.connect(DB_CONNINFO) as check_conn:
+    with db_connect(DB_CONNINFO) as check_conn:
         with check_conn.cursor() as check_cur:
             check_cur.execute(
                 "SELECT 1 FROM core.venta_catalogo_contextos WHERE venta_id = %s;",
@@ -10168,7 +10963,7 @@ def eliminar_venta(venta_id: int, sucursal_id: int, user=Depends(get_current_use
             user,
         )
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -10317,471 +11112,387 @@ def estadisticas_resumen(
     q_like = f"%{q_name}%"
     is_admin_user = str(user.get("rol", "")).lower() == "admin"
 
-    def _patient_filter_sql(alias: str) -> tuple[str, list[Any]]:
+    def _patient_filter_sql(alias: str) -> str:
         if not q_name:
-            return "", []
-        return (
-            f"""
+            return ""
+        return f"""
               AND EXISTS (
                 SELECT 1
                 FROM core.pacientes p
                 WHERE p.paciente_id = {alias}.paciente_id
                   AND p.sucursal_id = {alias}.sucursal_id
                   AND p.activo = true
-                  AND CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) ILIKE %s
+                  AND CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) ILIKE %(q_like)s
               )
-            """,
-            [q_like],
-        )
-
-    c_patient_sql, c_patient_params = _patient_filter_sql("c")
-    v_patient_sql, v_patient_params = _patient_filter_sql("v")
-    admin_sucursales_rows: list[tuple[Any, ...]] = []
-    admin_consultas_period_rows: list[tuple[Any, ...]] = []
-    admin_ventas_mensuales_rows: list[tuple[Any, ...]] = []
-    admin_pacientes_mensuales_rows: list[tuple[Any, ...]] = []
-
-    with psycopg.connect(DB_CONNINFO) as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                SELECT
-                  COUNT(*)::int AS total,
-                  COUNT(*) FILTER (
-                    WHERE LOWER(COALESCE(tipo_consulta, '')) LIKE '%%no_show%%'
-                  )::int AS no_show
-                FROM core.consultas c
-                WHERE activo = true
-                  AND {physical_scope_c}
-                  AND DATE(fecha_hora) BETWEEN %s AND %s
-                  {c_patient_sql};
-                """,
-                (fecha_desde, fecha_hasta, *c_patient_params),
-            )
-            c_total, c_no_show = cur.fetchone()
-
-            cur.execute(
-                f"""
-                SELECT
-                  COUNT(*)::int AS total,
-                  COALESCE(SUM(monto_total), 0)::numeric AS monto_total
-                FROM core.ventas v
-                WHERE activo = true
-                  AND {sales_scope}
-                  AND DATE(fecha_hora) BETWEEN %s AND %s
-                  {v_patient_sql};
-                """,
-                (fecha_desde, fecha_hasta, *v_patient_params),
-            )
-            v_total, v_monto_total = cur.fetchone()
-
-            cur.execute(
-                f"""
-                SELECT DATE(fecha_hora) AS dia, COUNT(*)::int
-                FROM core.consultas c
-                WHERE activo = true
-                  AND {physical_scope_c}
-                  AND DATE(fecha_hora) BETWEEN %s AND %s
-                  {c_patient_sql}
-                GROUP BY DATE(fecha_hora)
-                ORDER BY dia;
-                """,
-                (fecha_desde, fecha_hasta, *c_patient_params),
-            )
-            consultas_dia_rows = cur.fetchall()
-
-            cur.execute(
-                f"""
-                SELECT DATE(fecha_hora) AS dia, COUNT(*)::int
-                FROM core.ventas v
-                WHERE activo = true
-                  AND {sales_scope}
-                  AND DATE(fecha_hora) BETWEEN %s AND %s
-                  {v_patient_sql}
-                GROUP BY DATE(fecha_hora)
-                ORDER BY dia;
-                """,
-                (fecha_desde, fecha_hasta, *v_patient_params),
-            )
-            ventas_dia_rows = cur.fetchall()
-
-            cur.execute(
-                f"""
-                SELECT
-                  COALESCE(NULLIF(LOWER(TRIM(metodo_pago)), ''), 'sin_metodo') AS etiqueta,
-                  COUNT(*)::int AS total
-                FROM core.ventas v
-                WHERE activo = true
-                  AND {sales_scope}
-                  AND DATE(fecha_hora) BETWEEN %s AND %s
-                  {v_patient_sql}
-                GROUP BY etiqueta
-                ORDER BY total DESC, etiqueta ASC;
-                """,
-                (fecha_desde, fecha_hasta, *v_patient_params),
-            )
-            ventas_metodo_rows = cur.fetchall()
-
-            cur.execute(
-                f"""
-                SELECT
-                  item AS etiqueta,
-                  COUNT(*)::int AS total
-                FROM (
-                  SELECT LOWER(TRIM(x.item)) AS item
-                  FROM core.consultas c
-                  CROSS JOIN LATERAL regexp_split_to_table(COALESCE(NULLIF(c.motivo_consulta, ''), COALESCE(c.tipo_consulta, '')), '\\|') AS x(item)
-                  WHERE c.activo = true
-                    AND {physical_scope_c}
-                    AND DATE(c.fecha_hora) BETWEEN %s AND %s
-                    {c_patient_sql}
-                ) t
-                WHERE item <> ''
-                GROUP BY item
-                ORDER BY total DESC, etiqueta ASC
-                LIMIT 10;
-                """,
-                (fecha_desde, fecha_hasta, *c_patient_params),
-            )
-            consultas_tipo_rows = cur.fetchall()
-
-            cur.execute(
-                f"""
-                SELECT
-                  CASE
-                    WHEN POSITION('otro:' IN item) = 1 THEN 'otro'
-                    ELSE item
-                  END AS producto,
-                  COUNT(*)::int AS total
-                FROM (
-                  SELECT LOWER(TRIM(x.item)) AS item
-                  FROM core.ventas v
-                  CROSS JOIN LATERAL regexp_split_to_table(COALESCE(v.compra, ''), '\\|') AS x(item)
-                  WHERE v.activo = true
-                    AND {sales_scope}
-                    AND DATE(v.fecha_hora) BETWEEN %s AND %s
-                    {v_patient_sql}
-                ) t
-                WHERE item <> ''
-                GROUP BY producto
-                ORDER BY total DESC, producto ASC
-                LIMIT 10;
-                """,
-                (fecha_desde, fecha_hasta, *v_patient_params),
-            )
-            productos_top_rows = cur.fetchall()
+            """
 
-            mes_actual_desde = date(hoy.year, hoy.month, 1)
-            mes_actual_hasta = date(hoy.year, hoy.month, monthrange(hoy.year, hoy.month)[1])
-            top_mes_extra_sql = ""
-            top_mes_extra_params: list[Any] = []
-            if q_name:
-                top_mes_extra_sql = "AND CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) ILIKE %s"
-                top_mes_extra_params.append(q_like)
-            cur.execute(
-                f"""
-                SELECT
-                  v.paciente_id,
-                  CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) AS paciente_nombre,
-                  COUNT(*)::int AS total_ventas,
-                  COALESCE(SUM(v.monto_total), 0)::numeric AS monto_total
-                FROM core.ventas v
-                JOIN core.pacientes p ON p.paciente_id = v.paciente_id
-                WHERE v.activo = true
-                  AND p.activo = true
-                  AND {sales_scope}
-                  AND DATE(v.fecha_hora) BETWEEN %s AND %s
-                  {top_mes_extra_sql}
-                GROUP BY v.paciente_id, paciente_nombre
-                ORDER BY monto_total DESC, total_ventas DESC, paciente_nombre ASC
-                LIMIT 10;
-                """.format(top_mes_extra_sql=top_mes_extra_sql),
-                (mes_actual_desde, mes_actual_hasta, *top_mes_extra_params),
-            )
-            top_pacientes_mes_actual_rows = cur.fetchall()
-
-            top_consultas_extra_sql = ""
-            top_consultas_extra_params: list[Any] = []
-            if q_name:
-                top_consultas_extra_sql = "AND CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) ILIKE %s"
-                top_consultas_extra_params.append(q_like)
-            cur.execute(
-                f"""
-                SELECT
-                  c.paciente_id,
-                  CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) AS paciente_nombre,
-                  COUNT(*)::int AS total_consultas
-                FROM core.consultas c
-                JOIN core.pacientes p
-                  ON p.paciente_id = c.paciente_id
-                 AND p.sucursal_id = c.sucursal_id
-                WHERE c.activo = true
-                  AND p.activo = true
-                  AND {physical_scope_c}
-                  AND DATE(c.fecha_hora) BETWEEN %s AND %s
-                  {top_consultas_extra_sql}
-                GROUP BY c.paciente_id, paciente_nombre
-                ORDER BY total_consultas DESC, paciente_nombre ASC
-                LIMIT 10;
-                """.format(top_consultas_extra_sql=top_consultas_extra_sql),
-                (fecha_desde, fecha_hasta, *top_consultas_extra_params),
-            )
-            top_pacientes_consultas_rows = cur.fetchall()
-
-            pacientes_modo_clean = (pacientes_modo or "mes").strip().lower()
-            if pacientes_modo_clean not in {"dia", "semana", "mes", "anio", "rango"}:
-                raise HTTPException(status_code=400, detail="pacientes_modo inválido. Usa: dia, semana, mes, anio o rango.")
-
-            p_anio = pacientes_anio or hoy.year
-            p_mes = pacientes_mes or hoy.month
-            p_semana = pacientes_semana or int(hoy.strftime("%V"))
-            p_extra_sql = ""
-            p_extra_params: list[Any] = []
-            if q_name:
-                p_extra_sql = "AND CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) ILIKE %s"
-                p_extra_params.append(q_like)
-
-            pacientes_label = ""
-            pacientes_series: list[dict[str, Any]] = []
-            if pacientes_modo_clean == "anio":
-                cur.execute(
-                    f"""
-                    SELECT EXTRACT(MONTH FROM p.creado_en)::int AS mes_idx, COUNT(*)::int AS total
-                    FROM core.pacientes p
-                    WHERE p.activo = true
-                      AND {physical_scope_p}
-                      AND EXTRACT(YEAR FROM p.creado_en) = %s
-                      {p_extra_sql}
-                    GROUP BY mes_idx
-                    ORDER BY mes_idx;
-                    """,
-                    (p_anio, *p_extra_params),
-                )
-                rows = cur.fetchall()
-                month_map = {int(r[0]): int(r[1]) for r in rows}
-                meses_label = ["Ene", "Feb", "Mar", "Abr", "May", "Jun", "Jul", "Ago", "Sep", "Oct", "Nov", "Dic"]
-                pacientes_series = [
-                    {"etiqueta": meses_label[idx - 1], "total": int(month_map.get(idx, 0))}
-                    for idx in range(1, 13)
-                ]
-                pacientes_label = f"Pacientes creados por mes ({p_anio})"
-            elif pacientes_modo_clean == "mes":
-                _, last_day = calendar.monthrange(p_anio, p_mes)
-                p_desde = date(p_anio, p_mes, 1)
-                p_hasta = date(p_anio, p_mes, last_day)
-                cur.execute(
-                    f"""
-                    SELECT DATE(p.creado_en) AS dia, COUNT(*)::int AS total
-                    FROM core.pacientes p
-                    WHERE p.activo = true
-                      AND {physical_scope_p}
-                      AND DATE(p.creado_en) BETWEEN %s AND %s
-                      {p_extra_sql}
-                    GROUP BY dia
-                    ORDER BY dia;
-                    """,
-                    (p_desde, p_hasta, *p_extra_params),
-                )
-                day_map = {str(r[0]): int(r[1]) for r in cur.fetchall()}
-                pacientes_series = [
-                    {"etiqueta": str(day), "total": int(day_map.get(str(day), 0))}
-                    for day in (p_desde + timedelta(days=offset) for offset in range(last_day))
-                ]
-                pacientes_label = f"Pacientes creados por día ({p_mes:02d}/{p_anio})"
-            elif pacientes_modo_clean == "dia":
-                if pacientes_fecha:
-                    try:
-                        p_fecha = datetime.fromisoformat(pacientes_fecha).date()
-                    except Exception:
-                        raise HTTPException(status_code=400, detail="pacientes_fecha inválida. Usa YYYY-MM-DD.")
-                else:
-                    p_fecha = hoy
-                cur.execute(
-                    f"""
-                    SELECT COUNT(*)::int AS total
-                    FROM core.pacientes p
-                    WHERE p.activo = true
-                      AND {physical_scope_p}
-                      AND DATE(p.creado_en) = %s
-                      {p_extra_sql}
-                    ;
-                    """,
-                    (p_fecha, *p_extra_params),
-                )
-                total_dia = int((cur.fetchone() or [0])[0] or 0)
-                pacientes_series = [{"etiqueta": str(p_fecha), "total": total_dia}]
-                pacientes_label = f"Pacientes creados en día ({p_fecha.isoformat()})"
-            elif pacientes_modo_clean == "rango":
-                if not pacientes_fecha_desde or not pacientes_fecha_hasta:
-                    raise HTTPException(
-                        status_code=400,
-                        detail="Para pacientes_modo=rango envía pacientes_fecha_desde y pacientes_fecha_hasta.",
-                    )
-                try:
-                    p_desde = datetime.fromisoformat(pacientes_fecha_desde).date()
-                    p_hasta = datetime.fromisoformat(pacientes_fecha_hasta).date()
-                except Exception:
-                    raise HTTPException(
-                        status_code=400,
-                        detail="pacientes_fecha_desde/pacientes_fecha_hasta inválidas. Usa YYYY-MM-DD.",
-                    )
-                if p_hasta < p_desde:
-                    raise HTTPException(status_code=400, detail="Rango inválido en pacientes creados.")
-                cur.execute(
-                    f"""
-                    SELECT DATE(p.creado_en) AS dia, COUNT(*)::int AS total
-                    FROM core.pacientes p
-                    WHERE p.activo = true
-                      AND {physical_scope_p}
-                      AND DATE(p.creado_en) BETWEEN %s AND %s
-                      {p_extra_sql}
-                    GROUP BY dia
-                    ORDER BY dia;
-                    """,
-                    (p_desde, p_hasta, *p_extra_params),
-                )
-                rows = cur.fetchall()
-                day_map = {str(r[0]): int(r[1]) for r in rows}
-                dcur = p_desde
-                while dcur <= p_hasta:
-                    k = str(dcur)
-                    pacientes_series.append({"etiqueta": k, "total": int(day_map.get(k, 0))})
-                    dcur += timedelta(days=1)
-                pacientes_label = f"Pacientes creados por rango ({p_desde.isoformat()} a {p_hasta.isoformat()})"
-            else:
-                if p_semana < 1 or p_semana > 53:
-                    raise HTTPException(status_code=400, detail="pacientes_semana inválida. Debe ser 1..53.")
-                try:
-                    p_desde = date.fromisocalendar(p_anio, p_semana, 1)
-                except ValueError:
-                    raise HTTPException(status_code=400, detail="Semana/año inválidos para calendario ISO.")
-                p_hasta = p_desde + timedelta(days=6)
-                cur.execute(
-                    f"""
-                    SELECT DATE(p.creado_en) AS dia, COUNT(*)::int AS total
-                    FROM core.pacientes p
-                    WHERE p.activo = true
-                      AND {physical_scope_p}
-                      AND DATE(p.creado_en) BETWEEN %s AND %s
-                      {p_extra_sql}
-                    GROUP BY dia
-                    ORDER BY dia;
-                    """,
-                    (p_desde, p_hasta, *p_extra_params),
-                )
-                rows = cur.fetchall()
-                day_map = {str(r[0]): int(r[1]) for r in rows}
-                dcur = p_desde
-                while dcur <= p_hasta:
-                    k = str(dcur)
-                    pacientes_series.append({"etiqueta": k, "total": int(day_map.get(k, 0))})
-                    dcur += timedelta(days=1)
-                pacientes_label = f"Pacientes creados por semana (S{p_semana} {p_anio})"
-
-            series_year = series_anio or hoy.year
-            cur.execute(
-                f"""
-                SELECT EXTRACT(MONTH FROM v.fecha_hora)::int AS mes_idx, COALESCE(SUM(v.monto_total), 0)::numeric AS total
-                FROM core.ventas v
-                WHERE v.activo = true
-                  AND {sales_scope}
-                  AND EXTRACT(YEAR FROM v.fecha_hora) = %s
-                GROUP BY mes_idx
-                ORDER BY mes_idx;
-                """,
-                (series_year,),
-            )
-            ingresos_rows = cur.fetchall()
+    c_patient_sql = _patient_filter_sql("c")
+    v_patient_sql = _patient_filter_sql("v")
+    p_name_sql = (
+        "AND CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) ILIKE %(q_like)s"
+        if q_name
+        else ""
+    )
 
-            cur.execute(
-                f"""
-                SELECT EXTRACT(MONTH FROM c.fecha_hora)::int AS mes_idx, COUNT(*)::int AS total
-                FROM core.consultas c
-                WHERE c.activo = true
-                  AND {physical_scope_c}
-                  AND EXTRACT(YEAR FROM c.fecha_hora) = %s
-                GROUP BY mes_idx
-                ORDER BY mes_idx;
-                """,
-                (series_year,),
+    pacientes_modo_clean = (pacientes_modo or "mes").strip().lower()
+    if pacientes_modo_clean not in {"dia", "semana", "mes", "anio", "rango"}:
+        raise HTTPException(status_code=400, detail="pacientes_modo inválido. Usa: dia, semana, mes, anio o rango.")
+
+    p_anio = pacientes_anio or hoy.year
+    p_mes = pacientes_mes or hoy.month
+    p_semana = pacientes_semana or int(hoy.strftime("%V"))
+    if pacientes_modo_clean == "anio":
+        p_desde = date(p_anio, 1, 1)
+        p_hasta = date(p_anio, 12, 31)
+        pacientes_label = f"Pacientes creados por mes ({p_anio})"
+    elif pacientes_modo_clean == "mes":
+        _, last_day = calendar.monthrange(p_anio, p_mes)
+        p_desde = date(p_anio, p_mes, 1)
+        p_hasta = date(p_anio, p_mes, last_day)
+        pacientes_label = f"Pacientes creados por día ({p_mes:02d}/{p_anio})"
+    elif pacientes_modo_clean == "dia":
+        if pacientes_fecha:
+            try:
+                p_desde = datetime.fromisoformat(pacientes_fecha).date()
+            except Exception:
+                raise HTTPException(status_code=400, detail="pacientes_fecha inválida. Usa YYYY-MM-DD.")
+        else:
+            p_desde = hoy
+        p_hasta = p_desde
+        pacientes_label = f"Pacientes creados en día ({p_desde.isoformat()})"
+    elif pacientes_modo_clean == "rango":
+        if not pacientes_fecha_desde or not pacientes_fecha_hasta:
+            raise HTTPException(
+                status_code=400,
+                detail="Para pacientes_modo=rango envía pacientes_fecha_desde y pacientes_fecha_hasta.",
             )
-            consultas_mensuales_rows = cur.fetchall()
-
-            cur.execute(
-                f"""
-                SELECT EXTRACT(MONTH FROM v.fecha_hora)::int AS mes_idx, COUNT(*)::int AS total
-                FROM core.ventas v
-                WHERE v.activo = true
-                  AND {sales_scope}
-                  AND EXTRACT(YEAR FROM v.fecha_hora) = %s
-                GROUP BY mes_idx
-                ORDER BY mes_idx;
-                """,
-                (series_year,),
+        try:
+            p_desde = datetime.fromisoformat(pacientes_fecha_desde).date()
+            p_hasta = datetime.fromisoformat(pacientes_fecha_hasta).date()
+        except Exception:
+            raise HTTPException(
+                status_code=400,
+                detail="pacientes_fecha_desde/pacientes_fecha_hasta inválidas. Usa YYYY-MM-DD.",
             )
-            ventas_mensuales_count_rows = cur.fetchall()
+        if p_hasta < p_desde:
+            raise HTTPException(status_code=400, detail="Rango inválido en pacientes creados.")
+        pacientes_label = f"Pacientes creados por rango ({p_desde.isoformat()} a {p_hasta.isoformat()})"
+    else:
+        if p_semana < 1 or p_semana > 53:
+            raise HTTPException(status_code=400, detail="pacientes_semana inválida. Debe ser 1..53.")
+        try:
+            p_desde = date.fromisocalendar(p_anio, p_semana, 1)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Semana/año inválidos para calendario ISO.")
+        p_hasta = p_desde + timedelta(days=6)
+        pacientes_label = f"Pacientes creados por semana (S{p_semana} {p_anio})"
+
+    mes_actual_desde = date(hoy.year, hoy.month, 1)
+    mes_actual_hasta = date(hoy.year, hoy.month, monthrange(hoy.year, hoy.month)[1])
+    series_year = series_anio or hoy.year
+    pacientes_clave_sql = (
+        "EXTRACT(MONTH FROM p.dia)::int::text"
+        if pacientes_modo_clean == "anio"
+        else "to_char(p.dia, 'YYYY-MM-DD')"
+    )
 
-            if is_admin_user:
-                cur.execute(
-                    """
-                    SELECT s.sucursal_id, s.nombre
-                    FROM core.sucursales s
-                    WHERE s.activa = true
-                    ORDER BY s.sucursal_id ASC;
-                    """
-                )
-                admin_sucursales_rows = cur.fetchall()
+    def _local_day_range_sql(alias: str, ts_col: str, desde_param: str, hasta_param: str) -> str:
+        # El rango holgado sobre la columna cruda permite usar los índices por
+        # fecha; el día local exacto se filtra después.
+        return f"""
+            {alias}.{ts_col} >= %({desde_param})s::timestamptz - interval '1 day'
+            AND {alias}.{ts_col} < %({hasta_param})s::timestamptz + interval '2 days'
+            AND core.fn_fecha_local({alias}.{ts_col}, {alias}.sucursal_id) BETWEEN %({desde_param})s AND %({hasta_param})s
+        """
 
-                cur.execute(
-                    """
-                    SELECT c.sucursal_id, COUNT(*)::int AS total
-                    FROM core.consultas c
-                    JOIN core.sucursales s ON s.sucursal_id = c.sucursal_id
-                    WHERE c.activo = true
-                      AND s.activa = true
-                      AND DATE(c.fecha_hora) BETWEEN %s AND %s
-                    GROUP BY c.sucursal_id
-                    ORDER BY c.sucursal_id ASC;
-                    """,
-                    (fecha_desde, fecha_hasta),
-                )
-                admin_consultas_period_rows = cur.fetchall()
+    # Conteos diarios: salen de las tablas rollup (core.rpt_*) salvo cuando se
+    # filtra por nombre de paciente, que requiere las filas originales.
+    if q_name:
+        c_dias_sql = """
+          SELECT dia, COUNT(*) AS consultas, COUNT(*) FILTER (WHERE no_show) AS no_show
+          FROM c_periodo
+          GROUP BY dia
+        """
+        v_dias_sql = """
+          SELECT dia, metodo, COUNT(*) AS ventas, SUM(monto_total) AS monto_total
+          FROM v_periodo
+          GROUP BY dia, metodo
+        """
+        p_dias_sql = f"""
+          SELECT core.fn_fecha_local(p.creado_en, p.sucursal_id) AS dia, 1 AS pacientes
+          FROM core.pacientes p
+          WHERE p.activo = true
+            AND {physical_scope_p}
+            AND {_local_day_range_sql("p", "creado_en", "p_desde", "p_hasta")}
+            {p_name_sql}
+        """
+    else:
+        c_dias_sql = f"""
+          SELECT c.dia, c.consultas, c.no_show
+          FROM core.rpt_consultas_diarias c
+          WHERE {physical_scope_c}
+            AND c.dia BETWEEN %(desde)s AND %(hasta)s
+        """
+        v_dias_sql = f"""
+          SELECT v.dia, v.metodo_pago AS metodo, v.ventas, v.monto_total
+          FROM core.rpt_ventas_diarias v
+          WHERE {sales_scope}
+            AND v.dia BETWEEN %(desde)s AND %(hasta)s
+        """
+        p_dias_sql = f"""
+          SELECT p.dia, p.pacientes
+          FROM core.rpt_pacientes_diarios p
+          WHERE {physical_scope_p}
+            AND p.dia BETWEEN %(p_desde)s AND %(p_hasta)s
+        """
 
-                cur.execute(
-                    """
-                    SELECT
-                      v.sucursal_id,
-                      EXTRACT(MONTH FROM v.fecha_hora)::int AS mes_idx,
-                      COALESCE(SUM(v.monto_total), 0)::numeric AS total
-                    FROM core.ventas v
-                    JOIN core.sucursales s ON s.sucursal_id = v.sucursal_id
-                    WHERE v.activo = true
-                      AND s.activa = true
-                      AND EXTRACT(YEAR FROM v.fecha_hora) = %s
-                    GROUP BY v.sucursal_id, mes_idx
-                    ORDER BY v.sucursal_id ASC, mes_idx ASC;
-                    """,
-                    (series_year,),
-                )
-                admin_ventas_mensuales_rows = cur.fetchall()
+    # Todas las secciones del tablero salen de una sola consulta: cada rama
+    # del UNION ALL etiqueta sus filas con `seccion` y comparte columnas
+    # (clave, ref_id, nombre, total, extra, monto).
+    admin_sections_sql = ""
+    if is_admin_user:
+        admin_sections_sql = """
+            UNION ALL
+            SELECT 'sucursal', NULL, s.sucursal_id::bigint, s.nombre::text, NULL, NULL, NULL
+            FROM core.sucursales s
+            WHERE s.activa = true
+            UNION ALL
+            SELECT 'consultas_periodo_sucursal', NULL, c.sucursal_id::bigint, NULL, SUM(c.consultas)::bigint, NULL, NULL
+            FROM core.rpt_consultas_diarias c
+            JOIN core.sucursales s ON s.sucursal_id = c.sucursal_id
+            WHERE s.activa = true
+              AND c.dia BETWEEN %(desde)s AND %(hasta)s
+            GROUP BY c.sucursal_id
+            UNION ALL
+            SELECT 'ventas_mes_sucursal', mes::text, sucursal_id::bigint, NULL, NULL, NULL,
+                   COALESCE(SUM(monto_total), 0)::numeric
+            FROM v_anio
+            WHERE sucursal_activa
+            GROUP BY sucursal_id, mes
+            UNION ALL
+            SELECT 'pacientes_mes_sucursal', EXTRACT(MONTH FROM p.dia)::int::text,
+                   p.sucursal_id::bigint, NULL, SUM(p.pacientes)::bigint, NULL, NULL
+            FROM core.rpt_pacientes_diarios p
+            JOIN core.sucursales s ON s.sucursal_id = p.sucursal_id
+            WHERE s.activa = true
+              AND p.dia BETWEEN %(anio_desde)s AND %(anio_hasta)s
+            GROUP BY p.sucursal_id, EXTRACT(MONTH FROM p.dia)
+        """
+    resumen_sql = f"""
+        WITH c_periodo AS (
+          SELECT
+            c.paciente_id,
+            c.sucursal_id,
+            core.fn_fecha_local(c.fecha_hora, c.sucursal_id) AS dia,
+            LOWER(COALESCE(c.tipo_consulta, '')) LIKE '%%no_show%%' AS no_show,
+            COALESCE(NULLIF(c.motivo_consulta, ''), COALESCE(c.tipo_consulta, '')) AS motivos
+          FROM core.consultas c
+          WHERE c.activo = true
+            AND {physical_scope_c}
+            AND {_local_day_range_sql("c", "fecha_hora", "desde", "hasta")}
+            {c_patient_sql}
+        ),
+        v_periodo AS (
+          SELECT
+            core.fn_fecha_local(v.fecha_hora, v.sucursal_id) AS dia,
+            v.monto_total,
+            core.fn_rpt_metodo_pago(v.metodo_pago) AS metodo,
+            v.compra
+          FROM core.ventas v
+          WHERE v.activo = true
+            AND {sales_scope}
+            AND {_local_day_range_sql("v", "fecha_hora", "desde", "hasta")}
+            {v_patient_sql}
+        ),
+        c_dias AS ({c_dias_sql}),
+        v_dias AS ({v_dias_sql}),
+        p_dias AS ({p_dias_sql}),
+        v_anio AS (
+          SELECT
+            v.sucursal_id,
+            EXTRACT(MONTH FROM v.dia)::int AS mes,
+            v.ventas,
+            v.monto_total,
+            ({sales_scope}) AS en_alcance,
+            COALESCE(s.activa, false) AS sucursal_activa
+          FROM core.rpt_ventas_diarias v
+          LEFT JOIN core.sucursales s ON s.sucursal_id = v.sucursal_id
+          WHERE v.dia BETWEEN %(anio_desde)s AND %(anio_hasta)s
+        )
+        SELECT
+          CASE WHEN GROUPING(dia) = 1 THEN 'consultas_total' ELSE 'consultas_dia' END AS seccion,
+          to_char(dia, 'YYYY-MM-DD') AS clave,
+          NULL::bigint AS ref_id,
+          NULL::text AS nombre,
+          COALESCE(SUM(consultas), 0)::bigint AS total,
+          COALESCE(SUM(no_show), 0)::bigint AS extra,
+          NULL::numeric AS monto
+        FROM c_dias
+        GROUP BY GROUPING SETS ((dia), ())
+        UNION ALL
+        SELECT
+          CASE
+            WHEN GROUPING(dia, metodo) = 3 THEN 'ventas_total'
+            WHEN GROUPING(dia) = 0 THEN 'ventas_dia'
+            ELSE 'ventas_metodo'
+          END,
+          COALESCE(to_char(dia, 'YYYY-MM-DD'), metodo),
+          NULL, NULL,
+          COALESCE(SUM(ventas), 0)::bigint,
+          NULL,
+          COALESCE(SUM(monto_total), 0)::numeric
+        FROM v_dias
+        GROUP BY GROUPING SETS ((dia), (metodo), ())
+        UNION ALL
+        SELECT 'consultas_tipo', item, NULL, NULL, total, orden, NULL
+        FROM (
+          SELECT
+            LOWER(TRIM(x.item)) AS item,
+            COUNT(*) AS total,
+            ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC, LOWER(TRIM(x.item)) ASC) AS orden
+          FROM c_periodo c
+          CROSS JOIN LATERAL regexp_split_to_table(c.motivos, '\\|') AS x(item)
+          WHERE LOWER(TRIM(x.item)) <> ''
+          GROUP BY LOWER(TRIM(x.item))
+        ) t
+        WHERE orden <= 10
+        UNION ALL
+        SELECT 'productos_top', producto, NULL, NULL, total, orden, NULL
+        FROM (
+          SELECT
+            producto,
+            COUNT(*) AS total,
+            ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC, producto ASC) AS orden
+          FROM (
+            SELECT CASE WHEN POSITION('otro:' IN LOWER(TRIM(x.item))) = 1 THEN 'otro' ELSE LOWER(TRIM(x.item)) END AS producto
+            FROM v_periodo v
+            CROSS JOIN LATERAL regexp_split_to_table(COALESCE(v.compra, ''), '\\|') AS x(item)
+            WHERE LOWER(TRIM(x.item)) <> ''
+          ) items
+          GROUP BY producto
+        ) t
+        WHERE orden <= 10
+        UNION ALL
+        SELECT 'top_pacientes_mes', NULL, paciente_id, paciente_nombre, total_ventas, orden, monto_total
+        FROM (
+          SELECT
+            v.paciente_id::bigint AS paciente_id,
+            CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) AS paciente_nombre,
+            COUNT(*) AS total_ventas,
+            COALESCE(SUM(v.monto_total), 0)::numeric AS monto_total,
+            ROW_NUMBER() OVER (
+              ORDER BY COALESCE(SUM(v.monto_total), 0) DESC, COUNT(*) DESC,
+                       CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) ASC
+            ) AS orden
+          FROM core.ventas v
+          JOIN core.pacientes p ON p.paciente_id = v.paciente_id
+          WHERE v.activo = true
+            AND p.activo = true
+            AND {sales_scope}
+            AND {_local_day_range_sql("v", "fecha_hora", "mes_desde", "mes_hasta")}
+            {p_name_sql}
+          GROUP BY v.paciente_id, 2
+        ) t
+        WHERE orden <= 10
+        UNION ALL
+        SELECT 'top_pacientes_consultas', NULL, paciente_id, paciente_nombre, total_consultas, orden, NULL
+        FROM (
+          SELECT
+            c.paciente_id::bigint AS paciente_id,
+            CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) AS paciente_nombre,
+            COUNT(*) AS total_consultas,
+            ROW_NUMBER() OVER (
+              ORDER BY COUNT(*) DESC,
+                       CONCAT_WS(' ', p.primer_nombre, p.segundo_nombre, p.apellido_paterno, p.apellido_materno) ASC
+            ) AS orden
+          FROM c_periodo c
+          JOIN core.pacientes p
+            ON p.paciente_id = c.paciente_id
+           AND p.sucursal_id = c.sucursal_id
+          WHERE p.activo = true
+            {p_name_sql}
+          GROUP BY c.paciente_id, 2
+        ) t
+        WHERE orden <= 10
+        UNION ALL
+        SELECT 'pacientes_serie', {pacientes_clave_sql}, NULL, NULL, SUM(p.pacientes)::bigint, NULL, NULL
+        FROM p_dias p
+        GROUP BY 2
+        UNION ALL
+        SELECT 'ventas_mes', mes::text, NULL, NULL, SUM(ventas)::bigint, NULL, COALESCE(SUM(monto_total), 0)::numeric
+        FROM v_anio
+        WHERE en_alcance
+        GROUP BY mes
+        UNION ALL
+        SELECT 'consultas_mes', EXTRACT(MONTH FROM c.dia)::int::text, NULL, NULL, SUM(c.consultas)::bigint, NULL, NULL
+        FROM core.rpt_consultas_diarias c
+        WHERE {physical_scope_c}
+          AND c.dia BETWEEN %(anio_desde)s AND %(anio_hasta)s
+        GROUP BY EXTRACT(MONTH FROM c.dia)
+        {admin_sections_sql};
+    """
+    resumen_params = {
+        "desde": fecha_desde,
+        "hasta": fecha_hasta,
+        "mes_desde": mes_actual_desde,
+        "mes_hasta": mes_actual_hasta,
+        "p_desde": p_desde,
+        "p_hasta": p_hasta,
+        "anio_desde": date(series_year, 1, 1),
+        "anio_hasta": date(series_year, 12, 31),
+        "q_like": q_like,
+    }
 
-                cur.execute(
-                    """
-                    SELECT
-                      p.sucursal_id,
-                      EXTRACT(MONTH FROM p.creado_en)::int AS mes_idx,
-                      COUNT(*)::int AS total
-                    FROM core.pacientes p
-                    JOIN core.sucursales s ON s.sucursal_id = p.sucursal_id
-                    WHERE p.activo = true
-                      AND s.activa = true
-                      AND EXTRACT(YEAR FROM p.creado_en) = %s
-                    GROUP BY p.sucursal_id, mes_idx
-                    ORDER BY p.sucursal_id ASC, mes_idx ASC;
-                    """,
-                    (series_year,),
-                )
-                admin_pacientes_mensuales_rows = cur.fetchall()
+    with db_connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            cur.execute(resumen_sql, resumen_params)
+            resumen_rows = cur.fetchall()
+
+    secciones: dict[str, list[tuple[Any, ...]]] = {}
+    for row in resumen_rows:
+        secciones.setdefault(row[0], []).append(row[1:])
+
+    def _ranked(seccion: str) -> list[tuple[Any, ...]]:
+        return sorted(secciones.get(seccion, []), key=lambda r: int(r[4]))
+
+    consultas_total_row = (secciones.get("consultas_total") or [(None, None, None, 0, 0, None)])[0]
+    c_total, c_no_show = consultas_total_row[3], consultas_total_row[4]
+    ventas_total_row = (secciones.get("ventas_total") or [(None, None, None, 0, None, 0)])[0]
+    v_total, v_monto_total = ventas_total_row[3], ventas_total_row[5]
+    consultas_dia_rows = [(r[0], r[3]) for r in secciones.get("consultas_dia", [])]
+    ventas_dia_rows = [(r[0], r[3]) for r in secciones.get("ventas_dia", [])]
+    ventas_metodo_rows = sorted(
+        ((r[0], r[3]) for r in secciones.get("ventas_metodo", [])),
+        key=lambda r: (-int(r[1] or 0), str(r[0])),
+    )
+    consultas_tipo_rows = [(r[0], r[3]) for r in _ranked("consultas_tipo")]
+    productos_top_rows = [(r[0], r[3]) for r in _ranked("productos_top")]
+    top_pacientes_mes_actual_rows = [(r[1], r[2], r[3], r[5]) for r in _ranked("top_pacientes_mes")]
+    top_pacientes_consultas_rows = [(r[1], r[2], r[3]) for r in _ranked("top_pacientes_consultas")]
+    ingresos_rows = [(int(r[0]), r[5]) for r in secciones.get("ventas_mes", [])]
+    ventas_mensuales_count_rows = [(int(r[0]), r[3]) for r in secciones.get("ventas_mes", [])]
+    consultas_mensuales_rows = [(int(r[0]), r[3]) for r in secciones.get("consultas_mes", [])]
+    admin_sucursales_rows = sorted(
+        ((r[1], r[2]) for r in secciones.get("sucursal", [])), key=lambda r: int(r[0])
+    )
+    admin_consultas_period_rows = [(r[1], r[3]) for r in secciones.get("consultas_periodo_sucursal", [])]
+    admin_ventas_mensuales_rows = [(r[1], int(r[0]), r[5]) for r in secciones.get("ventas_mes_sucursal", [])]
+    admin_pacientes_mensuales_rows = [(r[1], int(r[0]), r[3]) for r in secciones.get("pacientes_mes_sucursal", [])]
+
+    pacientes_map = {str(r[0]): int(r[3] or 0) for r in secciones.get("pacientes_serie", [])}
+    pacientes_series: list[dict[str, Any]] = []
+    if pacientes_modo_clean == "anio":
+        meses_label = ["Ene", "Feb", "Mar", "Abr", "May", "Jun", "Jul", "Ago", "Sep", "Oct", "Nov", "Dic"]
+        pacientes_series = [
+            {"etiqueta": meses_label[idx - 1], "total": int(pacientes_map.get(str(idx), 0))}
+            for idx in range(1, 13)
+        ]
+    else:
+        dcur = p_desde
+        while dcur <= p_hasta:
+            k = str(dcur)
+            pacientes_series.append({"etiqueta": k, "total": int(pacientes_map.get(k, 0))})
+            dcur += timedelta(days=1)
 
     def _series_map(rows: list[tuple[Any, int]]) -> dict[str, int]:
         return {str(r[0]): int(r[1]) for r in rows}
@@ -10957,27 +11668,12 @@ def listar_consultas(
     sucursal_id = force_sucursal(user, sucursal_id)
     tz_name = _timezone_for_sucursal(sucursal_id) if sucursal_id is not None else None
     search_tz = tz_name or "America/Mexico_City"
-    fecha_hora_local_expr = (
-        f"DATE(v.fecha_hora AT TIME ZONE '{tz_name}')"
-        if tz_name
-        else "DATE(v.fecha_hora)"
-    )
-    year_expr = (
-        f"EXTRACT(YEAR FROM v.fecha_hora AT TIME ZONE '{tz_name}')"
-        if tz_name
-        else "EXTRACT(YEAR FROM v.fecha_hora)"
-    )
-    month_expr = (
-        f"EXTRACT(MONTH FROM v.fecha_hora AT TIME ZONE '{tz_name}')"
-        if tz_name
-        else "EXTRACT(MONTH FROM v.fecha_hora)"
-    )
 
     where = ["v.activo = true"]
     params = []
 
     if sucursal_id is not None:
-        where.append("v.sucursal_id = %s")
+        where.append("consulta_base.sucursal_id = %s")
         params.append(sucursal_id)
 
     # Filtro por fecha:
@@ -10988,31 +11684,17 @@ def listar_consultas(
     if mes is not None and (mes < 1 or mes > 12):
         raise HTTPException(status_code=400, detail="Mes inválido. Debe ser entre 1 y 12.")
 
-    if fecha_desde and fecha_hasta:
-        where.append(f"{fecha_hora_local_expr} BETWEEN %s AND %s")
-        params.extend([fecha_desde, fecha_hasta])
-    elif fecha_desde:
-        where.append(f"{fecha_hora_local_expr} >= %s")
-        params.append(fecha_desde)
-    elif fecha_hasta:
-        where.append(f"{fecha_hora_local_expr} <= %s")
-        params.append(fecha_hasta)
-    elif anio is not None and mes is not None:
-        where.append(f"{year_expr} = %s")
-        where.append(f"{month_expr} = %s")
-        params.extend([anio, mes])
-    elif anio is not None:
-        where.append(f"{year_expr} = %s")
-        params.append(anio)
-    else:
-        # Si hay texto de búsqueda, no limitar automáticamente a "hoy"
-        if not (q and q.strip()):
-            if tz_name:
-                hoy_local = datetime.now(ZoneInfo(tz_name)).date()
-                where.append(f"{fecha_hora_local_expr} = %s")
-                params.append(hoy_local)
-            else:
-                where.append("DATE(v.fecha_hora) = CURRENT_DATE")
+    # Si hay texto de búsqueda, no limitar automáticamente a "hoy"
+    fecha_where, fecha_params = _fecha_local_filtro(
+        "consulta_base.fecha_local",
+        fecha_desde=fecha_desde,
+        fecha_hasta=fecha_hasta,
+        anio=anio,
+        mes=mes,
+        hoy=None if (q and q.strip()) else datetime.now(ZoneInfo(search_tz)).date(),
+    )
+    where.extend(fecha_where)
+    params.extend(fecha_params)
 
     if q and q.strip():
         qq = f"%{q.strip()}%"
@@ -11048,6 +11730,7 @@ def listar_consultas(
       v.etapa_consulta,
       v.motivo_consulta
     FROM core.consultas_detalle v
+    JOIN core.consultas consulta_base ON consulta_base.consulta_id = v.consulta_id
     {where_sql}
     ORDER BY v.fecha_hora DESC, v.consulta_id DESC
     LIMIT %s;
@@ -11055,7 +11738,7 @@ def listar_consultas(
 
     params.append(limit)
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(sql, tuple(params))
             rows = cur.fetchall()
@@ -11099,7 +11782,7 @@ def historial_consultas_paciente(
     require_roles(user, ("admin", "recepcion", "doctor"))
     sucursal_id = force_sucursal(user, sucursal_id)
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 "SELECT 1 FROM core.pacientes WHERE paciente_id = %s AND sucursal_id = %s AND activo = true;",
@@ -11167,7 +11850,7 @@ def historial_ventas_paciente(
     require_roles(user, ("admin", "recepcion", "doctor"))
     sucursal_id = force_sucursal(user, sucursal_id)
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 "SELECT 1 FROM core.pacientes WHERE paciente_id = %s AND sucursal_id = %s AND activo = true;",
@@ -11234,7 +11917,7 @@ def get_historia_clinica(
 
     sucursal_id = force_sucursal(user, sucursal_id)
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             query_historia = """
             SELECT historia_id, paciente_id, sucursal_id,
@@ -11325,7 +12008,7 @@ def get_historias_estado_batch(
     if not unique_ids:
         return {"sucursal_id": sucursal_id, "items": []}
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -11364,7 +12047,7 @@ def create_historia_clinica(
     sucursal_id = force_sucursal(user, sucursal_id)
     sanitize_model_strings(data)
 
-    with psycopg.connect(DB_CONNINFO) as conn:
+    with db_connect(DB_CONNINFO) as conn:
         with conn.cursor() as cur:
             _fetch_paciente_snapshot(cur, paciente_id, sucursal_id)
             inserted_or_reactivated = _ensure_historia_clinica_base(cur, paciente_id, sucursal_id, user["username"])
@@ -11444,11 +12127,11 @@ def crear_consulta(c: ConsultaCreate, user=Depends(get_current_user)):
     agenda_event_id: str | None = None
     agenda_calendar_id: str | None = None
     try:
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
 
                 cur.execute(
-                    "SELECT activa, nombre, ciudad, estado FROM core.sucursales WHERE sucursal_id = %s;",
+                    "SELECT activa FROM core.sucursales WHERE sucursal_id = %s;",
                     (c.sucursal_id,),
                 )
                 row = cur.fetchone()
@@ -11456,14 +12139,10 @@ def crear_consulta(c: ConsultaCreate, user=Depends(get_current_user)):
                     raise HTTPException(status_code=400, detail="Sucursal no existe.")
                 if row[0] is not True:
                     raise HTTPException(status_code=400, detail="Sucursal está inactiva.")
-                sucursal_nombre = str(row[1]).strip() if row[1] else None
-                ciudad = str(row[2]).strip() if row[2] else ""
-                estado = str(row[3]).strip() if row[3] else ""
-                sucursal_location = ", ".join([x for x in [ciudad, estado] if x]) or None
 
                 cur.execute(
                     """
-                    SELECT primer_nombre, segundo_nombre, apellido_paterno, apellido_materno, correo
+                    SELECT 1
                     FROM core.pacientes
                     WHERE paciente_id = %s
                       AND sucursal_id = %s
@@ -11471,11 +12150,8 @@ def crear_consulta(c: ConsultaCreate, user=Depends(get_current_user)):
                     """,
                     (c.paciente_id, c.sucursal_id),
                 )
-                paciente_row = cur.fetchone()
-                if paciente_row is None:
+                if cur.fetchone() is None:
                     raise HTTPException(status_code=400, detail="Paciente no existe/activo en esa sucursal.")
-                paciente_nombre = " ".join([x for x in paciente_row[:4] if x and str(x).strip()])
-                paciente_correo = str(paciente_row[4]).strip() if paciente_row[4] else None
 
                 agenda_start: datetime | None = None
                 agenda_end: datetime | None = None
@@ -11544,46 +12220,24 @@ def crear_consulta(c: ConsultaCreate, user=Depends(get_current_user)):
                 )
                 new_id = cur.fetchone()[0]
 
-                if calendar_enabled and agenda_start and agenda_end:
-                    doctor_nombre = " ".join(
-                        [
-                            x
-                            for x in [c.doctor_primer_nombre, c.doctor_apellido_paterno]
-                            if x and str(x).strip()
-                        ]
-                    )
-                    agenda_event_id, agenda_calendar_id = _create_calendar_event_for_consulta(
+                if calendar_enabled:
+                    enqueue_calendar_sync(
+                        cur,
                         consulta_id=new_id,
                         sucursal_id=c.sucursal_id,
-                        start_dt=agenda_start,
-                        end_dt=agenda_end,
-                        paciente_id=c.paciente_id,
-                        paciente_nombre=paciente_nombre,
-                        paciente_correo=paciente_correo,
-                        tipo_consulta=c.tipo_consulta,
-                        doctor_id=str(user.get("user_id") or user.get("username") or ""),
-                        doctor_nombre=doctor_nombre,
-                        sucursal_nombre=sucursal_nombre,
-                        sucursal_location=sucursal_location,
+                        operation="sincronizar",
+                        requested_by=str(user.get("user_id") or user.get("username") or ""),
                     )
-                    if agenda_event_id:
-                        cur.execute(
-                            """
-                            UPDATE core.consultas
-                            SET agenda_event_id = %s,
-                                agenda_calendar_id = %s
-                            WHERE consulta_id = %s
-                              AND sucursal_id = %s
-                            """,
-                            (agenda_event_id, agenda_calendar_id, new_id, c.sucursal_id),
-                        )
 
             conn.commit()
+        if calendar_enabled:
+            CALENDAR_OUTBOX.notify()
 
         return {
             "consulta_id": new_id,
             "agenda_event_id": agenda_event_id,
             "agenda_calendar_id": agenda_calendar_id,
+            "calendar_sync": "pendiente" if calendar_enabled else None,
         }
 
     except HTTPException:
@@ -11612,7 +12266,7 @@ def eliminar_consulta(consulta_id: int, sucursal_id: int, user=Depends(get_curre
     """
 
     try:
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
                 cur.execute(sql, (consulta_id, sucursal_id))
                 row = cur.fetchone()
@@ -11620,15 +12274,26 @@ def eliminar_consulta(consulta_id: int, sucursal_id: int, user=Depends(get_curre
                     raise HTTPException(status_code=404, detail="Consulta no existe en esa sucursal.")
                 agenda_event_id = row[1]
                 agenda_calendar_id = row[2]
-                if agenda_event_id:
-                    _delete_calendar_event_for_consulta(
+                calendar_queued = bool(agenda_event_id) or _calendar_feature_enabled()
+                if calendar_queued:
+                    enqueue_calendar_sync(
+                        cur,
+                        consulta_id=int(row[0]),
                         sucursal_id=sucursal_id,
-                        event_id=str(agenda_event_id),
-                        calendar_id_hint=str(agenda_calendar_id) if agenda_calendar_id else None,
+                        operation="eliminar",
+                        event_id=str(agenda_event_id) if agenda_event_id else None,
+                        calendar_id=str(agenda_calendar_id) if agenda_calendar_id else None,
                     )
             conn.commit()
+        if calendar_queued:
+            CALENDAR_OUTBOX.notify()
 
-        return {"deleted_consulta_id": row[0], "hard_deleted": True, "calendar_event_deleted": bool(row[1])}
+        return {
+            "deleted_consulta_id": row[0],
+            "hard_deleted": True,
+            "calendar_event_deleted": bool(row[1]),
+            "calendar_sync": "pendiente" if calendar_queued else None,
+        }
 
     except HTTPException:
         raise
@@ -11654,7 +12319,7 @@ def actualizar_consulta(consulta_id: int, c: ConsultaCreate, user=Depends(get_cu
     c.tipo_consulta = tipo_consulta_compuesto
 
     try:
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     "SELECT activa FROM core.sucursales WHERE sucursal_id = %s;",
@@ -11691,7 +12356,7 @@ def actualizar_consulta(consulta_id: int, c: ConsultaCreate, user=Depends(get_cu
                     WHERE consulta_id = %s
                       AND sucursal_id = %s
                       AND activo = true
-                    RETURNING consulta_id;
+                    RETURNING consulta_id, agenda_inicio IS NOT NULL;
                     """,
                     (
                         c.paciente_id,
@@ -11707,8 +12372,24 @@ def actualizar_consulta(consulta_id: int, c: ConsultaCreate, user=Depends(get_cu
                 updated = cur.fetchone()
                 if updated is None:
                     raise HTTPException(status_code=404, detail="Consulta no existe en esa sucursal o está inactiva.")
+                # El evento muestra paciente, doctor y motivo: se reenvía con los datos nuevos.
+                calendar_queued = bool(updated[1]) and _calendar_feature_enabled()
+                if calendar_queued:
+                    enqueue_calendar_sync(
+                        cur,
+                        consulta_id=int(updated[0]),
+                        sucursal_id=c.sucursal_id,
+                        operation="sincronizar",
+                        requested_by=str(user.get("user_id") or user.get("username") or ""),
+                    )
             conn.commit()
-        return {"consulta_id": updated[0], "updated": True}
+        if calendar_queued:
+            CALENDAR_OUTBOX.notify()
+        return {
+            "consulta_id": updated[0],
+            "updated": True,
+            "calendar_sync": "pendiente" if calendar_queued else None,
+        }
     except HTTPException:
         raise
     except Exception as e:
@@ -11725,7 +12406,7 @@ def eliminar_paciente(paciente_id: int, sucursal_id: int, user=Depends(get_curre
     
 
     try:
-        with psycopg.connect(DB_CONNINFO) as conn:
+        with db_connect(DB_CONNINFO) as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """
@@ -11743,7 +12424,7 @@ def eliminar_paciente(paciente_id: int, sucursal_id: int, user=Depends(get_curre
                         detail="Paciente no existe en esa sucursal.",
                     )
 
-                # Consultas ligadas para borrar también evento en Google Calendar.
+                # Consultas ligadas: su evento de Google Calendar se borra vía outbox.
                 cur.execute(
                     """
                     SELECT consulta_id, agenda_event_id, agenda_calendar_id
@@ -11755,18 +12436,18 @@ def eliminar_paciente(paciente_id: int, sucursal_id: int, user=Depends(get_curre
                 )
                 consultas_rows = cur.fetchall()
                 calendar_deleted = 0
-                for _, agenda_event_id, agenda_calendar_id in consultas_rows:
-                    if agenda_event_id:
-                        try:
-                            _delete_calendar_event_for_consulta(
-                                sucursal_id=sucursal_id,
-                                event_id=str(agenda_event_id),
-                                calendar_id_hint=str(agenda_calendar_id) if agenda_calendar_id else None,
-                            )
-                            calendar_deleted += 1
-                        except Exception:
-                            # Si falla Calendar, priorizamos limpieza de DB.
-                            pass
+                calendar_enabled = _calendar_feature_enabled()
+                for consulta_row_id, agenda_event_id, agenda_calendar_id in consultas_rows:
+                    if agenda_event_id or calendar_enabled:
+                        enqueue_calendar_sync(
+                            cur,
+                            consulta_id=int(consulta_row_id),
+                            sucursal_id=sucursal_id,
+                            operation="eliminar",
+                            event_id=str(agenda_event_id) if agenda_event_id else None,
+                            calendar_id=str(agenda_calendar_id) if agenda_calendar_id else None,
+                        )
+                        calendar_deleted += 1
 
                 cur.execute(
                     """
@@ -11829,6 +12510,8 @@ def eliminar_paciente(paciente_id: int, sucursal_id: int, user=Depends(get_curre
                 row = cur.fetchone()
 
             conn.commit()
+        if calendar_deleted:
+            CALENDAR_OUTBOX.notify()
 
         if row is None:
             raise HTTPException(
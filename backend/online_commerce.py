@@ -21,6 +21,7 @@ from pydantic import BaseModel, Field
 import psycopg
 from psycopg.rows import dict_row
 
+from idempotency import IDEMPOTENCY, IdempotencyConflict, IdempotencyInProgress, IdempotencyKeyInvalid
 from public_catalog import (
     PublicCatalogConfig,
     UnsafeImageUrl,
@@ -656,67 +657,27 @@ class CommerceRepository:
         owner: CommerceOwner,
         request_payload: dict[str, Any],
     ) -> tuple[int | None, dict[str, Any] | None]:
-        clean_key = key.strip()
-        if not clean_key or len(clean_key) > 200:
-            raise CommerceRuleError(400, "Idempotency-Key is required and must be valid.")
-        key_hash = _sha256(clean_key)
-        request_hash = _sha256(_canonical_json(request_payload))
-        cur.execute(
-            """
-            INSERT INTO core.online_idempotencia (
-                alcance, clave_hash, propietario_ref_hash, solicitud_hash, expira_at
-            ) VALUES (
-                %s, %s, %s, %s, NOW() + (%s * INTERVAL '1 hour')
+        try:
+            return IDEMPOTENCY.begin(
+                cur,
+                scope=scope,
+                key=key,
+                owner_hash=owner.owner_hash,
+                request_hash=_sha256(_canonical_json(request_payload)),
+                lifetime_hours=self.config.idempotency_lifetime_hours,
             )
-            ON CONFLICT (alcance, clave_hash) DO NOTHING
-            RETURNING idempotencia_id
-            """,
-            (
-                scope,
-                key_hash,
-                owner.owner_hash,
-                request_hash,
-                self.config.idempotency_lifetime_hours,
-            ),
-        )
-        inserted = cur.fetchone()
-        if inserted:
-            return int(inserted["idempotencia_id"]), None
-
-        cur.execute(
-            """
-            SELECT *
-            FROM core.online_idempotencia
-            WHERE alcance = %s AND clave_hash = %s
-            FOR UPDATE
-            """,
-            (scope, key_hash),
-        )
-        existing = cur.fetchone()
-        if (
-            existing["propietario_ref_hash"] != owner.owner_hash
-            or existing["solicitud_hash"] != request_hash
-        ):
+        except IdempotencyKeyInvalid:
+            raise CommerceRuleError(400, "Idempotency-Key is required and must be valid.")
+        except IdempotencyConflict:
             raise CommerceRuleError(409, "Idempotency-Key was already used differently.")
-        if existing["estado"] == "completado" and existing["respuesta"] is not None:
-            return None, existing["respuesta"]
-        raise CommerceRuleError(409, "The same request is already being processed.")
+        except IdempotencyInProgress:
+            raise CommerceRuleError(409, "The same request is already being processed.")
 
     @staticmethod
     def _idempotency_finish(
         cur, idempotency_id: int | None, result: dict[str, Any], resource_id: int | None
     ) -> None:
-        if idempotency_id is None:
-            return
-        cur.execute(
-            """
-            UPDATE core.online_idempotencia
-            SET estado = 'completado', recurso_id = %s, codigo_respuesta = 200,
-                respuesta = %s::jsonb, updated_at = NOW()
-            WHERE idempotencia_id = %s
-            """,
-            (resource_id, _canonical_json(_json_safe(result)), idempotency_id),
-        )
+        IDEMPOTENCY.finish(cur, idempotency_id, _canonical_json(_json_safe(result)), resource_id)
 
     def _mutate(
         self,
@@ -1404,9 +1365,10 @@ def create_online_commerce_router(
     *,
     config: CommerceConfig | None = None,
     repository: CommerceRepository | None = None,
+    connect: Callable[..., Any] = psycopg.connect,
 ) -> APIRouter:
     config = config or CommerceConfig.from_env(db_conninfo)
-    repository = repository or CommerceRepository(config)
+    repository = repository or CommerceRepository(config, connect)
     router = APIRouter(prefix="/storefront/commerce/v1", tags=["Online commerce"])
     bearer = HTTPBearer(auto_error=False)
 
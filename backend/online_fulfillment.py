@@ -23,6 +23,7 @@ from pydantic import BaseModel, Field, field_validator
 import psycopg
 from psycopg.rows import dict_row
 
+from idempotency import IDEMPOTENCY, IdempotencyConflict, IdempotencyInProgress, IdempotencyKeyInvalid
 from online_commerce import CommerceOwner, _valid_owner_hash
 from online_checkout_identity import CheckoutIdentityRepository, verify_authenticated_identity_assertion
 from online_optical_drafts import (
@@ -31,11 +32,14 @@ from online_optical_drafts import (
     release_expired_optical_reservations,
 )
 from shipping_packages import (
+    BinPackingPackageCalculator,
+    PackageCalculator,
     PackageRuleError,
     PackagingConfiguration,
     ProductShippingMeasurement,
     SingleCombinedPackageCalculator,
 )
+from shipping_providers import ShippingRateQuote, ShippingRateRegistry
 
 
 FULFILLMENT_SCHEMA_VERSION = "1.0"
@@ -111,6 +115,8 @@ class FulfillmentConfig:
     payment_sessions_enabled: bool = False
     default_shipping_enabled: bool = False
     default_shipping_price: Decimal = Decimal("99.00")
+    multi_package_enabled: bool = True
+    packing_time_budget_ms: int = 200
 
     @classmethod
     def from_env(cls, db_conninfo: str) -> "FulfillmentConfig":
@@ -120,6 +126,10 @@ class FulfillmentConfig:
             default_shipping_price = Decimal("99.00")
         if default_shipping_price < 0:
             default_shipping_price = Decimal("99.00")
+        try:
+            packing_time_budget_ms = max(10, int(os.getenv("SHIPPING_PACKING_TIME_BUDGET_MS", "200")))
+        except ValueError:
+            packing_time_budget_ms = 200
         return cls(
             db_conninfo=db_conninfo,
             bearer_token=os.getenv("ONLINE_COMMERCE_BEARER_TOKEN", "").strip(),
@@ -129,6 +139,8 @@ class FulfillmentConfig:
             payment_sessions_enabled=_env_bool("PHASE_1FC2A_ENABLED", False),
             default_shipping_enabled=_env_bool("ONLINE_DEFAULT_SHIPPING_ENABLED", False),
             default_shipping_price=default_shipping_price,
+            multi_package_enabled=_env_bool("SHIPPING_MULTI_PACKAGE_ENABLED", True),
+            packing_time_budget_ms=packing_time_budget_ms,
         )
 
 
@@ -251,6 +263,195 @@ class CarrierUpdateInput(BaseModel):
     name: str = Field(min_length=1, max_length=120)
 
 
+# Shipping requests remember what was quoted (packages, destination, branches)
+# so an identical cart to the same postal code can reuse live options.
+# Needs the phase1fb1 table; the runtime migration that runs it declares it
+# in ``requires`` so it is deferred, not recorded, until the table exists.
+QUOTE_REUSE_SCHEMA_TABLES = ("core.online_solicitudes_cotizacion_envio",)
+
+QUOTE_REUSE_SCHEMA_SQL = """
+ALTER TABLE core.online_solicitudes_cotizacion_envio
+  ADD COLUMN IF NOT EXISTS cotizacion_fingerprint CHAR(64) NULL;
+CREATE INDEX IF NOT EXISTS online_solicitudes_fingerprint_idx
+  ON core.online_solicitudes_cotizacion_envio (cotizacion_fingerprint, created_at DESC)
+  WHERE cotizacion_fingerprint IS NOT NULL;
+"""
+
+
+def quote_fingerprint(packages: list[dict[str, Any]], address: dict[str, Any], branch_ids: list[int]) -> str:
+    """What a shipping quote depends on: packages, destination CP/state and origin branches."""
+    return _hash(
+        {
+            "packages": packages,
+            "postalCode": str(address.get("postalCode") or "").strip(),
+            "state": " ".join(str(address.get("state") or "").split()).casefold(),
+            "branches": sorted(int(branch_id) for branch_id in branch_ids),
+        }
+    )
+
+
+def expire_quote_options(cur, *, limit: int = 500) -> int:
+    """Deactivate one chunk of expired shipping options; returns how many."""
+    cur.execute(
+        """
+        WITH due AS (
+            SELECT opcion_id
+            FROM core.online_opciones_cotizacion_envio
+            WHERE activa = TRUE AND expira_at <= NOW()
+            ORDER BY expira_at, opcion_id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE core.online_opciones_cotizacion_envio option
+        SET activa = FALSE, invalidada_at = NOW(), motivo_invalidez = 'expired'
+        FROM due
+        WHERE option.opcion_id = due.opcion_id
+        """,
+        (max(1, min(limit, 5000)),),
+    )
+    return cur.rowcount
+
+
+def expire_quote_requests(cur, *, limit: int = 500) -> int:
+    """Expire one chunk of requests left without a live option."""
+    cur.execute(
+        """
+        WITH due AS (
+            SELECT request.solicitud_id
+            FROM core.online_solicitudes_cotizacion_envio request
+            WHERE request.estado IN ('pendiente', 'cotizada')
+              AND request.expira_at <= NOW()
+              AND NOT EXISTS (
+                  SELECT 1 FROM core.online_opciones_cotizacion_envio option
+                  WHERE option.solicitud_id = request.solicitud_id
+                    AND option.activa = TRUE AND option.expira_at > NOW()
+              )
+            ORDER BY request.expira_at, request.solicitud_id
+            LIMIT %s
+            FOR UPDATE OF request SKIP LOCKED
+        )
+        UPDATE core.online_solicitudes_cotizacion_envio request
+        SET estado = 'expirada', updated_at = NOW()
+        FROM due
+        WHERE request.solicitud_id = due.solicitud_id
+        """,
+        (max(1, min(limit, 5000)),),
+    )
+    return cur.rowcount
+
+
+def release_expired_reservations(cur, *, limit: int = 100) -> int:
+    """Expire one chunk of inventory reservations inside the caller's transaction.
+
+    Reserved stock is returned with one UPDATE per chunk. Reservations whose
+    lines exceed what is still reserved (stale local state) are marked
+    terminal without touching inventory, as before.
+    """
+    cur.execute(
+        """
+        SELECT reserva_id, sucursal_id
+        FROM core.online_reservas
+        WHERE estado = 'activa' AND expires_at <= clock_timestamp()
+        ORDER BY expires_at, reserva_id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+        """,
+        (max(1, min(limit, 1000)),),
+    )
+    reservations = list(cur.fetchall())
+    if not reservations:
+        return 0
+    reservation_ids = [int(row["reserva_id"]) for row in reservations]
+    cur.execute(
+        """
+        SELECT reserva_id, producto_id, sucursal_id, cantidad
+        FROM core.online_reserva_lineas
+        WHERE reserva_id = ANY(%s)
+        ORDER BY reserva_id, reserva_linea_id
+        FOR UPDATE
+        """,
+        (reservation_ids,),
+    )
+    lines: dict[int, dict[tuple[int, int], int]] = {}
+    for row in cur.fetchall():
+        key = (int(row["producto_id"]), int(row["sucursal_id"]))
+        needed = lines.setdefault(int(row["reserva_id"]), {})
+        needed[key] = needed.get(key, 0) + int(row["cantidad"])
+    keys = sorted({key for needed in lines.values() for key in needed}, key=lambda key: (key[1], key[0]))
+    reserved: dict[tuple[int, int], int] = {}
+    if keys:
+        # Same (branch, product) lock order as reservation creation.
+        cur.execute(
+            """
+            SELECT inventory.producto_id, inventory.sucursal_id, inventory.stock_reservado
+            FROM core.catalogo_inventario_sucursal inventory
+            JOIN unnest(%s::bigint[], %s::bigint[]) AS released(producto_id, sucursal_id)
+              ON released.producto_id = inventory.producto_id
+             AND released.sucursal_id = inventory.sucursal_id
+            ORDER BY inventory.sucursal_id, inventory.producto_id
+            FOR UPDATE OF inventory
+            """,
+            ([key[0] for key in keys], [key[1] for key in keys]),
+        )
+        reserved = {
+            (int(row["producto_id"]), int(row["sucursal_id"])): int(row["stock_reservado"])
+            for row in cur.fetchall()
+        }
+    released: dict[tuple[int, int], int] = {}
+    events: list[tuple[int, str, str]] = []
+    for reservation in reservations:
+        reservation_id = int(reservation["reserva_id"])
+        needed = lines.get(reservation_id, {})
+        if any(reserved.get(key, 0) < quantity for key, quantity in needed.items()):
+            # A stale local reservation may already have had its stock
+            # released. Mark it terminal without decrementing again;
+            # never make inventory negative just to clean old state.
+            events.append((reservation_id, "reservation_expired_inconsistent_state", _canonical({"stockReleaseSkipped": True})))
+            continue
+        for key, quantity in needed.items():
+            reserved[key] -= quantity
+            released[key] = released.get(key, 0) + quantity
+        events.append((reservation_id, "reservation_expired", _canonical({"branchId": str(reservation["sucursal_id"])})))
+    if released:
+        cur.execute(
+            """
+            UPDATE core.catalogo_inventario_sucursal inventory
+            SET stock_reservado = inventory.stock_reservado - released.cantidad,
+                version = inventory.version + 1,
+                updated_at = NOW()
+            FROM unnest(%s::bigint[], %s::bigint[], %s::int[]) AS released(producto_id, sucursal_id, cantidad)
+            WHERE inventory.producto_id = released.producto_id
+              AND inventory.sucursal_id = released.sucursal_id
+            """,
+            (
+                [key[0] for key in released],
+                [key[1] for key in released],
+                list(released.values()),
+            ),
+        )
+    cur.execute(
+        """
+        UPDATE core.online_reservas
+        SET estado = 'expirada', released_at = NOW(), updated_at = NOW()
+        WHERE reserva_id = ANY(%s) AND estado = 'activa'
+        """,
+        (reservation_ids,),
+    )
+    cur.execute(
+        """
+        INSERT INTO core.online_reserva_eventos (reserva_id, evento_tipo, actor_tipo, metadata)
+        SELECT event.reserva_id, event.evento_tipo, 'sistema', event.metadata::jsonb
+        FROM unnest(%s::bigint[], %s::text[], %s::text[]) AS event(reserva_id, evento_tipo, metadata)
+        """,
+        (
+            [event[0] for event in events],
+            [event[1] for event in events],
+            [event[2] for event in events],
+        ),
+    )
+    return len(reservation_ids)
+
+
 class FulfillmentRepository:
     @staticmethod
     def _inventory_item(item: dict[str, Any]) -> bool:
@@ -292,38 +493,25 @@ class FulfillmentRepository:
         discount = (gross * Decimal("0.50")).quantize(Decimal("0.01"))
         return gross, discount, gross - discount
 
-    def __init__(self, config: FulfillmentConfig, connect: Callable[..., Any] = psycopg.connect):
+    def __init__(
+        self,
+        config: FulfillmentConfig,
+        connect: Callable[..., Any] = psycopg.connect,
+        rates: ShippingRateRegistry | None = None,
+    ):
         self.config = config
         self._connect = connect
-        self._calculator = SingleCombinedPackageCalculator()
+        self._rates = rates
+        self._calculator: PackageCalculator = (
+            BinPackingPackageCalculator(time_budget_seconds=config.packing_time_budget_ms / 1000)
+            if config.multi_package_enabled
+            else SingleCombinedPackageCalculator()
+        )
         self._checkout_identity = CheckoutIdentityRepository(connect, config)
 
     def _connection(self):
         return self._connect(self.config.db_conninfo, row_factory=dict_row)
 
-    @staticmethod
-    def _expire(cur) -> None:
-        cur.execute(
-            """
-            UPDATE core.online_opciones_cotizacion_envio
-            SET activa = FALSE, invalidada_at = NOW(), motivo_invalidez = 'expired'
-            WHERE activa = TRUE AND expira_at <= NOW()
-            """
-        )
-        cur.execute(
-            """
-            UPDATE core.online_solicitudes_cotizacion_envio request
-            SET estado = 'expirada', updated_at = NOW()
-            WHERE request.estado IN ('pendiente', 'cotizada')
-              AND request.expira_at <= NOW()
-              AND NOT EXISTS (
-                  SELECT 1 FROM core.online_opciones_cotizacion_envio option
-                  WHERE option.solicitud_id = request.solicitud_id
-                    AND option.activa = TRUE AND option.expira_at > NOW()
-              )
-            """
-        )
-
     @staticmethod
     def _event(
         cur,
@@ -567,6 +755,67 @@ class FulfillmentRepository:
         except PackageRuleError as exc:
             raise FulfillmentRuleError(422, exc.code, exc.message, exc.details) from exc
 
+    @staticmethod
+    def _branch_stock(
+        cur, items: list[dict[str, Any]], product_key: str, branch_id: int | None = None
+    ) -> dict[tuple[int, int], dict[str, Any]]:
+        """Stock and optical holds for every (active branch, item) pair in one statement.
+
+        Keys are ``(sucursal_id, item index)``; holds are locked ``FOR SHARE``
+        like ``_optical_hold_quantity`` does for a single pair.
+        """
+        if not items:
+            return {}
+        product_ids = [int(item[product_key]) for item in items]
+        draft_refs = [
+            str(ref) if (ref := (item.get("configuracion") or {}).get("opticalDraftId")) else None
+            for item in items
+        ]
+        present_refs = [ref for ref in draft_refs if ref]
+        cur.execute(
+            """
+            WITH item AS (
+              SELECT ordinal - 1 AS indice, producto_id, draft_ref
+              FROM unnest(%s::bigint[], %s::text[]) WITH ORDINALITY AS item(producto_id, draft_ref, ordinal)
+            ),
+            branch AS (
+              SELECT sucursal_id FROM core.sucursales
+              WHERE activa = TRUE AND (%s::bigint IS NULL OR sucursal_id = %s::bigint)
+            ),
+            hold AS (
+              SELECT draft.borrador_public_id::text AS public_ref, draft.borrador_id::text AS id_ref,
+                     config.armazon_producto_id, reservation.sucursal_id, reservation.cantidad
+              FROM core.online_borradores_opticos draft
+              JOIN core.online_configuraciones_opticas_borrador config USING (borrador_id)
+              JOIN core.online_reservas_opticas_borrador reservation USING (borrador_id)
+              WHERE (draft.borrador_public_id::text = ANY(%s::text[]) OR draft.borrador_id::text = ANY(%s::text[]))
+                AND config.armazon_producto_id = ANY(%s::bigint[])
+                AND reservation.sucursal_id IN (SELECT sucursal_id FROM branch)
+                AND reservation.estado = 'activa'
+                AND reservation.expires_at > NOW()
+              FOR SHARE OF reservation
+            )
+            SELECT branch.sucursal_id, item.indice,
+                   inventory.producto_id IS NOT NULL AS inventariado,
+                   COALESCE(inventory.disponible_venta, FALSE) AS disponible_venta,
+                   COALESCE(inventory.stock - inventory.stock_reservado, 0) AS disponible,
+                   COALESCE((
+                     SELECT SUM(hold.cantidad)
+                     FROM hold
+                     WHERE item.draft_ref IN (hold.public_ref, hold.id_ref)
+                       AND hold.armazon_producto_id = item.producto_id
+                       AND hold.sucursal_id = branch.sucursal_id
+                   ), 0) AS retenido
+            FROM branch
+            CROSS JOIN item
+            LEFT JOIN core.catalogo_inventario_sucursal inventory
+              ON inventory.sucursal_id = branch.sucursal_id
+             AND inventory.producto_id = item.producto_id
+            """,
+            (product_ids, draft_refs, branch_id, branch_id, present_refs, present_refs, product_ids),
+        )
+        return {(int(row["sucursal_id"]), int(row["indice"])): row for row in cur.fetchall()}
+
     @staticmethod
     def _eligible_branches(cur, items: list[dict[str, Any]]) -> list[dict[str, Any]]:
         controlled = [item for item in items if FulfillmentRepository._inventory_item(item)]
@@ -577,23 +826,16 @@ class FulfillmentRepository:
             FROM core.sucursales WHERE activa = TRUE ORDER BY sucursal_id
             """
         )
+        branches = list(cur.fetchall())
+        stock = FulfillmentRepository._branch_stock(cur, controlled, "producto_id")
         eligible = []
-        for branch in cur.fetchall():
+        for branch in branches:
             availability = []
             valid = True
-            for item in controlled:
-                cur.execute(
-                    """
-                    SELECT stock, stock_reservado, disponible_venta,
-                           GREATEST(stock - stock_reservado, 0) AS disponible
-                    FROM core.catalogo_inventario_sucursal
-                    WHERE sucursal_id = %s AND producto_id = %s
-                    """,
-                    (branch["sucursal_id"], item["producto_id"]),
-                )
-                inventory = cur.fetchone()
-                available = int(inventory["disponible"]) if inventory and inventory["disponible_venta"] else 0
-                available += FulfillmentRepository._optical_hold_quantity(cur, item, int(branch["sucursal_id"]))
+            for index, item in enumerate(controlled):
+                row = stock.get((int(branch["sucursal_id"]), index))
+                available = max(int(row["disponible"]), 0) if row and row["disponible_venta"] else 0
+                available += int(row["retenido"]) if row else 0
                 valid = valid and available >= int(item["cantidad"])
                 availability.append(
                     {"productId": str(item["producto_id"]), "requested": int(item["cantidad"]), "available": available}
@@ -608,21 +850,17 @@ class FulfillmentRepository:
         branch = cur.fetchone()
         if not branch or not branch["activa"]:
             return False
-        for item in cart_snapshot["items"]:
-            if not item["controlsStock"] or item.get("productType") == "componente_mica":
-                continue
-            cur.execute(
-                """
-                SELECT disponible_venta, stock - stock_reservado AS disponible
-                FROM core.catalogo_inventario_sucursal
-                WHERE sucursal_id = %s AND producto_id = %s
-                """,
-                (branch_id, int(item["productId"])),
-            )
-            inventory = cur.fetchone()
-            available = int(inventory["disponible"]) if inventory and inventory["disponible_venta"] else 0
-            available += FulfillmentRepository._optical_hold_quantity(cur, item, branch_id)
-            if not inventory or not inventory["disponible_venta"] or available < item["quantity"]:
+        checked = [
+            item
+            for item in cart_snapshot["items"]
+            if item["controlsStock"] and item.get("productType") != "componente_mica"
+        ]
+        stock = FulfillmentRepository._branch_stock(cur, checked, "productId", branch_id)
+        for index, item in enumerate(checked):
+            row = stock.get((branch_id, index))
+            if not row or not row["inventariado"] or not row["disponible_venta"]:
+                return False
+            if int(row["disponible"]) + int(row["retenido"]) < item["quantity"]:
                 return False
         return True
 
@@ -691,12 +929,16 @@ class FulfillmentRepository:
         cur.execute("SELECT costo_weight, speed_weight FROM core.envio_configuracion_empaque WHERE configuracion_id = 1")
         weights = cur.fetchone() or {"costo_weight": Decimal("0.60"), "speed_weight": Decimal("0.40")}
         labels = self._score_options(options, Decimal(weights["costo_weight"]), Decimal(weights["speed_weight"]))
+        status = row["estado"]
+        # The expiry worker may not have swept this request yet.
+        if status in {"pendiente", "cotizada"} and not options and row["expira_at"] <= datetime.now(timezone.utc):
+            status = "expirada"
         return _safe(
             {
                 "schemaVersion": FULFILLMENT_SCHEMA_VERSION,
                 "requestId": str(row["solicitud_public_id"]),
                 "method": "shipping" if row["metodo_entrega"] == "envio" else "pickup",
-                "status": STATUS_TO_API[row["estado"]],
+                "status": STATUS_TO_API[status],
                 "contact": row["contacto_snapshot"],
                 "address": row["direccion_snapshot"],
                 "packages": row["paquetes_snapshot"],
@@ -742,9 +984,9 @@ class FulfillmentRepository:
             raise FulfillmentRuleError(422, "ADDRESS_REQUIRED", "Completa una dirección de entrega en México.")
         if data.method == "pickup" and data.pickupBranchId is None:
             raise FulfillmentRuleError(422, "PICKUP_BRANCH_REQUIRED", "Selecciona una sucursal para recoger tu pedido.")
+        prequoted = self._prequote(owner, data)
         with self._connection() as conn:
             with conn.cursor() as cur:
-                self._expire(cur)
                 idempotency_id, cached = self._idempotency_begin(cur, owner, "fulfillment_request", key, data.model_dump(mode="json"))
                 if cached is not None:
                     return cached
@@ -772,6 +1014,11 @@ class FulfillmentRepository:
                     branches = [entry for entry in branches if int(entry["branch"]["sucursal_id"]) == data.pickupBranchId]
                 if not branches:
                     raise FulfillmentRuleError(409, "NO_SINGLE_BRANCH_FULFILLMENT", "No encontramos una sucursal disponible para completar tu pedido.")
+                fingerprint_quote = (
+                    quote_fingerprint(packages, data.address.model_dump(), [entry["branch"]["sucursal_id"] for entry in branches])
+                    if data.method == "shipping" and packages
+                    else None
+                )
                 cur.execute("SELECT solicitud_vigencia_horas FROM core.envio_configuracion_empaque WHERE configuracion_id = 1")
                 lifetime = int(cur.fetchone()["solicitud_vigencia_horas"])
                 cur.execute(
@@ -779,12 +1026,13 @@ class FulfillmentRepository:
                     INSERT INTO core.online_solicitudes_cotizacion_envio (
                         propietario_tipo, propietario_ref_hash, carrito_id, carrito_fingerprint,
                         metodo_entrega, estado, direccion_snapshot, contacto_snapshot,
-                        carrito_snapshot, paquetes_snapshot, expira_at, optical_draft_id
+                        carrito_snapshot, paquetes_snapshot, expira_at, optical_draft_id,
+                        cotizacion_fingerprint
                     ) VALUES (%s, %s, %s, %s, %s, 'pendiente', %s::jsonb, %s::jsonb, %s::jsonb, %s::jsonb,
                               NOW() + (%s * INTERVAL '1 hour'),
                               (SELECT borrador_id FROM core.online_borradores_opticos
                                WHERE borrador_public_id = %s AND propietario_tipo = %s
-                                 AND propietario_ref_hash = %s)) RETURNING *
+                                 AND propietario_ref_hash = %s), %s) RETURNING *
                     """,
                     (
                         owner.db_type, owner.owner_hash, cart["carrito_id"], fingerprint,
@@ -793,6 +1041,7 @@ class FulfillmentRepository:
                         _canonical(data.contact.model_dump()), _canonical(cart_snapshot),
                         _canonical(packages), lifetime,
                         optical_draft_id, owner.db_type, owner.owner_hash,
+                        fingerprint_quote,
                     ),
                 )
                 request = cur.fetchone()
@@ -832,6 +1081,18 @@ class FulfillmentRepository:
                     cur.execute("UPDATE core.online_solicitudes_cotizacion_envio SET estado = 'cotizada', updated_at = NOW() WHERE solicitud_id = %s RETURNING *", (request["solicitud_id"],))
                     request = cur.fetchone()
                     self._event(cur, request_id=request["solicitud_id"], option_id=option_id, event_type="pickup_option_created", actor_type="sistema", before="pendiente", after="cotizada")
+                elif fingerprint_quote and (reused := self._reuse_options(cur, request, fingerprint_quote)):
+                    cur.execute("UPDATE core.online_solicitudes_cotizacion_envio SET estado = 'cotizada', updated_at = NOW() WHERE solicitud_id = %s RETURNING *", (request["solicitud_id"],))
+                    request = cur.fetchone()
+                    self._event(cur, request_id=request["solicitud_id"], event_type="quote_options_reused", actor_type="sistema", before="pendiente", after="cotizada", metadata=reused)
+                elif (
+                    prequoted is not None
+                    and prequoted[0] == fingerprint_quote
+                    and (quoted := self._carrier_options(cur, request, prequoted[1], branches))
+                ):
+                    cur.execute("UPDATE core.online_solicitudes_cotizacion_envio SET estado = 'cotizada', updated_at = NOW() WHERE solicitud_id = %s RETURNING *", (request["solicitud_id"],))
+                    request = cur.fetchone()
+                    self._event(cur, request_id=request["solicitud_id"], event_type="carrier_options_created", actor_type="sistema", before="pendiente", after="cotizada", metadata={"optionCount": quoted})
                 elif self.config.default_shipping_enabled and not packages:
                     # Local development fallback: one simple standard option while
                     # carrier/package configuration is intentionally unavailable.
@@ -873,45 +1134,160 @@ class FulfillmentRepository:
             return result
 
     @staticmethod
-    def _idempotency_begin(cur, owner: CommerceOwner, scope: str, key: str, payload: dict[str, Any]):
-        clean = key.strip()
-        if not clean or len(clean) > 200:
-            raise FulfillmentRuleError(400, "IDEMPOTENCY_KEY_REQUIRED", "A valid Idempotency-Key is required.")
-        key_hash, request_hash = hashlib.sha256(clean.encode()).hexdigest(), _hash(payload)
+    def _reuse_source(cur, fingerprint_quote: str, exclude_request_id: int | None = None) -> dict[str, Any] | None:
+        """Latest other request with the same fingerprint and live carrier options."""
         cur.execute(
             """
-            INSERT INTO core.online_idempotencia
-                (alcance, clave_hash, propietario_ref_hash, solicitud_hash, expira_at)
-            VALUES (%s, %s, %s, %s, NOW() + INTERVAL '24 hours')
-            ON CONFLICT (alcance, clave_hash) DO NOTHING RETURNING idempotencia_id
+            SELECT s.solicitud_id, s.solicitud_public_id
+            FROM core.online_solicitudes_cotizacion_envio s
+            WHERE s.cotizacion_fingerprint = %s
+              AND s.solicitud_id IS DISTINCT FROM %s
+              AND s.estado <> 'cancelada'
+              AND EXISTS (
+                  SELECT 1 FROM core.online_opciones_cotizacion_envio o
+                  WHERE o.solicitud_id = s.solicitud_id AND o.activa = TRUE
+                    AND o.expira_at > NOW() AND o.transportista_codigo_snapshot <> 'dev-default'
+              )
+            ORDER BY s.created_at DESC, s.solicitud_id DESC
+            LIMIT 1
             """,
-            (scope, key_hash, owner.owner_hash, request_hash),
+            (fingerprint_quote, exclude_request_id),
         )
-        inserted = cur.fetchone()
-        if inserted:
-            return int(inserted["idempotencia_id"]), None
-        cur.execute("SELECT * FROM core.online_idempotencia WHERE alcance = %s AND clave_hash = %s FOR UPDATE", (scope, key_hash))
-        existing = cur.fetchone()
-        if existing["propietario_ref_hash"] != owner.owner_hash or existing["solicitud_hash"] != request_hash:
-            raise FulfillmentRuleError(409, "IDEMPOTENCY_CONFLICT", "Idempotency-Key was already used differently.")
-        if existing["estado"] == "completado" and existing["respuesta"] is not None:
-            return None, existing["respuesta"]
-        raise FulfillmentRuleError(409, "REQUEST_IN_PROGRESS", "The same request is already being processed.")
+        return cur.fetchone()
 
     @staticmethod
-    def _idempotency_finish(cur, row_id: int | None, result: dict[str, Any], resource_id: int):
-        if row_id is not None:
+    def _reuse_options(cur, request: dict[str, Any], fingerprint_quote: str) -> dict[str, Any] | None:
+        """Copies the live options of the latest request with the same fingerprint.
+
+        Copies keep their own expiry (capped by the new request's) and who
+        entered or authorised them; development defaults depend on the cart
+        subtotal rather than the packages, so they are never reused.
+        """
+        source = FulfillmentRepository._reuse_source(cur, fingerprint_quote, request["solicitud_id"])
+        if source is None:
+            return None
+        cur.execute(
+            """
+            INSERT INTO core.online_opciones_cotizacion_envio (
+                solicitud_id, sucursal_id, transportista_id, transportista_codigo_snapshot,
+                transportista_nombre_snapshot, nivel_servicio_snapshot, monto, moneda,
+                entrega_min_dias, entrega_max_dias, quote_identifier, calculada_at, expira_at,
+                ingresada_por_usuario_id, ingresada_por_rol, autorizacion_cero_razon,
+                autorizada_cero_por_usuario_id, autorizada_cero_at
+            )
+            SELECT %s, o.sucursal_id, o.transportista_id, o.transportista_codigo_snapshot,
+                   o.transportista_nombre_snapshot, o.nivel_servicio_snapshot, o.monto, o.moneda,
+                   o.entrega_min_dias, o.entrega_max_dias, o.quote_identifier, o.calculada_at,
+                   LEAST(o.expira_at, %s), o.ingresada_por_usuario_id, o.ingresada_por_rol,
+                   o.autorizacion_cero_razon, o.autorizada_cero_por_usuario_id, o.autorizada_cero_at
+            FROM core.online_opciones_cotizacion_envio o
+            WHERE o.solicitud_id = %s AND o.activa = TRUE AND o.expira_at > NOW()
+              AND o.transportista_codigo_snapshot <> 'dev-default'
+            ORDER BY o.opcion_id
+            """,
+            (request["solicitud_id"], request["expira_at"], source["solicitud_id"]),
+        )
+        return {"sourceRequestId": str(source["solicitud_public_id"]), "optionCount": cur.rowcount}
+
+    def _prequote(self, owner: CommerceOwner, data: CreateFulfillmentRequest) -> tuple[str, list[ShippingRateQuote]] | None:
+        """Carrier quotes fetched before ``create_request`` opens its transaction.
+
+        Carriers are called over the network, so they must not run while the
+        idempotency row and the optical draft locks are held.  A short
+        read-only pass derives the packages and origins, and the quotes are
+        returned with the fingerprint they were made for; ``create_request``
+        only uses them when the fingerprint it computes under its locks still
+        matches.  Nothing is quoted when options can be reused or when the
+        cart cannot be quoted (``create_request`` reports that itself).
+        """
+        if data.method != "shipping" or data.address is None or self._rates is None:
+            return None
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    _cart, items = self._cart(cur, owner)
+                    packages = self._packages(cur, items)
+                    branches = [entry for entry in self._eligible_branches(cur, items) if entry["branch"].get("cp")]
+                    fingerprint_quote = (
+                        quote_fingerprint(packages, data.address.model_dump(), [entry["branch"]["sucursal_id"] for entry in branches])
+                        if packages and branches
+                        else None
+                    )
+                    reusable = fingerprint_quote is not None and self._reuse_source(cur, fingerprint_quote) is not None
+                # Releases the cart row lock before any carrier is called.
+                conn.rollback()
+        except FulfillmentRuleError:
+            return None
+        if fingerprint_quote is None or reusable:
+            return None
+        # The registry answers from its cache or within its per-carrier
+        # timeout, so this stays bounded even when a carrier is slow or down.
+        origins = {int(entry["branch"]["sucursal_id"]): entry["branch"] for entry in branches}
+        quotes = self._rates.quote(
+            {
+                "packages": packages,
+                "destinationPostalCode": data.address.postalCode,
+                "origins": [{"branchId": branch_id, "postalCode": branch.get("cp")} for branch_id, branch in origins.items()],
+            }
+        )
+        return fingerprint_quote, list(quotes)
+
+    def _carrier_options(self, cur, request: dict[str, Any], quotes: list[ShippingRateQuote], branches: list[dict[str, Any]]) -> int:
+        """Inserts prefetched carrier quotes (see ``_prequote``) as system options; returns how many."""
+        origins = {int(entry["branch"]["sucursal_id"]): entry["branch"] for entry in branches}
+        usable: list[ShippingRateQuote] = [
+            quote for quote in quotes
+            if quote.branch_id in origins
+            and quote.currency == "MXN"
+            and quote.amount > 0
+            and 0 <= quote.minimum_delivery_days <= quote.maximum_delivery_days
+            and quote.service_level.strip()
+        ]
+        if not usable:
+            return 0
+        cur.execute(
+            "SELECT codigo, transportista_id FROM core.envio_transportistas WHERE activo = TRUE AND codigo = ANY(%s)",
+            (sorted({quote.carrier_code for quote in usable}),),
+        )
+        carriers = {row["codigo"]: row["transportista_id"] for row in cur.fetchall()}
+        for quote in usable:
             cur.execute(
-                """UPDATE core.online_idempotencia SET estado = 'completado', recurso_id = %s,
-                   codigo_respuesta = 200, respuesta = %s::jsonb, updated_at = NOW()
-                   WHERE idempotencia_id = %s""",
-                (resource_id, _canonical(result), row_id),
+                """
+                INSERT INTO core.online_opciones_cotizacion_envio (
+                    solicitud_id, sucursal_id, transportista_id, transportista_codigo_snapshot,
+                    transportista_nombre_snapshot, nivel_servicio_snapshot, monto,
+                    entrega_min_dias, entrega_max_dias, quote_identifier, calculada_at,
+                    expira_at, ingresada_por_rol
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, LEAST(%s, %s), 'sistema')
+                """,
+                (
+                    request["solicitud_id"], quote.branch_id, carriers.get(quote.carrier_code),
+                    quote.carrier_code, quote.carrier_display_name, quote.service_level,
+                    quote.amount.quantize(Decimal("0.01")), quote.minimum_delivery_days,
+                    quote.maximum_delivery_days, quote.quote_identifier, quote.calculated_at,
+                    quote.expires_at, request["expira_at"],
+                ),
             )
+        return len(usable)
+
+    @staticmethod
+    def _idempotency_begin(cur, owner: CommerceOwner, scope: str, key: str, payload: dict[str, Any]):
+        try:
+            return IDEMPOTENCY.begin(cur, scope=scope, key=key, owner_hash=owner.owner_hash, request_hash=_hash(payload))
+        except IdempotencyKeyInvalid:
+            raise FulfillmentRuleError(400, "IDEMPOTENCY_KEY_REQUIRED", "A valid Idempotency-Key is required.")
+        except IdempotencyConflict:
+            raise FulfillmentRuleError(409, "IDEMPOTENCY_CONFLICT", "Idempotency-Key was already used differently.")
+        except IdempotencyInProgress:
+            raise FulfillmentRuleError(409, "REQUEST_IN_PROGRESS", "The same request is already being processed.")
+
+    @staticmethod
+    def _idempotency_finish(cur, row_id: int | None, result: dict[str, Any], resource_id: int):
+        IDEMPOTENCY.finish(cur, row_id, _canonical(result), resource_id)
 
     def list_requests(self, owner: CommerceOwner) -> dict[str, Any]:
         with self._connection() as conn:
             with conn.cursor() as cur:
-                self._expire(cur)
                 cur.execute(
                     """SELECT * FROM core.online_solicitudes_cotizacion_envio
                        WHERE propietario_tipo = %s AND propietario_ref_hash = %s
@@ -943,7 +1319,6 @@ class FulfillmentRepository:
     def get_request(self, owner: CommerceOwner, public_id: str) -> dict[str, Any]:
         with self._connection() as conn:
             with conn.cursor() as cur:
-                self._expire(cur)
                 cur.execute(
                     """SELECT * FROM core.online_solicitudes_cotizacion_envio
                        WHERE solicitud_public_id = %s AND propietario_tipo = %s AND propietario_ref_hash = %s""",
@@ -959,7 +1334,6 @@ class FulfillmentRepository:
     def select_option(self, owner: CommerceOwner, public_id: str, option_public_id: str, key: str) -> dict[str, Any]:
         with self._connection() as conn:
             with conn.cursor() as cur:
-                self._expire(cur)
                 idempotency_id, cached = self._idempotency_begin(cur, owner, "fulfillment_select", key, {"requestId": public_id, "optionId": option_public_id})
                 if cached is not None:
                     return cached
@@ -1135,6 +1509,10 @@ class FulfillmentRepository:
             }
             for row in cur.fetchall()
         ]
+        status = reservation["estado"]
+        # The expiry worker may not have released this reservation yet.
+        if status == "activa" and reservation["expires_at"] <= datetime.now(timezone.utc):
+            status = "expirada"
         return _safe(
             {
                 "schemaVersion": FULFILLMENT_SCHEMA_VERSION,
@@ -1143,7 +1521,7 @@ class FulfillmentRepository:
                 "selectedOptionId": str(reservation["opcion_public_id"]),
                 "branchId": str(reservation["sucursal_id"]),
                 "branchName": reservation["branch_name"],
-                "status": RESERVATION_STATUS_TO_API[reservation["estado"]],
+                "status": RESERVATION_STATUS_TO_API[status],
                 "createdAt": reservation["created_at"],
                 "expiresAt": reservation["expires_at"],
                 "releasedAt": reservation["released_at"],
@@ -1242,67 +1620,6 @@ class FulfillmentRepository:
                 ),
             )
 
-    def _release_expired_reservations(self, cur, *, limit: int = 100) -> int:
-        cur.execute(
-            """
-            SELECT reserva_id
-            FROM core.online_reservas
-            WHERE estado = 'activa' AND expires_at <= clock_timestamp()
-            ORDER BY expires_at, reserva_id
-            LIMIT %s
-            FOR UPDATE SKIP LOCKED
-            """,
-            (max(1, min(limit, 1000)),),
-        )
-        reservation_ids = [int(row["reserva_id"]) for row in cur.fetchall()]
-        released = 0
-        for reservation_id in reservation_ids:
-            cur.execute(self._reservation_query() + " FOR UPDATE", (reservation_id,))
-            reservation = cur.fetchone()
-            if reservation and reservation["estado"] == "activa" and reservation["expires_at"] <= datetime.now(timezone.utc):
-                cur.execute(
-                    """
-                    SELECT line.producto_id, line.sucursal_id, line.cantidad,
-                           inventory.stock_reservado
-                    FROM core.online_reserva_lineas line
-                    LEFT JOIN core.catalogo_inventario_sucursal inventory
-                      ON inventory.producto_id = line.producto_id
-                     AND inventory.sucursal_id = line.sucursal_id
-                    WHERE line.reserva_id = %s
-                    """,
-                    (reservation_id,),
-                )
-                inconsistent = any(
-                    row["stock_reservado"] is None
-                    or int(row["stock_reservado"]) < int(row["cantidad"])
-                    for row in cur.fetchall()
-                )
-                if inconsistent:
-                    # A stale local reservation may already have had its stock
-                    # released. Mark it terminal without decrementing again;
-                    # never make inventory negative just to clean old state.
-                    cur.execute(
-                        """
-                        UPDATE core.online_reservas
-                        SET estado = 'expirada', released_at = NOW(), updated_at = NOW()
-                        WHERE reserva_id = %s AND estado = 'activa'
-                        """,
-                        (reservation_id,),
-                    )
-                    cur.execute(
-                        """
-                        INSERT INTO core.online_reserva_eventos
-                            (reserva_id, evento_tipo, actor_tipo, metadata)
-                        VALUES (%s, 'reservation_expired_inconsistent_state', 'sistema', %s::jsonb)
-                        """,
-                        (reservation_id, _canonical({"stockReleaseSkipped": True})),
-                    )
-                    released += 1
-                    continue
-                self._release_reservation(cur, reservation, status="expirada", actor_type="sistema")
-                released += 1
-        return released
-
     def create_reservation(self, owner: CommerceOwner, public_id: str, key: str) -> dict[str, Any]:
         with self._connection() as conn:
             with conn.cursor() as cur:
@@ -1312,7 +1629,6 @@ class FulfillmentRepository:
                 if cached is not None:
                     conn.commit()
                     return cached
-                self._release_expired_reservations(cur)
                 cur.execute(
                     """
                     SELECT *
@@ -1341,10 +1657,14 @@ class FulfillmentRepository:
                 existing_id = cur.fetchone()
                 if existing_id:
                     cur.execute(self._reservation_query(), (existing_id["reserva_id"],))
-                    result = self._reservation_payload(cur, cur.fetchone())
-                    self._idempotency_finish(cur, idempotency_id, result, int(existing_id["reserva_id"]))
-                    conn.commit()
-                    return result
+                    existing = cur.fetchone()
+                    if existing["expires_at"] > datetime.now(timezone.utc):
+                        result = self._reservation_payload(cur, existing)
+                        self._idempotency_finish(cur, idempotency_id, result, int(existing_id["reserva_id"]))
+                        conn.commit()
+                        return result
+                    # Not swept yet; only one active reservation may exist per request.
+                    self._release_reservation(cur, existing, status="expirada", actor_type="sistema")
                 cur.execute(
                     """
                     SELECT selection.seleccion_id, option.*, branch.nombre AS branch_name
@@ -1466,7 +1786,6 @@ class FulfillmentRepository:
     def get_reservation(self, owner: CommerceOwner, public_id: str) -> dict[str, Any]:
         with self._connection() as conn:
             with conn.cursor() as cur:
-                self._release_expired_reservations(cur)
                 cur.execute(
                     self._reservation_query().replace("WHERE reservation.reserva_id = %s", "WHERE request.solicitud_public_id = %s AND request.propietario_tipo = %s AND request.propietario_ref_hash = %s ORDER BY reservation.created_at DESC LIMIT 1"),
                     (public_id, owner.db_type, owner.owner_hash),
@@ -1487,7 +1806,6 @@ class FulfillmentRepository:
                 if cached is not None:
                     conn.commit()
                     return cached
-                self._release_expired_reservations(cur)
                 cur.execute(
                     self._reservation_query().replace("WHERE reservation.reserva_id = %s", "WHERE request.solicitud_public_id = %s AND request.propietario_tipo = %s AND request.propietario_ref_hash = %s ORDER BY reservation.created_at DESC LIMIT 1 FOR UPDATE"),
                     (public_id, owner.db_type, owner.owner_hash),
@@ -1496,7 +1814,11 @@ class FulfillmentRepository:
                 if not reservation:
                     raise FulfillmentRuleError(404, "RESERVATION_NOT_FOUND", "No reservation exists for this checkout request.")
                 if reservation["estado"] == "activa":
-                    self._release_reservation(cur, reservation, status="liberada", actor_type=owner.db_type, owner_hash=owner.owner_hash)
+                    if reservation["expires_at"] <= datetime.now(timezone.utc):
+                        # Not swept yet: record it as expired, as the worker would.
+                        self._release_reservation(cur, reservation, status="expirada", actor_type="sistema")
+                    else:
+                        self._release_reservation(cur, reservation, status="liberada", actor_type=owner.db_type, owner_hash=owner.owner_hash)
                     cur.execute(self._reservation_query(), (reservation["reserva_id"],))
                     reservation = cur.fetchone()
                 result = self._reservation_payload(cur, reservation)
@@ -1582,7 +1904,6 @@ class FulfillmentRepository:
                 if cached is not None:
                     conn.commit()
                     return cached
-                self._release_expired_reservations(cur)
                 cur.execute(
                     """
                     SELECT *
@@ -2055,7 +2376,6 @@ class FulfillmentAdminRepository(PaymentSessionRepositoryMixin):
         with self._connection() as conn:
             with conn.cursor() as cur:
                 staff = self._staff(cur, user)
-                self._customer._expire(cur)
                 status_filter = STATUS_FROM_API.get(status, status) if status else None
                 query = """SELECT request.*, cart.item_count FROM core.online_solicitudes_cotizacion_envio request
                            LEFT JOIN LATERAL (
@@ -2079,7 +2399,6 @@ class FulfillmentAdminRepository(PaymentSessionRepositoryMixin):
         with self._connection() as conn:
             with conn.cursor() as cur:
                 self._staff(cur, user)
-                self._customer._expire(cur)
                 cur.execute("SELECT * FROM core.online_solicitudes_cotizacion_envio WHERE solicitud_public_id = %s", (public_id,))
                 request = cur.fetchone()
                 if not request:
@@ -2094,7 +2413,6 @@ class FulfillmentAdminRepository(PaymentSessionRepositoryMixin):
         with self._connection() as conn:
             with conn.cursor() as cur:
                 staff = self._staff(cur, user)
-                self._customer._release_expired_reservations(cur)
                 params: tuple[Any, ...] = ()
                 query = """
                     SELECT reservation.*, request.solicitud_public_id,
@@ -2129,7 +2447,7 @@ class FulfillmentAdminRepository(PaymentSessionRepositoryMixin):
         with self._connection() as conn:
             with conn.cursor() as cur:
                 staff = self._staff(cur, user, admin_only=True)
-                normal_released = self._customer._release_expired_reservations(cur, limit=1000)
+                normal_released = release_expired_reservations(cur, limit=1000)
                 optical_released = release_expired_optical_reservations(cur, limit=1000)
                 released = normal_released + optical_released
             conn.commit()
@@ -2348,9 +2666,9 @@ def _run(action: Callable[[], dict[str, Any]]) -> dict[str, Any]:
         raise HTTPException(status_code=503, detail={"code": "FULFILLMENT_UNAVAILABLE", "message": "Fulfillment is temporarily unavailable.", "details": {}})
 
 
-def create_storefront_fulfillment_router(db_conninfo: str, config: FulfillmentConfig | None = None, repository: FulfillmentRepository | None = None) -> APIRouter:
+def create_storefront_fulfillment_router(db_conninfo: str, config: FulfillmentConfig | None = None, repository: FulfillmentRepository | None = None, connect: Callable[..., Any] = psycopg.connect, rates: ShippingRateRegistry | None = None) -> APIRouter:
     config = config or FulfillmentConfig.from_env(db_conninfo)
-    repository = repository or FulfillmentRepository(config)
+    repository = repository or FulfillmentRepository(config, connect, rates=rates)
     router = APIRouter(prefix="/storefront/fulfillment/v1", tags=["Online fulfillment"])
     bearer = HTTPBearer(auto_error=False)
 
@@ -2442,9 +2760,9 @@ def create_storefront_fulfillment_router(db_conninfo: str, config: FulfillmentCo
     return router
 
 
-def create_admin_fulfillment_router(db_conninfo: str, current_user_dependency: Callable[..., Any], config: FulfillmentConfig | None = None, repository: FulfillmentAdminRepository | None = None) -> APIRouter:
+def create_admin_fulfillment_router(db_conninfo: str, current_user_dependency: Callable[..., Any], config: FulfillmentConfig | None = None, repository: FulfillmentAdminRepository | None = None, connect: Callable[..., Any] = psycopg.connect) -> APIRouter:
     config = config or FulfillmentConfig.from_env(db_conninfo)
-    repository = repository or FulfillmentAdminRepository(config)
+    repository = repository or FulfillmentAdminRepository(config, connect)
     router = APIRouter(prefix="/online-fulfillment/admin/v1", tags=["Online fulfillment admin"])
 
     def enabled():
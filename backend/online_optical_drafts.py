@@ -22,6 +22,7 @@ from pydantic import BaseModel, ConfigDict, Field
 import psycopg
 from psycopg.rows import dict_row
 
+from idempotency import IDEMPOTENCY, IdempotencyConflict, IdempotencyInProgress, IdempotencyKeyInvalid
 from online_commerce import CommerceOwner, _valid_owner_hash
 from optical_preview import (
     OPTICAL_PREVIEW_SCHEMA_VERSION,
@@ -141,91 +142,98 @@ def _event(
 
 
 def release_expired_optical_reservations(cur, *, limit: int = 100) -> int:
-    """Release expired optical frame holds inside the caller's transaction."""
+    """Release one chunk of expired optical frame holds inside the caller's transaction."""
     cur.execute("SELECT to_regclass('core.online_reservas_opticas_borrador') AS relation")
     if cur.fetchone()["relation"] is None:
         return 0
     cur.execute(
         """
-        SELECT reserva_id
-        FROM core.online_reservas_opticas_borrador
-        WHERE estado = 'activa' AND expires_at <= clock_timestamp()
-        ORDER BY expires_at, reserva_id
+        SELECT reservation.reserva_id, reservation.borrador_id,
+               reservation.armazon_producto_id, reservation.sucursal_id
+        FROM core.online_reservas_opticas_borrador reservation
+        JOIN core.online_borradores_opticos draft
+          ON draft.borrador_id = reservation.borrador_id
+        WHERE reservation.estado = 'activa' AND reservation.expires_at <= clock_timestamp()
+        ORDER BY reservation.expires_at, reservation.reserva_id
         LIMIT %s
-        FOR UPDATE SKIP LOCKED
+        FOR UPDATE OF reservation, draft SKIP LOCKED
         """,
         (max(1, min(limit, 1000)),),
     )
-    ids = [int(row["reserva_id"]) for row in cur.fetchall()]
-    released = 0
-    for reservation_id in ids:
-        cur.execute(
-            """
-            SELECT reservation.*, draft.estado AS draft_state
-            FROM core.online_reservas_opticas_borrador reservation
-            JOIN core.online_borradores_opticos draft
-              ON draft.borrador_id = reservation.borrador_id
-            WHERE reservation.reserva_id = %s
-            FOR UPDATE OF reservation, draft
-            """,
-            (reservation_id,),
-        )
-        reservation = cur.fetchone()
-        if not reservation or reservation["estado"] != "activa":
-            continue
-        cur.execute(
-            """
-            SELECT stock_reservado
-            FROM core.catalogo_inventario_sucursal
-            WHERE producto_id = %s AND sucursal_id = %s
-            FOR UPDATE
-            """,
-            (reservation["armazon_producto_id"], reservation["sucursal_id"]),
-        )
-        inventory = cur.fetchone()
-        if not inventory or int(inventory["stock_reservado"]) < 1:
-            raise OpticalDraftRuleError(
-                409, "OPTICAL_RESERVATION_INTEGRITY_ERROR",
-                "Reserved frame inventory does not match the optical draft reservation.",
-            )
-        cur.execute(
-            """
-            UPDATE core.catalogo_inventario_sucursal
-            SET stock_reservado = stock_reservado - 1,
-                version = version + 1, updated_at = NOW()
-            WHERE producto_id = %s AND sucursal_id = %s
-              AND stock_reservado >= 1
-            """,
-            (reservation["armazon_producto_id"], reservation["sucursal_id"]),
-        )
-        if cur.rowcount != 1:
-            raise OpticalDraftRuleError(409, "OPTICAL_RESERVATION_INTEGRITY_ERROR", "Frame hold could not be released safely.")
-        cur.execute(
-            """
-            UPDATE core.online_reservas_opticas_borrador
-            SET estado = 'expirada', released_at = NOW(), updated_at = NOW()
-            WHERE reserva_id = %s AND estado = 'activa'
-            """,
-            (reservation_id,),
-        )
-        cur.execute(
-            """
-            UPDATE core.online_borradores_opticos
-            SET estado = 'expirado', expirado_at = NOW(), updated_at = NOW()
-            WHERE borrador_id = %s AND estado NOT IN ('cancelado', 'expirado')
-            """,
-            (reservation["borrador_id"],),
-        )
-        _event(
-            cur, draft_id=int(reservation["borrador_id"]), reservation_id=reservation_id,
-            event_type="reservation_expired", actor_type="sistema", owner_hash=None,
-            metadata={"releasedFrameQuantity": 1},
-        )
-        cancel_job_for_online_draft(
-            cur, int(reservation["borrador_id"]), "cancelado_por_expiracion"
+    reservations = list(cur.fetchall())
+    if not reservations:
+        return 0
+    frames: dict[tuple[int, int], int] = {}
+    for reservation in reservations:
+        key = (int(reservation["armazon_producto_id"]), int(reservation["sucursal_id"]))
+        frames[key] = frames.get(key, 0) + 1
+    keys = sorted(frames, key=lambda key: (key[1], key[0]))
+    cur.execute(
+        """
+        SELECT inventory.producto_id, inventory.sucursal_id, inventory.stock_reservado
+        FROM core.catalogo_inventario_sucursal inventory
+        JOIN unnest(%s::bigint[], %s::bigint[]) AS released(producto_id, sucursal_id)
+          ON released.producto_id = inventory.producto_id
+         AND released.sucursal_id = inventory.sucursal_id
+        ORDER BY inventory.sucursal_id, inventory.producto_id
+        FOR UPDATE OF inventory
+        """,
+        ([key[0] for key in keys], [key[1] for key in keys]),
+    )
+    reserved = {
+        (int(row["producto_id"]), int(row["sucursal_id"])): int(row["stock_reservado"])
+        for row in cur.fetchall()
+    }
+    if any(reserved.get(key, 0) < quantity for key, quantity in frames.items()):
+        raise OpticalDraftRuleError(
+            409, "OPTICAL_RESERVATION_INTEGRITY_ERROR",
+            "Reserved frame inventory does not match the optical draft reservation.",
         )
-        released += 1
-    return released
+    cur.execute(
+        """
+        UPDATE core.catalogo_inventario_sucursal inventory
+        SET stock_reservado = inventory.stock_reservado - released.cantidad,
+            version = inventory.version + 1, updated_at = NOW()
+        FROM unnest(%s::bigint[], %s::bigint[], %s::int[]) AS released(producto_id, sucursal_id, cantidad)
+        WHERE inventory.producto_id = released.producto_id
+          AND inventory.sucursal_id = released.sucursal_id
+          AND inventory.stock_reservado >= released.cantidad
+        """,
+        ([key[0] for key in keys], [key[1] for key in keys], [frames[key] for key in keys]),
+    )
+    if cur.rowcount != len(keys):
+        raise OpticalDraftRuleError(409, "OPTICAL_RESERVATION_INTEGRITY_ERROR", "Frame hold could not be released safely.")
+    reservation_ids = [int(reservation["reserva_id"]) for reservation in reservations]
+    draft_ids = [int(reservation["borrador_id"]) for reservation in reservations]
+    cur.execute(
+        """
+        UPDATE core.online_reservas_opticas_borrador
+        SET estado = 'expirada', released_at = NOW(), updated_at = NOW()
+        WHERE reserva_id = ANY(%s) AND estado = 'activa'
+        """,
+        (reservation_ids,),
+    )
+    cur.execute(
+        """
+        UPDATE core.online_borradores_opticos
+        SET estado = 'expirado', expirado_at = NOW(), updated_at = NOW()
+        WHERE borrador_id = ANY(%s) AND estado NOT IN ('cancelado', 'expirado')
+        """,
+        (draft_ids,),
+    )
+    cur.execute(
+        """
+        INSERT INTO core.online_borrador_optico_eventos
+            (borrador_id, reserva_id, evento_tipo, actor_tipo, metadata)
+        SELECT event.borrador_id, event.reserva_id, 'reservation_expired', 'sistema', %s::jsonb
+        FROM unnest(%s::bigint[], %s::bigint[]) AS event(borrador_id, reserva_id)
+        ON CONFLICT DO NOTHING
+        """,
+        (_canonical({"releasedFrameQuantity": 1}), draft_ids, reservation_ids),
+    )
+    for draft_id in draft_ids:
+        cancel_job_for_online_draft(cur, draft_id, "cancelado_por_expiracion")
+    return len(reservation_ids)
 
 
 def convert_optical_reservation(
@@ -427,46 +435,18 @@ class OpticalDraftRepository:
 
     @staticmethod
     def _idempotency_begin(cur, owner: CommerceOwner, scope: str, key: str, payload: dict[str, Any]):
-        clean = key.strip()
-        if not clean or len(clean) > 200:
+        try:
+            return IDEMPOTENCY.begin(cur, scope=scope, key=key, owner_hash=owner.owner_hash, request_hash=_hash(payload))
+        except IdempotencyKeyInvalid:
             raise OpticalDraftRuleError(400, "IDEMPOTENCY_KEY_REQUIRED", "A valid Idempotency-Key is required.")
-        key_hash, request_hash = hashlib.sha256(clean.encode()).hexdigest(), _hash(payload)
-        cur.execute(
-            """
-            INSERT INTO core.online_idempotencia
-                (alcance, clave_hash, propietario_ref_hash, solicitud_hash, expira_at)
-            VALUES (%s, %s, %s, %s, NOW() + INTERVAL '24 hours')
-            ON CONFLICT (alcance, clave_hash) DO NOTHING
-            RETURNING idempotencia_id
-            """,
-            (scope, key_hash, owner.owner_hash, request_hash),
-        )
-        inserted = cur.fetchone()
-        if inserted:
-            return int(inserted["idempotencia_id"]), None
-        cur.execute(
-            "SELECT * FROM core.online_idempotencia WHERE alcance = %s AND clave_hash = %s FOR UPDATE",
-            (scope, key_hash),
-        )
-        existing = cur.fetchone()
-        if not existing or not hmac.compare_digest(str(existing["propietario_ref_hash"]), owner.owner_hash) or existing["solicitud_hash"] != request_hash:
+        except IdempotencyConflict:
             raise OpticalDraftRuleError(409, "IDEMPOTENCY_CONFLICT", "Idempotency-Key was already used differently.")
-        if existing["estado"] == "completado" and existing["respuesta"] is not None:
-            return None, existing["respuesta"]
-        raise OpticalDraftRuleError(409, "REQUEST_IN_PROGRESS", "The same request is already being processed.")
+        except IdempotencyInProgress:
+            raise OpticalDraftRuleError(409, "REQUEST_IN_PROGRESS", "The same request is already being processed.")
 
     @staticmethod
     def _idempotency_finish(cur, row_id: int | None, result: dict[str, Any], resource_id: int) -> None:
-        if row_id is not None:
-            cur.execute(
-                """
-                UPDATE core.online_idempotencia
-                SET estado = 'completado', recurso_id = %s, codigo_respuesta = 200,
-                    respuesta = %s::jsonb, updated_at = NOW()
-                WHERE idempotencia_id = %s
-                """,
-                (resource_id, _canonical(result), row_id),
-            )
+        IDEMPOTENCY.finish(cur, row_id, _canonical(result), resource_id)
 
     @staticmethod
     def _draft_payload(cur, draft_id: int) -> dict[str, Any]:
@@ -489,12 +469,18 @@ class OpticalDraftRepository:
         )
         row = cur.fetchone()
         snapshot = row["snapshot_comercial"]
+        status, reservation_state = row["estado"], row["reservation_state"]
+        # The expiry worker may not have released this hold yet.
+        if reservation_state == "activa" and row["expires_at"] <= datetime.now(timezone.utc):
+            reservation_state = "expirada"
+            if status not in TERMINAL_STATES:
+                status = "expirado"
         return _safe({
             "schemaVersion": OPTICAL_DRAFT_SCHEMA_VERSION,
             "draftPublicId": row["borrador_public_id"],
             "configurationPublicId": row["configuracion_public_id"],
             "reservationPublicId": row["reserva_public_id"],
-            "status": row["estado"],
+            "status": status,
             "paymentStatus": row["estado_pago"],
             "prescriptionMethod": row["prescription_method"],
             "prescriptionStatus": row["prescription_status"],
@@ -505,10 +491,10 @@ class OpticalDraftRepository:
             "configuredTotal": row["total_configurado_snapshot"],
             "previewFingerprint": row["preview_fingerprint"],
             "reservation": {
-                "status": row["reservation_state"],
+                "status": reservation_state,
                 "expiresAt": row["expires_at"],
                 "releasedAt": row["released_at"],
-                "reservedFrameQuantity": 1 if row["reservation_state"] == "activa" else 0,
+                "reservedFrameQuantity": 1 if reservation_state == "activa" else 0,
             },
             "createdAt": row["created_at"],
             "updatedAt": row["updated_at"],
@@ -520,7 +506,6 @@ class OpticalDraftRepository:
         request_payload = data.model_dump(mode="json")
         with self._connection() as conn:
             with conn.cursor() as cur:
-                release_expired_optical_reservations(cur)
                 idem_id, cached = self._idempotency_begin(cur, owner, "optical_draft_create", key, request_payload)
                 if cached is not None:
                     conn.commit()
@@ -770,7 +755,6 @@ class OpticalDraftRepository:
     def get(self, owner: CommerceOwner, public_id: str) -> dict[str, Any]:
         with self._connection() as conn:
             with conn.cursor() as cur:
-                release_expired_optical_reservations(cur)
                 cur.execute(
                     """
                     SELECT borrador_id FROM core.online_borradores_opticos
@@ -790,7 +774,6 @@ class OpticalDraftRepository:
         payload = {"draftPublicId": public_id}
         with self._connection() as conn:
             with conn.cursor() as cur:
-                release_expired_optical_reservations(cur)
                 idem_id, cached = self._idempotency_begin(cur, owner, "optical_draft_cancel", key, payload)
                 if cached is not None:
                     conn.commit()
@@ -870,11 +853,16 @@ def create_online_optical_drafts_router(
     *,
     config: OpticalDraftConfig | None = None,
     repository: OpticalDraftRepository | None = None,
+    connect: Callable[..., Any] = psycopg.connect,
 ) -> APIRouter:
     config = config or OpticalDraftConfig.from_env(db_conninfo)
     if repository is None:
         preview_config = PublicCatalogConfig.from_env(db_conninfo)
-        repository = OpticalDraftRepository(config, OpticalPreviewRepository(preview_config))
+        repository = OpticalDraftRepository(
+            config,
+            OpticalPreviewRepository(preview_config, connect=connect),
+            connect=connect,
+        )
     router = APIRouter(prefix="/storefront/optical/v1/drafts", tags=["Optical drafts"])
     bearer = HTTPBearer(auto_error=False)
 
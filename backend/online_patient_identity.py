@@ -22,6 +22,7 @@ from pydantic import BaseModel, ConfigDict, Field
 import psycopg
 from psycopg.rows import dict_row
 
+from idempotency import IDEMPOTENCY, IdempotencyConflict, IdempotencyInProgress, IdempotencyKeyInvalid
 from online_commerce import _valid_owner_hash
 from public_catalog import catalog_credentials_valid
 
@@ -173,37 +174,18 @@ class IdentityRepository:
 
     @staticmethod
     def _idempotency(cur, account_hash: str, scope: str, key: str, payload: dict[str, Any]):
-        clean = key.strip()
-        if not clean or len(clean) > 200:
+        try:
+            return IDEMPOTENCY.begin(cur, scope=scope, key=key, owner_hash=account_hash, request_hash=_sha(_canonical(payload)))
+        except IdempotencyKeyInvalid:
             raise IdentityRuleError(400, "IDEMPOTENCY_KEY_REQUIRED", "A valid Idempotency-Key is required.")
-        key_hash, request_hash = _sha(clean), _sha(_canonical(payload))
-        cur.execute(
-            """INSERT INTO core.online_idempotencia
-               (alcance, clave_hash, propietario_ref_hash, solicitud_hash, expira_at)
-               VALUES (%s,%s,%s,%s,NOW()+INTERVAL '24 hours')
-               ON CONFLICT (alcance, clave_hash) DO NOTHING RETURNING idempotencia_id""",
-            (scope, key_hash, account_hash, request_hash),
-        )
-        inserted = cur.fetchone()
-        if inserted:
-            return int(inserted["idempotencia_id"]), None
-        cur.execute("SELECT * FROM core.online_idempotencia WHERE alcance=%s AND clave_hash=%s FOR UPDATE", (scope, key_hash))
-        existing = cur.fetchone()
-        if not existing or not hmac.compare_digest(str(existing["propietario_ref_hash"]), account_hash) or existing["solicitud_hash"] != request_hash:
+        except IdempotencyConflict:
             raise IdentityRuleError(409, "IDEMPOTENCY_CONFLICT", "Idempotency-Key was already used differently.")
-        if existing["estado"] == "completado" and existing["respuesta"] is not None:
-            return None, existing["respuesta"]
-        raise IdentityRuleError(409, "REQUEST_IN_PROGRESS", "The same request is already being processed.")
+        except IdempotencyInProgress:
+            raise IdentityRuleError(409, "REQUEST_IN_PROGRESS", "The same request is already being processed.")
 
     @staticmethod
     def _finish(cur, idem_id: int | None, result: dict[str, Any], resource_id: int | None = None):
-        if idem_id is not None:
-            cur.execute(
-                """UPDATE core.online_idempotencia SET estado='completado', recurso_id=%s,
-                   codigo_respuesta=200, respuesta=%s::jsonb, updated_at=NOW()
-                   WHERE idempotencia_id=%s""",
-                (resource_id, _canonical(result), idem_id),
-            )
+        IDEMPOTENCY.finish(cur, idem_id, _canonical(result), resource_id)
 
     def current(self, account_hash: str) -> dict[str, Any]:
         with self._connection() as conn, conn.cursor() as cur:
@@ -501,9 +483,9 @@ class IdentityRepository:
         return result
 
 
-def create_online_identity_router(db_conninfo: str, *, config: IdentityConfig | None = None, repository: IdentityRepository | None = None) -> APIRouter:
+def create_online_identity_router(db_conninfo: str, *, config: IdentityConfig | None = None, repository: IdentityRepository | None = None, connect: Callable[..., Any] = psycopg.connect) -> APIRouter:
     cfg = config or IdentityConfig.from_env(db_conninfo)
-    repo = repository or IdentityRepository(cfg)
+    repo = repository or IdentityRepository(cfg, connect)
     router = APIRouter(prefix="/storefront/identity/v1", tags=["Storefront identity"])
     bearer = HTTPBearer(auto_error=False)
 
@@ -572,7 +554,7 @@ def create_online_identity_router(db_conninfo: str, *, config: IdentityConfig |
     return router
 
 
-def create_prescription_access_admin_router(db_conninfo: str, get_current_user: Callable[..., dict[str, Any]]) -> APIRouter:
+def create_prescription_access_admin_router(db_conninfo: str, get_current_user: Callable[..., dict[str, Any]], *, connect: Callable[..., Any] = psycopg.connect) -> APIRouter:
     router = APIRouter(prefix="/operaciones/optica/prescripciones-online", tags=["Online prescription access"])
 
     def admin(user: dict[str, Any] = Depends(get_current_user)):
@@ -589,7 +571,7 @@ def create_prescription_access_admin_router(db_conninfo: str, get_current_user:
 
     @router.post("")
     def approve(data: PrescriptionApprovalRequest, user=Depends(admin)):
-        with psycopg.connect(db_conninfo) as conn, conn.cursor() as cur:
+        with connect(db_conninfo) as conn, conn.cursor() as cur:
             user_id = actor(cur, user)
             cur.execute("SELECT paciente_id,activo FROM core.prescripciones_opticas WHERE prescripcion_id=%s FOR UPDATE", (data.prescripcionId,))
             prescription = cur.fetchone()
@@ -612,7 +594,7 @@ def create_prescription_access_admin_router(db_conninfo: str, get_current_user:
 
     @router.patch("/{prescription_ref}/revoke")
     def revoke(prescription_ref: str, data: PrescriptionRevokeRequest, user=Depends(admin)):
-        with psycopg.connect(db_conninfo) as conn, conn.cursor() as cur:
+        with connect(db_conninfo) as conn, conn.cursor() as cur:
             user_id = actor(cur, user)
             cur.execute("UPDATE core.prescripcion_optica_acceso_online SET estado='revocada',revocada_por=%s,revocada_at=NOW(),motivo_revocacion=%s,updated_at=NOW() WHERE acceso_public_id=%s AND estado='aprobada' RETURNING acceso_id", (user_id, data.motivo, prescription_ref))
             row = cur.fetchone()
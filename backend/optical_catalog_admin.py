@@ -389,9 +389,10 @@ def create_optical_catalog_admin_router(
     *,
     config: OpticalCatalogAdminConfig | None = None,
     repository: OpticalCatalogAdminRepository | None = None,
+    connect: Callable[..., Any] = psycopg.connect,
 ) -> APIRouter:
     config = config or OpticalCatalogAdminConfig.from_env(db_conninfo)
-    repository = repository or OpticalCatalogAdminRepository(config)
+    repository = repository or OpticalCatalogAdminRepository(config, connect=connect)
     router = APIRouter(prefix="/catalogo/optica", tags=["Optical catalog administration"])
 
     def enabled() -> None:
@@ -440,9 +440,10 @@ def create_optical_preview_router(
     *,
     config: PublicCatalogConfig | None = None,
     repository: OpticalPreviewRepository | None = None,
+    connect: Callable[..., Any] = psycopg.connect,
 ) -> APIRouter:
     config = config or PublicCatalogConfig.from_env(db_conninfo)
-    repository = repository or OpticalPreviewRepository(config)
+    repository = repository or OpticalPreviewRepository(config, connect=connect)
     router = APIRouter(prefix="/storefront/optical/v1", tags=["Optical preview"])
     bearer = HTTPBearer(auto_error=False)
 
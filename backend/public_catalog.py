@@ -7,30 +7,42 @@ token.
 
 from __future__ import annotations
 
+import base64
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from decimal import Decimal
+import json
 import os
 from pathlib import PurePosixPath
 import secrets
 from typing import Any, Callable
 from urllib.parse import unquote, urljoin, urlsplit
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import psycopg
 from psycopg.rows import dict_row
+from image_variants import VARIANT_MEDIA_TYPE, MediaVariantStore
+from catalog_cache import CatalogSnapshot, CatalogSnapshotCache, build_snapshot, etag_matches
 from online_product_policy import is_online_purchase_product
 
 
 CATALOG_SCHEMA_VERSION = "1.0"
+MAX_BULK_AVAILABILITY_IDS = 500
 PUBLIC_PRODUCT_TYPES = {"producto_fisico", "componente_mica", "servicio"}
 class SellingPrice(BaseModel):
     amount: str
     currency: str
 
 
+class PublicImageVariant(BaseModel):
+    url: str
+    width: int
+    height: int
+    mimeType: str = VARIANT_MEDIA_TYPE
+
+
 class PublicCatalogImage(BaseModel):
     imageId: str
     url: str
@@ -40,6 +52,8 @@ class PublicCatalogImage(BaseModel):
     mimeType: str | None = None
     width: int | None = None
     height: int | None = None
+    variants: list[PublicImageVariant] = []
+    srcset: str | None = None
 
 
 class PublicBranchAvailability(BaseModel):
@@ -81,9 +95,10 @@ class PublicProductListResponse(BaseModel):
     schemaVersion: str
     generatedAt: datetime
     products: list[PublicCatalogProduct]
-    total: int
+    total: int | None
     limit: int
     offset: int
+    nextCursor: str | None = None
 
 
 class PublicProductDetailResponse(BaseModel):
@@ -119,6 +134,11 @@ class PublicAvailabilityItem(BaseModel):
     availability: PublicProductAvailability
 
 
+class PublicAvailabilityRequest(BaseModel):
+    productIds: list[int]
+    branchId: int | None = Field(default=None, ge=1)
+
+
 class PublicAvailabilityResponse(BaseModel):
     schemaVersion: str
     generatedAt: datetime
@@ -196,6 +216,90 @@ def normalize_public_image_url(raw_url: str, config: PublicCatalogConfig) -> str
     return urljoin(base, decoded_path.lstrip("/"))
 
 
+_PRODUCT_COLUMNS = """
+    producto_id, sku, slug, nombre, descripcion, categoria, subcategoria,
+    tipo_producto, precio, moneda, controla_stock, orden_catalogo,
+    created_at, updated_at
+"""
+
+
+# Partial indexes that keep keyset pages and ILIKE search proportional to the
+# page size rather than the catalog size.  The runtime migration that creates
+# them waits (``requires``) for the phase SQL tables below.
+PUBLIC_CATALOG_INDEX_TABLES = ("core.catalogo_productos", "core.catalogo_producto_imagenes")
+
+PUBLIC_CATALOG_INDEX_SQL = """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_catalogo_productos_publico_orden
+  ON core.catalogo_productos (orden_catalogo, nombre, producto_id)
+  WHERE activo = true AND publicado_online = true;
+CREATE INDEX IF NOT EXISTS idx_catalogo_productos_publico_categoria_orden
+  ON core.catalogo_productos (categoria, orden_catalogo, nombre, producto_id)
+  WHERE activo = true AND publicado_online = true;
+CREATE INDEX IF NOT EXISTS idx_catalogo_productos_publico_nombre_trgm
+  ON core.catalogo_productos USING gin (nombre gin_trgm_ops)
+  WHERE activo = true AND publicado_online = true;
+CREATE INDEX IF NOT EXISTS idx_catalogo_productos_publico_sku_trgm
+  ON core.catalogo_productos USING gin (sku gin_trgm_ops)
+  WHERE activo = true AND publicado_online = true;
+CREATE INDEX IF NOT EXISTS idx_catalogo_productos_publico_descripcion_trgm
+  ON core.catalogo_productos USING gin (descripcion gin_trgm_ops)
+  WHERE activo = true AND publicado_online = true;
+CREATE INDEX IF NOT EXISTS idx_catalogo_producto_imagenes_activas
+  ON core.catalogo_producto_imagenes (producto_id, es_principal DESC, display_order, producto_imagen_id)
+  WHERE activo = true;
+"""
+
+
+# Per-branch sellable stock for the product aliased ``pg``; takes the branch
+# filter twice (``%s::bigint IS NULL OR ...``).
+_BRANCH_STOCK_SQL = """
+  SELECT json_agg(
+           json_build_object(
+             'sucursal_id', s.sucursal_id,
+             'codigo', s.codigo,
+             'nombre', s.nombre,
+             'disponible', CASE
+               WHEN inv.disponible_venta = true
+               THEN GREATEST(inv.stock - inv.stock_reservado, 0)
+               ELSE 0
+             END
+           )
+           ORDER BY s.sucursal_id
+         ) AS sucursales
+  FROM core.sucursales s
+  LEFT JOIN core.catalogo_inventario_sucursal inv
+    ON inv.producto_id = pg.producto_id
+   AND inv.sucursal_id = s.sucursal_id
+  WHERE pg.controla_stock = true
+    AND s.activa = true
+    AND (%s::bigint IS NULL OR s.sucursal_id = %s::bigint)
+"""
+
+
+class InvalidCatalogCursor(ValueError):
+    pass
+
+
+def encode_catalog_cursor(row: dict[str, Any]) -> str:
+    """Opaque keyset cursor for the (orden_catalogo, nombre, producto_id) order."""
+    key = [int(row["orden_catalogo"]), str(row["nombre"]), int(row["producto_id"])]
+    raw = json.dumps(key, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_catalog_cursor(cursor: str) -> tuple[int, str, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        order, name, product_id = json.loads(raw.decode("utf-8"))
+        if not isinstance(name, str):
+            raise TypeError(name)
+        return int(order), name, int(product_id)
+    except (ValueError, TypeError, UnicodeDecodeError) as exc:
+        raise InvalidCatalogCursor("Invalid catalog cursor") from exc
+
+
 def _money(value: Decimal | int | float | str) -> str:
     return f"{Decimal(value):.2f}"
 
@@ -205,9 +309,11 @@ class PublicCatalogRepository:
         self,
         config: PublicCatalogConfig,
         connect: Callable[..., Any] = psycopg.connect,
+        variants: MediaVariantStore | None = None,
     ) -> None:
         self.config = config
         self._connect = connect
+        self._variants = variants
 
     def _connection(self):
         return self._connect(self.config.db_conninfo, row_factory=dict_row)
@@ -227,161 +333,135 @@ class PublicCatalogRepository:
         cur.execute(sql, params)
         return list(cur.fetchall())
 
-    def _images(self, cur, product_ids: list[int]) -> dict[int, list[PublicCatalogImage]]:
-        images: dict[int, list[PublicCatalogImage]] = {pid: [] for pid in product_ids}
-        if not product_ids:
-            return images
-        cur.execute(
-            """
-            SELECT producto_imagen_id, producto_id, url, alt_text,
-                   display_order, es_principal, mime_type, ancho, alto
-            FROM core.catalogo_producto_imagenes
-            WHERE activo = true
-              AND producto_id = ANY(%s)
-            ORDER BY producto_id, es_principal DESC, display_order, producto_imagen_id;
-            """,
-            (product_ids,),
+    def _image(self, raw: dict[str, Any]) -> PublicCatalogImage | None:
+        try:
+            safe_url = normalize_public_image_url(raw["url"], self.config)
+        except UnsafeImageUrl:
+            return None
+        variants, srcset = self._image_variants(safe_url)
+        return PublicCatalogImage(
+            imageId=str(raw["producto_imagen_id"]),
+            url=safe_url,
+            altText=str(raw["alt_text"] or "Imagen de producto"),
+            displayOrder=int(raw["display_order"]),
+            isPrimary=bool(raw["es_principal"]),
+            mimeType=raw["mime_type"],
+            width=raw["ancho"],
+            height=raw["alto"],
+            variants=variants,
+            srcset=srcset,
         )
-        for row in cur.fetchall():
-            try:
-                safe_url = normalize_public_image_url(row["url"], self.config)
-            except UnsafeImageUrl:
-                continue
-            images[int(row["producto_id"])].append(
-                PublicCatalogImage(
-                    imageId=str(row["producto_imagen_id"]),
-                    url=safe_url,
-                    altText=str(row["alt_text"] or "Imagen de producto"),
-                    displayOrder=int(row["display_order"]),
-                    isPrimary=bool(row["es_principal"]),
-                    mimeType=row["mime_type"],
-                    width=row["ancho"],
-                    height=row["alto"],
-                )
-            )
-        return images
 
-    @staticmethod
-    def _commerce_settings(cur, product_ids: list[int]) -> dict[int, dict[str, Any]]:
-        if not product_ids:
-            return {}
-        cur.execute(
-            """
-            SELECT producto_id, comprable_online, permite_favorito,
-                   cantidad_maxima_por_linea
-            FROM core.online_producto_configuracion
-            WHERE producto_id = ANY(%s)
-            """,
-            (product_ids,),
+    def _image_variants(self, safe_url: str) -> tuple[list[PublicImageVariant], str | None]:
+        """Resized WebP variants for images served from our own ``/media``."""
+        base = f"{self.config.media_base_url.rstrip('/')}/"
+        if self._variants is None or not safe_url.startswith(base):
+            return [], None
+        media_path = unquote(urlsplit(safe_url[len(base):]).path)
+        if not media_path.startswith("media/"):
+            return [], None
+        source, variants = self._variants.describe(media_path[len("media/"):])
+        if source is None or not variants:
+            return [], None
+        items = [
+            PublicImageVariant(
+                url=urljoin(base, variant.url.lstrip("/")),
+                width=variant.width,
+                height=variant.height,
+            )
+            for variant in variants
+        ]
+        srcset = ", ".join(
+            [f"{item.url} {item.width}w" for item in items] + [f"{safe_url} {source.width}w"]
         )
-        return {
-            int(row["producto_id"]): {
-                "purchasable": bool(row["comprable_online"]),
-                "favoritable": bool(row["permite_favorito"]),
-                "maximum": (
-                    int(row["cantidad_maxima_por_linea"])
-                    if row["cantidad_maxima_por_linea"] is not None
-                    else None
-                ),
-            }
-            for row in cur.fetchall()
-        }
+        return items, srcset
 
     @staticmethod
-    def _availability(
-        cur,
-        product_rows: list[dict[str, Any]],
-        branches: list[dict[str, Any]],
-    ) -> dict[int, PublicProductAvailability]:
-        physical_ids = [
-            int(row["producto_id"])
-            for row in product_rows
-            if bool(row["controla_stock"])
-        ]
-        quantities: dict[tuple[int, int], int] = {}
-        if physical_ids and branches:
-            branch_ids = [int(branch["sucursal_id"]) for branch in branches]
-            cur.execute(
-                """
-                SELECT producto_id, sucursal_id,
-                       CASE
-                         WHEN disponible_venta = true
-                         THEN GREATEST(stock - stock_reservado, 0)
-                         ELSE 0
-                       END AS disponible
-                FROM core.catalogo_inventario_sucursal
-                WHERE producto_id = ANY(%s)
-                  AND sucursal_id = ANY(%s);
-                """,
-                (physical_ids, branch_ids),
+    def _availability(row: dict[str, Any]) -> PublicProductAvailability:
+        if not bool(row["controla_stock"]):
+            return PublicProductAvailability(
+                mode="not_stock_controlled",
+                controlsStock=False,
+                availableOnline=True,
+                totalOnlineAvailability=None,
+                branches=[],
             )
-            quantities = {
-                (int(row["producto_id"]), int(row["sucursal_id"])): int(
-                    row["disponible"]
-                )
-                for row in cur.fetchall()
-            }
-
-        result: dict[int, PublicProductAvailability] = {}
-        for product in product_rows:
-            product_id = int(product["producto_id"])
-            controls_stock = bool(product["controla_stock"])
-            if not controls_stock:
-                result[product_id] = PublicProductAvailability(
-                    mode="not_stock_controlled",
-                    controlsStock=False,
-                    availableOnline=True,
-                    totalOnlineAvailability=None,
-                    branches=[],
-                )
-                continue
-
-            branch_rows = [
-                PublicBranchAvailability(
-                    branchId=str(branch["sucursal_id"]),
-                    branchCode=str(branch["codigo"]),
-                    branchName=str(branch["nombre"]),
-                    availableQuantity=quantities.get(
-                        (product_id, int(branch["sucursal_id"])), 0
-                    ),
-                )
-                for branch in branches
-            ]
-            total = sum(branch.availableQuantity for branch in branch_rows)
-            result[product_id] = PublicProductAvailability(
-                mode="branch_stock",
-                controlsStock=True,
-                availableOnline=total > 0,
-                totalOnlineAvailability=total,
-                branches=branch_rows,
+        branch_rows = [
+            PublicBranchAvailability(
+                branchId=str(branch["sucursal_id"]),
+                branchCode=str(branch["codigo"]),
+                branchName=str(branch["nombre"]),
+                availableQuantity=int(branch["disponible"]),
             )
-        return result
+            for branch in row["sucursales"] or []
+        ]
+        total = sum(branch.availableQuantity for branch in branch_rows)
+        return PublicProductAvailability(
+            mode="branch_stock",
+            controlsStock=True,
+            availableOnline=total > 0,
+            totalOnlineAvailability=total,
+            branches=branch_rows,
+        )
 
-    def _hydrate(
+    def _hydrated(
         self,
         cur,
-        rows: list[dict[str, Any]],
+        page_sql: str,
+        page_params: tuple[Any, ...],
         branch_id: int | None,
-    ) -> list[PublicCatalogProduct]:
-        product_ids = [int(row["producto_id"]) for row in rows]
-        images = self._images(cur, product_ids)
-        commerce = self._commerce_settings(cur, product_ids)
-        branches = self._active_branches(cur, branch_id)
-        availability = self._availability(cur, rows, branches)
+    ) -> list[dict[str, Any]]:
+        """Run ``page_sql`` (the product page) with images, online settings and
+        branch stock folded in, so a page is one round trip."""
+        cur.execute(
+            f"""
+            WITH pagina AS ({page_sql})
+            SELECT pg.*,
+                   cfg.comprable_online,
+                   cfg.permite_favorito,
+                   cfg.cantidad_maxima_por_linea,
+                   img.imagenes,
+                   inv.sucursales
+            FROM pagina pg
+            LEFT JOIN core.online_producto_configuracion cfg
+              ON cfg.producto_id = pg.producto_id
+            LEFT JOIN LATERAL (
+              SELECT json_agg(
+                       json_build_object(
+                         'producto_imagen_id', i.producto_imagen_id,
+                         'url', i.url,
+                         'alt_text', i.alt_text,
+                         'display_order', i.display_order,
+                         'es_principal', i.es_principal,
+                         'mime_type', i.mime_type,
+                         'ancho', i.ancho,
+                         'alto', i.alto
+                       )
+                       ORDER BY i.es_principal DESC, i.display_order, i.producto_imagen_id
+                     ) AS imagenes
+              FROM core.catalogo_producto_imagenes i
+              WHERE i.producto_id = pg.producto_id
+                AND i.activo = true
+            ) img ON true
+            LEFT JOIN LATERAL ({_BRANCH_STOCK_SQL}) inv ON true
+            ORDER BY pg.orden_catalogo, pg.nombre, pg.producto_id;
+            """,
+            (*page_params, branch_id, branch_id),
+        )
+        return list(cur.fetchall())
+
+    def _products(self, rows: list[dict[str, Any]]) -> list[PublicCatalogProduct]:
         products: list[PublicCatalogProduct] = []
         for row in rows:
             product_id = int(row["producto_id"])
             product_type = str(row["tipo_producto"])
             if product_type not in PUBLIC_PRODUCT_TYPES:
                 continue
-            settings = commerce.get(
-                product_id,
-                {"purchasable": False, "favoritable": True, "maximum": None},
-            )
             can_purchase = bool(
-                settings["purchasable"]
+                row["comprable_online"]
                 and is_online_purchase_product(row)
             )
+            images = [self._image(raw) for raw in row["imagenes"] or []]
             products.append(
                 PublicCatalogProduct(
                     productId=str(product_id),
@@ -396,12 +476,18 @@ class PublicCatalogRepository:
                         amount=_money(row["precio"]),
                         currency=str(row["moneda"]).strip(),
                     ),
-                    images=images.get(product_id, []),
-                    availability=availability[product_id],
+                    images=[image for image in images if image is not None],
+                    availability=self._availability(row),
                     publishedOnline=True,
                     purchasableOnline=can_purchase,
-                    favoritable=bool(settings["favoritable"]),
-                    maximumQuantityPerLine=settings["maximum"],
+                    favoritable=(
+                        True if row["permite_favorito"] is None else bool(row["permite_favorito"])
+                    ),
+                    maximumQuantityPerLine=(
+                        int(row["cantidad_maxima_por_linea"])
+                        if row["cantidad_maxima_por_linea"] is not None
+                        else None
+                    ),
                     createdAt=row["created_at"],
                     updatedAt=row["updated_at"] or row["created_at"],
                 )
@@ -415,8 +501,16 @@ class PublicCatalogRepository:
         search: str | None,
         branch_id: int | None,
         limit: int,
-        offset: int,
-    ) -> tuple[list[PublicCatalogProduct], int]:
+        offset: int = 0,
+        cursor: str | None = None,
+        include_total: bool = True,
+    ) -> tuple[list[PublicCatalogProduct], int | None, str | None]:
+        """One page in catalog order plus the cursor for the next one.
+
+        With ``cursor`` the page starts after that key (``offset`` is ignored),
+        so deep pages cost the same as the first; ``total`` is only counted
+        when ``include_total`` is set.
+        """
         where = ["activo = true", "publicado_online = true"]
         params: list[Any] = []
         if category:
@@ -426,29 +520,39 @@ class PublicCatalogRepository:
             where.append("(nombre ILIKE %s OR sku ILIKE %s OR descripcion ILIKE %s)")
             pattern = f"%{search.strip()}%"
             params.extend([pattern, pattern, pattern])
-        where_sql = " AND ".join(where)
+        filter_sql = " AND ".join(where)
+        filter_params = tuple(params)
+        if cursor is not None:
+            where.append("(orden_catalogo, nombre, producto_id) > (%s, %s, %s)")
+            params.extend(decode_catalog_cursor(cursor))
+            offset = 0
         with self._connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("SET TRANSACTION READ ONLY;")
-                cur.execute(
-                    f"SELECT COUNT(*) AS total FROM core.catalogo_productos WHERE {where_sql};",
-                    tuple(params),
-                )
-                total = int(cur.fetchone()["total"])
-                cur.execute(
+                total = None
+                if include_total:
+                    cur.execute(
+                        f"SELECT COUNT(*) AS total FROM core.catalogo_productos WHERE {filter_sql};",
+                        filter_params,
+                    )
+                    total = int(cur.fetchone()["total"])
+                rows = self._hydrated(
+                    cur,
                     f"""
-                    SELECT producto_id, sku, slug, nombre, descripcion, categoria,
-                           subcategoria, tipo_producto, precio, moneda, controla_stock,
-                           created_at, updated_at
+                    SELECT {_PRODUCT_COLUMNS}
                     FROM core.catalogo_productos
-                    WHERE {where_sql}
+                    WHERE {" AND ".join(where)}
                     ORDER BY orden_catalogo, nombre, producto_id
-                    LIMIT %s OFFSET %s;
+                    LIMIT %s OFFSET %s
                     """,
-                    (*params, limit, offset),
+                    (*params, limit + 1, offset),
+                    branch_id,
                 )
-                rows = list(cur.fetchall())
-                return self._hydrate(cur, rows, branch_id), total
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_catalog_cursor(rows[-1])
+        return self._products(rows), total, next_cursor
 
     def get_product(
         self, slug: str, branch_id: int | None = None
@@ -456,21 +560,19 @@ class PublicCatalogRepository:
         with self._connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("SET TRANSACTION READ ONLY;")
-                cur.execute(
-                    """
-                    SELECT producto_id, sku, slug, nombre, descripcion, categoria,
-                           subcategoria, tipo_producto, precio, moneda, controla_stock,
-                           created_at, updated_at
+                rows = self._hydrated(
+                    cur,
+                    f"""
+                    SELECT {_PRODUCT_COLUMNS}
                     FROM core.catalogo_productos
                     WHERE slug = %s AND activo = true AND publicado_online = true
-                    LIMIT 1;
+                    LIMIT 1
                     """,
                     (slug,),
+                    branch_id,
                 )
-                row = cur.fetchone()
-                if row is None:
-                    return None
-                return self._hydrate(cur, [row], branch_id)[0]
+        products = self._products(rows)
+        return products[0] if products else None
 
     def list_categories(self) -> list[PublicCategory]:
         with self._connection() as conn:
@@ -511,28 +613,27 @@ class PublicCatalogRepository:
         with self._connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("SET TRANSACTION READ ONLY;")
+                # Stock only: no images or online settings are read here.
                 cur.execute(
-                    """
-                    SELECT producto_id, sku, slug, nombre, descripcion, categoria,
-                           subcategoria, tipo_producto, precio, moneda, controla_stock,
-                           created_at, updated_at
-                    FROM core.catalogo_productos
-                    WHERE producto_id = ANY(%s)
-                      AND activo = true
-                      AND publicado_online = true
-                    ORDER BY producto_id;
+                    f"""
+                    SELECT pg.producto_id, pg.sku, pg.controla_stock, inv.sucursales
+                    FROM core.catalogo_productos pg
+                    LEFT JOIN LATERAL ({_BRANCH_STOCK_SQL}) inv ON true
+                    WHERE pg.producto_id = ANY(%s)
+                      AND pg.activo = true
+                      AND pg.publicado_online = true
+                      AND pg.tipo_producto = ANY(%s)
+                    ORDER BY pg.producto_id;
                     """,
-                    (product_ids,),
+                    (branch_id, branch_id, product_ids, sorted(PUBLIC_PRODUCT_TYPES)),
                 )
-                rows = list(cur.fetchall())
-                products = self._hydrate(cur, rows, branch_id)
                 return [
                     PublicAvailabilityItem(
-                        productId=product.productId,
-                        sku=product.sku,
-                        availability=product.availability,
+                        productId=str(row["producto_id"]),
+                        sku=str(row["sku"]),
+                        availability=self._availability(row),
                     )
-                    for product in products
+                    for row in cur.fetchall()
                 ]
 
     def health(self) -> None:
@@ -548,9 +649,12 @@ def create_public_catalog_router(
     *,
     config: PublicCatalogConfig | None = None,
     repository: PublicCatalogRepository | None = None,
+    connect: Callable[..., Any] = psycopg.connect,
+    cache: CatalogSnapshotCache | None = None,
+    variants: MediaVariantStore | None = None,
 ) -> APIRouter:
     config = config or PublicCatalogConfig.from_env(db_conninfo)
-    repository = repository or PublicCatalogRepository(config)
+    repository = repository or PublicCatalogRepository(config, connect, variants)
     router = APIRouter(prefix="/public/catalog/v1", tags=["Public catalog"])
     bearer = HTTPBearer(auto_error=False)
 
@@ -569,6 +673,25 @@ def create_public_catalog_router(
     def unavailable() -> HTTPException:
         return HTTPException(status_code=503, detail="Catalog temporarily unavailable.")
 
+    def snapshot(key: tuple[Any, ...], build: Callable[[], Any]) -> CatalogSnapshot:
+        # Without a cache every call still gets an ETag, it just costs the queries.
+        try:
+            if cache is None:
+                return build_snapshot(build)
+            return cache.get_or_load(key, build)
+        except psycopg.Error:
+            raise unavailable()
+
+    def conditional(
+        current: CatalogSnapshot, request: Request | None, response: Response | None
+    ) -> Any:
+        headers = {"ETag": current.etag, "Cache-Control": "no-cache"}
+        if request is not None and etag_matches(request.headers.get("if-none-match"), current.etag):
+            return Response(status_code=304, headers=headers)
+        if response is not None:
+            response.headers.update(headers)
+        return current.payload
+
     @router.get("/health", dependencies=[Depends(require_catalog_token)])
     def health():
         try:
@@ -588,70 +711,104 @@ def create_public_catalog_router(
         branch_id: int | None = Query(default=None, ge=1),
         limit: int = Query(default=50, ge=1, le=200),
         offset: int = Query(default=0, ge=0),
+        cursor: str | None = None,
+        include_total: bool | None = None,
+        request: Request = None,
+        response: Response = None,
     ):
-        try:
-            items, total = repository.list_products(
+        # The first page carries the total; cursor pages skip the COUNT unless asked.
+        count = (cursor is None) if include_total is None else include_total
+
+        def build() -> PublicProductListResponse:
+            items, total, next_cursor = repository.list_products(
                 category=category,
                 search=search,
                 branch_id=branch_id,
                 limit=limit,
                 offset=offset,
+                cursor=cursor,
+                include_total=count,
             )
-        except psycopg.Error:
-            raise unavailable()
-        return PublicProductListResponse(
-            schemaVersion=CATALOG_SCHEMA_VERSION,
-            generatedAt=datetime.now(timezone.utc),
-            products=items,
-            total=total,
-            limit=limit,
-            offset=offset,
-        )
+            return PublicProductListResponse(
+                schemaVersion=CATALOG_SCHEMA_VERSION,
+                generatedAt=datetime.now(timezone.utc),
+                products=items,
+                total=total,
+                limit=limit,
+                offset=0 if cursor is not None else offset,
+                nextCursor=next_cursor,
+            )
+
+        key = ("products", category, search, branch_id, limit, offset, cursor, count)
+        try:
+            return conditional(snapshot(key, build), request, response)
+        except InvalidCatalogCursor:
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
 
     @router.get(
         "/products/{slug}",
         response_model=PublicProductDetailResponse,
         dependencies=[Depends(require_catalog_token)],
     )
-    def product(slug: str, branch_id: int | None = Query(default=None, ge=1)):
-        try:
+    def product(
+        slug: str,
+        branch_id: int | None = Query(default=None, ge=1),
+        request: Request = None,
+        response: Response = None,
+    ):
+        def build() -> PublicProductDetailResponse | None:
             item = repository.get_product(slug, branch_id)
-        except psycopg.Error:
-            raise unavailable()
-        if item is None:
+            if item is None:
+                return None
+            return PublicProductDetailResponse(
+                schemaVersion=CATALOG_SCHEMA_VERSION,
+                generatedAt=datetime.now(timezone.utc),
+                product=item,
+            )
+
+        current = snapshot(("product", slug, branch_id), build)
+        if current.payload is None:
             raise HTTPException(status_code=404, detail="Product not found.")
-        return PublicProductDetailResponse(
-            schemaVersion=CATALOG_SCHEMA_VERSION,
-            generatedAt=datetime.now(timezone.utc),
-            product=item,
-        )
+        return conditional(current, request, response)
 
     @router.get(
         "/categories",
         response_model=PublicCategoryListResponse,
         dependencies=[Depends(require_catalog_token)],
     )
-    def categories():
-        try:
-            items = repository.list_categories()
-        except psycopg.Error:
-            raise unavailable()
-        return PublicCategoryListResponse(
-            schemaVersion=CATALOG_SCHEMA_VERSION, categories=items
-        )
+    def categories(request: Request = None, response: Response = None):
+        def build() -> PublicCategoryListResponse:
+            return PublicCategoryListResponse(
+                schemaVersion=CATALOG_SCHEMA_VERSION, categories=repository.list_categories()
+            )
+
+        return conditional(snapshot(("categories",), build), request, response)
 
     @router.get(
         "/branches",
         response_model=PublicBranchListResponse,
         dependencies=[Depends(require_catalog_token)],
     )
-    def branches():
+    def branches(request: Request = None, response: Response = None):
+        def build() -> PublicBranchListResponse:
+            return PublicBranchListResponse(
+                schemaVersion=CATALOG_SCHEMA_VERSION, branches=repository.list_branches()
+            )
+
+        return conditional(snapshot(("branches",), build), request, response)
+
+    def load_availability(product_ids: list[int], branch_id: int | None) -> PublicAvailabilityResponse:
         try:
-            items = repository.list_branches()
+            if cache is None:
+                items = repository.get_availability(product_ids, branch_id)
+            else:
+                items = cache.availability(product_ids, branch_id, repository.get_availability)
         except psycopg.Error:
             raise unavailable()
-        return PublicBranchListResponse(
-            schemaVersion=CATALOG_SCHEMA_VERSION, branches=items
+        return PublicAvailabilityResponse(
+            schemaVersion=CATALOG_SCHEMA_VERSION,
+            generatedAt=datetime.now(timezone.utc),
+            products=items,
         )
 
     @router.get(
@@ -662,6 +819,8 @@ def create_public_catalog_router(
     def availability(
         product_id: list[int] = Query(default=[]),
         branch_id: int | None = Query(default=None, ge=1),
+        request: Request = None,
+        response: Response = None,
     ):
         unique_ids = sorted({value for value in product_id if value > 0})
         if not unique_ids or len(unique_ids) > 100:
@@ -669,14 +828,21 @@ def create_public_catalog_router(
                 status_code=400,
                 detail="Provide between 1 and 100 valid product_id values.",
             )
-        try:
-            items = repository.get_availability(unique_ids, branch_id)
-        except psycopg.Error:
-            raise unavailable()
-        return PublicAvailabilityResponse(
-            schemaVersion=CATALOG_SCHEMA_VERSION,
-            generatedAt=datetime.now(timezone.utc),
-            products=items,
-        )
+        current = build_snapshot(lambda: load_availability(unique_ids, branch_id))
+        return conditional(current, request, response)
+
+    @router.post(
+        "/availability",
+        response_model=PublicAvailabilityResponse,
+        dependencies=[Depends(require_catalog_token)],
+    )
+    def bulk_availability(body: PublicAvailabilityRequest):
+        unique_ids = sorted({value for value in body.productIds if value > 0})
+        if not unique_ids or len(unique_ids) > MAX_BULK_AVAILABILITY_IDS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Provide between 1 and {MAX_BULK_AVAILABILITY_IDS} valid productIds.",
+            )
+        return load_availability(unique_ids, body.branchId)
 
     return router
@@ -0,0 +1,453 @@
+"""Per-branch daily rollups behind the reporting endpoints.
+
+``/estadisticas/resumen`` and ``/finanzas/datos`` used to re-aggregate
+``core.ventas``, ``core.consultas`` and ``core.pacientes`` on every request,
+including full-year series.  The tables created here hold one row per branch
+and local business day (plus channel / payment method / cancellation state for
+sales).  ``core.rpt_paciente_actividad`` keeps the same per-day counts per
+patient so the rolling six-month patient tier is a short index range scan.
+Row triggers on the source tables apply each insert, update and delete as a
+signed delta, so month and year views read a few hundred rows regardless of
+how much history exists.
+
+Only active rows (``activo = true``) are counted.  The business day follows
+the same rule as the CSV exports: branch 2 uses ``America/Cancun``, every
+other branch ``America/Mexico_City``.
+"""
+
+from __future__ import annotations
+
+from typing import Any
+
+
+# Bump when the rollup definitions change.  The stored version is checked on
+# every startup and migration run (not only by runtime migration v1), so a
+# bump reinstalls and rebuilds the rollups once.
+REPORTING_ROLLUPS_VERSION = 2
+
+
+REPORTING_ROLLUPS_SCHEMA_SQL = """
+-- Same definition as scripts/migrations/20260815_reporting_sale_origin.sql;
+-- the sales trigger below needs the column even on a fresh database.
+ALTER TABLE core.ventas
+  ADD COLUMN IF NOT EXISTS canal_venta TEXT NOT NULL DEFAULT 'fisica';
+
+CREATE OR REPLACE FUNCTION core.fn_fecha_local(p_ts timestamptz, p_sucursal_id integer)
+RETURNS date
+LANGUAGE sql
+IMMUTABLE
+PARALLEL SAFE
+AS $$
+  SELECT (
+    p_ts AT TIME ZONE CASE WHEN p_sucursal_id = 2 THEN 'America/Cancun' ELSE 'America/Mexico_City' END
+  )::date
+$$;
+
+CREATE OR REPLACE FUNCTION core.fn_rpt_metodo_pago(p_metodo text)
+RETURNS text
+LANGUAGE sql
+IMMUTABLE
+PARALLEL SAFE
+AS $$
+  SELECT COALESCE(NULLIF(LOWER(TRIM(p_metodo)), ''), 'sin_metodo')
+$$;
+
+CREATE OR REPLACE FUNCTION core.fn_rpt_venta_vigente(p_estado_venta text)
+RETURNS boolean
+LANGUAGE sql
+IMMUTABLE
+PARALLEL SAFE
+AS $$
+  SELECT COALESCE(p_estado_venta, 'confirmada') NOT IN ('cancelada', 'devuelta')
+$$;
+
+CREATE TABLE IF NOT EXISTS core.rpt_rollups_estado (
+  rollup_id boolean PRIMARY KEY DEFAULT true CHECK (rollup_id),
+  version integer NOT NULL,
+  reconstruido_en timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS core.rpt_ventas_diarias (
+  sucursal_id integer NOT NULL,
+  dia date NOT NULL,
+  canal_venta text NOT NULL,
+  metodo_pago text NOT NULL,
+  vigente boolean NOT NULL,
+  ventas bigint NOT NULL DEFAULT 0,
+  subtotal numeric NOT NULL DEFAULT 0,
+  descuentos numeric NOT NULL DEFAULT 0,
+  monto_total numeric NOT NULL DEFAULT 0,
+  PRIMARY KEY (sucursal_id, dia, canal_venta, metodo_pago, vigente)
+);
+CREATE INDEX IF NOT EXISTS idx_rpt_ventas_diarias_dia
+  ON core.rpt_ventas_diarias (dia);
+
+CREATE TABLE IF NOT EXISTS core.rpt_consultas_diarias (
+  sucursal_id integer NOT NULL,
+  dia date NOT NULL,
+  consultas bigint NOT NULL DEFAULT 0,
+  no_show bigint NOT NULL DEFAULT 0,
+  PRIMARY KEY (sucursal_id, dia)
+);
+CREATE INDEX IF NOT EXISTS idx_rpt_consultas_diarias_dia
+  ON core.rpt_consultas_diarias (dia);
+
+CREATE TABLE IF NOT EXISTS core.rpt_pacientes_diarios (
+  sucursal_id integer NOT NULL,
+  dia date NOT NULL,
+  pacientes bigint NOT NULL DEFAULT 0,
+  PRIMARY KEY (sucursal_id, dia)
+);
+CREATE INDEX IF NOT EXISTS idx_rpt_pacientes_diarios_dia
+  ON core.rpt_pacientes_diarios (dia);
+
+CREATE TABLE IF NOT EXISTS core.rpt_paciente_actividad (
+  paciente_id bigint NOT NULL,
+  dia date NOT NULL,
+  sucursal_id integer NOT NULL,
+  consultas bigint NOT NULL DEFAULT 0,
+  ventas bigint NOT NULL DEFAULT 0,
+  monto_total numeric NOT NULL DEFAULT 0,
+  PRIMARY KEY (paciente_id, dia, sucursal_id)
+);
+
+CREATE OR REPLACE FUNCTION core.fn_rpt_paciente_actividad_aplicar(
+  p_paciente_id bigint,
+  p_sucursal_id integer,
+  p_fecha_hora timestamptz,
+  p_consultas integer,
+  p_ventas integer,
+  p_monto_total numeric
+)
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_dia date := core.fn_fecha_local(p_fecha_hora, p_sucursal_id);
+BEGIN
+  IF p_paciente_id IS NULL THEN
+    RETURN;
+  END IF;
+
+  INSERT INTO core.rpt_paciente_actividad AS r (
+    paciente_id, dia, sucursal_id, consultas, ventas, monto_total
+  )
+  VALUES (p_paciente_id, v_dia, p_sucursal_id, p_consultas, p_ventas, COALESCE(p_monto_total, 0))
+  ON CONFLICT (paciente_id, dia, sucursal_id) DO UPDATE
+  SET consultas = r.consultas + EXCLUDED.consultas,
+      ventas = r.ventas + EXCLUDED.ventas,
+      monto_total = r.monto_total + EXCLUDED.monto_total;
+
+  IF p_consultas < 0 OR p_ventas < 0 THEN
+    DELETE FROM core.rpt_paciente_actividad
+    WHERE paciente_id = p_paciente_id
+      AND dia = v_dia
+      AND sucursal_id = p_sucursal_id
+      AND consultas = 0
+      AND ventas = 0;
+  END IF;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION core.fn_rpt_ventas_aplicar(
+  p_sucursal_id integer,
+  p_fecha_hora timestamptz,
+  p_canal_venta text,
+  p_metodo_pago text,
+  p_estado_venta text,
+  p_subtotal numeric,
+  p_monto_total numeric,
+  p_signo integer
+)
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_dia date := core.fn_fecha_local(p_fecha_hora, p_sucursal_id);
+  v_canal text := COALESCE(p_canal_venta, 'fisica');
+  v_metodo text := core.fn_rpt_metodo_pago(p_metodo_pago);
+  v_vigente boolean := core.fn_rpt_venta_vigente(p_estado_venta);
+BEGIN
+  INSERT INTO core.rpt_ventas_diarias AS r (
+    sucursal_id, dia, canal_venta, metodo_pago, vigente,
+    ventas, subtotal, descuentos, monto_total
+  )
+  VALUES (
+    p_sucursal_id, v_dia, v_canal, v_metodo, v_vigente,
+    p_signo,
+    p_signo * COALESCE(p_subtotal, 0),
+    p_signo * (COALESCE(p_subtotal, 0) - COALESCE(p_monto_total, 0)),
+    p_signo * COALESCE(p_monto_total, 0)
+  )
+  ON CONFLICT (sucursal_id, dia, canal_venta, metodo_pago, vigente) DO UPDATE
+  SET ventas = r.ventas + EXCLUDED.ventas,
+      subtotal = r.subtotal + EXCLUDED.subtotal,
+      descuentos = r.descuentos + EXCLUDED.descuentos,
+      monto_total = r.monto_total + EXCLUDED.monto_total;
+
+  IF p_signo < 0 THEN
+    DELETE FROM core.rpt_ventas_diarias
+    WHERE sucursal_id = p_sucursal_id
+      AND dia = v_dia
+      AND canal_venta = v_canal
+      AND metodo_pago = v_metodo
+      AND vigente = v_vigente
+      AND ventas = 0;
+  END IF;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION core.fn_rpt_ventas_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.activo THEN
+    PERFORM core.fn_rpt_ventas_aplicar(
+      OLD.sucursal_id, OLD.fecha_hora, OLD.canal_venta, OLD.metodo_pago,
+      OLD.estado_venta, OLD.subtotal, OLD.monto_total, -1
+    );
+    PERFORM core.fn_rpt_paciente_actividad_aplicar(
+      OLD.paciente_id, OLD.sucursal_id, OLD.fecha_hora, 0, -1, -OLD.monto_total
+    );
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.activo THEN
+    PERFORM core.fn_rpt_ventas_aplicar(
+      NEW.sucursal_id, NEW.fecha_hora, NEW.canal_venta, NEW.metodo_pago,
+      NEW.estado_venta, NEW.subtotal, NEW.monto_total, 1
+    );
+    PERFORM core.fn_rpt_paciente_actividad_aplicar(
+      NEW.paciente_id, NEW.sucursal_id, NEW.fecha_hora, 0, 1, NEW.monto_total
+    );
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_ventas_rpt_rollup ON core.ventas;
+CREATE TRIGGER trg_ventas_rpt_rollup
+AFTER INSERT OR DELETE OR UPDATE OF
+  sucursal_id, paciente_id, fecha_hora, canal_venta, metodo_pago, estado_venta, subtotal,
+  monto_total, activo
+ON core.ventas
+FOR EACH ROW EXECUTE FUNCTION core.fn_rpt_ventas_trigger();
+
+CREATE OR REPLACE FUNCTION core.fn_rpt_consultas_aplicar(
+  p_sucursal_id integer,
+  p_fecha_hora timestamptz,
+  p_tipo_consulta text,
+  p_signo integer
+)
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_dia date := core.fn_fecha_local(p_fecha_hora, p_sucursal_id);
+BEGIN
+  INSERT INTO core.rpt_consultas_diarias AS r (sucursal_id, dia, consultas, no_show)
+  VALUES (
+    p_sucursal_id, v_dia, p_signo,
+    CASE WHEN LOWER(COALESCE(p_tipo_consulta, '')) LIKE '%no_show%' THEN p_signo ELSE 0 END
+  )
+  ON CONFLICT (sucursal_id, dia) DO UPDATE
+  SET consultas = r.consultas + EXCLUDED.consultas,
+      no_show = r.no_show + EXCLUDED.no_show;
+
+  IF p_signo < 0 THEN
+    DELETE FROM core.rpt_consultas_diarias
+    WHERE sucursal_id = p_sucursal_id AND dia = v_dia AND consultas = 0;
+  END IF;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION core.fn_rpt_consultas_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.activo THEN
+    PERFORM core.fn_rpt_consultas_aplicar(OLD.sucursal_id, OLD.fecha_hora, OLD.tipo_consulta, -1);
+    PERFORM core.fn_rpt_paciente_actividad_aplicar(OLD.paciente_id, OLD.sucursal_id, OLD.fecha_hora, -1, 0, 0);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.activo THEN
+    PERFORM core.fn_rpt_consultas_aplicar(NEW.sucursal_id, NEW.fecha_hora, NEW.tipo_consulta, 1);
+    PERFORM core.fn_rpt_paciente_actividad_aplicar(NEW.paciente_id, NEW.sucursal_id, NEW.fecha_hora, 1, 0, 0);
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_consultas_rpt_rollup ON core.consultas;
+CREATE TRIGGER trg_consultas_rpt_rollup
+AFTER INSERT OR DELETE OR UPDATE OF sucursal_id, paciente_id, fecha_hora, tipo_consulta, activo
+ON core.consultas
+FOR EACH ROW EXECUTE FUNCTION core.fn_rpt_consultas_trigger();
+
+CREATE OR REPLACE FUNCTION core.fn_rpt_pacientes_aplicar(
+  p_sucursal_id integer,
+  p_creado_en timestamptz,
+  p_signo integer
+)
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_dia date := core.fn_fecha_local(p_creado_en, p_sucursal_id);
+BEGIN
+  INSERT INTO core.rpt_pacientes_diarios AS r (sucursal_id, dia, pacientes)
+  VALUES (p_sucursal_id, v_dia, p_signo)
+  ON CONFLICT (sucursal_id, dia) DO UPDATE
+  SET pacientes = r.pacientes + EXCLUDED.pacientes;
+
+  IF p_signo < 0 THEN
+    DELETE FROM core.rpt_pacientes_diarios
+    WHERE sucursal_id = p_sucursal_id AND dia = v_dia AND pacientes = 0;
+  END IF;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION core.fn_rpt_pacientes_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.activo THEN
+    PERFORM core.fn_rpt_pacientes_aplicar(OLD.sucursal_id, OLD.creado_en, -1);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.activo THEN
+    PERFORM core.fn_rpt_pacientes_aplicar(NEW.sucursal_id, NEW.creado_en, 1);
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_pacientes_rpt_rollup ON core.pacientes;
+CREATE TRIGGER trg_pacientes_rpt_rollup
+AFTER INSERT OR DELETE OR UPDATE OF sucursal_id, creado_en, activo
+ON core.pacientes
+FOR EACH ROW EXECUTE FUNCTION core.fn_rpt_pacientes_trigger();
+"""
+
+
+REPORTING_ROLLUPS_REBUILD_SQL = f"""
+LOCK TABLE core.ventas, core.consultas, core.pacientes IN SHARE MODE;
+
+TRUNCATE
+  core.rpt_ventas_diarias,
+  core.rpt_consultas_diarias,
+  core.rpt_pacientes_diarios,
+  core.rpt_paciente_actividad;
+
+INSERT INTO core.rpt_ventas_diarias (
+  sucursal_id, dia, canal_venta, metodo_pago, vigente,
+  ventas, subtotal, descuentos, monto_total
+)
+SELECT
+  v.sucursal_id,
+  core.fn_fecha_local(v.fecha_hora, v.sucursal_id),
+  COALESCE(v.canal_venta, 'fisica'),
+  core.fn_rpt_metodo_pago(v.metodo_pago),
+  core.fn_rpt_venta_vigente(v.estado_venta),
+  COUNT(*),
+  COALESCE(SUM(v.subtotal), 0),
+  COALESCE(SUM(v.subtotal - v.monto_total), 0),
+  COALESCE(SUM(v.monto_total), 0)
+FROM core.ventas v
+WHERE v.activo = true
+GROUP BY 1, 2, 3, 4, 5;
+
+INSERT INTO core.rpt_consultas_diarias (sucursal_id, dia, consultas, no_show)
+SELECT
+  c.sucursal_id,
+  core.fn_fecha_local(c.fecha_hora, c.sucursal_id),
+  COUNT(*),
+  COUNT(*) FILTER (WHERE LOWER(COALESCE(c.tipo_consulta, '')) LIKE '%no_show%')
+FROM core.consultas c
+WHERE c.activo = true
+GROUP BY 1, 2;
+
+INSERT INTO core.rpt_pacientes_diarios (sucursal_id, dia, pacientes)
+SELECT p.sucursal_id, core.fn_fecha_local(p.creado_en, p.sucursal_id), COUNT(*)
+FROM core.pacientes p
+WHERE p.activo = true
+GROUP BY 1, 2;
+
+INSERT INTO core.rpt_paciente_actividad (
+  paciente_id, dia, sucursal_id, consultas, ventas, monto_total
+)
+SELECT paciente_id, dia, sucursal_id, SUM(consultas), SUM(ventas), SUM(monto_total)
+FROM (
+  SELECT c.paciente_id, core.fn_fecha_local(c.fecha_hora, c.sucursal_id) AS dia, c.sucursal_id,
+         1 AS consultas, 0 AS ventas, 0::numeric AS monto_total
+  FROM core.consultas c
+  WHERE c.activo = true AND c.paciente_id IS NOT NULL
+  UNION ALL
+  SELECT v.paciente_id, core.fn_fecha_local(v.fecha_hora, v.sucursal_id), v.sucursal_id,
+         0, 1, COALESCE(v.monto_total, 0)
+  FROM core.ventas v
+  WHERE v.activo = true AND v.paciente_id IS NOT NULL
+) actividad
+GROUP BY paciente_id, dia, sucursal_id;
+
+INSERT INTO core.rpt_rollups_estado (rollup_id, version, reconstruido_en)
+VALUES (true, {REPORTING_ROLLUPS_VERSION}, now())
+ON CONFLICT (rollup_id) DO UPDATE
+SET version = EXCLUDED.version, reconstruido_en = EXCLUDED.reconstruido_en;
+"""
+
+
+# Stored business day per row, so list views and exports filter with index
+# range scans on (sucursal_id, fecha_local) instead of wrapping the timestamp
+# in DATE()/EXTRACT().  Generated from core.fn_fecha_local, so it always
+# matches the rollups above.
+LOCAL_DATE_COLUMNS_SQL = """
+ALTER TABLE core.ventas
+  ADD COLUMN IF NOT EXISTS fecha_local date
+  GENERATED ALWAYS AS (core.fn_fecha_local(fecha_hora, sucursal_id)) STORED;
+ALTER TABLE core.consultas
+  ADD COLUMN IF NOT EXISTS fecha_local date
+  GENERATED ALWAYS AS (core.fn_fecha_local(fecha_hora, sucursal_id)) STORED;
+ALTER TABLE core.pacientes
+  ADD COLUMN IF NOT EXISTS fecha_local date
+  GENERATED ALWAYS AS (core.fn_fecha_local(creado_en, sucursal_id)) STORED;
+ALTER TABLE core.historias_clinicas
+  ADD COLUMN IF NOT EXISTS fecha_local date
+  GENERATED ALWAYS AS (core.fn_fecha_local(created_at_tz, sucursal_id)) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_ventas_sucursal_fecha_local
+  ON core.ventas (sucursal_id, fecha_local);
+CREATE INDEX IF NOT EXISTS idx_consultas_sucursal_fecha_local
+  ON core.consultas (sucursal_id, fecha_local);
+CREATE INDEX IF NOT EXISTS idx_pacientes_sucursal_fecha_local
+  ON core.pacientes (sucursal_id, fecha_local);
+CREATE INDEX IF NOT EXISTS idx_historias_sucursal_fecha_local
+  ON core.historias_clinicas (sucursal_id, fecha_local);
+"""
+
+
+def reporting_rollups_outdated(cur: Any) -> bool:
+    """True when the installed rollups were built by another ``REPORTING_ROLLUPS_VERSION``.
+
+    Rollups that were never installed are left to the runtime migration.
+    """
+    cur.execute("SELECT to_regclass('core.rpt_rollups_estado') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return False
+    cur.execute("SELECT version FROM core.rpt_rollups_estado WHERE rollup_id = true;")
+    row = cur.fetchone()
+    return row is None or int(row[0]) != REPORTING_ROLLUPS_VERSION
+
+
+def ensure_reporting_rollups(cur: Any, *, force_rebuild: bool = False) -> bool:
+    """Install the rollup tables/triggers; backfill them on first install.
+
+    Returns ``True`` when the rollups were rebuilt from the source tables.
+    Must run after the ``core.ventas``/``consultas``/``pacientes`` schemas.
+    """
+    cur.execute(REPORTING_ROLLUPS_SCHEMA_SQL)
+    cur.execute("SELECT version FROM core.rpt_rollups_estado WHERE rollup_id = true;")
+    row = cur.fetchone()
+    if not force_rebuild and row is not None and int(row[0]) == REPORTING_ROLLUPS_VERSION:
+        return False
+    cur.execute(REPORTING_ROLLUPS_REBUILD_SQL)
+    return True
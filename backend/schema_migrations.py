@@ -0,0 +1,208 @@
+"""Versioned runner for the idempotent ``ensure_*`` schema steps.
+
+Every uvicorn worker used to run all ``ensure_*`` functions on start, which
+rewrites functions, triggers and views and scans ``core.historias_clinicas``.
+The steps are now grouped into numbered :class:`RuntimeMigration` entries and
+each applied version is recorded in ``core.schema_migrations``.
+
+``scripts/apply_runtime_migrations.py`` (or the first worker, in ``auto``
+mode) applies the pending versions while holding a session advisory lock, so
+concurrent starters wait and then find nothing to do.  A worker whose schema
+is already current only runs one ``SELECT``.
+
+Schema changes must ship as a new version at the end of the list; versions
+already recorded are never re-run.  A version that alters tables created by
+the phase SQL files lists them in ``requires``: while any is missing the
+version is deferred, not recorded, and the next start (or script run) after
+the phase SQL lands applies it.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import os
+import time
+from typing import Any, Callable, Iterable, Sequence
+
+import psycopg
+
+
+# pg_advisory_lock key shared by every process that applies runtime migrations.
+SCHEMA_MIGRATIONS_LOCK_KEY = 0x6F6C6D5F736368  # "olm_sch"
+
+SCHEMA_MIGRATIONS_MODES = ("auto", "verify", "off")
+
+SCHEMA_MIGRATIONS_TABLE_SQL = """
+CREATE SCHEMA IF NOT EXISTS core;
+
+CREATE TABLE IF NOT EXISTS core.schema_migrations (
+  version integer PRIMARY KEY,
+  nombre text NOT NULL,
+  aplicado_en timestamptz NOT NULL DEFAULT NOW(),
+  duracion_ms integer NOT NULL DEFAULT 0
+);
+"""
+
+
+class SchemaVersionError(RuntimeError):
+    """Raised when the database is behind the code and may not be migrated here."""
+
+
+@dataclass(frozen=True)
+class RuntimeMigration:
+    version: int
+    name: str
+    steps: tuple[tuple[str, Callable[[], Any]], ...]
+    # Relations (``schema.table``) the steps alter but do not create.
+    requires: tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class SchemaMigrationConfig:
+    # auto: the first worker applies pending versions; verify: refuse to start
+    # when behind; off: skip the check entirely.
+    mode: str = "auto"
+    lock_timeout_seconds: float = 300.0
+
+    @classmethod
+    def from_env(cls) -> "SchemaMigrationConfig":
+        mode = os.getenv("SCHEMA_MIGRATIONS_MODE", "auto").strip().lower()
+        try:
+            lock_timeout = float(os.getenv("SCHEMA_MIGRATIONS_LOCK_TIMEOUT_SECONDS", "").strip() or 300.0)
+        except ValueError:
+            lock_timeout = 300.0
+        return cls(
+            mode=mode if mode in SCHEMA_MIGRATIONS_MODES else "auto",
+            lock_timeout_seconds=max(1.0, lock_timeout),
+        )
+
+
+def required_version(migrations: Sequence[RuntimeMigration]) -> int:
+    return max((m.version for m in migrations), default=0)
+
+
+def current_version(cur: Any) -> int:
+    cur.execute("SELECT to_regclass('core.schema_migrations') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM core.schema_migrations")
+    return int(cur.fetchone()[0])
+
+
+def recorded_versions(cur: Any) -> set[int]:
+    cur.execute("SELECT to_regclass('core.schema_migrations') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return set()
+    cur.execute("SELECT version FROM core.schema_migrations")
+    return {int(row[0]) for row in cur.fetchall()}
+
+
+def missing_relations(cur: Any, migration: RuntimeMigration) -> list[str]:
+    missing = []
+    for relation in migration.requires:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (relation,))
+        if not cur.fetchone()[0]:
+            missing.append(relation)
+    return missing
+
+
+def pending_versions(cur: Any, migrations: Sequence[RuntimeMigration]) -> list[int]:
+    """Unrecorded versions whose required relations exist (deferred ones are left out)."""
+    recorded = recorded_versions(cur)
+    return [
+        m.version
+        for m in sorted(migrations, key=lambda m: m.version)
+        if m.version not in recorded and not missing_relations(cur, m)
+    ]
+
+
+def _validate(migrations: Sequence[RuntimeMigration]) -> list[RuntimeMigration]:
+    ordered = sorted(migrations, key=lambda m: m.version)
+    versions = [m.version for m in ordered]
+    if len(set(versions)) != len(versions) or any(v <= 0 for v in versions):
+        raise ValueError(f"Runtime migration versions must be unique and positive: {versions}")
+    return ordered
+
+
+def apply_migrations(
+    conninfo: str,
+    migrations: Sequence[RuntimeMigration],
+    *,
+    lock_timeout_seconds: float = 300.0,
+    log: Callable[[str], None] = print,
+    connect: Callable[..., Any] = psycopg.connect,
+) -> list[int]:
+    """Apply pending versions under the advisory lock; returns the applied ones.
+
+    The lock lives on its own autocommit session; the steps open their own
+    connections and commit as they always did.
+    """
+    ordered = _validate(migrations)
+    applied_now: list[int] = []
+    with connect(conninfo, autocommit=True) as lock_conn:
+        with lock_conn.cursor() as cur:
+            cur.execute("SELECT set_config('lock_timeout', %s, false)", (f"{int(lock_timeout_seconds * 1000)}ms",))
+            cur.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_MIGRATIONS_LOCK_KEY,))
+            try:
+                cur.execute(SCHEMA_MIGRATIONS_TABLE_SQL)
+                recorded = recorded_versions(cur)
+                for migration in ordered:
+                    if migration.version in recorded:
+                        continue
+                    missing = missing_relations(cur, migration)
+                    if missing:
+                        # Recording it now would skip the steps for good once
+                        # the phase SQL creates the tables.
+                        log(f"[schema] v{migration.version} {migration.name} diferida: falta {', '.join(missing)}")
+                        continue
+                    started = time.perf_counter()
+                    for step_name, step in migration.steps:
+                        step()
+                        log(f"[schema] v{migration.version} {step_name}")
+                    elapsed_ms = int((time.perf_counter() - started) * 1000)
+                    cur.execute(
+                        """
+                        INSERT INTO core.schema_migrations (version, nombre, duracion_ms)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (version) DO NOTHING
+                        """,
+                        (migration.version, migration.name, elapsed_ms),
+                    )
+                    applied_now.append(migration.version)
+                    log(f"[schema] v{migration.version} {migration.name} aplicada ({elapsed_ms} ms)")
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_MIGRATIONS_LOCK_KEY,))
+    return applied_now
+
+
+def ensure_schema_version(
+    conninfo: str,
+    migrations: Sequence[RuntimeMigration],
+    config: SchemaMigrationConfig,
+    *,
+    connect: Callable[..., Any] = psycopg.connect,
+    log: Callable[[str], None] = print,
+) -> int:
+    """Startup hook: check the recorded versions and act according to ``config``."""
+    required = required_version(migrations)
+    if config.mode == "off":
+        return required
+    with connect(conninfo) as conn:
+        with conn.cursor() as cur:
+            version = current_version(cur)
+            pending = pending_versions(cur, migrations)
+    if not pending:
+        return version
+    if config.mode == "verify":
+        raise SchemaVersionError(
+            f"Esquema en versión {version}, faltan las versiones {pending}. "
+            "Ejecuta scripts/apply_runtime_migrations.py antes de iniciar la API."
+        )
+    applied = apply_migrations(
+        conninfo, migrations, lock_timeout_seconds=config.lock_timeout_seconds, log=log, connect=connect
+    )
+    return max([version, *applied])
+
+
+def describe(migrations: Iterable[RuntimeMigration]) -> list[str]:
+    return [f"v{m.version} {m.name}: {', '.join(name for name, _ in m.steps)}" for m in migrations]
@@ -1,31 +1,73 @@
 #!/usr/bin/env python3
+"""Apply pending runtime schema versions (see backend/schema_migrations.py).
+
+Run once per deploy before restarting the API workers; the workers then only
+check ``core.schema_migrations``.
+"""
+
+import argparse
 from pathlib import Path
 import sys
 
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Aplica las migraciones runtime pendientes.")
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Solo muestra la versión registrada y la requerida por el código.",
+    )
+    return parser.parse_args()
+
+
 def main() -> int:
+    args = parse_args()
     backend_dir = Path(__file__).resolve().parents[1]
     sys.path.insert(0, str(backend_dir))
 
+    import psycopg
     from main import (
-        ensure_historia_schema,
-        ensure_ventas_schema,
-        ensure_consultas_schema,
-        ensure_pacientes_schema,
-        ensure_reporting_views,
+        DB_CONNINFO,
+        ensure_reporting_rollups_version,
+        repair_historia_diag_fields,
+        runtime_migrations,
+    )
+    from schema_migrations import (
+        SchemaMigrationConfig,
+        apply_migrations,
+        current_version,
+        describe,
+        pending_versions,
+        required_version,
+    )
+
+    migrations = runtime_migrations()
+    with psycopg.connect(DB_CONNINFO) as conn:
+        with conn.cursor() as cur:
+            version = current_version(cur)
+            pending = pending_versions(cur, migrations)
+    required = required_version(migrations)
+    print(f"Schema version: {version} (required {required}, pending {pending or 'none'})")
+    if args.status:
+        for line in describe(migrations):
+            print(f"  {line}")
+        return 1 if pending else 0
+
+    applied = apply_migrations(
+        DB_CONNINFO,
+        migrations,
+        lock_timeout_seconds=SchemaMigrationConfig.from_env().lock_timeout_seconds,
     )
+    for migration_version in applied:
+        print(f"[OK] v{migration_version}")
 
-    steps = [
-        ("ensure_historia_schema", ensure_historia_schema),
-        ("ensure_ventas_schema", ensure_ventas_schema),
-        ("ensure_consultas_schema", ensure_consultas_schema),
-        ("ensure_pacientes_schema", ensure_pacientes_schema),
-        ("ensure_reporting_views", ensure_reporting_views),
-    ]
-
-    for name, fn in steps:
-        fn()
-        print(f"[OK] {name}")
+    # Histories edited since the last run are pending again (v2 trigger).
+    repaired = repair_historia_diag_fields()
+    print(f"[OK] historia diagnoses repaired: {repaired}")
+    # Runtime migration v1 installs the rollups once; later version bumps
+    # are picked up here.
+    if ensure_reporting_rollups_version():
+        print("[OK] reporting rollups rebuilt")
 
     print("Runtime migrations completed.")
     return 0
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Pre-generate the responsive WebP variants of every image under ``media/``.
+
+Run after adding or replacing product images so the first storefront visitor
+does not pay for the resize; variants are otherwise created on first request.
+"""
+
+import argparse
+from pathlib import Path
+import sys
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Genera variantes WebP por ancho de las imágenes de media/.")
+    parser.add_argument("paths", nargs="*", help="Rutas relativas a media/ (por defecto, todas).")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    backend_dir = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(backend_dir))
+
+    from image_variants import SOURCE_EXTENSIONS, MediaVariantConfig, MediaVariantStore, image_variants_available
+
+    if not image_variants_available():
+        print("Pillow no está instalado; no se generan variantes.")
+        return 1
+    media_root = backend_dir / "media"
+    store = MediaVariantStore(str(media_root), MediaVariantConfig.from_env(str(backend_dir)))
+    paths = args.paths or sorted(
+        str(path.relative_to(media_root))
+        for path in media_root.rglob("*")
+        if path.is_file() and path.suffix.lower() in SOURCE_EXTENSIONS
+    )
+    total = 0
+    for media_path in paths:
+        generated = store.warm(media_path)
+        total += generated
+        print(f"[OK] {media_path}: {generated} variantes")
+    print(f"Variantes listas: {total}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -6,6 +6,7 @@ import csv
 import json
 import os
 import re
+import sys
 import unicodedata
 from dataclasses import dataclass
 from datetime import datetime
@@ -14,6 +15,13 @@ from typing import Any
 
 import psycopg
 
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from columnar_export import COLUMNAR_FORMATS, columnar_chunks  # noqa: E402
+from csv_export import copy_csv_chunks  # noqa: E402
+
 
 DEFAULT_CONNINFO = "host=localhost port=5432 dbname=eyecare user=alejandromoncadag"
 
@@ -68,6 +76,11 @@ HISTORIAS_CANONICAL_COLUMNS = [
 ]
 
 
+# Graduaciones guardadas como texto que el export columnar convierte a float64
+# (además de las del dataset ML).
+HISTORIAS_NUMERIC_TEXT_COLUMNS = frozenset({"od_add", "oi_add"})
+
+
 def normalize_controlled_token(value: str | None) -> str | None:
     if value is None:
         return None
@@ -227,6 +240,48 @@ def write_csv(path: Path, columns: list[str], rows: list[tuple[Any, ...]]) -> No
             writer.writerow(list(row))
 
 
+def copy_query_to_csv(
+    cur: psycopg.Cursor[Any],
+    path: Path,
+    sql: str,
+    params: dict[str, Any],
+) -> tuple[list[str], int]:
+    """Write the query result with COPY; returns (columns, row count)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("wb") as f:
+        for chunk in copy_csv_chunks(cur, sql, params, bom=False):
+            f.write(chunk)
+    with path.open(newline="", encoding="utf-8") as f:
+        columns = next(csv.reader(f), [])
+    return columns, max(cur.rowcount, 0)
+
+
+def copy_query_to_columnar(
+    conn: psycopg.Connection[Any],
+    path: Path,
+    sql: str,
+    params: dict[str, Any],
+    fmt: str,
+) -> tuple[list[str], int]:
+    """Write the query result as Arrow/Parquet; returns (columns, row count)."""
+    from main import HISTORIAS_ML_CATEGORICAL_COLUMNS, HISTORIAS_ML_NUMERIC_TEXT_COLUMNS
+
+    stats: dict[str, Any] = {}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("wb") as f:
+        for chunk in columnar_chunks(
+            conn,
+            sql,
+            params,
+            fmt=fmt,
+            categorical=HISTORIAS_ML_CATEGORICAL_COLUMNS,
+            numeric_text=HISTORIAS_ML_NUMERIC_TEXT_COLUMNS | HISTORIAS_NUMERIC_TEXT_COLUMNS,
+            stats=stats,
+        ):
+            f.write(chunk)
+    return list(stats.get("columns", [])), int(stats.get("rows", 0))
+
+
 def drop_columns(
     columns: list[str],
     rows: list[tuple[Any, ...]],
@@ -301,6 +356,7 @@ def export_for_sucursal(
     anio: int,
     output_root: Path,
     include_inactive: bool,
+    historias_formato: str = "csv",
 ) -> dict[str, Any]:
     normalized = (
         unicodedata.normalize("NFKD", sucursal_nombre).encode("ascii", "ignore").decode("ascii").lower()
@@ -318,18 +374,19 @@ def export_for_sucursal(
     }
 
     for export_query in build_queries(include_inactive):
-        with conn.cursor() as cur:
-            cur.execute(
-                export_query.sql,
-                {"sucursal_id": sucursal_id, "anio": anio},
-            )
-            rows = cur.fetchall()
-            columns = [desc[0] for desc in cur.description]
+        params = {"sucursal_id": sucursal_id, "anio": anio}
+        filename = export_query.filename
+        if filename == "historias_clinicas.csv" and historias_formato != "csv":
+            filename = f"historias_clinicas.{COLUMNAR_FORMATS[historias_formato][1]}"
+            out_path = folder / filename
+            columns, row_count = copy_query_to_columnar(conn, out_path, export_query.sql, params, historias_formato)
+        else:
+            out_path = folder / filename
+            with conn.cursor() as cur:
+                columns, row_count = copy_query_to_csv(cur, out_path, export_query.sql, params)
 
-        out_path = folder / export_query.filename
-        write_csv(out_path, columns, rows)
-        summary["files"][export_query.filename] = {
-            "rows": len(rows),
+        summary["files"][filename] = {
+            "rows": row_count,
             "columns": columns,
             "path": str(out_path),
         }
@@ -354,6 +411,12 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Incluye registros inactivos (soft-delete). Por defecto exporta solo activos.",
     )
+    parser.add_argument(
+        "--formato-historias",
+        choices=["csv", *COLUMNAR_FORMATS],
+        default="csv",
+        help="Formato de historias_clinicas: csv, arrow (IPC stream) o parquet (requiere pyarrow).",
+    )
     parser.add_argument(
         "--conninfo",
         type=str,
@@ -392,6 +455,7 @@ def main() -> None:
                 anio=args.anio,
                 output_root=output_root,
                 include_inactive=bool(args.include_inactive),
+                historias_formato=args.formato_historias,
             )
             full_summary["exports"].append(summary)
 
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""Normalize pending clinical-history diagnosis tokens in resumable chunks.
+
+Schema version 2 runs this once, and ``apply_runtime_migrations.py`` and
+API startup (``auto`` mode) run it again for rows the trigger marked pending;
+use the script after bumping ``HISTORIA_DIAG_NORMALIZACION_VERSION``.
+"""
+
+import argparse
+from pathlib import Path
+import sys
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Repara diagnósticos de historias clínicas pendientes.")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Historias por transacción.")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    backend_dir = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(backend_dir))
+
+    from main import repair_historia_diag_fields
+
+    repaired = repair_historia_diag_fields(chunk_size=max(1, args.chunk_size))
+    print(f"Historias con diagnósticos reparados: {repaired}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
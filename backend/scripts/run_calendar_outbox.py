@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""Run the Google Calendar outbox worker as its own process.
+
+Set ``CALENDAR_OUTBOX_ENABLED=false`` for the API when this runs instead, or
+keep both: rows are leased with ``SKIP LOCKED`` so no appointment is synced by
+two workers at once.
+"""
+
+import argparse
+from pathlib import Path
+import sys
+import time
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Sincroniza con Google Calendar las consultas encoladas.")
+    parser.add_argument("--once", action="store_true", help="Ejecuta una sola pasada y termina.")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    backend_dir = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(backend_dir))
+
+    from main import CALENDAR_OUTBOX, db_connect
+
+    worker = CALENDAR_OUTBOX
+    try:
+        while True:
+            counts = worker.run_once()
+            print(", ".join(f"{name}={count}" for name, count in counts.items()), flush=True)
+            if args.once:
+                return 0
+            if sum(counts.values()) < worker.config.batch_size:
+                time.sleep(worker.config.interval_seconds)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        db_connect.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
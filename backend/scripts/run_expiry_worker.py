@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""Run the quote/reservation expiry worker as its own process.
+
+Set ``EXPIRY_WORKER_ENABLED=false`` for the API when this runs instead, or
+keep both: chunks use ``SKIP LOCKED`` so they never process the same rows.
+"""
+
+import argparse
+from pathlib import Path
+import sys
+import time
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Expira cotizaciones, reservas y apartados ópticos vencidos.")
+    parser.add_argument("--once", action="store_true", help="Ejecuta una sola pasada y termina.")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    backend_dir = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(backend_dir))
+
+    from expiry_worker import ExpiryWorker, ExpiryWorkerConfig
+    from main import DB_CONNINFO, db_connect
+
+    worker = ExpiryWorker(DB_CONNINFO, ExpiryWorkerConfig.from_env(), connect=db_connect)
+    try:
+        while True:
+            counts = worker.run_once()
+            print(", ".join(f"{name}={count}" for name, count in counts.items()), flush=True)
+            if args.once:
+                return 0
+            time.sleep(worker.config.interval_seconds)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        db_connect.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,12 +1,16 @@
 """Package calculation contracts for Phase 1F-B1.
 
-Only one combined package is supported. The list return type is intentional so
-future phases can add multi-package calculation without changing snapshots.
+``SingleCombinedPackageCalculator`` only supports one combined package.
+``BinPackingPackageCalculator`` splits a cart into as many packages as its
+compatibility groups, individual-package products and size/weight limits
+require. Both return the same list-of-packages snapshot.
 """
 
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from itertools import permutations
+import time
 from typing import Any
 
 
@@ -124,3 +128,167 @@ class SingleCombinedPackageCalculator(PackageCalculator):
                 ],
             }
         ]
+
+
+@dataclass
+class _OpenPackage:
+    group: str
+    # Free cuboids (x, y, z, length, width, height) left by guillotine cuts.
+    free: list[tuple[int, int, int, int, int, int]]
+    units: list[ProductShippingMeasurement] = field(default_factory=list)
+    weight_grams: int = 0
+    extent: tuple[int, int, int] = (0, 0, 0)
+
+    def place(self, unit: ProductShippingMeasurement, maximum_weight: int) -> bool:
+        if self.weight_grams + unit.weight_grams > maximum_weight:
+            return False
+        for index, (x, y, z, length, width, height) in enumerate(self.free):
+            for a, b, c in _orientations(unit):
+                if a > length or b > width or c > height:
+                    continue
+                del self.free[index]
+                self.free.extend(
+                    space
+                    for space in (
+                        (x + a, y, z, length - a, width, height),
+                        (x, y + b, z, a, width - b, height),
+                        (x, y, z + c, a, b, height - c),
+                    )
+                    if space[3] > 0 and space[4] > 0 and space[5] > 0
+                )
+                # Lowest, then back-most, then left-most space is tried first.
+                self.free.sort(key=lambda space: (space[2], space[1], space[0], space[3:]))
+                self.units.append(unit)
+                self.weight_grams += unit.weight_grams
+                self.extent = (
+                    max(self.extent[0], x + a),
+                    max(self.extent[1], y + b),
+                    max(self.extent[2], z + c),
+                )
+                return True
+        return False
+
+
+def _orientations(unit: ProductShippingMeasurement) -> list[tuple[int, int, int]]:
+    # Flattest orientations first so light products are laid down, not stood up.
+    return sorted(
+        set(permutations((unit.length_mm, unit.width_mm, unit.height_mm))),
+        key=lambda dims: (dims[2], -dims[0], -dims[1]),
+    )
+
+
+class BinPackingPackageCalculator(PackageCalculator):
+    """Deterministic 3D first-fit-decreasing packing with guillotine cuts.
+
+    Units (one per quantity) are packed per compatibility group, largest
+    first, into the first package with room; free space is split into three
+    cuboids after each placement. Products that require an individual package
+    get one each. Package dimensions are the packed extent plus padding, so
+    every package stays within ``PackagingConfiguration`` limits.
+    """
+
+    calculation_method = "bin_packing_v1"
+
+    def __init__(self, *, time_budget_seconds: float = 0.2, max_units: int = 500) -> None:
+        self.time_budget_seconds = time_budget_seconds
+        self.max_units = max_units
+
+    def calculate(
+        self,
+        measurements: list[ProductShippingMeasurement],
+        configuration: PackagingConfiguration,
+    ) -> list[dict[str, Any]]:
+        if not measurements:
+            raise PackageRuleError("EMPTY_CART", "The cart has no shippable products.")
+        units = sum(max(0, item.quantity) for item in measurements)
+        if units > self.max_units:
+            raise PackageRuleError(
+                "MULTI_PACKAGE_NOT_SUPPORTED",
+                "The cart has too many units to calculate packages automatically.",
+                details={"units": units, "maximumUnits": self.max_units},
+            )
+
+        inner = (
+            configuration.maximum_length_mm - configuration.padding_length_mm,
+            configuration.maximum_width_mm - configuration.padding_width_mm,
+            configuration.maximum_height_mm - configuration.padding_height_mm,
+        )
+        maximum_weight = configuration.maximum_weight_grams - configuration.packaging_weight_grams
+        for item in measurements:
+            fits = any(
+                a <= inner[0] and b <= inner[1] and c <= inner[2] for a, b, c in _orientations(item)
+            )
+            if not fits or item.weight_grams > maximum_weight:
+                raise PackageRuleError(
+                    "ITEM_EXCEEDS_PACKAGE_LIMITS",
+                    "A product does not fit in a package within the approved limits.",
+                    details={
+                        "productId": str(item.product_id),
+                        "weightGrams": item.weight_grams,
+                        "lengthMm": item.length_mm,
+                        "widthMm": item.width_mm,
+                        "heightMm": item.height_mm,
+                    },
+                )
+
+        deadline = time.perf_counter() + self.time_budget_seconds
+        order = {id(item): index for index, item in enumerate(measurements)}
+        groups: dict[str, list[ProductShippingMeasurement]] = {}
+        for item in measurements:
+            groups.setdefault(item.compatibility_group.strip().lower(), []).extend([item] * item.quantity)
+
+        packages: list[_OpenPackage] = []
+        for group in sorted(groups):
+            shared: list[_OpenPackage] = []
+            individual: list[_OpenPackage] = []
+            for unit in sorted(
+                groups[group],
+                key=lambda unit: (
+                    -(unit.length_mm * unit.width_mm * unit.height_mm),
+                    -max(unit.length_mm, unit.width_mm, unit.height_mm),
+                    -unit.weight_grams,
+                    order[id(unit)],
+                ),
+            ):
+                if time.perf_counter() > deadline:
+                    raise PackageRuleError(
+                        "MULTI_PACKAGE_NOT_SUPPORTED",
+                        "Package calculation exceeded its time budget.",
+                        details={"units": units},
+                    )
+                if unit.requires_individual_package:
+                    package = _OpenPackage(group, [(0, 0, 0, *inner)])
+                    package.place(unit, maximum_weight)
+                    individual.append(package)
+                    continue
+                if not any(package.place(unit, maximum_weight) for package in shared):
+                    package = _OpenPackage(group, [(0, 0, 0, *inner)])
+                    package.place(unit, maximum_weight)
+                    shared.append(package)
+            packages.extend(shared + individual)
+
+        snapshots = []
+        for number, package in enumerate(packages, start=1):
+            quantities: dict[int, int] = {}
+            for unit in package.units:
+                quantities[order[id(unit)]] = quantities.get(order[id(unit)], 0) + 1
+            snapshots.append(
+                {
+                    "packageNumber": number,
+                    "weightGrams": configuration.packaging_weight_grams + package.weight_grams,
+                    "lengthMm": package.extent[0] + configuration.padding_length_mm,
+                    "widthMm": package.extent[1] + configuration.padding_width_mm,
+                    "heightMm": package.extent[2] + configuration.padding_height_mm,
+                    "compatibilityGroup": package.group,
+                    "calculationMethod": self.calculation_method,
+                    "measurementSources": [
+                        {
+                            "productId": str(measurements[index].product_id),
+                            "quantity": quantity,
+                            "source": measurements[index].source,
+                        }
+                        for index, quantity in sorted(quantities.items())
+                    ],
+                }
+            )
+        return snapshots
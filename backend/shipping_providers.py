@@ -1,11 +1,27 @@
-"""Shipping-rate provider abstractions for Phase 1F-B1."""
+"""Shipping-rate provider abstractions for Phase 1F-B1.
+
+``ShippingRateRegistry`` fans a rate request out to every configured carrier
+adapter at once.  Each provider gets its own timeout and circuit breaker, so a
+slow or failing carrier only drops its own options instead of holding up
+checkout, and quotes are cached per provider for ``cache_ttl_seconds`` keyed by
+the package snapshot, the origin branches and the destination postal code.
+"""
 
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
-from typing import Any
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from auth_cache import TTLCache
 
 
 @dataclass(frozen=True)
@@ -24,9 +40,16 @@ class ShippingRateQuote:
 
 
 class ShippingRateProvider:
-    """Future carrier adapters and the manual provider share this contract."""
+    """Future carrier adapters and the manual provider share this contract.
+
+    ``request`` carries ``packages`` (the package snapshot stored on the quote
+    request), ``destinationPostalCode`` and ``origins``: one
+    ``{"branchId", "postalCode"}`` entry per eligible branch.
+    """
 
     provider_code = "abstract"
+    # Overrides ShippingRateRegistry's default when set.
+    timeout_seconds: float | None = None
 
     def quote(self, request: dict[str, Any]) -> list[ShippingRateQuote]:
         raise NotImplementedError
@@ -39,3 +62,274 @@ class ManualShippingRateProvider(ShippingRateProvider):
 
     def quote(self, request: dict[str, Any]) -> list[ShippingRateQuote]:
         return []
+
+
+class FakeCarrierRateProvider(ShippingRateProvider):
+    """Deterministic local carrier for development and tests.
+
+    Prices by billable kilograms (actual or volumetric, whichever is larger)
+    and offers a standard and an express service per origin branch.
+    ``delay_seconds`` and ``fail`` simulate a slow or broken carrier.
+    """
+
+    provider_code = "fake"
+
+    def __init__(
+        self,
+        *,
+        carrier_code: str = "fake_carrier",
+        display_name: str = "Paquetería de prueba",
+        base_amount: Decimal = Decimal("89.00"),
+        per_kilogram: Decimal = Decimal("18.00"),
+        delay_seconds: float = 0.0,
+        fail: bool = False,
+        quote_ttl_seconds: int = 3600,
+    ) -> None:
+        self.provider_code = carrier_code
+        self.carrier_code = carrier_code
+        self.display_name = display_name
+        self.base_amount = base_amount
+        self.per_kilogram = per_kilogram
+        self.delay_seconds = delay_seconds
+        self.fail = fail
+        self.quote_ttl_seconds = quote_ttl_seconds
+        self.calls = 0
+
+    def quote(self, request: dict[str, Any]) -> list[ShippingRateQuote]:
+        self.calls += 1
+        if self.delay_seconds:
+            time.sleep(self.delay_seconds)
+        if self.fail:
+            raise RuntimeError(f"{self.carrier_code} no está disponible")
+        kilograms = 0
+        for package in request.get("packages") or []:
+            volumetric = int(package["lengthMm"]) * int(package["widthMm"]) * int(package["heightMm"]) / 5_000_000
+            kilograms += math.ceil(max(int(package["weightGrams"]) / 1000, volumetric))
+        calculated_at = datetime.now(timezone.utc).replace(microsecond=0)
+        destination = str(request.get("destinationPostalCode") or "")
+        quotes: list[ShippingRateQuote] = []
+        for origin in request.get("origins") or []:
+            # Same first digit of the postal code means the same region.
+            remote = str(origin.get("postalCode") or "")[:1] != destination[:1]
+            standard = (self.base_amount + self.per_kilogram * kilograms + (Decimal("40.00") if remote else 0)).quantize(Decimal("0.01"))
+            for service, amount, days in (
+                ("Estándar", standard, (3, 6) if remote else (2, 4)),
+                ("Express", (standard * Decimal("1.8")).quantize(Decimal("0.01")), (1, 2) if remote else (1, 1)),
+            ):
+                quotes.append(
+                    ShippingRateQuote(
+                        branch_id=int(origin["branchId"]),
+                        carrier_code=self.carrier_code,
+                        carrier_display_name=self.display_name,
+                        service_level=service,
+                        amount=amount,
+                        currency="MXN",
+                        minimum_delivery_days=days[0],
+                        maximum_delivery_days=days[1],
+                        quote_identifier=f"{self.carrier_code}-{origin['branchId']}-{destination}-{service.lower()}-{amount}",
+                        calculated_at=calculated_at,
+                        expires_at=calculated_at + timedelta(seconds=self.quote_ttl_seconds),
+                    )
+                )
+        return quotes
+
+
+class ProviderCircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures; after
+    ``reset_seconds`` one trial call is let through (half-open)."""
+
+    def __init__(
+        self,
+        failure_threshold: int = 3,
+        reset_seconds: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if self._clock() - self._opened_at >= self.reset_seconds else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._clock() - self._opened_at < self.reset_seconds or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+
+    def stats(self) -> dict[str, Any]:
+        state = self.state
+        with self._lock:
+            return {"state": state, "consecutive_failures": self._failures}
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    return default if value is None else value.strip().lower() in {"1", "true", "yes", "on"}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+@dataclass(frozen=True)
+class ShippingRatesConfig:
+    enabled: bool = False
+    fake_carrier_enabled: bool = False
+    timeout_seconds: float = 2.0
+    cache_ttl_seconds: float = 300.0
+    cache_max_entries: int = 2048
+    failure_threshold: int = 3
+    reset_seconds: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> "ShippingRatesConfig":
+        return cls(
+            enabled=_env_bool("SHIPPING_RATES_ENABLED", False),
+            fake_carrier_enabled=_env_bool("SHIPPING_RATES_FAKE_CARRIER_ENABLED", False),
+            timeout_seconds=max(0.1, _env_float("SHIPPING_RATES_TIMEOUT_SECONDS", 2.0)),
+            cache_ttl_seconds=max(0.0, _env_float("SHIPPING_RATES_CACHE_TTL_SECONDS", 300.0)),
+            cache_max_entries=max(1, int(_env_float("SHIPPING_RATES_CACHE_MAX_ENTRIES", 2048))),
+            failure_threshold=max(1, int(_env_float("SHIPPING_RATES_BREAKER_FAILURES", 3))),
+            reset_seconds=max(1.0, _env_float("SHIPPING_RATES_BREAKER_RESET_SECONDS", 30.0)),
+        )
+
+
+def rate_request_key(request: dict[str, Any]) -> str:
+    """Cache key: package snapshot, origin branches and destination postal code."""
+    origins = sorted((str(origin["branchId"]), str(origin.get("postalCode") or "")) for origin in request.get("origins") or [])
+    canonical = json.dumps(
+        [request.get("packages") or [], origins, str(request.get("destinationPostalCode") or "").strip()],
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ShippingRateRegistry:
+    """Concurrent, cached, circuit-broken quoting across carrier adapters."""
+
+    def __init__(
+        self,
+        providers: list[ShippingRateProvider] | tuple[ShippingRateProvider, ...],
+        config: ShippingRatesConfig | None = None,
+        *,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.config = config or ShippingRatesConfig.from_env()
+        self.providers = tuple(providers)
+        self._cache = TTLCache(self.config.cache_ttl_seconds, self.config.cache_max_entries, clock=clock)
+        self._breakers = {
+            provider.provider_code: ProviderCircuitBreaker(self.config.failure_threshold, self.config.reset_seconds, clock=clock)
+            for provider in self.providers
+        }
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, 2 * len(self.providers)),
+            thread_name_prefix="shipping-rates",
+        ) if self.providers else None
+        self._lock = threading.Lock()
+        self._counters = {
+            provider.provider_code: {"calls": 0, "errors": 0, "timeouts": 0, "skipped": 0, "last_error": None}
+            for provider in self.providers
+        }
+
+    def _count(self, code: str, field: str, error: str | None = None) -> None:
+        with self._lock:
+            self._counters[code][field] += 1
+            if error is not None:
+                self._counters[code]["last_error"] = error
+
+    def quote(self, request: dict[str, Any]) -> list[ShippingRateQuote]:
+        """Returns every live quote; providers that fail, time out or are
+        short-circuited simply contribute nothing."""
+        key = rate_request_key(request)
+        results: list[ShippingRateQuote] = []
+        pending = []
+        for provider in self.providers:
+            code = provider.provider_code
+            cached = self._cache.get((code, key))
+            if cached is not None:
+                results.extend(cached)
+                continue
+            if not self._breakers[code].allow():
+                self._count(code, "skipped")
+                continue
+            self._count(code, "calls")
+            timeout = provider.timeout_seconds or self.config.timeout_seconds
+            pending.append((provider, time.monotonic() + timeout, self._executor.submit(provider.quote, request)))
+        for provider, deadline, future in pending:
+            code = provider.provider_code
+            try:
+                quotes = list(future.result(timeout=max(0.0, deadline - time.monotonic())))
+            except TimeoutError:
+                # The thread finishes on its own; its answer is discarded.
+                future.cancel()
+                self._breakers[code].record_failure()
+                self._count(code, "timeouts", "timeout")
+                continue
+            except Exception as exc:
+                self._breakers[code].record_failure()
+                self._count(code, "errors", f"{type(exc).__name__}: {exc}")
+                print(f"[shipping-rates] {code} falló: {type(exc).__name__}: {exc}")
+                continue
+            self._breakers[code].record_success()
+            self._cache.set((code, key), quotes)
+            results.extend(quotes)
+        now = datetime.now(timezone.utc)
+        return [quote for quote in results if quote.expires_at > now]
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            providers = {code: dict(counters) for code, counters in self._counters.items()}
+        for code, breaker in self._breakers.items():
+            providers[code]["breaker"] = breaker.stats()
+        return {"providers": providers, "cache": self._cache.stats()}
+
+
+def build_rate_registry(config: ShippingRatesConfig | None = None) -> ShippingRateRegistry | None:
+    """The configured carrier adapters, or ``None`` when automatic rating is off."""
+    config = config or ShippingRatesConfig.from_env()
+    if not config.enabled:
+        return None
+    providers: list[ShippingRateProvider] = []
+    if config.fake_carrier_enabled:
+        providers.append(FakeCarrierRateProvider())
+    if not providers:
+        return None
+    return ShippingRateRegistry(providers, config)
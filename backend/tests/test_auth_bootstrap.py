@@ -164,7 +164,7 @@ class AuthenticationBootstrapTests(unittest.TestCase):
         }
         with (
             patch.dict(os.environ, environment, clear=False),
-            patch.object(backend_main.psycopg, "connect", return_value=self.wrapper),
+            patch.object(backend_main, "db_connect", return_value=self.wrapper),
             redirect_stdout(output),
             redirect_stderr(output),
         ):
@@ -203,7 +203,7 @@ class AuthenticationBootstrapTests(unittest.TestCase):
         output = StringIO()
         with (
             patch.dict(os.environ, environment, clear=False),
-            patch.object(backend_main.psycopg, "connect", return_value=self.wrapper),
+            patch.object(backend_main, "db_connect", return_value=self.wrapper),
             redirect_stdout(output),
             redirect_stderr(output),
         ):
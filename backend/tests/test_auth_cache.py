@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+import unittest
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from auth_cache import AuthCacheConfig, AuthLookupCache, TTLCache  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TTLCacheTests(unittest.TestCase):
+    def test_entries_expire_and_size_is_bounded(self) -> None:
+        clock = FakeClock()
+        cache = TTLCache(ttl_seconds=10, max_entries=2, clock=clock)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        clock.now += 11
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNone(cache.get("c"))
+        self.assertEqual(0, cache.stats()["size"])
+
+    def test_stale_load_is_not_cached_after_invalidation(self) -> None:
+        cache = TTLCache(ttl_seconds=10, max_entries=10)
+        generation = cache.generation
+        cache.pop("admin")
+        cache.set("admin", "stale", generation=generation)
+        self.assertIsNone(cache.get("admin"))
+
+
+class AuthLookupCacheTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache = AuthLookupCache(AuthCacheConfig(ttl_seconds=30, max_entries=10))
+        self.loads: list[str] = []
+
+    def _load(self, username: str):
+        self.loads.append(username)
+        return ("admin", None, True, "2026-08-01")
+
+    def test_user_lookup_hits_database_once_until_notified(self) -> None:
+        self.cache.get_user("admin", self._load)
+        self.cache.get_user("admin", self._load)
+        self.assertEqual(["admin"], self.loads)
+        self.cache.apply_notification("usuario:admin")
+        self.cache.get_user("admin", self._load)
+        self.assertEqual(["admin", "admin"], self.loads)
+
+    def test_missing_user_is_never_cached(self) -> None:
+        calls = []
+        for _ in range(2):
+            self.assertIsNone(self.cache.get_user("ghost", lambda name: calls.append(name)))
+        self.assertEqual(["ghost", "ghost"], calls)
+
+    def test_branch_notification_only_drops_branch_set(self) -> None:
+        self.cache.get_user("admin", self._load)
+        self.assertEqual(frozenset({1, 2}), self.cache.active_branch_ids(lambda: {1, 2}))
+        self.cache.apply_notification("sucursales")
+        self.assertEqual(frozenset({1}), self.cache.active_branch_ids(lambda: {1}))
+        self.cache.get_user("admin", self._load)
+        self.assertEqual(["admin"], self.loads)
+
+    def test_disabled_cache_always_loads(self) -> None:
+        cache = AuthLookupCache(AuthCacheConfig(enabled=False))
+        cache.get_user("admin", self._load)
+        cache.get_user("admin", self._load)
+        self.assertEqual(["admin", "admin"], self.loads)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+import re
+import sys
+import unittest
+from unittest.mock import patch
+
+import psycopg
+from psycopg.rows import dict_row
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from calendar_outbox import (  # noqa: E402
+    CalendarOutboxConfig,
+    CalendarOutboxWorker,
+    calendar_event_id,
+    enqueue_calendar_sync,
+)
+
+
+class SharedTransaction:
+    """Hands the worker one connection whose commits stay inside the test transaction."""
+
+    def __init__(self, connection) -> None:
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        return False
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def commit(self):
+        return None
+
+
+class CalendarOutboxConfigTests(unittest.TestCase):
+    def test_backoff_doubles_and_is_capped(self) -> None:
+        config = CalendarOutboxConfig(backoff_seconds=30, max_backoff_seconds=200)
+        self.assertEqual([30, 60, 120, 200, 200], [config.retry_delay(n) for n in range(1, 6)])
+
+    def test_event_ids_use_the_google_base32hex_alphabet(self) -> None:
+        event_id = calendar_event_id(42)
+        self.assertEqual(event_id, calendar_event_id(42))
+        self.assertRegex(event_id, re.compile(r"^[a-v0-9]{5,1024}$"))
+
+
+class CalendarOutboxLiveTests(unittest.TestCase):
+    # Negative ids never collide with real consultas; the table has no FK.
+    CONSULTA_ID = -970001
+
+    def setUp(self) -> None:
+        conninfo = os.getenv("DB_CONNINFO", "").strip()
+        if not conninfo:
+            self.skipTest("DB_CONNINFO is not configured")
+        self.connection = psycopg.connect(conninfo, row_factory=dict_row)
+        with self.connection.cursor() as cur:
+            cur.execute("SELECT to_regclass('core.agenda_calendario_outbox') IS NOT NULL AS ready")
+            ready = cur.fetchone()["ready"]
+        if not ready:
+            self.connection.close()
+            self.skipTest("Runtime migration v8 (agenda_calendario_outbox) has not been applied")
+
+    def tearDown(self) -> None:
+        if not self.connection.closed:
+            self.connection.rollback()
+            self.connection.close()
+
+    def _worker(self, sync, **config) -> CalendarOutboxWorker:
+        shared = SharedTransaction(self.connection)
+        return CalendarOutboxWorker(
+            "unused",
+            sync,
+            CalendarOutboxConfig(**config),
+            connect=lambda *_a, **_k: shared,
+        )
+
+    def _enqueue(self, operation: str, **kwargs) -> None:
+        with self.connection.cursor() as cur:
+            enqueue_calendar_sync(
+                cur, consulta_id=self.CONSULTA_ID, sucursal_id=1, operation=operation, **kwargs
+            )
+
+    def _row(self):
+        with self.connection.cursor() as cur:
+            cur.execute(
+                "SELECT * FROM core.agenda_calendario_outbox WHERE consulta_id = %s",
+                (self.CONSULTA_ID,),
+            )
+            return cur.fetchone()
+
+    def test_later_changes_collapse_into_one_row_per_consulta(self) -> None:
+        self._enqueue("sincronizar", requested_by="recepcion")
+        self._enqueue("eliminar", event_id="evt123", calendar_id="cal@example.com")
+        self._enqueue("eliminar")
+
+        row = self._row()
+        self.assertEqual("eliminar", row["operacion"])
+        self.assertEqual(3, row["version"])
+        self.assertEqual("evt123", row["evento_id"])
+        self.assertEqual("cal@example.com", row["calendario_id"])
+        self.assertEqual("recepcion", row["solicitado_por"])
+        with self.assertRaises(ValueError):
+            self._enqueue("crear")
+
+    def test_successful_sync_removes_the_row(self) -> None:
+        self._enqueue("sincronizar")
+        seen: list[tuple[int, str]] = []
+
+        def sync(job):
+            seen.append((job["consulta_id"], job["operacion"]))
+            return calendar_event_id(job["consulta_id"]), "primary"
+
+        worker = self._worker(sync)
+        self.assertEqual(1, worker.run_once()["synced"])
+        self.assertEqual([(self.CONSULTA_ID, "sincronizar")], seen)
+        self.assertIsNone(self._row())
+        self.assertEqual({"synced": 0, "deleted": 0, "superseded": 0, "retried": 0, "failed": 0}, worker.run_once())
+
+    def test_failures_back_off_and_stop_after_max_attempts(self) -> None:
+        self._enqueue("eliminar", event_id="evt123")
+
+        def sync(_job):
+            raise RuntimeError("Google no responde")
+
+        worker = self._worker(sync, max_attempts=2, backoff_seconds=60)
+        self.assertEqual(1, worker.run_once()["retried"])
+        row = self._row()
+        self.assertEqual(("pendiente", 1), (row["estado"], row["intentos"]))
+        self.assertIsNone(row["bloqueado_hasta"])
+        self.assertIn("Google no responde", row["ultimo_error"])
+        # Not due again until the backoff elapses.
+        self.assertEqual(0, sum(worker.run_once().values()))
+
+        with self.connection.cursor() as cur:
+            cur.execute(
+                "UPDATE core.agenda_calendario_outbox SET proximo_intento_at = NOW() - INTERVAL '1 second' WHERE consulta_id = %s",
+                (self.CONSULTA_ID,),
+            )
+        self.assertEqual(1, worker.run_once()["failed"])
+        self.assertEqual(("fallido", 2), (self._row()["estado"], self._row()["intentos"]))
+
+        # A new change to the appointment re-arms a failed row.
+        self._enqueue("eliminar")
+        self.assertEqual(("pendiente", 0), (self._row()["estado"], self._row()["intentos"]))
+
+    def test_change_during_sync_keeps_the_newer_operation(self) -> None:
+        self._enqueue("sincronizar")
+
+        def sync(job):
+            self._enqueue("eliminar")
+            return calendar_event_id(job["consulta_id"]), "primary"
+
+        worker = self._worker(sync)
+        self.assertEqual(1, worker.run_once()["superseded"])
+        row = self._row()
+        self.assertEqual(("eliminar", 2), (row["operacion"], row["version"]))
+        self.assertEqual(calendar_event_id(self.CONSULTA_ID), row["evento_id"])
+        self.assertIsNone(row["bloqueado_hasta"])
+
+    def test_leased_rows_are_not_claimed_twice(self) -> None:
+        self._enqueue("sincronizar")
+        with self.connection.cursor() as cur:
+            cur.execute(
+                "UPDATE core.agenda_calendario_outbox SET bloqueado_hasta = NOW() + INTERVAL '1 minute' WHERE consulta_id = %s",
+                (self.CONSULTA_ID,),
+            )
+        self._enqueue("eliminar")
+        worker = self._worker(lambda _job: self.fail("leased row was synced again"))
+        self.assertEqual(0, sum(worker.run_once().values()))
+
+
+class ConsultaCalendarSyncTests(unittest.TestCase):
+    def test_delete_job_falls_back_to_the_deterministic_event_id(self) -> None:
+        import main as backend_main
+
+        with patch.object(backend_main, "_delete_calendar_event_for_consulta") as delete:
+            result = backend_main._sync_consulta_calendar(
+                {"consulta_id": 55, "sucursal_id": 2, "operacion": "eliminar", "evento_id": None, "calendario_id": None}
+            )
+        self.assertEqual((None, None), result)
+        delete.assert_called_once_with(sucursal_id=2, event_id=calendar_event_id(55), calendar_id_hint=None)
+
+    def test_sync_job_is_dropped_while_the_calendar_is_disabled(self) -> None:
+        import main as backend_main
+
+        with patch.dict("os.environ", {"ENABLE_GOOGLE_CALENDAR": "false"}), \
+                patch.object(backend_main, "db_connect") as connect, \
+                patch.object(backend_main, "_create_calendar_event_for_consulta") as create:
+            result = backend_main._sync_consulta_calendar(
+                {"consulta_id": 55, "sucursal_id": 2, "operacion": "sincronizar", "evento_id": None}
+            )
+        self.assertEqual((None, None), result)
+        connect.assert_not_called()
+        create.assert_not_called()
+
+    def test_worker_starts_without_the_calendar_flag(self) -> None:
+        import main as backend_main
+
+        with patch.dict("os.environ", {"ENABLE_GOOGLE_CALENDAR": "false"}), \
+                patch.object(backend_main.AUTH_CACHE_LISTENER, "start"), \
+                patch.object(backend_main.CATALOG_CACHE_LISTENER, "start"), \
+                patch.object(backend_main.EXPIRY_WORKER, "start"), \
+                patch.object(backend_main.CALENDAR_OUTBOX, "start") as start:
+            backend_main.start_auth_cache_listener()
+        start.assert_called_once_with()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+import sys
+import unittest
+
+from fastapi import Response
+from fastapi.routing import APIRoute
+from starlette.requests import Request
+import psycopg
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from catalog_cache import (  # noqa: E402
+    CATALOG_CACHE_REQUIRED_TABLES,
+    CATALOG_CACHE_TRIGGER_SQL,
+    CatalogCacheConfig,
+    CatalogSnapshotCache,
+    etag_matches,
+)
+from public_catalog import (  # noqa: E402
+    PublicAvailabilityItem,
+    PublicAvailabilityRequest,
+    PublicCatalogConfig,
+    PublicCategory,
+    PublicProductAvailability,
+    create_public_catalog_router,
+)
+
+
+class CountingRepository:
+    def __init__(self) -> None:
+        self.calls: list[str] = []
+        self.categories = [PublicCategory(code="lentes_opticos", productCount=2)]
+
+    def list_products(self, **kwargs):
+        self.calls.append(f"products:{kwargs['offset']}")
+        return [], 0, None
+
+    def get_product(self, slug: str, _branch_id=None):
+        self.calls.append(f"product:{slug}")
+        return None
+
+    def list_categories(self):
+        self.calls.append("categories")
+        return list(self.categories)
+
+    def get_availability(self, product_ids, branch_id):
+        self.calls.append(f"stock:{','.join(map(str, product_ids))}")
+        return [
+            PublicAvailabilityItem(
+                productId=str(product_id),
+                sku=f"SKU-{product_id}",
+                availability=PublicProductAvailability(
+                    mode="branch_stock",
+                    controlsStock=True,
+                    availableOnline=True,
+                    totalOnlineAvailability=product_id,
+                    branches=[],
+                ),
+            )
+            for product_id in product_ids
+            if product_id != 404
+        ]
+
+
+def _request(if_none_match: str | None = None) -> Request:
+    headers = [] if if_none_match is None else [(b"if-none-match", if_none_match.encode())]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+class CatalogCacheTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.repository = CountingRepository()
+        self.cache = CatalogSnapshotCache(CatalogCacheConfig(enabled=True, ttl_seconds=60))
+        self.router = router = create_public_catalog_router(
+            "unused",
+            config=PublicCatalogConfig(
+                db_conninfo="unused",
+                bearer_token="token",
+                media_base_url="http://127.0.0.1:8000",
+                allowed_image_origins=("http://127.0.0.1:8000",),
+            ),
+            repository=self.repository,
+            cache=self.cache,
+        )
+        self.endpoints = {
+            route.path: route.endpoint
+            for route in router.routes
+            if isinstance(route, APIRoute) and "GET" in route.methods
+        }
+
+    def test_repeated_requests_are_served_from_the_snapshot(self) -> None:
+        products = self.endpoints["/public/catalog/v1/products"]
+        for offset in (0, 0, 50, 0):
+            products(category=None, search=None, branch_id=None, limit=50, offset=offset)
+        self.assertEqual(["products:0", "products:50"], self.repository.calls)
+
+    def test_matching_etag_returns_not_modified(self) -> None:
+        categories = self.endpoints["/public/catalog/v1/categories"]
+        response = Response()
+        payload = categories(request=_request(), response=response)
+        etag = response.headers["etag"]
+        self.assertEqual("lentes_opticos", payload.categories[0].code)
+
+        not_modified = categories(request=_request(f'W/{etag}, "other"'), response=Response())
+        self.assertEqual(304, not_modified.status_code)
+        self.assertEqual(etag, not_modified.headers["etag"])
+        self.assertEqual(["categories"], self.repository.calls)
+
+    def test_notification_invalidates_and_changes_the_etag(self) -> None:
+        categories = self.endpoints["/public/catalog/v1/categories"]
+        first = Response()
+        categories(request=_request(), response=first)
+
+        self.repository.categories = [PublicCategory(code="solares", productCount=1)]
+        self.cache.apply_notification("42")
+        second = Response()
+        payload = categories(request=_request(first.headers["etag"]), response=second)
+
+        self.assertEqual(42, self.cache.version)
+        self.assertEqual("solares", payload.categories[0].code)
+        self.assertNotEqual(first.headers["etag"], second.headers["etag"])
+        self.assertEqual(["categories", "categories"], self.repository.calls)
+
+    def test_unknown_products_are_not_cached(self) -> None:
+        product = self.endpoints["/public/catalog/v1/products/{slug}"]
+        for _ in range(2):
+            with self.assertRaises(Exception) as ctx:
+                product(slug="nope", branch_id=None)
+            self.assertEqual(404, ctx.exception.status_code)
+        self.assertEqual(["product:nope", "product:nope"], self.repository.calls)
+        self.assertEqual(0, self.cache.stats()["entries"]["size"])
+
+    def test_stock_cache_only_loads_missing_products(self) -> None:
+        bulk = self.endpoints["/public/catalog/v1/availability"]
+        first = bulk(product_id=[3, 1], branch_id=None)
+        second = bulk(product_id=[1, 2, 404], branch_id=None)
+        bulk(product_id=[2, 404], branch_id=None)
+
+        self.assertEqual(["1", "3"], [item.productId for item in first.products])
+        self.assertEqual(["1", "2"], [item.productId for item in second.products])
+        self.assertEqual(["stock:1,3", "stock:2,404"], self.repository.calls)
+
+        self.cache.apply_notification("7")
+        bulk(product_id=[1], branch_id=None)
+        self.assertEqual("stock:1", self.repository.calls[-1])
+
+    def test_post_availability_accepts_large_carts(self) -> None:
+        post = next(
+            route.endpoint
+            for route in self.router.routes
+            if isinstance(route, APIRoute) and route.path.endswith("/availability") and "POST" in route.methods
+        )
+        payload = post(PublicAvailabilityRequest(productIds=list(range(1, 301))))
+        self.assertEqual(300, len(payload.products))
+        with self.assertRaises(Exception) as ctx:
+            post(PublicAvailabilityRequest(productIds=list(range(1, 502))))
+        self.assertEqual(400, ctx.exception.status_code)
+
+    def test_etag_ignores_generated_at(self) -> None:
+        bulk = self.endpoints["/public/catalog/v1/availability"]
+        first, second = Response(), Response()
+        bulk(product_id=[1], branch_id=None, request=_request(), response=first)
+        self.cache.invalidate_all()
+        bulk(product_id=[1], branch_id=None, request=_request(), response=second)
+        self.assertEqual(first.headers["etag"], second.headers["etag"])
+
+    def test_etag_matching(self) -> None:
+        self.assertTrue(etag_matches("*", '"a"'))
+        self.assertTrue(etag_matches('"b", W/"a"', '"a"'))
+        self.assertFalse(etag_matches('"b"', '"a"'))
+        self.assertFalse(etag_matches(None, '"a"'))
+
+    def test_live_catalog_writes_bump_the_version(self) -> None:
+        conninfo = os.getenv("DB_CONNINFO")
+        if not conninfo:
+            self.skipTest("DB_CONNINFO is not configured")
+        connection = psycopg.connect(conninfo)
+        try:
+            with connection.cursor() as cur:
+                cur.execute(
+                    "SELECT bool_and(to_regclass(t) IS NOT NULL) FROM unnest(%s::text[]) AS t",
+                    (list(CATALOG_CACHE_REQUIRED_TABLES),),
+                )
+                if not cur.fetchone()[0]:
+                    self.skipTest("Catalog tables have not been installed")
+                cur.execute(CATALOG_CACHE_TRIGGER_SQL)
+                cur.execute("SELECT nextval('core.catalogo_version_seq')")
+                before = cur.fetchone()[0]
+                # Statement triggers fire even when no row matches.
+                cur.execute("UPDATE core.catalogo_productos SET nombre = nombre WHERE false")
+                cur.execute("SELECT currval('core.catalogo_version_seq')")
+                self.assertGreater(cur.fetchone()[0], before)
+        finally:
+            connection.rollback()
+            connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
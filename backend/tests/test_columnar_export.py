@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timedelta
+from io import BytesIO
+from pathlib import Path
+import sys
+import unittest
+from unittest.mock import patch
+
+import psycopg
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+import main as backend_main  # noqa: E402
+from columnar_export import columnar_chunks, columnar_export_available  # noqa: E402
+
+
+class TransactionConnectionProxy:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exc_type, _exc, _traceback):
+        return False
+
+    def cursor(self, *args, **kwargs):
+        return self.connection.cursor(*args, **kwargs)
+
+    def commit(self):
+        return None
+
+
+async def _read_body(response) -> bytes:
+    body = b""
+    async for chunk in response.body_iterator:
+        body += chunk
+    return body
+
+
+@unittest.skipUnless(columnar_export_available(), "pyarrow is not installed")
+class ColumnarExportTests(unittest.TestCase):
+    def setUp(self):
+        self.connection = psycopg.connect(backend_main.DB_CONNINFO)
+
+    def tearDown(self):
+        self.connection.rollback()
+        self.connection.close()
+
+    def test_live_arrow_stream_keeps_types_and_grows_dictionaries(self):
+        import pyarrow as pa
+
+        body = b"".join(
+            columnar_chunks(
+                self.connection,
+                """
+                SELECT n::int AS id, (n * 1.5)::numeric AS monto, DATE '2024-03-01' + n AS dia,
+                       CASE WHEN n %% 2 = 0 THEN 'par' ELSE 'non' END AS token,
+                       CASE WHEN n = 3 THEN 'n/a' ELSE '-1.25' END AS esfera
+                FROM generate_series(1, 5) AS n
+                ORDER BY n
+                """,
+                (),
+                fmt="arrow",
+                categorical={"token"},
+                numeric_text={"esfera"},
+                batch_size=2,
+            )
+        )
+        table = pa.ipc.open_stream(BytesIO(body)).read_all()
+
+        self.assertEqual(5, table.num_rows)
+        self.assertEqual(pa.int32(), table.schema.field("id").type)
+        self.assertEqual(pa.float64(), table.schema.field("monto").type)
+        self.assertEqual(pa.date32(), table.schema.field("dia").type)
+        self.assertEqual(pa.dictionary(pa.int32(), pa.string()), table.schema.field("token").type)
+        self.assertEqual(["non", "par", "non", "par", "non"], table.column("token").to_pylist())
+        self.assertEqual([-1.25, -1.25, None, -1.25, -1.25], table.column("esfera").to_pylist())
+
+    def test_live_parquet_endpoint_exports_changes_since_watermark(self):
+        import pyarrow.parquet as pq
+
+        with self.connection.cursor() as cur:
+            cur.execute("SELECT sucursal_id FROM core.sucursales ORDER BY sucursal_id LIMIT 1")
+            branch = cur.fetchone()
+            if branch is None:
+                self.skipTest("At least one branch is required")
+            cur.execute(
+                """INSERT INTO core.pacientes (sucursal_id, primer_nombre, apellido_paterno, sexo)
+                   VALUES (%s, 'Columnar', 'Prueba', 'F') RETURNING paciente_id""",
+                (branch[0],),
+            )
+            patient_id = int(cur.fetchone()[0])
+            cur.execute(
+                """INSERT INTO core.historias_clinicas (
+                       sucursal_id, paciente_id, created_at_tz, updated_at, activo, od_esfera, diabetes_estado
+                   )
+                   VALUES (%s, %s, '2024-01-01 10:00+00', NULL, true, '-1.25', 'no'),
+                          (%s, %s, '2023-06-01 10:00+00', '2024-01-02 10:00+00', false, ' +0.50 ', 'si'),
+                          (%s, %s, '2023-06-01 10:00+00', NULL, true, '-3.00', 'no')
+                   RETURNING historia_id""",
+                (branch[0], patient_id, branch[0], patient_id, branch[0], patient_id),
+            )
+            new_id, deactivated_id, _old_id = [int(row[0]) for row in cur.fetchall()]
+
+        user = {"rol": "admin", "username": "admin", "sucursal_id": None}
+        proxy = TransactionConnectionProxy(self.connection)
+        with patch.object(backend_main, "db_connect", return_value=proxy):
+            response = backend_main.export_historias_ml_columnar(
+                formato="parquet",
+                sucursal_id=str(branch[0]),
+                paciente_id=patient_id,
+                cambios_desde="2023-12-31T00:00:00Z",
+                user=user,
+            )
+            body = asyncio.run(_read_body(response))
+
+        table = pq.read_table(BytesIO(body))
+        self.assertEqual("2024-01-02T10:00:00+00:00", response.headers["x-export-watermark"])
+        self.assertEqual(b"2024-01-02T10:00:00+00:00", table.schema.metadata[b"watermark"])
+        self.assertEqual([new_id, deactivated_id], table.column("historia_id").to_pylist())
+        self.assertEqual([True, False], table.column("activo").to_pylist())
+        self.assertEqual([-1.25, 0.5], table.column("od_esfera").to_pylist())
+        self.assertEqual(["no", "si"], table.column("diabetes_estado").to_pylist())
+
+    def test_live_watermark_stays_below_a_transaction_that_commits_late(self):
+        import pyarrow.parquet as pq
+
+        writer = psycopg.connect(backend_main.DB_CONNINFO)
+        patient_id = None
+        try:
+            with writer.cursor() as cur:
+                cur.execute("SELECT sucursal_id FROM core.sucursales ORDER BY sucursal_id LIMIT 1")
+                branch = cur.fetchone()
+                if branch is None:
+                    self.skipTest("At least one branch is required")
+                cur.execute(
+                    """INSERT INTO core.pacientes (sucursal_id, primer_nombre, apellido_paterno, sexo)
+                       VALUES (%s, 'Marca', 'Tardia', 'F') RETURNING paciente_id""",
+                    (branch[0],),
+                )
+                patient_id = int(cur.fetchone()[0])
+                writer.commit()
+                # The writer stamps updated_at with NOW() and stays open.
+                cur.execute(
+                    """INSERT INTO core.historias_clinicas (sucursal_id, paciente_id, updated_at, activo)
+                       VALUES (%s, %s, NOW(), true) RETURNING historia_id, updated_at""",
+                    (branch[0], patient_id),
+                )
+                late_id, late_stamp = cur.fetchone()
+
+            with self.connection.cursor() as cur:
+                cur.execute(
+                    """INSERT INTO core.historias_clinicas (sucursal_id, paciente_id, updated_at, activo)
+                       VALUES (%s, %s, %s - INTERVAL '1 minute', true),
+                              (%s, %s, clock_timestamp(), true)
+                       RETURNING historia_id""",
+                    (branch[0], patient_id, late_stamp, branch[0], patient_id),
+                )
+                early_id = int(cur.fetchone()[0])
+
+            user = {"rol": "admin", "username": "admin", "sucursal_id": None}
+            proxy = TransactionConnectionProxy(self.connection)
+
+            def export(cambios_desde):
+                response = backend_main.export_historias_ml_columnar(
+                    formato="parquet",
+                    paciente_id=patient_id,
+                    cambios_desde=cambios_desde,
+                    user=user,
+                )
+                body = asyncio.run(_read_body(response))
+                return response.headers["x-export-watermark"], pq.read_table(BytesIO(body))
+
+            with patch.object(backend_main, "db_connect", return_value=proxy), patch.object(
+                backend_main, "HISTORIAS_ML_WATERMARK_LAG_SECONDS", 0.0
+            ):
+                first_watermark, first = export((late_stamp - timedelta(hours=1)).isoformat())
+                writer.commit()
+                with self.connection.cursor() as cur:
+                    cur.execute("SELECT pg_stat_clear_snapshot()")
+                second_watermark, second = export(first_watermark)
+
+            self.assertEqual([early_id], first.column("historia_id").to_pylist())
+            self.assertLess(datetime.fromisoformat(first_watermark), late_stamp)
+            self.assertEqual([int(late_id)], second.column("historia_id").to_pylist())
+            self.assertEqual(late_stamp, datetime.fromisoformat(second_watermark))
+        finally:
+            writer.rollback()
+            if patient_id is not None:
+                with writer.cursor() as cur:
+                    cur.execute("DELETE FROM core.historias_clinicas WHERE paciente_id = %s", (patient_id,))
+                    cur.execute("DELETE FROM core.pacientes WHERE paciente_id = %s", (patient_id,))
+                writer.commit()
+            writer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
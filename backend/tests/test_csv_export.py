@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+import unittest
+
+import psycopg
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+import main as backend_main  # noqa: E402
+from csv_export import CSV_BOM, copy_csv_chunks  # noqa: E402
+
+
+class CopyCsvExportTests(unittest.TestCase):
+    def test_live_copy_matches_python_csv_formatting(self):
+        try:
+            connection = psycopg.connect(backend_main.DB_CONNINFO)
+        except psycopg.OperationalError:
+            self.skipTest("Database is not available")
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SET LOCAL TIME ZONE 'UTC'")
+                body = b"".join(
+                    copy_csv_chunks(
+                        cur,
+                        """
+                        SELECT %s::int AS id, true AS flag, NULL::bool AS empty,
+                               '2024-03-01 05:30:00+00'::timestamptz AS ts,
+                               '2024-03-01 05:30:00.25+00'::timestamptz AS ts_micro,
+                               '2024-03-01'::date AS day, '09:15'::time AS hour,
+                               'a;b "c"' AS txt, ''::text AS blank, ''::varchar AS blank_varchar,
+                               ' '::text AS space
+                        ORDER BY 1;
+                        """,
+                        (7,),
+                        headers=["id", "flag", "empty", "ts", "ts_micro", "day", "hour", "txt", "blank", "blank_varchar", "space"],
+                        delimiter=";",
+                    )
+                )
+        finally:
+            connection.rollback()
+            connection.close()
+
+        self.assertTrue(body.startswith(CSV_BOM))
+        lines = body[len(CSV_BOM):].decode("utf-8").splitlines()
+        self.assertEqual("id;flag;empty;ts;ts_micro;day;hour;txt;blank;blank_varchar;space", lines[0])
+        # Empty strings come out as empty fields, as csv.writer wrote them.
+        self.assertEqual(
+            '7;true;;2024-03-01T05:30:00+00:00;2024-03-01T05:30:00.250000+00:00;2024-03-01;09:15:00;"a;b ""c""";;; ',
+            lines[1],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
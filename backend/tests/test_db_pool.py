@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+import unittest
+from unittest.mock import patch
+
+from psycopg.rows import dict_row, tuple_row
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from db_pool import DatabasePoolConfig, PooledConnect  # noqa: E402
+
+
+class FakeConnection:
+    def __init__(self) -> None:
+        self.closed = False
+        self.row_factory = tuple_row
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self) -> None:
+        self.commits += 1
+
+    def rollback(self) -> None:
+        self.rollbacks += 1
+
+
+class FakePool:
+    def __init__(self) -> None:
+        self.connection = FakeConnection()
+        self.returned: list[FakeConnection] = []
+
+    def getconn(self) -> FakeConnection:
+        return self.connection
+
+    def putconn(self, connection: FakeConnection) -> None:
+        self.returned.append(connection)
+
+    def get_stats(self) -> dict[str, int]:
+        return {"pool_size": 1}
+
+
+class PooledConnectTests(unittest.TestCase):
+    def test_disabled_pool_delegates_to_psycopg_connect(self) -> None:
+        connect = PooledConnect("dbname=unused", DatabasePoolConfig(enabled=False))
+        with patch("db_pool.psycopg.connect", return_value="direct") as direct:
+            self.assertEqual("direct", connect("dbname=unused", row_factory=dict_row))
+        direct.assert_called_once_with("dbname=unused", row_factory=dict_row)
+
+    def test_foreign_conninfo_bypasses_the_pool(self) -> None:
+        connect = PooledConnect("dbname=unused", DatabasePoolConfig())
+        with patch("db_pool.psycopg.connect", return_value="direct") as direct:
+            self.assertEqual("direct", connect("dbname=other"))
+        direct.assert_called_once_with("dbname=other")
+        self.assertFalse(connect.stats()["open"])
+
+    def test_checkout_commits_on_success_and_returns_connection(self) -> None:
+        connect = PooledConnect("dbname=unused", DatabasePoolConfig())
+        fake = FakePool()
+        connect._pool = fake
+        with connect("dbname=unused", row_factory=dict_row) as conn:
+            self.assertIs(dict_row, conn.row_factory)
+        self.assertEqual(1, fake.connection.commits)
+        self.assertEqual([fake.connection], fake.returned)
+        stats = connect.stats()
+        self.assertEqual(1, stats["wait"]["checkouts"])
+        self.assertEqual({"pool_size": 1}, stats["pool"])
+
+    def test_checkout_rolls_back_on_error(self) -> None:
+        connect = PooledConnect("dbname=unused", DatabasePoolConfig())
+        fake = FakePool()
+        connect._pool = fake
+        with self.assertRaises(RuntimeError):
+            with connect("dbname=unused"):
+                raise RuntimeError("boom")
+        self.assertEqual(0, fake.connection.commits)
+        self.assertEqual(1, fake.connection.rollbacks)
+        self.assertEqual([fake.connection], fake.returned)
+
+    def test_config_from_env_clamps_sizes(self) -> None:
+        environment = {"DB_POOL_MIN_SIZE": "50", "DB_POOL_MAX_SIZE": "4", "DB_POOL_ENABLED": "false"}
+        with patch.dict("os.environ", environment, clear=False):
+            config = DatabasePoolConfig.from_env()
+        self.assertFalse(config.enabled)
+        self.assertEqual(4, config.max_size)
+        self.assertEqual(4, config.min_size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,271 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+import sys
+import unittest
+
+import psycopg
+from psycopg.rows import dict_row
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from expiry_worker import ExpiryWorker, ExpiryWorkerConfig  # noqa: E402
+from online_fulfillment import (  # noqa: E402
+    expire_quote_options,
+    expire_quote_requests,
+    release_expired_reservations,
+)
+
+
+class FakeCursor:
+    def __init__(self, relations: set[str]) -> None:
+        self.relations = relations
+        self.row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        return False
+
+    def execute(self, _sql, params=None):
+        self.row = {"relation": params[0] if params[0] in self.relations else None}
+
+    def fetchone(self):
+        return self.row
+
+
+class FakeConnection:
+    def __init__(self, relations: set[str]) -> None:
+        self.relations = relations
+        self.commits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        return False
+
+    def cursor(self):
+        return FakeCursor(self.relations)
+
+    def commit(self):
+        self.commits += 1
+
+
+class ExpiryWorkerTests(unittest.TestCase):
+    def _worker(self, tasks, relations=("core.a", "core.b")):
+        connection = FakeConnection(set(relations))
+        worker = ExpiryWorker(
+            "unused",
+            ExpiryWorkerConfig(batch_size=10, max_batches=3),
+            connect=lambda *_a, **_k: connection,
+            tasks=tasks,
+        )
+        return worker, connection
+
+    def test_chunks_until_a_short_batch_and_caps_batches_per_run(self) -> None:
+        backlog = {"a": [10, 10, 4], "b": [10, 10, 10, 10]}
+        limits: list[int] = []
+
+        def task(name):
+            def run(_cur, *, limit):
+                limits.append(limit)
+                return backlog[name].pop(0)
+            return run
+
+        worker, connection = self._worker((("a", "core.a", task("a")), ("b", "core.b", task("b"))))
+        self.assertEqual({"a": 24, "b": 30}, worker.run_once())
+        self.assertEqual({10}, set(limits))
+        self.assertEqual(6, connection.commits)
+        self.assertEqual([10], backlog["b"])
+        stats = worker.stats()
+        self.assertEqual(1, stats["runs"])
+        self.assertEqual({"total": 24, "last": 24, "batches": 3, "errors": 0, "last_error": None}, stats["tasks"]["a"])
+
+    def test_failing_task_is_recorded_and_others_still_run(self) -> None:
+        def broken(_cur, *, limit):
+            raise RuntimeError("boom")
+
+        worker, _connection = self._worker(
+            (("a", "core.a", broken), ("b", "core.b", lambda _cur, *, limit: 2)),
+        )
+        self.assertEqual({"a": 0, "b": 2}, worker.run_once())
+        self.assertEqual(1, worker.stats()["tasks"]["a"]["errors"])
+        self.assertIn("boom", worker.stats()["tasks"]["a"]["last_error"])
+
+    def test_missing_tables_are_skipped(self) -> None:
+        calls: list[str] = []
+        worker, _connection = self._worker(
+            (("a", "core.a", lambda _cur, *, limit: calls.append("a") or 0),
+             ("c", "core.c", lambda _cur, *, limit: calls.append("c") or 0)),
+            relations=("core.a",),
+        )
+        self.assertEqual({"a": 0, "c": 0}, worker.run_once())
+        self.assertEqual(["a"], calls)
+
+    def test_live_chunks_expire_quotes_and_release_reserved_stock_in_bulk(self) -> None:
+        conninfo = os.getenv("DB_CONNINFO", "").strip()
+        if not conninfo:
+            self.skipTest("DB_CONNINFO is not configured")
+        connection = psycopg.connect(conninfo, row_factory=dict_row)
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT to_regclass('core.online_reservas') IS NOT NULL AS ready")
+                if not cur.fetchone()["ready"]:
+                    self.skipTest("Phase 1F-B2 tables have not been installed")
+                cur.execute("SELECT sucursal_id FROM core.sucursales WHERE activa = true ORDER BY sucursal_id LIMIT 1")
+                branch = cur.fetchone()
+                if branch is None:
+                    self.skipTest("At least one active branch is required")
+                branch_id = int(branch["sucursal_id"])
+                cur.execute(
+                    """
+                    INSERT INTO core.catalogo_productos (
+                      sku, slug, nombre, descripcion, categoria, subcategoria, tipo_producto, modalidad_precio,
+                      precio, controla_stock, comportamiento_abasto_default, unidad_medida
+                    )
+                    VALUES ('EXPIRY-1', 'expiry-1', 'Expiry', 'Prueba de expiración', 'lentes_de_sol', 'armazon', 'producto_fisico',
+                            'precio_base', 100, true, 'inventario', 'pieza')
+                    RETURNING producto_id
+                    """
+                )
+                product_id = int(cur.fetchone()["producto_id"])
+                # 2 + 1 units are held by the two consistent reservations below.
+                cur.execute(
+                    """
+                    INSERT INTO core.catalogo_inventario_sucursal (producto_id, sucursal_id, stock, stock_reservado)
+                    VALUES (%s, %s, 10, 3)
+                    """,
+                    (product_id, branch_id),
+                )
+                owner = "a" * 64
+                cur.execute(
+                    "INSERT INTO core.online_carritos (propietario_tipo, propietario_ref_hash) VALUES ('cliente', %s) RETURNING carrito_id",
+                    (owner,),
+                )
+                cart_id = int(cur.fetchone()["carrito_id"])
+
+                def request(estado: str, expires: str) -> int:
+                    cur.execute(
+                        f"""
+                        INSERT INTO core.online_solicitudes_cotizacion_envio (
+                          propietario_tipo, propietario_ref_hash, carrito_id, carrito_fingerprint,
+                          metodo_entrega, contacto_snapshot, carrito_snapshot, paquetes_snapshot,
+                          estado, expira_at
+                        )
+                        VALUES ('cliente', %s, %s, %s, 'recoger_sucursal', '{{}}', '{{}}', '[]', %s, NOW() + INTERVAL '{expires}')
+                        RETURNING solicitud_id
+                        """,
+                        (owner, cart_id, "b" * 64, estado),
+                    )
+                    return int(cur.fetchone()["solicitud_id"])
+
+                def option(request_id: int, expires: str) -> int:
+                    cur.execute(
+                        f"""
+                        INSERT INTO core.online_opciones_cotizacion_envio (
+                          solicitud_id, sucursal_id, transportista_codigo_snapshot,
+                          transportista_nombre_snapshot, nivel_servicio_snapshot, monto,
+                          entrega_min_dias, entrega_max_dias, quote_identifier, expira_at,
+                          ingresada_por_rol
+                        )
+                        VALUES (%s, %s, 'pickup', 'Sucursal', 'Recoger', 0, 0, 0, %s,
+                                NOW() + INTERVAL '{expires}', 'admin')
+                        RETURNING opcion_id
+                        """,
+                        (request_id, branch_id, f"expiry-{request_id}"),
+                    )
+                    return int(cur.fetchone()["opcion_id"])
+
+                def reservation(expires: str, quantity: int) -> int:
+                    request_id = request("seleccionada", "1 hour")
+                    option_id = option(request_id, "1 hour")
+                    cur.execute(
+                        "INSERT INTO core.online_cotizacion_selecciones (solicitud_id, opcion_id, opcion_snapshot) VALUES (%s, %s, '{}') RETURNING seleccion_id",
+                        (request_id, option_id),
+                    )
+                    selection_id = int(cur.fetchone()["seleccion_id"])
+                    cur.execute(
+                        f"""
+                        INSERT INTO core.online_reservas (
+                          solicitud_id, seleccion_id, propietario_tipo, propietario_ref_hash,
+                          carrito_fingerprint, sucursal_id, created_at, expires_at
+                        )
+                        VALUES (%s, %s, 'cliente', %s, %s, %s, NOW() - INTERVAL '1 day',
+                                NOW() + INTERVAL '{expires}')
+                        RETURNING reserva_id
+                        """,
+                        (request_id, selection_id, owner, "b" * 64, branch_id),
+                    )
+                    reservation_id = int(cur.fetchone()["reserva_id"])
+                    cur.execute(
+                        """
+                        INSERT INTO core.online_reserva_lineas (
+                          reserva_id, producto_id, sucursal_id, configuracion_hash,
+                          sku_snapshot, nombre_snapshot, cantidad
+                        )
+                        VALUES (%s, %s, %s, %s, 'EXPIRY-1', 'Expiry', %s)
+                        """,
+                        (reservation_id, product_id, branch_id, "0" * 64, quantity),
+                    )
+                    return reservation_id
+
+                stale_request = request("cotizada", "-1 minute")
+                stale_option = option(stale_request, "-1 minute")
+                live_request = request("cotizada", "-1 minute")
+                option(live_request, "1 hour")
+                expired = reservation("-1 minute", 2)
+                inconsistent = reservation("-30 seconds", 5)
+                active = reservation("1 hour", 1)
+
+                while expire_quote_options(cur, limit=1):
+                    pass
+                while expire_quote_requests(cur, limit=1):
+                    pass
+                while release_expired_reservations(cur, limit=1):
+                    pass
+
+                cur.execute(
+                    "SELECT activa, motivo_invalidez FROM core.online_opciones_cotizacion_envio WHERE opcion_id = %s",
+                    (stale_option,),
+                )
+                self.assertEqual({"activa": False, "motivo_invalidez": "expired"}, cur.fetchone())
+                cur.execute(
+                    "SELECT solicitud_id, estado FROM core.online_solicitudes_cotizacion_envio WHERE solicitud_id = ANY(%s) ORDER BY solicitud_id",
+                    ([stale_request, live_request],),
+                )
+                self.assertEqual(["expirada", "cotizada"], [row["estado"] for row in cur.fetchall()])
+
+                cur.execute(
+                    "SELECT reserva_id, estado FROM core.online_reservas WHERE reserva_id = ANY(%s) ORDER BY reserva_id",
+                    ([expired, inconsistent, active],),
+                )
+                self.assertEqual(["expirada", "expirada", "activa"], [row["estado"] for row in cur.fetchall()])
+                cur.execute(
+                    "SELECT stock, stock_reservado FROM core.catalogo_inventario_sucursal WHERE producto_id = %s",
+                    (product_id,),
+                )
+                self.assertEqual({"stock": 10, "stock_reservado": 1}, cur.fetchone())
+                cur.execute(
+                    "SELECT reserva_id, evento_tipo, actor_tipo FROM core.online_reserva_eventos WHERE reserva_id = ANY(%s) ORDER BY reserva_id",
+                    ([expired, inconsistent, active],),
+                )
+                self.assertEqual(
+                    [
+                        (expired, "reservation_expired", "sistema"),
+                        (inconsistent, "reservation_expired_inconsistent_state", "sistema"),
+                    ],
+                    [(row["reserva_id"], row["evento_tipo"], row["actor_tipo"]) for row in cur.fetchall()],
+                )
+        finally:
+            connection.rollback()
+            connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import sys
+import threading
+import unittest
+from unittest.mock import patch
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from google_calendar_client import GoogleCalendarClientCache, GoogleCalendarClientConfig  # noqa: E402
+
+
+NOW = datetime(2026, 10, 17, 12, 0, 0)
+
+
+class FakeCredentials:
+    def __init__(self, label: str) -> None:
+        self.label = label
+        self.token: str | None = None
+        self.expiry: datetime | None = None
+
+
+class Harness:
+    def __init__(self, *, lifetime: timedelta = timedelta(hours=1), enabled: bool = True) -> None:
+        self.now = NOW
+        self.lifetime = lifetime
+        self.created: list[FakeCredentials] = []
+        self.refreshed: list[str] = []
+        self.built: list[str] = []
+        self.lock = threading.Lock()
+        self.cache = GoogleCalendarClientCache(
+            GoogleCalendarClientConfig(enabled=enabled, refresh_margin_seconds=300),
+            clock=lambda: self.now,
+        )
+
+    def create(self, label: str) -> FakeCredentials:
+        credentials = FakeCredentials(label)
+        with self.lock:
+            self.created.append(credentials)
+        return credentials
+
+    def refresh(self, credentials: FakeCredentials) -> None:
+        with self.lock:
+            self.refreshed.append(credentials.label)
+        credentials.token = f"token-{len(self.refreshed)}"
+        credentials.expiry = self.now + self.lifetime
+
+    def build(self, credentials: FakeCredentials) -> dict:
+        with self.lock:
+            self.built.append(credentials.label)
+        return {"credentials": credentials}
+
+    def service(self, key: str = "oauth:1", fingerprint: str = "a"):
+        return self.cache.service(
+            key,
+            fingerprint,
+            create_credentials=lambda: self.create(f"{key}/{fingerprint}"),
+            refresh=self.refresh,
+            build=self.build,
+        )
+
+
+class GoogleCalendarClientCacheTests(unittest.TestCase):
+    def test_reuses_credentials_token_and_service_until_near_expiry(self) -> None:
+        harness = Harness()
+        first = harness.service()
+        self.assertIs(first, harness.service())
+        self.assertEqual((1, 1, 1), (len(harness.created), len(harness.refreshed), len(harness.built)))
+
+        harness.now = NOW + timedelta(minutes=54)
+        harness.service()
+        self.assertEqual(1, len(harness.refreshed))
+
+        # Inside the five-minute margin the same credentials refresh in place.
+        harness.now = NOW + timedelta(minutes=56)
+        self.assertIs(first, harness.service())
+        self.assertEqual((1, 2, 1), (len(harness.created), len(harness.refreshed), len(harness.built)))
+        self.assertEqual("token-2", first["credentials"].token)
+        self.assertEqual(
+            {"entries": 1, "credentials_created": 1, "token_refreshes": 2, "services_built": 1, "hits": 3},
+            {key: value for key, value in harness.cache.stats().items() if key in {"entries", "credentials_created", "token_refreshes", "services_built", "hits"}},
+        )
+
+    def test_branches_and_new_secrets_get_their_own_credentials(self) -> None:
+        harness = Harness()
+        one = harness.service("oauth:1", "a")
+        two = harness.service("oauth:2", "a")
+        self.assertIsNot(one, two)
+
+        rotated = harness.service("oauth:1", "b")
+        self.assertIsNot(one, rotated)
+        self.assertEqual(["oauth:1/a", "oauth:2/a", "oauth:1/b"], harness.refreshed)
+
+        harness.cache.invalidate("oauth:2")
+        harness.service("oauth:2", "a")
+        self.assertEqual(4, len(harness.created))
+
+    def test_concurrent_threads_share_one_refresh_but_build_their_own_service(self) -> None:
+        harness = Harness()
+        barrier = threading.Barrier(8)
+        services: list[dict] = []
+
+        def call() -> None:
+            barrier.wait()
+            service = harness.service()
+            with harness.lock:
+                services.append(service)
+
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(harness.refreshed))
+        self.assertEqual(8, len(harness.built))
+        self.assertEqual(1, len({id(service["credentials"]) for service in services}))
+
+    def test_disabled_cache_exchanges_a_token_every_call(self) -> None:
+        harness = Harness(enabled=False)
+        harness.service()
+        harness.service()
+        self.assertEqual((2, 2, 2), (len(harness.created), len(harness.refreshed), len(harness.built)))
+
+
+class GoogleCalendarServiceTests(unittest.TestCase):
+    def test_oauth_service_is_cached_per_branch(self) -> None:
+        try:
+            from google.oauth2 import credentials as oauth2_credentials
+        except ImportError:
+            self.skipTest("google-auth is not installed")
+        import main as backend_main
+
+        refreshes: list[str] = []
+
+        def fake_refresh(credentials, _request) -> None:
+            refreshes.append(credentials.refresh_token)
+            credentials.token = "access"
+            credentials.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+
+        env = {
+            "GOOGLE_OAUTH_CLIENT_ID": "client",
+            "GOOGLE_OAUTH_CLIENT_SECRET": "secret",
+            "GOOGLE_OAUTH_REFRESH_TOKEN": "",
+        }
+        cache = GoogleCalendarClientCache(GoogleCalendarClientConfig())
+        with patch.dict("os.environ", env), \
+                patch.object(backend_main, "GOOGLE_CALENDAR_CLIENTS", cache), \
+                patch.object(backend_main, "_ensure_google_env_cache_loaded"), \
+                patch.object(backend_main, "_GOOGLE_OAUTH_REFRESH_TOKENS_BY_SUCURSAL", {"1": "r1", "2": "r2"}), \
+                patch.object(oauth2_credentials.Credentials, "refresh", fake_refresh):
+            first = backend_main._get_google_calendar_service(sucursal_id=1)
+            again = backend_main._get_google_calendar_service(sucursal_id=1)
+            other = backend_main._get_google_calendar_service(sucursal_id=2)
+
+        self.assertIs(first, again)
+        self.assertIsNot(first, other)
+        self.assertEqual(["r1", "r2"], refreshes)
+
+
+if __name__ == "__main__":
+    unittest.main()
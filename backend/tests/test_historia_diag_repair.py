@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+import unittest
+from unittest.mock import patch
+
+import psycopg
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+import main as backend_main  # noqa: E402
+
+
+class TransactionConnectionProxy:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exc_type, _exc, _traceback):
+        return False
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def commit(self):
+        return None
+
+
+class HistoriaDiagRepairTests(unittest.TestCase):
+    def test_canonical_values_are_left_alone(self):
+        self.assertIsNone(
+            backend_main._historia_diag_reparada(None, "miopia|astigmatismo", None, None, None)
+        )
+        # Duplicates survive the original repair; only the formatting and the
+        # stray *_otro values change.
+        self.assertEqual(
+            ("miopia|astigmatismo|miopia", None, None, None),
+            backend_main._historia_diag_reparada(None, "Miopia | ASTIGMATISMO|miopia", " nota ", None, "x"),
+        )
+
+    def test_formatting_is_repaired_like_the_original_startup_pass(self):
+        # Lowercase/trim/pipe formatting first, then the per-row token repair;
+        # unknown tokens survive, as they did before.
+        self.assertEqual(
+            ("miopia", None, None, None),
+            backend_main._historia_diag_reparada(None, "MIOPIA", None, None, None),
+        )
+        self.assertEqual(
+            ("miopia|astigmatismo", None, None, None),
+            backend_main._historia_diag_reparada(None, " miopia | astigmatismo ", None, None, None),
+        )
+        self.assertEqual(
+            ("miopia|zzz", None, None, None),
+            backend_main._historia_diag_reparada(None, "Miopia | zzz", None, None, None),
+        )
+        self.assertIsNone(backend_main._historia_diag_reparada(None, "miopia|zzz", None, None, None))
+        self.assertEqual(
+            ("miopia|otro", "nota", None, None),
+            backend_main._historia_diag_reparada(None, "miopia|otro", " nota ", None, None),
+        )
+        self.assertEqual(
+            ("miopia", None, None, None),
+            backend_main._historia_diag_reparada(None, "m|i|o|p|i|a", None, None, None),
+        )
+
+    def test_live_repair_processes_pending_rows_in_chunks(self):
+        connection = psycopg.connect(backend_main.DB_CONNINFO)
+        try:
+            with connection.cursor() as cur:
+                cur.execute(
+                    """SELECT 1 FROM information_schema.columns
+                       WHERE table_schema='core' AND table_name='historias_clinicas'
+                         AND column_name='diag_normalizado_version'"""
+                )
+                if cur.fetchone() is None:
+                    self.skipTest("Diagnosis normalization column has not been installed")
+                cur.execute("SELECT sucursal_id FROM core.sucursales ORDER BY sucursal_id LIMIT 1")
+                branch = cur.fetchone()
+                if branch is None:
+                    self.skipTest("At least one branch is required")
+                cur.execute(
+                    """INSERT INTO core.pacientes (sucursal_id, primer_nombre, apellido_paterno)
+                       VALUES (%s, 'Diag', 'Prueba') RETURNING paciente_id""",
+                    (branch[0],),
+                )
+                patient_id = int(cur.fetchone()[0])
+                cur.execute(
+                    """INSERT INTO core.historias_clinicas (
+                           sucursal_id, paciente_id, diagnostico_principal, diagnostico_principal_otro,
+                           diagnosticos_secundarios, updated_at
+                       )
+                       VALUES (%s, %s, 'MIOPIA | Astigmatismo', 'borrar', NULL, '2020-01-01 00:00+00'),
+                              (%s, %s, 'm|i|o|p|i|a', NULL, NULL, '2020-01-01 00:00+00'),
+                              (%s, %s, 'miopia', NULL, NULL, '2020-01-01 00:00+00')
+                       RETURNING historia_id""",
+                    (branch[0], patient_id) * 3,
+                )
+                ids = [int(row[0]) for row in cur.fetchall()]
+
+            messages: list[str] = []
+            proxy = TransactionConnectionProxy(connection)
+            with patch.object(backend_main, "db_connect", return_value=proxy):
+                repaired = backend_main.repair_historia_diag_fields(chunk_size=2, log=messages.append)
+                again = backend_main.repair_historia_diag_fields(chunk_size=2, log=messages.append)
+
+            self.assertGreaterEqual(repaired, 2)
+            self.assertEqual(0, again)
+            self.assertTrue(messages)
+            with connection.cursor() as cur:
+                cur.execute(
+                    """SELECT diagnostico_principal, diagnostico_principal_otro, diag_normalizado_version,
+                              updated_at > '2020-01-01 00:00+00'
+                       FROM core.historias_clinicas WHERE historia_id = ANY(%s) ORDER BY historia_id""",
+                    (ids,),
+                )
+                rows = cur.fetchall()
+                version = backend_main.HISTORIA_DIAG_NORMALIZACION_VERSION
+                self.assertEqual(
+                    [
+                        ("miopia|astigmatismo", None, version, True),
+                        ("miopia", None, version, True),
+                        ("miopia", None, version, False),
+                    ],
+                    rows,
+                )
+
+                # Editing a diagnosis outside the job marks the row pending again.
+                cur.execute(
+                    "UPDATE core.historias_clinicas SET diagnostico_principal = 'Glaucoma' WHERE historia_id = %s "
+                    "RETURNING diag_normalizado_version",
+                    (ids[2],),
+                )
+                self.assertEqual(0, cur.fetchone()[0])
+        finally:
+            connection.rollback()
+            connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
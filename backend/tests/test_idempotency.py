@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+import sys
+import unittest
+
+import psycopg
+from psycopg.rows import dict_row
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from idempotency import (  # noqa: E402
+    IdempotencyConfig,
+    IdempotencyConflict,
+    IdempotencyInProgress,
+    IdempotencyKeyInvalid,
+    IdempotencyStore,
+    idempotency_key_hash,
+    purge_expired_idempotency,
+)
+
+
+OWNER = "e" * 64
+OTHER = "f" * 64
+REQUEST = "1" * 64
+
+
+class IdempotencyStoreTests(unittest.TestCase):
+    def test_keys_are_validated_and_hashed(self) -> None:
+        self.assertEqual(idempotency_key_hash(" abc "), idempotency_key_hash("abc"))
+        for key in ("", "   ", "x" * 201):
+            with self.assertRaises(IdempotencyKeyInvalid):
+                idempotency_key_hash(key)
+
+    def test_live_begin_replay_conflict_takeover_and_purge(self) -> None:
+        conninfo = os.getenv("DB_CONNINFO", "").strip()
+        if not conninfo:
+            self.skipTest("DB_CONNINFO is not configured")
+        connection = psycopg.connect(conninfo, row_factory=dict_row)
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT to_regclass('core.online_idempotencia') IS NOT NULL AS ready")
+                if not cur.fetchone()["ready"]:
+                    self.skipTest("Phase 1F-A tables have not been installed")
+                store = IdempotencyStore(IdempotencyConfig(cache_ttl_seconds=60))
+
+                def begin(key: str, owner: str = OWNER, request: str = REQUEST):
+                    return store.begin(cur, scope="test_idempotency", key=key, owner_hash=owner, request_hash=request)
+
+                row_id, cached = begin("clave-1")
+                self.assertIsNone(cached)
+                with self.assertRaises(IdempotencyInProgress):
+                    begin("clave-1")
+                store.finish(cur, row_id, '{"ok": true}', 7)
+
+                self.assertEqual((None, {"ok": True}), begin("clave-1"))
+                # The second replay is answered from the in-process cache.
+                self.assertEqual((None, {"ok": True}), begin("clave-1"))
+                with self.assertRaises(IdempotencyConflict):
+                    begin("clave-1", owner=OTHER)
+                with self.assertRaises(IdempotencyConflict):
+                    begin("clave-1", request="2" * 64)
+
+                stale_id, _ = begin("clave-2")
+                store.finish(cur, stale_id, '{"old": true}', None)
+                cur.execute(
+                    "UPDATE core.online_idempotencia SET expira_at = NOW() - INTERVAL '1 minute' WHERE idempotencia_id = %s",
+                    (stale_id,),
+                )
+                # An expired key is taken over by a different request, in place.
+                self.assertEqual((stale_id, None), begin("clave-2", owner=OTHER, request="3" * 64))
+
+                expired_id, _ = begin("clave-3")
+                cur.execute(
+                    "UPDATE core.online_idempotencia SET expira_at = NOW() - INTERVAL '1 minute' WHERE idempotencia_id = %s",
+                    (expired_id,),
+                )
+                while purge_expired_idempotency(cur, limit=1):
+                    pass
+                cur.execute(
+                    "SELECT idempotencia_id FROM core.online_idempotencia WHERE alcance = 'test_idempotency' ORDER BY idempotencia_id"
+                )
+                self.assertEqual([row_id, stale_id], [row["idempotencia_id"] for row in cur.fetchall()])
+
+                stats = store.stats()
+                self.assertEqual(
+                    (3, 1, 1, 1, 2, 1),
+                    (stats["started"], stats["expired_reused"], stats["replayed_from_db"],
+                     stats["replayed_from_cache"], stats["conflicts"], stats["in_progress"]),
+                )
+                self.assertEqual(0.2222, stats["conflict_rate"])
+        finally:
+            connection.rollback()
+            connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
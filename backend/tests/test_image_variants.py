@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from image_variants import (  # noqa: E402
+    MediaVariantConfig,
+    MediaVariantMoved,
+    MediaVariantNotFound,
+    MediaVariantStore,
+    image_variants_available,
+)
+from public_catalog import PublicCatalogConfig, PublicCatalogRepository  # noqa: E402
+
+
+@unittest.skipUnless(image_variants_available(), "Pillow is not installed")
+class MediaVariantTests(unittest.TestCase):
+    def setUp(self) -> None:
+        from PIL import Image
+
+        self.tmp = tempfile.TemporaryDirectory()
+        root = Path(self.tmp.name)
+        self.media = root / "media"
+        (self.media / "products").mkdir(parents=True)
+        self.source = self.media / "products" / "lente.png"
+        Image.new("RGB", (1000, 500), (200, 30, 30)).save(self.source)
+        self.store = MediaVariantStore(
+            str(self.media),
+            MediaVariantConfig(cache_dir=str(root / "variants"), widths=(320, 640, 1280)),
+        )
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_only_smaller_widths_are_offered_and_encoded_once(self) -> None:
+        source, variants = self.store.describe("products/lente.png")
+        self.assertEqual((1000, 500), (source.width, source.height))
+        self.assertEqual([(320, 160), (640, 320)], [(v.width, v.height) for v in variants])
+        self.assertTrue(variants[0].url.startswith(f"/media/_v/{source.digest}/320/"))
+
+        path = self.store.variant_file("products/lente.png", source.digest, 640)
+        self.assertEqual(b"RIFF", path.read_bytes()[:4])
+        mtime = path.stat().st_mtime_ns
+        self.assertEqual(path, self.store.variant_file("products/lente.png", source.digest, 640))
+        self.assertEqual(mtime, path.stat().st_mtime_ns)
+
+        with self.assertRaises(MediaVariantNotFound):
+            self.store.variant_file("products/lente.png", source.digest, 1280)
+        with self.assertRaises(MediaVariantNotFound):
+            self.store.variant_file("../variants/x.png", source.digest, 320)
+
+    def test_replaced_source_gets_a_new_digest(self) -> None:
+        from PIL import Image
+
+        source, _ = self.store.describe("products/lente.png")
+        Image.new("RGB", (1000, 500), (10, 10, 200)).save(self.source)
+        with self.assertRaises(MediaVariantMoved) as ctx:
+            self.store.variant_file("products/lente.png", source.digest, 320)
+        self.assertNotIn(source.digest, ctx.exception.url)
+
+    def test_catalog_images_list_variants_and_srcset(self) -> None:
+        config = PublicCatalogConfig(
+            db_conninfo="unused",
+            bearer_token="unused",
+            media_base_url="http://127.0.0.1:8000",
+            allowed_image_origins=("http://127.0.0.1:8000",),
+        )
+        repository = PublicCatalogRepository(config, variants=self.store)
+        raw = {
+            "producto_imagen_id": 1,
+            "url": "/media/products/lente.png",
+            "alt_text": None,
+            "display_order": 0,
+            "es_principal": True,
+            "mime_type": "image/png",
+            "ancho": 1000,
+            "alto": 500,
+        }
+        image = repository._image(raw)
+        self.assertEqual([320, 640], [variant.width for variant in image.variants])
+        self.assertTrue(image.variants[0].url.startswith("http://127.0.0.1:8000/media/_v/"))
+        self.assertTrue(image.srcset.endswith("http://127.0.0.1:8000/media/products/lente.png 1000w"))
+
+        missing = repository._image({**raw, "url": "/media/products/no-existe.png"})
+        self.assertEqual([], missing.variants)
+        self.assertIsNone(missing.srcset)
+
+
+if __name__ == "__main__":
+    unittest.main()
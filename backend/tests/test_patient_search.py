@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+import unittest
+from unittest.mock import patch
+from uuid import uuid4
+
+import psycopg
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+import main as backend_main  # noqa: E402
+
+
+class TransactionConnectionProxy:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exc_type, _exc, _traceback):
+        return False
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def commit(self):
+        return None
+
+
+class PatientSearchTests(unittest.TestCase):
+    def test_live_search_is_accent_insensitive_and_phone_is_exact(self):
+        connection = psycopg.connect(backend_main.DB_CONNINFO)
+        marker = uuid4().hex[:8]
+        user = {"rol": "admin", "username": "admin", "sucursal_id": None}
+        try:
+            with connection.cursor() as cur:
+                cur.execute(
+                    """SELECT 1 FROM information_schema.columns
+                       WHERE table_schema='core' AND table_name='pacientes' AND column_name='busqueda'"""
+                )
+                if cur.fetchone() is None:
+                    self.skipTest("Patient search column has not been installed")
+                cur.execute("SELECT sucursal_id FROM core.sucursales ORDER BY sucursal_id LIMIT 1")
+                branch = cur.fetchone()
+                if branch is None:
+                    self.skipTest("At least one branch is required")
+                phone_digits = "99" + str(int(marker, 16) % 10**8).zfill(8)
+                cur.execute(
+                    """INSERT INTO core.pacientes (
+                           sucursal_id, primer_nombre, apellido_paterno, apellido_materno, telefono
+                       )
+                       VALUES (%s, 'Íñigo', %s, 'Núñez', %s), (%s, 'Inés', %s, 'Pérez', NULL)
+                       RETURNING paciente_id""",
+                    (
+                        branch[0], f"Zúñiga{marker}", f"{phone_digits[:2]}-{phone_digits[2:6]}-{phone_digits[6:]}",
+                        branch[0], f"Zuniga{marker}",
+                    ),
+                )
+                inigo_id, ines_id = [int(row[0]) for row in cur.fetchall()]
+                cur.execute(
+                    """INSERT INTO core.consultas (sucursal_id, paciente_id, fecha_hora, tipo_consulta)
+                       SELECT %s, %s, NOW() - (n || ' days')::interval, 'revision_general'
+                       FROM generate_series(1, %s) AS n""",
+                    (branch[0], inigo_id, backend_main.PACIENTE_INTERMEDIO_CONSULTAS_6M),
+                )
+
+            proxy = TransactionConnectionProxy(connection)
+            with patch.object(backend_main, "db_connect", return_value=proxy):
+                by_name = backend_main.buscar_pacientes(q=f"ZUNIGA{marker}", user=user)
+                by_full_name = backend_main.buscar_pacientes(q=f"inigo  zúñiga{marker}", user=user)
+                by_phone = backend_main.buscar_pacientes(q=f"({phone_digits[:2]}) {phone_digits[2:]}", user=user)
+                by_id = backend_main.buscar_pacientes(q=str(ines_id), user=user)
+
+            self.assertEqual({inigo_id, ines_id}, {row["paciente_id"] for row in by_name})
+            self.assertEqual(inigo_id, by_full_name[0]["paciente_id"])
+            self.assertEqual([inigo_id], [row["paciente_id"] for row in by_phone])
+            self.assertEqual(ines_id, by_id[0]["paciente_id"])
+            estados = {row["paciente_id"]: row["estado_paciente"] for row in by_name}
+            self.assertEqual({inigo_id: "intermedio", ines_id: "nuevo"}, estados)
+        finally:
+            connection.rollback()
+            connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
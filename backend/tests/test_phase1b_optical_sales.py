@@ -197,6 +197,52 @@ class Phase1BOpticalSalesTests(unittest.TestCase):
         )
         self.assertEqual("listo_para_produccion", cursor.params[0][13])
 
+    def test_sale_details_load_a_whole_page_with_five_queries(self) -> None:
+        def header(venta_id):
+            return (venta_id, "2026-08-01", 3, "Ana López", 1, "Centro", "lentes", 1000, 900,
+                    "efectivo", "contado", None, "activa", "anticipo", "pendiente", "nota",
+                    100, 0, 1, "activo")
+
+        def product(detail_id, venta_id):
+            return (detail_id, f"l{detail_id}", "producto", 7, None, "SKU", "Armazón", None,
+                    "armazones", None, 1, 500, 200, 500, "activo", 0, None, None, None, None, venta_id)
+
+        def configuration(config_id, venta_id):
+            return (config_id, f"c{config_id}", "completa", False, 7, 8, None, None, "lejos", None,
+                    None, None, "inventario", "pendiente_anticipo", 500, 400, None, None,
+                    200, 150, None, None, 900, "activo", venta_id)
+
+        class BatchCursor:
+            def __init__(self):
+                self.queries = []
+                self.results = [
+                    [header(11), header(12)],
+                    [(1, "efectivo", 300, None, "2026-08-01", 11), (2, "tarjeta", 100, "x", "2026-08-02", 11)],
+                    [product(21, 11), product(22, 12), product(23, 12)],
+                    [configuration(31, 12)],
+                    [(41, "d1", "monto", 100, "promocion_especial", None, "sin_cupon", "venta", 1, 1000, 100, [], [], 12)],
+                ]
+
+            def execute(self, query, params):
+                self.queries.append((query, params))
+
+            def fetchall(self):
+                return self.results[len(self.queries) - 1]
+
+        cursor = BatchCursor()
+        details = backend_main._phase1b_sale_details(cursor, [12, 11, 12, 13], "recepcion")
+        self.assertEqual(5, len(cursor.queries))
+        self.assertTrue(all(params == ([11, 12, 13],) for _query, params in cursor.queries))
+        self.assertEqual([11, 12], sorted(details))
+        self.assertEqual((400.0, 500.0), (details[11]["monto_pagado"], details[11]["saldo_pendiente"]))
+        self.assertEqual([21], [item["venta_catalogo_detalle_id"] for item in details[11]["productos"]])
+        self.assertEqual([22, 23], [item["venta_catalogo_detalle_id"] for item in details[12]["productos"]])
+        self.assertIsNone(details[12]["productos"][0]["costo_unitario"])
+        self.assertEqual(([], [31]), ([c["configuracion_id"] for c in details[11]["configuraciones"]], [c["configuracion_id"] for c in details[12]["configuraciones"]]))
+        self.assertNotIn("costo_armazon_snapshot", details[12]["configuraciones"][0])
+        self.assertEqual(([], ["d1"]), ([d["descuento_ref"] for d in details[11]["descuentos"]], [d["descuento_ref"] for d in details[12]["descuentos"]]))
+        self.assertEqual({}, backend_main._phase1b_sale_details(cursor, [], "admin"))
+
     def test_frontend_uses_global_catalog_and_explicit_discount_order(self) -> None:
         source = FRONTEND_PATH.read_text(encoding="utf-8")
         self.assertIn('apiFetch(`/catalogo/inventario?sucursal_id=', source)
@@ -308,7 +354,7 @@ class Phase1BOpticalSalesTests(unittest.TestCase):
                 "sucursal_id": None,
             }
             proxy = TransactionConnectionProxy(connection)
-            with patch.object(backend_main.psycopg, "connect", return_value=proxy):
+            with patch.object(backend_main, "db_connect", return_value=proxy):
                 response = backend_main.actualizar_stock_catalogo(
                     producto_id=product_id,
                     data=backend_main.InventarioStockUpdate(stock=3, expected_stock=0),
@@ -377,6 +423,117 @@ class Phase1BOpticalSalesTests(unittest.TestCase):
             connection.rollback()
             connection.close()
 
+    def test_bulk_inventory_changes_lock_once_and_chain_movements(self) -> None:
+        connection = psycopg.connect(backend_main.DB_CONNINFO)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT sucursal_id FROM core.sucursales WHERE activa = true ORDER BY sucursal_id LIMIT 1;"
+                )
+                branch_id = int(cursor.fetchone()[0])
+                cursor.execute(
+                    """
+                    SELECT producto_id
+                    FROM core.catalogo_productos
+                    WHERE controla_stock = true AND activo = true
+                    ORDER BY producto_id
+                    LIMIT 2;
+                    """
+                )
+                product_ids = [int(row[0]) for row in cursor.fetchall()]
+                if len(product_ids) < 2:
+                    self.skipTest("Se requieren dos productos con control de stock.")
+                first, second = product_ids
+                for product_id, stock in ((first, 5), (second, 2)):
+                    cursor.execute(
+                        """
+                        INSERT INTO core.catalogo_inventario_sucursal (
+                            producto_id, sucursal_id, stock, stock_reservado,
+                            stock_minimo, disponible_venta, version
+                        ) VALUES (%s, %s, %s, 1, 0, true, 0)
+                        ON CONFLICT (producto_id, sucursal_id) DO UPDATE
+                        SET stock = EXCLUDED.stock, stock_reservado = 1, version = 0;
+                        """,
+                        (product_id, branch_id, stock),
+                    )
+
+                def change(product_id: int, quantity: int, note: str) -> dict:
+                    return {
+                        "producto_id": product_id,
+                        "cantidad": quantity,
+                        "tipo": "ajuste_manual",
+                        "fuente_tipo": "prueba",
+                        "fuente_id": None,
+                        "notas": note,
+                    }
+
+                class CountingCursor:
+                    def __init__(self, inner):
+                        self.inner = inner
+                        self.statements: list[str] = []
+
+                    def execute(self, query, params=None):
+                        self.statements.append(query)
+                        return self.inner.execute(query, params)
+
+                    def fetchall(self):
+                        return self.inner.fetchall()
+
+                counting = CountingCursor(cursor)
+                movements = backend_main._phase1b_apply_inventory_changes(
+                    counting,
+                    sucursal_id=branch_id,
+                    changes=[
+                        change(second, -1, "bulk-a"),
+                        change(first, -3, "bulk-b"),
+                        change(first, 2, "bulk-c"),
+                    ],
+                    username="test-bulk",
+                    missing_detail="falta",
+                )
+                self.assertEqual(3, len(counting.statements))
+                self.assertEqual(
+                    [(second, 2, 1), (first, 5, 2), (first, 2, 4)],
+                    [(m["producto_id"], m["stock_anterior"], m["stock_nuevo"]) for m in movements],
+                )
+
+                cursor.execute(
+                    """
+                    SELECT producto_id, stock, version
+                    FROM core.catalogo_inventario_sucursal
+                    WHERE sucursal_id = %s AND producto_id = ANY(%s::bigint[])
+                    ORDER BY producto_id;
+                    """,
+                    (branch_id, product_ids),
+                )
+                self.assertEqual([(first, 4, 1), (second, 1, 1)], [tuple(map(int, row)) for row in cursor.fetchall()])
+                cursor.execute(
+                    """
+                    SELECT notas, cantidad, stock_anterior, stock_nuevo
+                    FROM core.catalogo_inventario_movimientos
+                    WHERE created_by = 'test-bulk'
+                    ORDER BY movimiento_id;
+                    """
+                )
+                self.assertEqual(
+                    [("bulk-a", -1, 2, 1), ("bulk-b", -3, 5, 2), ("bulk-c", 2, 2, 4)],
+                    [(row[0], int(row[1]), int(row[2]), int(row[3])) for row in cursor.fetchall()],
+                )
+
+                with self.assertRaises(HTTPException) as context:
+                    backend_main._phase1b_apply_inventory_changes(
+                        cursor,
+                        sucursal_id=branch_id,
+                        changes=[change(second, -1, "bulk-d")],
+                        username="test-bulk",
+                        missing_detail="falta",
+                    )
+                self.assertEqual(409, context.exception.status_code)
+                self.assertIn("Disponible para venta: 0", context.exception.detail)
+        finally:
+            connection.rollback()
+            connection.close()
+
     def test_preview_and_creation_normalize_all_sale_input_types_transactionally(self) -> None:
         class TransactionConnectionProxy:
             def __init__(self, connection):
@@ -512,7 +669,7 @@ class Phase1BOpticalSalesTests(unittest.TestCase):
             )
 
             proxy = TransactionConnectionProxy(connection)
-            with patch.object(backend_main.psycopg, "connect", return_value=proxy):
+            with patch.object(backend_main, "db_connect", return_value=proxy):
                 eye_preview = backend_main.previsualizar_venta_fase1b(eye_exam_sale(), user=user)
                 standalone_preview = backend_main.previsualizar_venta_fase1b(standalone_sale, user=user)
                 optical_preview = backend_main.previsualizar_venta_fase1b(optical_sale, user=user)
@@ -543,7 +700,7 @@ class Phase1BOpticalSalesTests(unittest.TestCase):
                 )
                 self.assertEqual(inventory_before, cursor.fetchall())
 
-            with patch.object(backend_main.psycopg, "connect", return_value=proxy):
+            with patch.object(backend_main, "db_connect", return_value=proxy):
                 created_sale = backend_main.crear_venta_fase1b(eye_exam_sale(), user=user)
 
             create_route = next(
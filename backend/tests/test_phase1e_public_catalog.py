@@ -101,7 +101,7 @@ class FakeRepository:
         return None
 
     def list_products(self, **_kwargs):
-        return self.items, len(self.items)
+        return self.items, len(self.items), None
 
     def get_product(self, slug: str, _branch_id=None):
         return next((item for item in self.items if item.slug == slug), None)
@@ -258,7 +258,7 @@ class PublicCatalogLiveReadOnlySmokeTests(unittest.TestCase):
             from public_catalog import PublicCatalogRepository
 
             repository = PublicCatalogRepository(config)
-            products, _total = repository.list_products(
+            products, _total, _next_cursor = repository.list_products(
                 category=None,
                 search=None,
                 branch_id=None,
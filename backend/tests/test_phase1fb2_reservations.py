@@ -74,6 +74,7 @@ class Phase1FB2LiveTests(unittest.TestCase):
             FulfillmentRepository,
             ManualQuoteInput,
             FulfillmentAdminRepository,
+            release_expired_reservations,
         )
         import main as backend_main
 
@@ -138,7 +139,7 @@ class Phase1FB2LiveTests(unittest.TestCase):
                 cur.execute("UPDATE core.online_reservas SET expires_at=created_at + INTERVAL '1 second' WHERE reserva_public_id=%s", (expiring["reservationId"],))
             time.sleep(2)
             with connection.cursor() as cur:
-                self.assertEqual(1, repository._release_expired_reservations(cur))
+                self.assertEqual(1, release_expired_reservations(cur))
                 # The public ID is intentionally opaque; retrieve the row by its
                 # public identifier for an exact reaper assertion.
                 cur.execute("SELECT reserva_id FROM core.online_reservas WHERE reserva_public_id=%s", (expiring["reservationId"],))
@@ -125,7 +125,7 @@ class Phase1GFPhysicalOpticalQueueTests(unittest.TestCase):
             pagos=payments,
         )
         user = {"rol": "admin", "username": self.username, "sucursal_id": None}
-        with patch.object(backend_main.psycopg, "connect", return_value=self.proxy):
+        with patch.object(backend_main, "db_connect", return_value=self.proxy):
             return backend_main._phase1b_save_sale(data, user)
 
     def jobs(self, sale_id: int):
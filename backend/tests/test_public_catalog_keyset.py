@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+import sys
+import unittest
+
+import psycopg
+from psycopg.rows import dict_row
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from public_catalog import (  # noqa: E402
+    InvalidCatalogCursor,
+    PublicCatalogConfig,
+    PublicCatalogRepository,
+    decode_catalog_cursor,
+    encode_catalog_cursor,
+)
+
+
+class FixtureConnection:
+    """Runs the repository inside the test transaction so fixtures roll back.
+
+    The repository marks each transaction READ ONLY, which Postgres refuses
+    after the fixture inserts; that one statement is skipped here.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        return False
+
+    def cursor(self):
+        return FixtureCursor(self.connection.cursor(row_factory=dict_row))
+
+
+class FixtureCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        self.cursor.close()
+        return False
+
+    def execute(self, sql, params=None):
+        if not sql.strip().upper().startswith("SET TRANSACTION READ ONLY"):
+            self.cursor.execute(sql, params)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+
+class PublicCatalogKeysetTests(unittest.TestCase):
+    def test_cursor_round_trip_and_rejects_garbage(self) -> None:
+        cursor = encode_catalog_cursor({"orden_catalogo": 10, "nombre": "Óptica, ñ", "producto_id": 7})
+        self.assertEqual((10, "Óptica, ñ", 7), decode_catalog_cursor(cursor))
+        for bad in ("", "not-base64!", encode_catalog_cursor({"orden_catalogo": 1, "nombre": "x", "producto_id": 1})[:-3]):
+            with self.assertRaises(InvalidCatalogCursor):
+                decode_catalog_cursor(bad)
+
+    def test_live_cursor_pages_match_offset_pages_and_hydrate_in_one_query(self) -> None:
+        conninfo = os.getenv("DB_CONNINFO", "").strip()
+        if not conninfo:
+            self.skipTest("DB_CONNINFO is not configured")
+        connection = psycopg.connect(conninfo)
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT to_regclass('core.catalogo_productos') IS NOT NULL")
+                if not cur.fetchone()[0]:
+                    self.skipTest("Catalog tables have not been installed")
+                cur.execute("SELECT sucursal_id FROM core.sucursales WHERE activa = true ORDER BY sucursal_id LIMIT 1")
+                branch = cur.fetchone()
+                if branch is None:
+                    self.skipTest("At least one active branch is required")
+                # Hide existing published products so the fixture is the whole catalog.
+                cur.execute("UPDATE core.catalogo_productos SET publicado_online = false WHERE publicado_online = true")
+                ids = []
+                for index, (order, name) in enumerate(
+                    [(5, "Zeta"), (1, "Beta"), (1, "Alfa"), (1, "Alfa"), (9, "Gamma")]
+                ):
+                    cur.execute(
+                        """
+                        INSERT INTO core.catalogo_productos (
+                          sku, slug, nombre, descripcion, categoria, subcategoria, tipo_producto,
+                          modalidad_precio, precio, controla_stock, comportamiento_abasto_default,
+                          unidad_medida, publicado_online, orden_catalogo
+                        )
+                        VALUES (%s, %s, %s, 'Prueba keyset', 'lentes_de_sol', 'armazon', 'producto_fisico',
+                                'precio_base', 100, true, 'inventario', 'pieza', true, %s)
+                        RETURNING producto_id
+                        """,
+                        (f"KEYSET-{index}", f"keyset-{index}", name, order),
+                    )
+                    ids.append(int(cur.fetchone()[0]))
+                cur.execute(
+                    """
+                    INSERT INTO core.catalogo_producto_imagenes (producto_id, url, mime_type, es_principal)
+                    VALUES (%s, '/media/products/keyset.webp', 'image/webp', true),
+                           (%s, 'https://evil.example/x.webp', 'image/webp', false)
+                    """,
+                    (ids[0], ids[0]),
+                )
+                cur.execute(
+                    """
+                    INSERT INTO core.catalogo_inventario_sucursal (producto_id, sucursal_id, stock, stock_reservado)
+                    VALUES (%s, %s, 5, 2)
+                    ON CONFLICT (producto_id, sucursal_id) DO UPDATE SET stock = 5, stock_reservado = 2
+                    """,
+                    (ids[0], branch[0]),
+                )
+                cur.execute(
+                    """
+                    INSERT INTO core.online_producto_configuracion (producto_id, comprable_online, cantidad_maxima_por_linea)
+                    VALUES (%s, true, 2)
+                    """,
+                    (ids[0],),
+                )
+
+            config = PublicCatalogConfig(
+                db_conninfo=conninfo,
+                bearer_token="unused",
+                media_base_url="http://127.0.0.1:8000",
+                allowed_image_origins=("http://127.0.0.1:8000",),
+            )
+            repository = PublicCatalogRepository(config, lambda *_a, **_k: FixtureConnection(connection))
+
+            by_offset, total, _ = repository.list_products(
+                category=None, search=None, branch_id=branch[0], limit=50, offset=0
+            )
+            self.assertEqual(5, total)
+            expected = [ids[2], ids[3], ids[1], ids[0], ids[4]]
+            self.assertEqual(expected, [int(item.productId) for item in by_offset])
+
+            walked: list[int] = []
+            cursor = None
+            while True:
+                page, page_total, cursor = repository.list_products(
+                    category=None,
+                    search=None,
+                    branch_id=branch[0],
+                    limit=2,
+                    cursor=cursor,
+                    include_total=False,
+                )
+                self.assertIsNone(page_total)
+                walked.extend(int(item.productId) for item in page)
+                if cursor is None:
+                    break
+            self.assertEqual(expected, walked)
+
+            hydrated = next(item for item in by_offset if int(item.productId) == ids[0])
+            self.assertEqual(["http://127.0.0.1:8000/media/products/keyset.webp"], [i.url for i in hydrated.images])
+            self.assertEqual(3, hydrated.availability.totalOnlineAvailability)
+            self.assertEqual(str(branch[0]), hydrated.availability.branches[0].branchId)
+            self.assertTrue(hydrated.purchasableOnline)
+            self.assertEqual(2, hydrated.maximumQuantityPerLine)
+
+            searched, search_total, _ = repository.list_products(
+                category="lentes_de_sol", search="alf", branch_id=None, limit=50
+            )
+            self.assertEqual(2, search_total)
+            self.assertEqual([ids[2], ids[3]], [int(item.productId) for item in searched])
+
+            detail = repository.get_product("keyset-4")
+            self.assertEqual(0, detail.availability.totalOnlineAvailability)
+            self.assertIsNone(repository.get_product("keyset-missing"))
+            availability = repository.get_availability([ids[4], ids[0]], None)
+            self.assertEqual([str(ids[0]), str(ids[4])], [item.productId for item in availability])
+        finally:
+            connection.rollback()
+            connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+import sys
+from types import SimpleNamespace
+import unittest
+from unittest.mock import patch
+
+import psycopg
+from psycopg.rows import dict_row
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from online_fulfillment import FulfillmentRepository, quote_fingerprint  # noqa: E402
+
+
+PACKAGES = [{"packageNumber": 1, "weightGrams": 400, "lengthMm": 200, "widthMm": 150, "heightMm": 80}]
+ADDRESS = {"postalCode": "77500", "state": "Quintana Roo"}
+
+
+class QuoteFingerprintTests(unittest.TestCase):
+    def test_fingerprint_covers_packages_destination_and_branches(self) -> None:
+        base = quote_fingerprint(PACKAGES, ADDRESS, [2, 1])
+        self.assertEqual(base, quote_fingerprint(PACKAGES, {"postalCode": " 77500 ", "state": "quintana  roo", "street": "Otra"}, [1, 2]))
+        self.assertNotEqual(base, quote_fingerprint(PACKAGES, {**ADDRESS, "postalCode": "77501"}, [1, 2]))
+        self.assertNotEqual(base, quote_fingerprint(PACKAGES, ADDRESS, [1]))
+        self.assertNotEqual(base, quote_fingerprint([{**PACKAGES[0], "weightGrams": 401}], ADDRESS, [1, 2]))
+
+    def test_live_reuse_copies_only_live_options_of_the_latest_match(self) -> None:
+        conninfo = os.getenv("DB_CONNINFO", "").strip()
+        if not conninfo:
+            self.skipTest("DB_CONNINFO is not configured")
+        connection = psycopg.connect(conninfo, row_factory=dict_row)
+        try:
+            with connection.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_schema = 'core' AND table_name = 'online_solicitudes_cotizacion_envio'
+                      AND column_name = 'cotizacion_fingerprint'
+                    """
+                )
+                if cur.fetchone() is None:
+                    self.skipTest("Runtime migration v6 has not been applied")
+                cur.execute("SELECT sucursal_id FROM core.sucursales WHERE activa = true ORDER BY sucursal_id LIMIT 1")
+                branch = cur.fetchone()
+                if branch is None:
+                    self.skipTest("At least one active branch is required")
+                branch_id = int(branch["sucursal_id"])
+                owner = "c" * 64
+                cur.execute(
+                    "INSERT INTO core.online_carritos (propietario_tipo, propietario_ref_hash) VALUES ('cliente', %s) RETURNING carrito_id",
+                    (owner,),
+                )
+                cart_id = int(cur.fetchone()["carrito_id"])
+                fingerprint = quote_fingerprint(PACKAGES, ADDRESS, [branch_id])
+
+                def request(estado: str, fingerprint_value: str | None = fingerprint) -> dict:
+                    cur.execute(
+                        """
+                        INSERT INTO core.online_solicitudes_cotizacion_envio (
+                          propietario_tipo, propietario_ref_hash, carrito_id, carrito_fingerprint,
+                          metodo_entrega, direccion_snapshot, contacto_snapshot, carrito_snapshot,
+                          paquetes_snapshot, estado, expira_at, cotizacion_fingerprint
+                        )
+                        VALUES ('cliente', %s, %s, %s, 'envio', '{}', '{}', '{}', '[]', %s,
+                                NOW() + INTERVAL '2 hours', %s)
+                        RETURNING *
+                        """,
+                        (owner, cart_id, "d" * 64, estado, fingerprint_value),
+                    )
+                    return cur.fetchone()
+
+                def option(request_id: int, code: str, amount: str, expires: str, active: bool = True) -> None:
+                    cur.execute(
+                        f"""
+                        INSERT INTO core.online_opciones_cotizacion_envio (
+                          solicitud_id, sucursal_id, transportista_codigo_snapshot,
+                          transportista_nombre_snapshot, nivel_servicio_snapshot, monto,
+                          entrega_min_dias, entrega_max_dias, quote_identifier, expira_at,
+                          ingresada_por_rol, activa
+                        )
+                        VALUES (%s, %s, %s, 'Carrier', 'Estándar', %s, 2, 4, %s,
+                                NOW() + INTERVAL '{expires}', 'admin', %s)
+                        """,
+                        (request_id, branch_id, code, amount, f"{code}-{request_id}", active),
+                    )
+
+                older = request("cotizada")
+                option(older["solicitud_id"], "fedex", "150.00", "1 hour")
+                latest = request("cotizada")
+                option(latest["solicitud_id"], "dhl", "120.00", "5 hours")
+                option(latest["solicitud_id"], "estafeta", "90.00", "-1 minute")
+                option(latest["solicitud_id"], "other", "80.00", "1 hour", active=False)
+                option(latest["solicitud_id"], "dev-default", "99.00", "1 hour")
+                other = request("cotizada", quote_fingerprint(PACKAGES, {**ADDRESS, "postalCode": "01000"}, [branch_id]))
+                option(other["solicitud_id"], "fedex", "70.00", "1 hour")
+
+                new = request("pendiente")
+                reused = FulfillmentRepository._reuse_options(cur, new, fingerprint)
+                self.assertEqual({"sourceRequestId": str(latest["solicitud_public_id"]), "optionCount": 1}, reused)
+                cur.execute(
+                    """
+                    SELECT transportista_codigo_snapshot, monto, ingresada_por_rol, expira_at
+                    FROM core.online_opciones_cotizacion_envio WHERE solicitud_id = %s
+                    """,
+                    (new["solicitud_id"],),
+                )
+                copied = cur.fetchall()
+                self.assertEqual([("dhl", "120.00", "admin")], [(row["transportista_codigo_snapshot"], f"{row['monto']:.2f}", row["ingresada_por_rol"]) for row in copied])
+                # Capped by the new request's own expiry (2 hours, not 5).
+                self.assertEqual(new["expira_at"], copied[0]["expira_at"])
+
+                fresh = request("pendiente", quote_fingerprint(PACKAGES, {**ADDRESS, "postalCode": "99999"}, [branch_id]))
+                self.assertIsNone(FulfillmentRepository._reuse_options(cur, fresh, fresh["cotizacion_fingerprint"]))
+        finally:
+            connection.rollback()
+            connection.close()
+
+
+class PrequoteTests(unittest.TestCase):
+    class Connection:
+        def __init__(self, events: list[str]) -> None:
+            self.events = events
+
+        def __enter__(self):
+            self.events.append("open")
+            return self
+
+        def __exit__(self, *_args):
+            self.events.append("close")
+            return False
+
+        def cursor(self):
+            return self
+
+        def rollback(self) -> None:
+            self.events.append("rollback")
+
+    def _repository(self, events: list[str]) -> FulfillmentRepository:
+        repository = FulfillmentRepository.__new__(FulfillmentRepository)
+        repository.config = SimpleNamespace(db_conninfo="unused")
+        repository._connect = lambda *_a, **_k: self.Connection(events)
+        repository._rates = SimpleNamespace(quote=lambda payload: events.append(f"quote:{payload['destinationPostalCode']}") or ["q"])
+        return repository
+
+    def _data(self):
+        return SimpleNamespace(
+            method="shipping",
+            address=SimpleNamespace(postalCode="77500", model_dump=lambda: dict(ADDRESS)),
+        )
+
+    def test_carriers_are_quoted_after_the_short_read_transaction(self) -> None:
+        events: list[str] = []
+        repository = self._repository(events)
+        branches = [{"branch": {"sucursal_id": 3, "cp": "77500"}}]
+        with patch.object(FulfillmentRepository, "_cart", return_value=({}, [])), \
+                patch.object(FulfillmentRepository, "_packages", return_value=PACKAGES), \
+                patch.object(FulfillmentRepository, "_eligible_branches", return_value=branches), \
+                patch.object(FulfillmentRepository, "_reuse_source", return_value=None):
+            prequoted = repository._prequote(SimpleNamespace(), self._data())
+        self.assertEqual((quote_fingerprint(PACKAGES, ADDRESS, [3]), ["q"]), prequoted)
+        # The cart lock is released before any carrier is called.
+        self.assertEqual(["rollback", "close", "quote:77500"], events[-3:])
+
+    def test_reusable_options_skip_the_carriers(self) -> None:
+        events: list[str] = []
+        repository = self._repository(events)
+        branches = [{"branch": {"sucursal_id": 3, "cp": "77500"}}]
+        with patch.object(FulfillmentRepository, "_cart", return_value=({}, [])), \
+                patch.object(FulfillmentRepository, "_packages", return_value=PACKAGES), \
+                patch.object(FulfillmentRepository, "_eligible_branches", return_value=branches), \
+                patch.object(FulfillmentRepository, "_reuse_source", return_value={"solicitud_id": 1}):
+            self.assertIsNone(repository._prequote(SimpleNamespace(), self._data()))
+        self.assertNotIn("quote:77500", events)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+from datetime import date
+from pathlib import Path
+import sys
+import unittest
+from unittest.mock import patch
+
+import psycopg
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+import main as backend_main  # noqa: E402
+from reporting_rollups import REPORTING_ROLLUPS_REBUILD_SQL, REPORTING_ROLLUPS_VERSION  # noqa: E402
+
+
+ROLLUP_KEYS = {
+    "rpt_ventas_diarias": "sucursal_id, dia, canal_venta, metodo_pago, vigente",
+    "rpt_consultas_diarias": "sucursal_id, dia",
+    "rpt_pacientes_diarios": "sucursal_id, dia",
+    "rpt_paciente_actividad": "paciente_id, dia, sucursal_id",
+}
+
+
+class TransactionConnectionProxy:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exc_type, _exc, _traceback):
+        return False
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def execute(self, *args, **kwargs):
+        return self.connection.execute(*args, **kwargs)
+
+    def commit(self):
+        return None
+
+
+class ReportingRollupTests(unittest.TestCase):
+    def _snapshot(self, cur) -> dict[str, list[tuple]]:
+        snapshot = {}
+        for table, key in ROLLUP_KEYS.items():
+            cur.execute(f"SELECT * FROM core.{table} ORDER BY {key}")
+            snapshot[table] = cur.fetchall()
+        return snapshot
+
+    def _consult_days(self, cur, branch_id: int) -> dict[str, tuple[int, int]]:
+        cur.execute(
+            """SELECT dia::text, consultas, no_show FROM core.rpt_consultas_diarias
+               WHERE sucursal_id=%s AND dia BETWEEN '2024-02-29' AND '2024-03-02'""",
+            (branch_id,),
+        )
+        return {row[0]: (int(row[1]), int(row[2])) for row in cur.fetchall()}
+
+    def test_live_triggers_match_full_rebuild_after_writes(self):
+        connection = psycopg.connect(backend_main.DB_CONNINFO)
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT to_regclass('core.rpt_ventas_diarias') IS NOT NULL")
+                if not cur.fetchone()[0]:
+                    self.skipTest("Reporting rollups have not been installed")
+                cur.execute("SELECT sucursal_id FROM core.sucursales ORDER BY sucursal_id LIMIT 2")
+                branches = [int(row[0]) for row in cur.fetchall()]
+                if not branches:
+                    self.skipTest("At least one branch is required")
+                other_branch = branches[-1]
+                days_before = self._consult_days(cur, branches[0])
+                cur.execute(
+                    """INSERT INTO core.pacientes (sucursal_id, primer_nombre, apellido_paterno)
+                       VALUES (%s, 'Rollup', 'Prueba') RETURNING paciente_id""",
+                    (branches[0],),
+                )
+                patient_id = int(cur.fetchone()[0])
+                cur.execute(
+                    """INSERT INTO core.ventas (
+                           sucursal_id, paciente_id, fecha_hora, compra, subtotal, monto_total,
+                           metodo_pago, created_by
+                       )
+                       VALUES (%s, %s, '2024-03-01 05:30+00', 'examen_de_la_vista', 500, 450, 'Tarjeta', 'test'),
+                              (%s, %s, '2024-03-01 18:00+00', 'examen_de_la_vista', 300, 300, '', 'test')
+                       RETURNING venta_id""",
+                    (branches[0], patient_id, branches[0], patient_id),
+                )
+                sale_ids = [int(row[0]) for row in cur.fetchall()]
+                cur.execute(
+                    """INSERT INTO core.consultas (sucursal_id, paciente_id, fecha_hora, tipo_consulta)
+                       VALUES (%s, %s, '2024-03-01 05:30+00', 'no_show'),
+                              (%s, %s, '2024-03-02 16:00+00', 'revision_general')
+                       RETURNING consulta_id""",
+                    (branches[0], patient_id, branches[0], patient_id),
+                )
+                consult_ids = [int(row[0]) for row in cur.fetchall()]
+
+                cur.execute(
+                    "UPDATE core.ventas SET estado_venta='cancelada', sucursal_id=%s WHERE venta_id=%s",
+                    (other_branch, sale_ids[0]),
+                )
+                cur.execute("UPDATE core.ventas SET activo=false WHERE venta_id=%s", (sale_ids[1],))
+                cur.execute(
+                    "UPDATE core.consultas SET fecha_hora = fecha_hora + interval '1 day' WHERE consulta_id=%s",
+                    (consult_ids[0],),
+                )
+                cur.execute("DELETE FROM core.consultas WHERE consulta_id=%s", (consult_ids[1],))
+
+                # 05:30 UTC is still the previous local day in Mexico City.
+                days_after = self._consult_days(cur, branches[0])
+                for day, delta in (("2024-02-29", (0, 0)), ("2024-03-01", (1, 1)), ("2024-03-02", (0, 0))):
+                    before = days_before.get(day, (0, 0))
+                    after = days_after.get(day, (0, 0))
+                    self.assertEqual(delta, (after[0] - before[0], after[1] - before[1]), day)
+
+                maintained = self._snapshot(cur)
+                cur.execute(REPORTING_ROLLUPS_REBUILD_SQL)
+                self.assertEqual(maintained, self._snapshot(cur))
+        finally:
+            connection.rollback()
+            connection.close()
+
+    def test_local_date_filters_become_half_open_ranges(self):
+        filtro = backend_main._fecha_local_filtro
+        self.assertEqual(
+            (["v.fecha_local >= %s", "v.fecha_local < %s"], [date(2025, 12, 1), date(2026, 1, 1)]),
+            filtro("v.fecha_local", anio=2025, mes=12),
+        )
+        self.assertEqual(
+            (["v.fecha_local >= %s", "v.fecha_local < %s"], [date(2026, 1, 1), date(2027, 1, 1)]),
+            filtro("v.fecha_local", anio=2026, mes=None, hoy=date(2026, 5, 5)),
+        )
+        self.assertEqual((["v.fecha_local BETWEEN %s AND %s"], ["2026-01-01", "2026-01-31"]),
+                         filtro("v.fecha_local", fecha_desde="2026-01-01", fecha_hasta="2026-01-31", anio=2025))
+        self.assertEqual((["v.fecha_local = %s"], [date(2026, 5, 5)]), filtro("v.fecha_local", mes=3, hoy=date(2026, 5, 5)))
+        self.assertEqual(([], []), filtro("v.fecha_local"))
+        self.assertEqual((["FALSE"], []), filtro("v.fecha_local", anio=99999))
+
+    def test_live_fecha_local_follows_the_branch_business_day(self):
+        connection = psycopg.connect(backend_main.DB_CONNINFO)
+        try:
+            with connection.cursor() as cur:
+                cur.execute(
+                    """SELECT 1 FROM information_schema.columns
+                       WHERE table_schema='core' AND table_name='pacientes' AND column_name='fecha_local'"""
+                )
+                if cur.fetchone() is None:
+                    self.skipTest("Runtime migration v7 has not been applied")
+                cur.execute("SELECT sucursal_id FROM core.sucursales ORDER BY sucursal_id LIMIT 1")
+                branch = cur.fetchone()
+                if branch is None:
+                    self.skipTest("At least one branch is required")
+                cur.execute(
+                    """INSERT INTO core.pacientes (sucursal_id, primer_nombre, apellido_paterno, creado_en)
+                       VALUES (%s, 'Fecha', 'Local', '2024-03-01 05:30+00') RETURNING fecha_local,
+                              core.fn_fecha_local(creado_en, sucursal_id)""",
+                    (branch[0],),
+                )
+                stored, expected = cur.fetchone()
+                self.assertEqual(expected, stored)
+                # 05:30 UTC is 00:30 in Cancún (branch 2) but still Feb 29 in Mexico City.
+                self.assertEqual(date(2024, 3, 1) if branch[0] == 2 else date(2024, 2, 29), stored)
+        finally:
+            connection.rollback()
+            connection.close()
+
+    def test_live_finance_figures_share_the_local_business_day(self):
+        connection = psycopg.connect(backend_main.DB_CONNINFO)
+        user = {"rol": "admin", "username": "admin", "sucursal_id": None}
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT to_regclass('core.rpt_ventas_diarias') IS NOT NULL")
+                if not cur.fetchone()[0]:
+                    self.skipTest("Reporting rollups have not been installed")
+                cur.execute("SELECT sucursal_id FROM core.sucursales WHERE activa = true ORDER BY sucursal_id LIMIT 1")
+                branch = cur.fetchone()
+                if branch is None:
+                    self.skipTest("At least one active branch is required")
+                branch_id = int(branch[0])
+                # The session day (UTC) is March 1 while the business day differs per branch.
+                cur.execute("SET LOCAL TIME ZONE 'UTC'")
+                local_day = "2024-03-01" if branch_id == 2 else "2024-02-29"
+
+            proxy = TransactionConnectionProxy(connection)
+
+            def figures():
+                with patch.object(backend_main, "db_connect", return_value=proxy):
+                    data = backend_main.obtener_datos_finanzas(
+                        sucursal_id=str(branch_id), fecha_desde=local_day, fecha_hasta=local_day, user=user
+                    )
+                resumen = data["resumen"]
+                return resumen["ventas_netas"], resumen["dinero_cobrado"], resumen["saldos_pendientes"]
+
+            before = figures()
+            with connection.cursor() as cur:
+                cur.execute(
+                    """INSERT INTO core.pacientes (sucursal_id, primer_nombre, apellido_paterno)
+                       VALUES (%s, 'Finanzas', 'Prueba') RETURNING paciente_id""",
+                    (branch_id,),
+                )
+                patient_id = int(cur.fetchone()[0])
+                cur.execute(
+                    """INSERT INTO core.ventas (
+                           sucursal_id, paciente_id, fecha_hora, compra, subtotal, monto_total, metodo_pago, created_by
+                       )
+                       VALUES (%s, %s, '2024-03-01 05:30+00', 'examen_de_la_vista', 450, 450, 'efectivo', 'test')
+                       RETURNING venta_id""",
+                    (branch_id, patient_id),
+                )
+                venta_id = int(cur.fetchone()[0])
+                cur.execute(
+                    """INSERT INTO core.venta_pagos (venta_id, metodo, monto, created_by, created_at)
+                       VALUES (%s, 'efectivo', 200, 'test', '2024-03-01 05:30+00')""",
+                    (venta_id,),
+                )
+            after = figures()
+
+            self.assertEqual((450.0, 200.0, 250.0), tuple(round(a - b, 2) for a, b in zip(after, before)))
+        finally:
+            connection.rollback()
+            connection.close()
+
+    def test_live_version_bump_rebuilds_outside_migration_v1(self):
+        connection = psycopg.connect(backend_main.DB_CONNINFO)
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT to_regclass('core.rpt_rollups_estado') IS NOT NULL")
+                if not cur.fetchone()[0]:
+                    self.skipTest("Reporting rollups have not been installed")
+                cur.execute("UPDATE core.rpt_rollups_estado SET version = %s", (REPORTING_ROLLUPS_VERSION - 1,))
+
+            proxy = TransactionConnectionProxy(connection)
+            with patch.object(backend_main, "db_connect", return_value=proxy):
+                rebuilt = backend_main.ensure_reporting_rollups_version()
+                again = backend_main.ensure_reporting_rollups_version()
+
+            self.assertTrue(rebuilt)
+            self.assertFalse(again)
+            with connection.cursor() as cur:
+                cur.execute("SELECT version FROM core.rpt_rollups_estado")
+                self.assertEqual([(REPORTING_ROLLUPS_VERSION,)], cur.fetchall())
+        finally:
+            connection.rollback()
+            connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
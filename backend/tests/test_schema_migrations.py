@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+import unittest
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from schema_migrations import (  # noqa: E402
+    SCHEMA_MIGRATIONS_LOCK_KEY,
+    RuntimeMigration,
+    SchemaMigrationConfig,
+    SchemaVersionError,
+    apply_migrations,
+    ensure_schema_version,
+)
+
+
+class FakeCursor:
+    def __init__(self, db: "FakeDatabase") -> None:
+        self.db = db
+        self._result: list[tuple] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        return False
+
+    def execute(self, sql: str, params=None) -> None:
+        text = " ".join(sql.split())
+        self.db.statements.append((text, params))
+        if text.startswith("SELECT to_regclass(%s)"):
+            self._result = [(params[0] in self.db.relations,)]
+        elif text.startswith("SELECT to_regclass"):
+            self._result = [(self.db.table_exists,)]
+        elif text.startswith("SELECT COALESCE(MAX(version)"):
+            self._result = [(max(self.db.recorded, default=0),)]
+        elif text.startswith("SELECT version FROM"):
+            self._result = [(v,) for v in sorted(self.db.recorded)]
+        elif text.startswith("INSERT INTO core.schema_migrations"):
+            self.db.recorded.add(params[0])
+        elif "CREATE TABLE IF NOT EXISTS core.schema_migrations" in text:
+            self.db.table_exists = True
+
+    def fetchone(self):
+        return self._result[0]
+
+    def fetchall(self):
+        return list(self._result)
+
+
+class FakeDatabase:
+    def __init__(self, recorded: set[int] | None = None) -> None:
+        self.recorded = set(recorded or ())
+        self.table_exists = recorded is not None
+        self.relations: set[str] = set()
+        self.statements: list[tuple[str, object]] = []
+        self.connections: list[dict] = []
+
+    def connect(self, _conninfo: str, **kwargs):
+        self.connections.append(kwargs)
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        return False
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+
+class SchemaMigrationTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.calls: list[str] = []
+        self.migrations = [
+            RuntimeMigration(2, "second", (("b", lambda: self.calls.append("b")),)),
+            RuntimeMigration(1, "baseline", (("a1", lambda: self.calls.append("a1")), ("a2", lambda: self.calls.append("a2")))),
+        ]
+
+    def test_current_schema_only_reads_the_version(self) -> None:
+        db = FakeDatabase({1, 2})
+        version = ensure_schema_version("db", self.migrations, SchemaMigrationConfig(), connect=db.connect)
+        self.assertEqual(2, version)
+        self.assertEqual([], self.calls)
+        self.assertEqual(1, len(db.connections))
+
+    def test_auto_mode_applies_pending_versions_in_order_under_the_lock(self) -> None:
+        db = FakeDatabase()
+        ensure_schema_version("db", self.migrations, SchemaMigrationConfig(), connect=db.connect, log=lambda _m: None)
+        self.assertEqual(["a1", "a2", "b"], self.calls)
+        self.assertEqual({1, 2}, db.recorded)
+        self.assertEqual({"autocommit": True}, db.connections[-1])
+        lock_statements = [(sql, params) for sql, params in db.statements if "advisory" in sql]
+        self.assertEqual(
+            [
+                ("SELECT pg_advisory_lock(%s)", (SCHEMA_MIGRATIONS_LOCK_KEY,)),
+                ("SELECT pg_advisory_unlock(%s)", (SCHEMA_MIGRATIONS_LOCK_KEY,)),
+            ],
+            lock_statements,
+        )
+
+    def test_recorded_versions_are_skipped(self) -> None:
+        db = FakeDatabase({1})
+        applied = apply_migrations("db", self.migrations, connect=db.connect, log=lambda _m: None)
+        self.assertEqual([2], applied)
+        self.assertEqual(["b"], self.calls)
+
+    def test_failed_step_releases_the_lock_without_recording(self) -> None:
+        db = FakeDatabase()
+
+        def boom() -> None:
+            raise RuntimeError("boom")
+
+        migrations = [RuntimeMigration(1, "baseline", (("boom", boom),))]
+        with self.assertRaises(RuntimeError):
+            apply_migrations("db", migrations, connect=db.connect, log=lambda _m: None)
+        self.assertEqual(set(), db.recorded)
+        self.assertIn("pg_advisory_unlock", db.statements[-1][0])
+
+    def test_verify_mode_refuses_an_outdated_schema(self) -> None:
+        db = FakeDatabase({1})
+        with self.assertRaises(SchemaVersionError):
+            ensure_schema_version("db", self.migrations, SchemaMigrationConfig(mode="verify"), connect=db.connect)
+        self.assertEqual([], self.calls)
+
+    def test_version_is_deferred_until_its_tables_exist(self) -> None:
+        migrations = [
+            *self.migrations,
+            RuntimeMigration(3, "needs_phase", (("c", lambda: self.calls.append("c")),), requires=("core.fase",)),
+        ]
+        db = FakeDatabase()
+        logs: list[str] = []
+        self.assertEqual([1, 2], apply_migrations("db", migrations, connect=db.connect, log=logs.append))
+        self.assertEqual({1, 2}, db.recorded)
+        self.assertNotIn("c", self.calls)
+        self.assertTrue(any("v3 needs_phase diferida: falta core.fase" in line for line in logs))
+
+        # Nothing is ready to apply, so startup does not take the lock.
+        statements = len(db.statements)
+        self.assertEqual(2, ensure_schema_version("db", migrations, SchemaMigrationConfig(mode="verify"), connect=db.connect))
+        self.assertFalse(any("advisory" in sql for sql, _ in db.statements[statements:]))
+
+        db.relations.add("core.fase")
+        with self.assertRaises(SchemaVersionError):
+            ensure_schema_version("db", migrations, SchemaMigrationConfig(mode="verify"), connect=db.connect)
+        self.assertEqual(3, ensure_schema_version("db", migrations, SchemaMigrationConfig(), connect=db.connect, log=lambda _m: None))
+        self.assertEqual({1, 2, 3}, db.recorded)
+        self.assertEqual("c", self.calls[-1])
+
+    def test_duplicate_versions_are_rejected(self) -> None:
+        db = FakeDatabase()
+        migrations = [RuntimeMigration(1, "a", ()), RuntimeMigration(1, "b", ())]
+        with self.assertRaises(ValueError):
+            apply_migrations("db", migrations, connect=db.connect)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sys
+import unittest
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from shipping_packages import (  # noqa: E402
+    BinPackingPackageCalculator,
+    PackageRuleError,
+    PackagingConfiguration,
+    ProductShippingMeasurement,
+)
+
+
+CONFIG = PackagingConfiguration(
+    packaging_weight_grams=50,
+    padding_length_mm=10,
+    padding_width_mm=10,
+    padding_height_mm=10,
+    maximum_weight_grams=2000,
+    maximum_length_mm=410,
+    maximum_width_mm=310,
+    maximum_height_mm=210,
+)
+
+
+def _item(product_id, quantity, weight, dims, *, individual=False, group="general"):
+    return ProductShippingMeasurement(
+        product_id, quantity, weight, *dims,
+        requires_individual_package=individual, compatibility_group=group,
+    )
+
+
+def _within_limits(test: unittest.TestCase, package: dict) -> None:
+    test.assertLessEqual(package["weightGrams"], CONFIG.maximum_weight_grams)
+    test.assertLessEqual(package["lengthMm"], CONFIG.maximum_length_mm)
+    test.assertLessEqual(package["widthMm"], CONFIG.maximum_width_mm)
+    test.assertLessEqual(package["heightMm"], CONFIG.maximum_height_mm)
+
+
+class BinPackingPackageCalculatorTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.calculator = BinPackingPackageCalculator()
+
+    def test_small_cart_fits_in_one_package(self) -> None:
+        packages = self.calculator.calculate(
+            [_item(1, 3, 100, (150, 60, 40)), _item(2, 1, 200, (180, 80, 60))], CONFIG
+        )
+        self.assertEqual(1, len(packages))
+        package = packages[0]
+        self.assertEqual(50 + 3 * 100 + 200, package["weightGrams"])
+        self.assertEqual("bin_packing_v1", package["calculationMethod"])
+        self.assertEqual(
+            [("1", 3), ("2", 1)],
+            [(source["productId"], source["quantity"]) for source in package["measurementSources"]],
+        )
+        _within_limits(self, package)
+
+    def test_groups_and_individual_products_get_their_own_packages(self) -> None:
+        packages = self.calculator.calculate(
+            [
+                _item(1, 2, 100, (100, 50, 40)),
+                _item(2, 1, 100, (100, 50, 40), group="Liquidos "),
+                _item(3, 2, 300, (200, 100, 80), individual=True),
+            ],
+            CONFIG,
+        )
+        self.assertEqual(
+            [("general", ["1"]), ("general", ["3"]), ("general", ["3"]), ("liquidos", ["2"])],
+            [
+                (package["compatibilityGroup"], [source["productId"] for source in package["measurementSources"]])
+                for package in packages
+            ],
+        )
+        self.assertEqual([1, 2, 3, 4], [package["packageNumber"] for package in packages])
+        self.assertEqual((210, 110, 90), (packages[1]["lengthMm"], packages[1]["widthMm"], packages[1]["heightMm"]))
+
+    def test_weight_and_volume_limits_split_the_cart(self) -> None:
+        packages = self.calculator.calculate([_item(1, 9, 450, (120, 100, 90))], CONFIG)
+        self.assertEqual(3, len(packages))
+        self.assertEqual(9, sum(package["measurementSources"][0]["quantity"] for package in packages))
+        for package in packages:
+            _within_limits(self, package)
+
+        boxes = self.calculator.calculate([_item(1, 20, 10, (200, 150, 100))], CONFIG)
+        # 400 x 300 x 200 inner space holds exactly eight 200 x 150 x 100 boxes.
+        self.assertEqual([8, 8, 4], [package["measurementSources"][0]["quantity"] for package in boxes])
+        self.assertEqual((410, 310, 210), (boxes[0]["lengthMm"], boxes[0]["widthMm"], boxes[0]["heightMm"]))
+
+    def test_products_are_rotated_to_fit(self) -> None:
+        packages = self.calculator.calculate([_item(1, 1, 100, (100, 380, 50))], CONFIG)
+        self.assertEqual(1, len(packages))
+        _within_limits(self, packages[0])
+
+    def test_result_is_deterministic(self) -> None:
+        cart = [
+            _item(1, 4, 120, (160, 70, 45)),
+            _item(2, 3, 90, (90, 90, 90), group="frágil"),
+            _item(3, 5, 300, (210, 120, 30)),
+        ]
+        self.assertEqual(self.calculator.calculate(cart, CONFIG), self.calculator.calculate(list(cart), CONFIG))
+
+    def test_items_beyond_the_limits_and_time_budget_are_rejected(self) -> None:
+        with self.assertRaises(PackageRuleError) as caught:
+            self.calculator.calculate([_item(1, 1, 100, (500, 50, 50))], CONFIG)
+        self.assertEqual("ITEM_EXCEEDS_PACKAGE_LIMITS", caught.exception.code)
+        self.assertEqual("1", caught.exception.details["productId"])
+
+        with self.assertRaises(PackageRuleError) as caught:
+            self.calculator.calculate([_item(1, 1, 1990, (50, 50, 50))], CONFIG)
+        self.assertEqual("ITEM_EXCEEDS_PACKAGE_LIMITS", caught.exception.code)
+
+        with self.assertRaises(PackageRuleError) as caught:
+            BinPackingPackageCalculator(time_budget_seconds=-1).calculate([_item(1, 2, 10, (10, 10, 10))], CONFIG)
+        self.assertEqual("MULTI_PACKAGE_NOT_SUPPORTED", caught.exception.code)
+
+        with self.assertRaises(PackageRuleError) as caught:
+            BinPackingPackageCalculator(max_units=5).calculate([_item(1, 6, 10, (10, 10, 10))], CONFIG)
+        self.assertEqual("MULTI_PACKAGE_NOT_SUPPORTED", caught.exception.code)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from pathlib import Path
+import sys
+import time
+import unittest
+
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from online_fulfillment import FulfillmentRepository  # noqa: E402
+from shipping_providers import (  # noqa: E402
+    FakeCarrierRateProvider,
+    ProviderCircuitBreaker,
+    ShippingRateQuote,
+    ShippingRateRegistry,
+    ShippingRatesConfig,
+    build_rate_registry,
+    rate_request_key,
+)
+
+
+PACKAGE = {"packageNumber": 1, "weightGrams": 1200, "lengthMm": 300, "widthMm": 200, "heightMm": 100}
+REQUEST = {
+    "packages": [PACKAGE],
+    "destinationPostalCode": "77500",
+    "origins": [{"branchId": 1, "postalCode": "77710"}, {"branchId": 2, "postalCode": "03100"}],
+}
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class ShippingRateRegistryTests(unittest.TestCase):
+    def _registry(self, *providers, **config):
+        registry = ShippingRateRegistry(providers, ShippingRatesConfig(enabled=True, **config))
+        self.addCleanup(registry.shutdown)
+        return registry
+
+    def test_fake_carrier_quotes_every_origin_deterministically(self) -> None:
+        provider = FakeCarrierRateProvider()
+        quotes = provider.quote(REQUEST)
+        self.assertEqual(
+            [(1, "Estándar", Decimal("125.00"), 2, 4), (1, "Express", Decimal("225.00"), 1, 1),
+             (2, "Estándar", Decimal("165.00"), 3, 6), (2, "Express", Decimal("297.00"), 1, 2)],
+            [(q.branch_id, q.service_level, q.amount, q.minimum_delivery_days, q.maximum_delivery_days) for q in quotes],
+        )
+        self.assertEqual([q.quote_identifier for q in quotes], [q.quote_identifier for q in provider.quote(REQUEST)])
+
+    def test_providers_are_quoted_concurrently_and_cached(self) -> None:
+        first = FakeCarrierRateProvider(carrier_code="uno", delay_seconds=0.2)
+        second = FakeCarrierRateProvider(carrier_code="dos", delay_seconds=0.2)
+        registry = self._registry(first, second)
+        started = time.perf_counter()
+        quotes = registry.quote(REQUEST)
+        self.assertLess(time.perf_counter() - started, 0.35)
+        self.assertEqual({"uno", "dos"}, {quote.carrier_code for quote in quotes})
+        self.assertEqual(8, len(quotes))
+
+        self.assertEqual(quotes, registry.quote({**REQUEST, "origins": list(reversed(REQUEST["origins"]))}))
+        self.assertEqual((1, 1), (first.calls, second.calls))
+        registry.quote({**REQUEST, "destinationPostalCode": "01000"})
+        self.assertEqual(2, first.calls)
+
+    def test_slow_and_failing_providers_only_drop_their_own_quotes(self) -> None:
+        slow = FakeCarrierRateProvider(carrier_code="lento", delay_seconds=0.5)
+        broken = FakeCarrierRateProvider(carrier_code="roto", fail=True)
+        healthy = FakeCarrierRateProvider(carrier_code="sano")
+        registry = self._registry(slow, broken, healthy, timeout_seconds=0.1, failure_threshold=2)
+        started = time.perf_counter()
+        self.assertEqual({"sano"}, {quote.carrier_code for quote in registry.quote(REQUEST)})
+        self.assertLess(time.perf_counter() - started, 0.4)
+        stats = registry.stats()["providers"]
+        self.assertEqual(1, stats["lento"]["timeouts"])
+        self.assertEqual(1, stats["roto"]["errors"])
+
+        registry.quote({**REQUEST, "destinationPostalCode": "01000"})
+        registry.quote({**REQUEST, "destinationPostalCode": "44100"})
+        self.assertEqual("open", registry.stats()["providers"]["roto"]["breaker"]["state"])
+        self.assertEqual(2, broken.calls)
+        self.assertEqual(1, registry.stats()["providers"]["roto"]["skipped"])
+
+    def test_expired_quotes_are_dropped(self) -> None:
+        class StaleProvider(FakeCarrierRateProvider):
+            def quote(self, request):
+                past = datetime.now(timezone.utc) - timedelta(minutes=1)
+                return [ShippingRateQuote(1, "viejo", "Viejo", "Estándar", Decimal("10"), "MXN", 1, 2, "q", past, past)]
+
+        self.assertEqual([], self._registry(StaleProvider()).quote(REQUEST))
+
+    def test_circuit_breaker_half_opens_after_the_reset_window(self) -> None:
+        clock = FakeClock()
+        breaker = ProviderCircuitBreaker(failure_threshold=2, reset_seconds=30, clock=clock)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        clock.now += 30
+        self.assertEqual("half_open", breaker.state)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual("open", breaker.state)
+        clock.now += 30
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual("closed", breaker.state)
+
+    def test_cache_key_and_registry_configuration(self) -> None:
+        self.assertNotEqual(rate_request_key(REQUEST), rate_request_key({**REQUEST, "packages": [{**PACKAGE, "weightGrams": 1300}]}))
+        self.assertIsNone(build_rate_registry(ShippingRatesConfig(enabled=False, fake_carrier_enabled=True)))
+        self.assertIsNone(build_rate_registry(ShippingRatesConfig(enabled=True)))
+        registry = build_rate_registry(ShippingRatesConfig(enabled=True, fake_carrier_enabled=True))
+        self.addCleanup(registry.shutdown)
+        self.assertEqual(["fake_carrier"], [provider.provider_code for provider in registry.providers])
+
+    def test_registry_quotes_rank_through_score_options(self) -> None:
+        quotes = self._registry(FakeCarrierRateProvider()).quote(REQUEST)
+        rows = [
+            {"opcion_public_id": quote.quote_identifier, "monto": quote.amount, "entrega_max_dias": quote.maximum_delivery_days}
+            for quote in quotes
+        ]
+        labels = FulfillmentRepository._score_options(rows, Decimal("0.60"), Decimal("0.40"))
+        self.assertEqual(quotes[0].quote_identifier, labels["cheapestOptionId"])
+        self.assertEqual(quotes[1].quote_identifier, labels["fastestOptionId"])
+
+
+if __name__ == "__main__":
+    unittest.main()